@@ -0,0 +1,242 @@
+import os
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Callable, Awaitable
+
+from .database import logger
+
+
+class _TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, capacity: float, now: float):
+        self.tokens = capacity
+        self.updated = now
+
+
+class _PendingRender:
+    __slots__ = ('task', 'refs')
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        # 正在等待或正在发送这张图片的请求数，归零时删除图片文件
+        self.refs = 0
+
+
+class RenderAdmission:
+    """图片渲染准入控制
+
+    零点签到高峰时所有命令的瓶颈在图片渲染，这里在渲染前做三件事：
+    - 有界队列：同时渲染的数量和排队数量都有上限，队列满时降级为纯文本回复
+    - 群限流：每个群按令牌桶限制图片回复的频率，超出的回复降级为纯文本
+    - 合并：文本完全相同的待渲染请求（如同一时刻的排行榜）只渲染一次，图片由所有等待者共享
+    另外可以按文本缓存渲染好的图片（如排行榜的每一页），缓存期内相同文本直接复用。
+    签到等命令的业务逻辑始终执行，被降级的只是回复形式。
+    """
+
+    def __init__(self, render: Callable[[str], Awaitable[Optional[str]]], concurrency: int = 2,
+                 queue_size: int = 20, group_per_minute: float = 30, max_buckets: int = 4096,
+                 max_cached: int = 64):
+        """
+        Args:
+            render: 渲染函数，接收文本返回图片路径
+            concurrency: 同时渲染的数量
+            queue_size: 最多排队等待渲染的数量，超过时降级为纯文本
+            group_per_minute: 每个群每分钟的图片回复数，0 表示不限流
+            max_buckets: 最多保留的群令牌桶数量
+            max_cached: 最多缓存的图片数量
+        """
+        self._render = render
+        self.concurrency = max(1, concurrency)
+        self.queue_size = max(0, queue_size)
+        self.group_per_minute = group_per_minute
+        self.max_buckets = max_buckets
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._buckets: Dict[str, _TokenBucket] = {}
+        self._pending: Dict[str, _PendingRender] = {}
+        self._paths: Dict[str, str] = {}
+        self.max_cached = max_cached
+        # 缓存的图片 key -> 过期时间，缓存持有一个引用，过期或被挤出前图片文件不会被删除
+        self._cached: 'OrderedDict[str, float]' = OrderedDict()
+        # 统计
+        self.waiting = 0
+        self.running = 0
+        self.max_waiting = 0
+        self.rendered = 0
+        self.coalesced = 0
+        self.shed_queue = 0
+        self.shed_rate = 0
+        self.cache_hits = 0
+        self._last_shed_log = 0.0
+
+    def _allow_group(self, group_id: Optional[str]) -> bool:
+        """按群扣减令牌，私聊不限流"""
+        if not group_id or self.group_per_minute <= 0:
+            return True
+        now = time.monotonic()
+        bucket = self._buckets.get(group_id)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._evict_buckets(now)
+            bucket = self._buckets[group_id] = _TokenBucket(self.group_per_minute, now)
+        else:
+            bucket.tokens = min(self.group_per_minute,
+                                bucket.tokens + (now - bucket.updated) * self.group_per_minute / 60)
+            bucket.updated = now
+        if bucket.tokens < 1:
+            return False
+        bucket.tokens -= 1
+        return True
+
+    def _evict_buckets(self, now: float):
+        """回收已经回满的令牌桶（闲置超过一分钟），仍不够时回收最久未用的"""
+        for group_id in [g for g, b in self._buckets.items() if now - b.updated >= 60]:
+            del self._buckets[group_id]
+        if len(self._buckets) >= self.max_buckets:
+            oldest = sorted(self._buckets, key=lambda g: self._buckets[g].updated)
+            for group_id in oldest[:len(oldest) - self.max_buckets + 1]:
+                del self._buckets[group_id]
+
+    def _shed(self, reason: str):
+        if reason == 'queue':
+            self.shed_queue += 1
+        else:
+            self.shed_rate += 1
+        now = time.monotonic()
+        if now - self._last_shed_log >= 60:
+            self._last_shed_log = now
+            logger.warning(f"图片渲染降级为纯文本({reason}): {self.stats()}")
+
+    async def _run(self, text: str) -> Optional[str]:
+        # waiting 在提交时已经计入，保证同一轮事件循环内的突发请求也受队列上限约束
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            path = await self._render(text)
+            self.rendered += 1
+            return path
+        finally:
+            self.running -= 1
+            self._slots.release()
+
+    async def acquire(self, text: str, group_id: Optional[str] = None, cache_ttl: float = 0,
+                      cached_only: bool = False) -> Optional[str]:
+        """获取文本对应的图片
+
+        Args:
+            cache_ttl: 大于 0 时缓存渲染结果(秒)，缓存期内相同文本不再渲染，也不计入群限流
+            cached_only: 只使用缓存或正在渲染的相同文本，没有时返回 None 而不发起新的渲染
+        Returns:
+            图片路径；被降级或渲染失败时返回 None，调用方应回复纯文本。
+            返回图片路径时，发送完毕后必须调用 release 释放。
+        """
+        key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+        self._expire_cache()
+        pending = self._pending.get(key)
+        if pending is not None:
+            if key in self._cached and pending.task.done():
+                self.cache_hits += 1
+            else:
+                # 与正在渲染的相同文本合并
+                self.coalesced += 1
+        elif cached_only:
+            return None
+        else:
+            if not self._allow_group(group_id):
+                self._shed('rate')
+                return None
+            if self.waiting + self.running >= self.concurrency + self.queue_size:
+                self._shed('queue')
+                return None
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+            pending = self._pending[key] = _PendingRender(asyncio.ensure_future(self._run(text)))
+
+        if cache_ttl > 0 and key not in self._cached:
+            pending.refs += 1
+            self._cached[key] = time.monotonic() + cache_ttl
+            while len(self._cached) > self.max_cached:
+                self._uncache(next(iter(self._cached)))
+        pending.refs += 1
+        try:
+            path = await asyncio.shield(pending.task)
+        except BaseException:
+            self._unref(key, None)
+            raise
+        if not path:
+            self._uncache(key)
+            self._unref(key, None)
+            return None
+        self._paths[path] = key
+        return path
+
+    def release(self, path: Optional[str]):
+        """发送完毕后释放图片，最后一个使用者负责删除文件"""
+        if not path:
+            return
+        key = self._paths.get(path)
+        if key is None:
+            # 不是经由 acquire 得到的图片
+            self._remove(path)
+            return
+        self._unref(key, path)
+
+    def _unref(self, key: str, path: Optional[str]):
+        pending = self._pending.get(key)
+        if pending is None:
+            return
+        pending.refs -= 1
+        if pending.refs > 0:
+            return
+        del self._pending[key]
+        if not pending.task.done():
+            # 所有等待者都已离开，渲染完成后直接丢弃图片
+            pending.task.add_done_callback(self._discard)
+        elif path is None:
+            self._discard(pending.task)
+        else:
+            self._remove(path)
+
+    def _expire_cache(self):
+        now = time.monotonic()
+        for key in [key for key, expires in self._cached.items() if expires <= now]:
+            self._uncache(key)
+
+    def _uncache(self, key: str):
+        if self._cached.pop(key, None) is not None:
+            self._unref(key, None)
+
+    def clear_cache(self):
+        """丢弃所有缓存的图片"""
+        for key in list(self._cached):
+            self._uncache(key)
+
+    def _discard(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is None:
+            self._remove(task.result())
+
+    def _remove(self, path: Optional[str]):
+        if path:
+            self._paths.pop(path, None)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def stats(self) -> Dict[str, Any]:
+        """队列深度和降级统计"""
+        return {
+            'waiting': self.waiting,
+            'running': self.running,
+            'max_waiting': self.max_waiting,
+            'rendered': self.rendered,
+            'coalesced': self.coalesced,
+            'shed_queue': self.shed_queue,
+            'shed_rate': self.shed_rate,
+            'groups': len(self._buckets),
+            'cached': len(self._cached),
+            'cache_hits': self.cache_hits,
+        }
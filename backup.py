@@ -0,0 +1,218 @@
+import os
+import json
+import gzip
+import time
+import shutil
+import asyncio
+import datetime
+from typing import Dict, Any, List, Optional
+
+from .database import logger
+from .storage import SignStorage
+
+
+class SignBackup:
+    """在线备份与恢复
+
+    - 备份：通过存储的 backup_to 在线复制每个数据库文件（单文件存储一个，分片存储每个分片一个），
+      复制在工作线程中进行，步间休眠，不占用写连接；复制完成后检查完整性并 gzip 压缩，
+      一次备份为 backups 下的一个快照目录，附带 manifest.json，超出保留份数的旧快照被删除
+    - 恢复：先解压快照中的所有文件并逐一检查完整性，全部通过后为当前数据做一次恢复前备份，
+      再通过写连接整体覆盖；任一文件损坏或与当前的分片不对应时不做任何修改
+    分片存储的快照按分片依次复制，各分片分别是一致的，但分片之间不是同一时刻。
+    """
+
+    MANIFEST = "manifest.json"
+    # 恢复前备份的快照编号后缀，不参与轮换，避免挤掉要恢复的快照
+    PRE_RESTORE_SUFFIX = "-pre-restore"
+
+    def __init__(self, db: SignStorage, interval_hours: float = 0, keep: int = 7,
+                 backup_dir: str = None, pages: int = 256, pause: float = 0.05):
+        """
+        Args:
+            db: 数据库实例
+            interval_hours: 定时备份间隔(小时)，0 表示不定时备份
+            keep: 保留的快照份数
+            backup_dir: 快照目录，默认为数据库目录下的 backups
+            pages: 在线备份每步复制的页数
+            pause: 在线备份步间休眠(秒)
+        """
+        self.db = db
+        self.interval_hours = interval_hours
+        self.keep = max(1, keep)
+        self.backup_dir = backup_dir or os.path.join(db.data_dir, "backups")
+        self.pages = pages
+        self.pause = pause
+        # 备份与恢复互斥
+        self._lock = asyncio.Lock()
+
+    @property
+    def supported(self) -> bool:
+        """纯内存存储没有数据库文件，不支持备份"""
+        return bool(self.db.database_files)
+
+    @property
+    def enabled(self) -> bool:
+        return self.supported and self.interval_hours > 0
+
+    def _snapshot_path(self, snapshot_id: str) -> str:
+        return os.path.join(self.backup_dir, snapshot_id)
+
+    def _read_manifest(self, snapshot_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self._snapshot_path(snapshot_id), self.MANIFEST), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def list_snapshots(self) -> List[Dict[str, Any]]:
+        """已完成的快照，最新的在前；未写完的临时目录和缺少清单的目录不计入"""
+        if not os.path.isdir(self.backup_dir):
+            return []
+        snapshots = []
+        for name in os.listdir(self.backup_dir):
+            if name.startswith('.'):
+                continue
+            manifest = self._read_manifest(name)
+            if manifest:
+                snapshots.append(manifest)
+        snapshots.sort(key=lambda m: (m['created_at'], m['id']), reverse=True)
+        return snapshots
+
+    def seconds_until_due(self) -> float:
+        """距离下一次定时备份的秒数，以最新快照的时间为准，重启后不会立即重复备份"""
+        snapshots = [m for m in self.list_snapshots() if not m['id'].endswith(self.PRE_RESTORE_SUFFIX)]
+        if not snapshots:
+            return 0
+        return max(0.0, snapshots[0]['created_at'] + self.interval_hours * 3600 - time.time())
+
+    def resolve(self, ref: str) -> Optional[str]:
+        """按快照编号或 /备份 列表中的序号（从 1 开始）查找快照"""
+        snapshots = self.list_snapshots()
+        if ref.isdigit() and 1 <= int(ref) <= len(snapshots):
+            return snapshots[int(ref) - 1]['id']
+        for manifest in snapshots:
+            if manifest['id'] == ref:
+                return ref
+        return None
+
+    def _new_snapshot_id(self, suffix: str = "") -> str:
+        base = datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + suffix
+        snapshot_id, n = base, 1
+        while os.path.exists(self._snapshot_path(snapshot_id)):
+            n += 1
+            snapshot_id = f"{base}-{n}"
+        return snapshot_id
+
+    def _backup_files(self, staging: str) -> List[Dict[str, Any]]:
+        """在工作线程中复制、检查并压缩所有数据库文件"""
+        copied = self.db.backup_to(staging, pages=self.pages, pause=self.pause)
+        for name, problems in self.db.check_integrity(staging).items():
+            if problems:
+                raise RuntimeError(f"{name} 备份后完整性检查失败: {'; '.join(problems[:3])}")
+        files = []
+        for name, pages in copied.items():
+            raw_path = os.path.join(staging, name)
+            size = os.path.getsize(raw_path)
+            with open(raw_path, 'rb') as src, gzip.open(raw_path + '.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(raw_path)
+            files.append({'name': name, 'file': name + '.gz', 'pages': pages, 'bytes': size,
+                          'compressed_bytes': os.path.getsize(raw_path + '.gz')})
+        return files
+
+    async def _snapshot(self, suffix: str = "") -> Dict[str, Any]:
+        """生成一个快照，先写入临时目录，全部完成后改名，中断时不会留下不完整的快照"""
+        os.makedirs(self.backup_dir, exist_ok=True)
+        snapshot_id = self._new_snapshot_id(suffix)
+        staging = self._snapshot_path(f".{snapshot_id}.partial")
+        os.makedirs(staging, exist_ok=True)
+        try:
+            started = time.monotonic()
+            files = await asyncio.to_thread(self._backup_files, staging)
+            manifest = {
+                'id': snapshot_id,
+                'created_at': int(time.time()),
+                'seconds': round(time.monotonic() - started, 3),
+                'files': files,
+            }
+            with open(os.path.join(staging, self.MANIFEST), 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            os.replace(staging, self._snapshot_path(snapshot_id))
+            return manifest
+        finally:
+            if os.path.exists(staging):
+                shutil.rmtree(staging, ignore_errors=True)
+
+    def _rotate(self):
+        """删除超出保留份数的旧快照和中断时残留的临时目录，需在持有锁时调用"""
+        regular = [m['id'] for m in self.list_snapshots() if not m['id'].endswith(self.PRE_RESTORE_SUFFIX)]
+        for snapshot_id in regular[self.keep:]:
+            shutil.rmtree(self._snapshot_path(snapshot_id), ignore_errors=True)
+        # 恢复前备份只保留最近一份
+        pre_restore = [m['id'] for m in self.list_snapshots() if m['id'].endswith(self.PRE_RESTORE_SUFFIX)]
+        for snapshot_id in pre_restore[1:]:
+            shutil.rmtree(self._snapshot_path(snapshot_id), ignore_errors=True)
+        for name in os.listdir(self.backup_dir):
+            if name.startswith('.') and name.endswith(('.partial', '.restore')):
+                shutil.rmtree(os.path.join(self.backup_dir, name), ignore_errors=True)
+
+    async def run(self) -> Dict[str, Any]:
+        """备份一次并轮换旧快照，返回快照清单"""
+        if not self.supported:
+            raise RuntimeError("当前存储不支持备份")
+        async with self._lock:
+            manifest = await self._snapshot()
+            self._rotate()
+        total = sum(f['bytes'] for f in manifest['files'])
+        compressed = sum(f['compressed_bytes'] for f in manifest['files'])
+        logger.info(f"签到数据备份完成: {manifest['id']}，{len(manifest['files'])} 个文件，"
+                    f"{total} 字节，压缩后 {compressed} 字节，耗时 {manifest['seconds']} 秒")
+        return manifest
+
+    def _extract(self, manifest: Dict[str, Any], staging: str):
+        """解压快照到 staging 并检查每个文件的完整性"""
+        snapshot_path = self._snapshot_path(manifest['id'])
+        for entry in manifest['files']:
+            raw_path = os.path.join(staging, entry['name'])
+            with gzip.open(os.path.join(snapshot_path, entry['file']), 'rb') as src, open(raw_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        for name, problems in self.db.check_integrity(staging).items():
+            if problems:
+                raise ValueError(f"{name} 完整性检查失败: {'; '.join(problems[:3])}")
+
+    async def restore(self, snapshot_id: str) -> Dict[str, Any]:
+        """用快照覆盖当前数据
+
+        Returns:
+            {'id': 恢复的快照, 'pre_restore': 恢复前备份的快照, 'files': 文件数}
+        Raises:
+            ValueError: 快照不存在、损坏或与当前的分片不对应，此时当前数据没有被修改
+        """
+        if not self.supported:
+            raise RuntimeError("当前存储不支持备份")
+        manifest = self._read_manifest(snapshot_id)
+        if not manifest:
+            raise ValueError(f"快照 {snapshot_id} 不存在")
+        files = set(self.db.database_files)
+        names = {entry['name'] for entry in manifest['files']}
+        if names != files:
+            raise ValueError(f"快照包含 {len(names)} 个文件，与当前的 {len(files)} 个数据库文件不对应，请检查分片配置")
+
+        async with self._lock:
+            staging = self._snapshot_path(f".{snapshot_id}.restore")
+            os.makedirs(staging, exist_ok=True)
+            try:
+                try:
+                    await asyncio.to_thread(self._extract, manifest, staging)
+                except (OSError, EOFError) as e:
+                    raise ValueError(f"快照文件无法读取: {str(e)}")
+                pre_restore = await self._snapshot(self.PRE_RESTORE_SUFFIX)
+                failed = self.db.restore_from(staging)
+                if failed:
+                    raise RuntimeError(f"{', '.join(failed)} 恢复失败，可用恢复前备份 {pre_restore['id']} 回滚")
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+            self._rotate()
+        logger.info(f"签到数据已从快照 {snapshot_id} 恢复，恢复前备份: {pre_restore['id']}")
+        return {'id': snapshot_id, 'pre_restore': pre_restore['id'], 'files': len(names)}
@@ -0,0 +1,237 @@
+"""签到插件离线基准测试
+
+通过 fake_astrbot 替身加载插件，在 1k / 10万 / 100万 用户规模的合成数据库上逐条执行命令，
+统计每个命令的吞吐、p50/p99 延迟，以及其中数据库、图片渲染的耗时和每次命令的 SQL 条数。
+每次改动前后各跑一次即可对比::
+
+    python benchmark.py --users 1000,100000,1000000 --iterations 30 --json bench.json
+
+不依赖运行中的 AstrBot，也不会改动插件目录下的数据库，所有数据写在临时工作目录中。
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import sqlite3
+import argparse
+import datetime
+import platform
+import tempfile
+import unicodedata
+from typing import Dict, Any, List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_astrbot  # noqa: E402
+
+# 基准测试的命令和消息
+COMMANDS = [
+    ('签到', '签到'),
+    ('个人信息', '个人信息'),
+    ('签到日历', '签到日历'),
+    ('我的排名', '我的排名'),
+    ('世界排行榜', '世界排行榜'),
+    ('等级排行榜', '等级排行榜'),
+    ('连续签到排行榜', '连续签到排行榜'),
+    ('查看城堡', '查看城堡'),
+    ('捐献金币', '捐献金币 1'),
+]
+
+# 固定的“今天”，保证不同日期跑出的结果可比
+BENCH_NOW = datetime.datetime(2024, 6, 1, 12, 0, 0)
+
+# 基准测试使用的插件配置：不限流、不导出指标，奖励可重放
+BENCH_CONFIG = {
+    'reward_seed': 'benchmark',
+    'render_queue_size': 100000,
+    'group_render_per_minute': 0,
+    'metrics_export_interval': 0,
+}
+
+CHUNK_SIZE = 100000
+
+
+def user_id(index: int) -> str:
+    return str(100000 + index)
+
+
+def group_count(n_users: int) -> int:
+    return max(1, min(1000, n_users // 100))
+
+
+def group_id(index: int, n_groups: int) -> str:
+    return str(900000 + index % n_groups)
+
+
+def populate(db, n_users: int, seed: int = 0):
+    """生成合成数据：所有用户昨天签到过，每个群一座城堡"""
+    rng = random.Random(seed)
+    n_groups = group_count(n_users)
+    yesterday = (BENCH_NOW.date() - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+    for start in range(0, n_users, CHUNK_SIZE):
+        users, history = [], []
+        for index in range(start, min(n_users, start + CHUNK_SIZE)):
+            total_days = rng.randint(1, 365)
+            level = rng.randint(1, 30)
+            users.append({
+                'user_id': user_id(index),
+                'user_name': f"用户{index}",
+                'total_days': total_days,
+                'last_sign': yesterday,
+                'continuous_days': rng.randint(1, total_days),
+                'exp': rng.randint(0, level * 100),
+                'level': level,
+                'next_level_exp': (level + 1) * 100,
+                'coins': rng.randint(100, 5000),
+                'group_id': group_id(index, n_groups),
+            })
+            history.append((user_id(index), rng.randint(10, 50), rng.randint(10, 50), yesterday))
+        db.import_users(users)
+        db.import_sign_history(history)
+    for index in range(n_groups):
+        members = [user_id(index + n_groups * k) for k in range(6) if index + n_groups * k < n_users]
+        db.create_castle(group_id(index, n_groups), f"城堡{index}", members[0], members[1:])
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def _snapshot(metrics, name: str) -> Dict[str, float]:
+    """某个命令当前累计的数据库、渲染耗时和 SQL 条数"""
+    snapshot = {'statements': sum(count for (command, _), (count, _) in metrics.statements.items() if command == name)}
+    for phase in ('db', 'render'):
+        histogram = metrics.latency.get((name, phase))
+        snapshot[phase] = histogram.sum if histogram else 0.0
+    return snapshot
+
+
+async def bench_command(plugin, command: str, message: str, users: List[int], n_groups: int,
+                        concurrency: int = 1) -> Dict[str, Any]:
+    """执行一个命令 len(users) 次并统计"""
+    handler = fake_astrbot.find_handler(plugin, command)
+    before = _snapshot(plugin.metrics, handler.__name__)
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(index: int):
+        event = fake_astrbot.FakeEvent(user_id(index), message, group_id=group_id(index, n_groups))
+        async with semaphore:
+            start = time.perf_counter()
+            async for _ in handler(event):
+                pass
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_one(index) for index in users))
+    elapsed = time.perf_counter() - start
+
+    after = _snapshot(plugin.metrics, handler.__name__)
+    ops = len(users)
+    return {
+        'ops': ops,
+        'throughput': ops / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'db_ms': (after['db'] - before['db']) / ops * 1000,
+        'render_ms': (after['render'] - before['render']) / ops * 1000,
+        'queries': (after['statements'] - before['statements']) / ops,
+    }
+
+
+async def bench_scale(n_users: int, iterations: int, concurrency: int = 1, seed: int = 0,
+                      commands: List[tuple] = None, shards: int = 0, engine: str = 'sqlite') -> Dict[str, Any]:
+    """在一个用户规模上跑全部命令，shards 大于 0 时使用分片存储，engine 为 memory 时使用纯内存存储"""
+    workdir = tempfile.mkdtemp(prefix='sign-bench-')
+    try:
+        plugin = await fake_astrbot.create_plugin(
+            workdir, config=dict(BENCH_CONFIG, shard_count=shards, storage_engine=engine)
+        )
+        clock = fake_astrbot.plugin_module('clock').FrozenClock(BENCH_NOW)
+        fake_astrbot.set_clock(plugin, clock)
+
+        start = time.perf_counter()
+        populate(plugin.db, n_users, seed)
+        populate_seconds = time.perf_counter() - start
+
+        rng = random.Random(seed)
+        n_groups = group_count(n_users)
+        # 签到每次使用不同的用户，其余命令随机抽取用户
+        sign_users = rng.sample(range(n_users), min(iterations, n_users))
+        results = {}
+        for command, message in commands or COMMANDS:
+            users = sign_users if command == '签到' else [rng.randrange(n_users) for _ in range(iterations)]
+            results[command] = await bench_command(plugin, command, message, users, n_groups, concurrency)
+        await fake_astrbot.close_plugin(plugin)
+        return {'users': n_users, 'populate_seconds': populate_seconds, 'commands': results}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def environment() -> Dict[str, str]:
+    return {
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+def pad(text: str, width: int) -> str:
+    """按显示宽度左对齐，中文字符占两列"""
+    display = sum(2 if unicodedata.east_asian_width(char) in 'WF' else 1 for char in text)
+    return text + ' ' * max(0, width - display)
+
+
+def format_results(results: List[Dict[str, Any]]) -> str:
+    lines = []
+    for scale in results:
+        lines.append(f"== {scale['users']} 用户（造数 {scale['populate_seconds']:.1f}s）==")
+        lines.append(f"{pad('命令', 16)}{'ops/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'db ms':>9}{'render':>9}{'SQL/op':>8}")
+        for command, stat in scale['commands'].items():
+            lines.append(
+                f"{pad(command, 16)}{stat['throughput']:>9.1f}{stat['p50_ms']:>9.1f}{stat['p99_ms']:>9.1f}"
+                f"{stat['db_ms']:>9.2f}{stat['render_ms']:>9.1f}{stat['queries']:>8.1f}"
+            )
+    return "\n".join(lines)
+
+
+async def run(users: List[int], iterations: int, concurrency: int = 1, seed: int = 0,
+              commands: List[tuple] = None, shards: int = 0, engine: str = 'sqlite') -> List[Dict[str, Any]]:
+    return [await bench_scale(n, iterations, concurrency, seed, commands, shards, engine) for n in users]
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="签到插件离线基准测试")
+    parser.add_argument('--users', default='1000,100000,1000000', help="用户规模，逗号分隔")
+    parser.add_argument('--iterations', type=int, default=30, help="每个命令执行的次数")
+    parser.add_argument('--concurrency', type=int, default=1, help="同时执行的命令数")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--commands', default='', help="只测试这些命令，逗号分隔")
+    parser.add_argument('--shards', type=int, default=0, help="分片数，0 表示单文件存储")
+    parser.add_argument('--engine', choices=['sqlite', 'memory'], default='sqlite',
+                        help="存储引擎，memory 不落盘，用于单独测量命令本身的开销")
+    parser.add_argument('--json', default='', help="把结果写入 JSON 文件")
+    args = parser.parse_args(argv)
+
+    commands = COMMANDS
+    if args.commands:
+        wanted = args.commands.split(',')
+        commands = [item for item in COMMANDS if item[0] in wanted]
+    results = asyncio.run(run(
+        [int(n) for n in args.users.split(',')], args.iterations, args.concurrency, args.seed, commands, args.shards,
+        args.engine
+    ))
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'environment': environment(), 'results': results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
 import random
 import datetime
 from typing import Dict, Any, List, Tuple
-from .database import SignDatabase
+from .storage import SignStorage
+from .request_context import SignContext
 
 class CastleManager:
     # 城堡升级所需经验和金币
@@ -22,24 +23,27 @@ class CastleManager:
     }
     
     @staticmethod
-    def get_castle_exp_gain() -> int:
+    def get_castle_exp_gain(rng=None) -> int:
         """获取城堡经验随机增长"""
-        return random.randint(15, 35)
+        return (rng or random).randint(15, 35)
     
     @staticmethod
-    def format_castle_info(castle_data: Dict[str, Any], db: SignDatabase) -> str:
+    def format_castle_info(castle_data: Dict[str, Any], db: SignStorage, ctx: SignContext = None) -> str:
         """格式化城堡信息"""
         if not castle_data:
             return "该群聊还没有建造城堡哦~"
         
-        # 获取领主和总管的昵称
+        # 一次查询获取领主和总管的昵称
+        user_ids = ([castle_data['lord_id']] if castle_data['lord_id'] else []) + castle_data['managers']
+        names = ctx.get_user_names(user_ids) if ctx else db.get_user_names(user_ids)
+        
         lord_name = "无"
         if castle_data['lord_id']:
-            lord_name = db.get_user_name(castle_data['lord_id']) or castle_data['lord_id']
+            lord_name = names.get(castle_data['lord_id']) or castle_data['lord_id']
         
         manager_names = []
         for manager_id in castle_data['managers']:
-            manager_name = db.get_user_name(manager_id) or manager_id
+            manager_name = names.get(manager_id) or manager_id
             manager_names.append(manager_name)
         
         managers_str = "、".join(manager_names) if manager_names else "无"
@@ -86,10 +90,14 @@ class CastleManager:
         return result.strip()
     
     @staticmethod
-    def get_buffed_rewards(base_exp: int, base_coin_range: Tuple[int, int], castle_level: int) -> Tuple[int, int]:
-        """根据城堡等级获取增益后的奖励"""
+    def get_buffed_rewards(base_exp: int, base_coin_range: Tuple[int, int], castle_level: int, rng=None) -> Tuple[int, int]:
+        """根据城堡等级获取增益后的奖励
+        Args:
+            rng: 随机数源，默认使用全局 random
+        """
+        rng = rng or random
         if castle_level not in CastleManager.CASTLE_BUFFS:
-            return base_exp, random.randint(*base_coin_range)
+            return base_exp, rng.randint(*base_coin_range)
         
         buff = CastleManager.CASTLE_BUFFS[castle_level]
         
@@ -97,6 +105,6 @@ class CastleManager:
         exp_reward = int(base_exp * (1 + buff['exp_bonus']))
         
         # 计算金币奖励（带增益）
-        coin_reward = random.randint(*buff['coin_range'])
+        coin_reward = rng.randint(*buff['coin_range'])
         
         return exp_reward, coin_reward
\ No newline at end of file
@@ -0,0 +1,89 @@
+import re
+import datetime
+from typing import Callable, Optional
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9
+    ZoneInfo = None
+
+
+class SignClock:
+    """签到时钟
+
+    统一计算“签到日”，所有模块都应该通过同一个时钟实例获取日期，
+    避免一次请求内多次调用 today() 在零点前后得到不同的结果。
+    """
+
+    def __init__(self, timezone: str = "", rollover_hour: float = 0,
+                 time_source: Optional[Callable[[], datetime.datetime]] = None):
+        """
+        Args:
+            timezone: 时区，支持 IANA 名称(如 Asia/Shanghai)或固定偏移(如 UTC+8、+08:00)，为空时使用服务器本地时区
+            rollover_hour: 换日偏移(小时)，例如 4 表示每天 04:00 才算新的一天
+            time_source: 自定义时间源，返回当前时间，主要用于测试和压测
+        """
+        self.tz = self._parse_timezone(timezone)
+        self.rollover = datetime.timedelta(hours=rollover_hour or 0)
+        self._time_source = time_source
+
+    @staticmethod
+    def _parse_timezone(timezone: str) -> Optional[datetime.tzinfo]:
+        """解析时区配置，无法解析时回退到服务器本地时区"""
+        if not timezone:
+            return None
+
+        # 固定偏移，例如 UTC+8、GMT-5、+08:00
+        match = re.fullmatch(r'(?:UTC|GMT)?\s*([+-])(\d{1,2})(?::?(\d{2}))?', timezone.strip(), re.IGNORECASE)
+        if match:
+            sign, hours, minutes = match.groups()
+            offset = datetime.timedelta(hours=int(hours), minutes=int(minutes or 0))
+            return datetime.timezone(-offset if sign == '-' else offset)
+
+        # database 依赖本模块，日志在用到时再导入
+        from .database import logger
+        if ZoneInfo is not None:
+            try:
+                return ZoneInfo(timezone)
+            except Exception as e:
+                logger.warning(f"无法解析时区 {timezone}，使用服务器本地时区: {e}")
+                return None
+
+        logger.warning(f"当前 Python 版本不支持时区 {timezone}，使用服务器本地时区")
+        return None
+
+    def now(self) -> datetime.datetime:
+        """获取当前时间（带时区）"""
+        if self._time_source:
+            now = self._time_source()
+            if now.tzinfo is None:
+                # 未带时区的时间视为时钟所在时区的时间
+                return now.replace(tzinfo=self.tz) if self.tz else now.astimezone()
+        else:
+            now = datetime.datetime.now(datetime.timezone.utc)
+
+        return now.astimezone(self.tz) if self.tz else now.astimezone()
+
+    def today(self) -> datetime.date:
+        """获取当前签到日（已应用换日偏移）"""
+        return (self.now() - self.rollover).date()
+
+    def today_str(self) -> str:
+        """获取当前签到日字符串 YYYY-MM-DD"""
+        return self.today().strftime('%Y-%m-%d')
+
+
+class FrozenClock(SignClock):
+    """可手动拨动的时钟，用于测试和压测中模拟跨日"""
+
+    def __init__(self, start: datetime.datetime, timezone: str = "", rollover_hour: float = 0):
+        super().__init__(timezone, rollover_hour, time_source=lambda: self._now)
+        self._now = start
+
+    def set(self, now: datetime.datetime):
+        """设置当前时间"""
+        self._now = now
+
+    def advance(self, **kwargs):
+        """向前拨动时间，参数同 datetime.timedelta"""
+        self._now = self._now + datetime.timedelta(**kwargs)
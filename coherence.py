@@ -0,0 +1,99 @@
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Set
+
+from .database import SignDatabase, logger
+
+# 缓存失效回调：参数为发生变化的键集合，为 None 时表示无法确定范围，应清空全部
+InvalidateCallback = Callable[[Optional[Set[str]]], None]
+
+
+class CoherenceMonitor:
+    """多实例部署下的缓存一致性
+
+    多个 AstrBot 实例共用同一个数据库文件时，其他进程的写入不会经过本进程的缓存。
+    - 每次轮询先读 PRAGMA data_version，只有其他连接提交过修改时才读取变更日志，平时几乎没有开销
+    - 变更日志由 SignDatabase 的触发器在写入的同一事务中记录 (范围, 键)，按范围分发给订阅者，
+      只失效受影响的键；本进程自己的写入也会出现在日志中，重复失效不影响正确性
+    - 日志按时间清理；本实例落后太多、需要的日志已被清理时，通知所有订阅者全部失效
+    """
+
+    def __init__(self, db: SignDatabase, retention: int = 3600, batch_size: int = 1000,
+                 prune_interval: int = 600):
+        """
+        Args:
+            db: 数据库实例
+            retention: 变更日志保留时间(秒)，应远大于轮询间隔
+            batch_size: 每次读取的日志行数
+            prune_interval: 清理过期日志的间隔(秒)
+        """
+        self.db = db
+        self.retention = retention
+        self.batch_size = batch_size
+        self.prune_interval = prune_interval
+        self._subscribers: Dict[str, List[InvalidateCallback]] = defaultdict(list)
+        self._version = db.data_version()
+        # 只关心启动之后的变更
+        self._last_id = db.get_change_bounds()[1]
+        self._last_prune = time.monotonic()
+        # 处理过的变更数和全部失效次数
+        self.changes = 0
+        self.resets = 0
+
+    def subscribe(self, scope: str, callback: InvalidateCallback):
+        """订阅某个范围（user / title / inventory / castle / group）的变更"""
+        self._subscribers[scope].append(callback)
+
+    def poll(self) -> int:
+        """检查其他连接的写入并分发失效通知，返回本次处理的变更数"""
+        if time.monotonic() - self._last_prune >= self.prune_interval:
+            self._last_prune = time.monotonic()
+            self.db.prune_change_log(int(time.time()) - self.retention)
+
+        version = self.db.data_version()
+        if version == self._version:
+            return 0
+        self._version = version
+
+        oldest, newest = self.db.get_change_bounds()
+        if oldest > self._last_id + 1 or newest < self._last_id:
+            # 中间的日志已被清理，或数据库被恢复为旧的备份（日志 ID 回退），无法知道哪些键变了
+            self._last_id = newest
+            self.resets += 1
+            self._notify_all()
+            return 0
+
+        processed = 0
+        changed: Dict[str, Set[str]] = defaultdict(set)
+        while True:
+            rows = self.db.get_changes(self._last_id, self.batch_size)
+            for change_id, scope, key in rows:
+                changed[scope].add(key)
+            if rows:
+                self._last_id = rows[-1][0]
+                processed += len(rows)
+            if len(rows) < self.batch_size:
+                break
+        for scope, keys in changed.items():
+            self._notify(scope, keys)
+        self.changes += processed
+        return processed
+
+    def resync(self):
+        """本进程替换了数据库内容（如恢复备份）并已自行清空缓存后，从当前的日志位置重新开始"""
+        self._version = self.db.data_version()
+        self._last_id = self.db.get_change_bounds()[1]
+
+    def _notify(self, scope: str, keys: Optional[Set[str]]):
+        for callback in self._subscribers.get(scope, ()):
+            try:
+                callback(keys)
+            except Exception as e:
+                logger.error(f"缓存失效回调执行失败: {str(e)}")
+
+    def _notify_all(self):
+        for scope in list(self._subscribers):
+            self._notify(scope, None)
+
+    def stats(self) -> dict:
+        return {'last_id': self._last_id, 'changes': self.changes, 'resets': self.resets}
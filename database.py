@@ -1,32 +1,248 @@
 import sqlite3
 import os
 import json
-from typing import Dict, Any, Optional, List
-from datetime import datetime
+import time
+import datetime
+import functools
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List, Callable, Tuple
+from .clock import SignClock
+from .sign_calendar import SignCalendar
+from .slow_query import SlowQueryLog
+from .read_pool import ReadConnectionPool, connect_read_only
+from .storage import SignStorage, StatementHook
+from .schema_migrations import SchemaMigrator
 
 # 创建简单的logger替代astrbot.api.logger
 class SimpleLogger:
+    def __init__(self):
+        # 日志监听器 listener(级别, 消息)，供压测等工具统计错误
+        self.listeners: List[Callable[[str, str], None]] = []
+
+    def _emit(self, level: str, msg):
+        print(f"{level}: {msg}")
+        for listener in self.listeners:
+            listener(level, str(msg))
+
     def error(self, msg):
-        print(f"ERROR: {msg}")
+        self._emit("ERROR", msg)
     
     def info(self, msg):
-        print(f"INFO: {msg}")
+        self._emit("INFO", msg)
+    
+    def warning(self, msg):
+        self._emit("WARNING", msg)
 
 logger = SimpleLogger()
 
-class SignDatabase:
-    def __init__(self, plugin_dir: str):
+class InstrumentedCursor:
+    """包装 sqlite3.Cursor，对每次 execute 和结果读取计时并通知钩子"""
+
+    def __init__(self, cursor: sqlite3.Cursor, hooks: List[StatementHook]):
+        self._cursor = cursor
+        self._hooks = hooks
+        self._sql = ''
+        self._params = ()
+
+    def _notify(self, seconds: float, fetch: bool):
+        for hook in self._hooks:
+            try:
+                hook(self._sql, self._params, seconds, fetch)
+            except Exception as e:
+                logger.error(f"语句钩子执行失败: {str(e)}")
+
+    def execute(self, sql: str, params=()):
+        self._sql, self._params = sql, params
+        start = time.perf_counter()
+        try:
+            self._cursor.execute(sql, params)
+        finally:
+            self._notify(time.perf_counter() - start, False)
+        return self
+
+    def executemany(self, sql: str, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        self._sql, self._params = sql, seq_of_params
+        start = time.perf_counter()
+        try:
+            self._cursor.executemany(sql, seq_of_params)
+        finally:
+            self._notify(time.perf_counter() - start, False)
+        return self
+
+    def _fetch(self, method, *args):
+        # SQLite 的查询在读取结果时才真正逐行执行，这部分耗时也要计入
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._notify(time.perf_counter() - start, True)
+
+    def fetchone(self):
+        return self._fetch(self._cursor.fetchone)
+
+    def fetchall(self):
+        return self._fetch(self._cursor.fetchall)
+
+    def fetchmany(self, size: int = None):
+        return self._fetch(self._cursor.fetchmany, *(() if size is None else (size,)))
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def read_only(method):
+    """标记只读查询方法：在只读连接池的连接上执行，可以在任意线程调用
+
+    写连接所在线程有未提交的事务时（写操作内部的读取）仍使用写连接，以读到本事务的修改。
+    方法内部照常使用 self.cursor，调用期间它指向借出的只读游标。
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        pool = self.read_pool
+        if (pool is None or getattr(self._local, 'cursor', None) is not None
+                or (threading.get_ident() == self._writer_thread and self.conn.in_transaction)):
+            return method(self, *args, **kwargs)
+        with pool.cursor() as cursor:
+            self._local.cursor = cursor
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._local.cursor = None
+    return wrapper
+
+class _BackupRestarted(Exception):
+    """在线备份因源库被修改而反复重新开始"""
+
+
+class SignDatabase(SignStorage):
+    """SQLite 存储，单个数据库文件"""
+
+    # 物化排行榜: 榜名 -> (来源, 主排序列, 次排序列)
+    # 所有榜统一按 k1 DESC, k2 DESC, entity_id ASC 排序；last_sign 越早越靠前，因此存为负的 YYYYMMDD
+    LEADERBOARDS = {
+        'world': ('user', 'total_days', 'last_sign'),
+        'continuous': ('user', 'continuous_days', 'last_sign'),
+        'level': ('user', 'level', 'exp'),
+        'castle_level': ('castle', 'level', 'exp'),
+        'castle_coins': ('castle', 'coins', None),
+    }
+    USER_BOARDS = ('world', 'continuous', 'level')
+    CASTLE_BOARDS = ('castle_level', 'castle_coins')
+    # 影响用户榜排序的列
+    USER_BOARD_COLUMNS = {'total_days', 'last_sign', 'continuous_days', 'level', 'exp'}
+    # 保证准确的名次数为 LEADERBOARD_SIZE；榜上额外保留到 LEADERBOARD_CAPACITY 名，成员掉榜时不必立即重建
+    LEADERBOARD_CAPACITY = 200
+    # group_members 中冗余的用户排序列，用于群内排行
+    GROUP_MEMBER_COLUMNS = ['total_days', 'last_sign', 'continuous_days', 'level', 'exp']
+    # 变更日志：表 -> (范围, 键列)。由触发器在写入的同一事务中记录，其他进程据此失效各自的缓存
+    CHANGE_SCOPES = {
+        'sign_data': ('user', 'user_id'),
+        'user_names': ('user', 'user_id'),
+        'user_titles': ('title', 'user_id'),
+        'inventory': ('inventory', 'user_id'),
+        'castle_data': ('castle', 'group_id'),
+        'group_members': ('group', 'group_id'),
+    }
+    # 分片存储：表 -> 分片键列。用户的数据（含群成员关系）放在同一分片，城堡按群号分片
+    SHARD_KEYS = {
+        'sign_data': 'user_id',
+        'sign_history': 'user_id',
+        'sign_history_monthly': 'user_id',
+        'sign_calendar': 'user_id',
+        'inventory': 'user_id',
+        'user_names': 'user_id',
+        'user_titles': 'user_id',
+        'group_members': 'user_id',
+        'castle_data': 'group_id',
+        'sign_requests': 'user_id',
+    }
+    # 在分片之间移动行时不复制的自增主键，由目标库重新分配
+    SHARD_SKIP_COLUMNS = {'sign_history': 'id', 'castle_data': 'castle_id'}
+    DB_NAME = "astrbot_plugin_advanced_sign.db"
+    
+    def __init__(self, plugin_dir: str, clock: SignClock = None, slow_query_ms: float = 0,
+                 read_pool_size: int = None, db_name: str = None, castle_id_step: int = 1,
+                 castle_id_offset: int = 0):
+        """
+        Args:
+            plugin_dir: 插件目录，数据库位于其下的 plugins_db
+            clock: 签到时钟
+            slow_query_ms: 慢查询阈值(毫秒)，大于 0 时记录慢查询日志 plugins_db/slow_query.log
+            read_pool_size: 只读连接数，为空时取 CPU 核数（最多 8），0 表示所有查询都使用写连接
+            db_name: 数据库文件名，默认为 DB_NAME
+            castle_id_step, castle_id_offset: 新城堡编号取 (编号 - 1) % step == offset 的值，
+                分片存储时各分片的城堡编号互不重复
+        """
+        self.clock = clock or SignClock()
+        self.castle_id_step = max(1, castle_id_step)
+        self.castle_id_offset = castle_id_offset % self.castle_id_step
+        self._statement_hooks: List[StatementHook] = []
+        # 只读方法调用期间，当前线程借出的只读游标
+        self._local = threading.local()
+        self._writer_thread = threading.get_ident()
+        self.read_pool: Optional[ReadConnectionPool] = None
+        # 各排行榜的行数、末位和是否完整；其他连接提交过修改（data_version 变化）后作废
+        self._board_states: Dict[str, Dict[str, Any]] = {}
+        self._board_version: Optional[int] = None
+        # transaction() 的嵌套深度和事务内是否有写操作失败
+        self._tx_depth = 0
+        self._tx_failed = False
+        # 变更日志触发器的开关，None 表示保持数据库中现有的状态（见 set_change_log）
+        self.change_log_enabled: Optional[bool] = None
         db_dir = os.path.join(plugin_dir, "plugins_db")
         if not os.path.exists(db_dir):
             os.makedirs(db_dir)
-        self.db_path = os.path.join(db_dir, "astrbot_plugin_advanced_sign.db")
+        self.db_path = os.path.join(db_dir, db_name or self.DB_NAME)
         self.init_db()
+        if read_pool_size is None:
+            read_pool_size = min(8, os.cpu_count() or 1)
+        if read_pool_size > 0:
+            self.read_pool = ReadConnectionPool(
+                lambda: connect_read_only(self.db_path), read_pool_size, self._wrap_read_cursor
+            )
+        self.slow_query_log = None
+        if slow_query_ms and slow_query_ms > 0:
+            # 读写连接上的语句都会经过慢查询日志，EXPLAIN 使用独立的只读连接
+            self.slow_query_log = SlowQueryLog(
+                connect_read_only(self.db_path), os.path.join(db_dir, "slow_query.log"), slow_query_ms
+            )
+            self.add_statement_hook(self.slow_query_log)
         
+    @property
+    def cursor(self):
+        """当前游标：只读方法执行期间为借出的只读游标，否则为写连接的游标"""
+        return getattr(self._local, 'cursor', None) or self._write_cursor
+
+    @cursor.setter
+    def cursor(self, value):
+        self._write_cursor = value
+
+    @property
+    def data_dir(self) -> str:
+        return os.path.dirname(self.db_path)
+
+    @property
+    def change_logs(self) -> List['SignDatabase']:
+        return [self]
+
+    def _wrap_read_cursor(self, cursor: sqlite3.Cursor):
+        return InstrumentedCursor(cursor, self._statement_hooks) if self._statement_hooks else cursor
+
     def init_db(self):
         """初始化数据库连接和表结构"""
         self.conn = sqlite3.connect(self.db_path)
         self.cursor = self.conn.cursor()
         
+        # 新建的数据库启用增量 VACUUM，便于归档后分批回收空间（对已有数据库无效）
+        self.cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        # WAL 模式下只读连接读取已提交的快照，与写连接互不阻塞
+        self.cursor.execute('PRAGMA journal_mode = WAL')
+        
         # 创建所需的表
         tables = [
             '''CREATE TABLE IF NOT EXISTS sign_data (
@@ -82,8 +298,83 @@ class SignDatabase:
         
         for table in tables:
             self.cursor.execute(table)
-        self.conn.commit()
+        # 基线之后的表结构变化由迁移完成，回填在后台分批进行（见 schema_migrations.py）
+        self.migrator = SchemaMigrator(self.conn, steps={'leaderboards': self._backfill_leaderboards})
+        executed = self.migrator.apply_schema()
+        if executed:
+            logger.info(f"{os.path.basename(self.db_path)} 表结构已升级到版本 {executed[-1]}")
+        if self.migrator.current_version() > self.migrator.latest_version:
+            logger.warning(f"{os.path.basename(self.db_path)} 的表结构版本 {self.migrator.current_version()} "
+                           f"高于插件支持的版本 {self.migrator.latest_version}，可能由更新版本的插件创建")
+        self._commit()
+
+    def set_change_log(self, enabled: bool):
+        """开启或关闭变更日志触发器
+        只有启用多实例缓存一致性检查时才有进程读取 change_log；关闭时删除已有的触发器，写入不再额外记日志。
+        未调用时保持数据库中现有的状态，离线工具打开数据库不会影响运行中的其他实例
+        """
+        self.change_log_enabled = enabled
+        self._sync_change_triggers()
+        self._commit()
+
+    def _sync_change_triggers(self):
+        """按 change_log_enabled 创建或删除变更日志触发器，触发器在写入的同一事务中记录 (范围, 键)"""
+        for table, (scope, key) in self.CHANGE_SCOPES.items():
+            for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+                name = f"trg_{table}_{event.lower()}_log"
+                if self.change_log_enabled:
+                    self.cursor.execute(f'''
+                        CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table}
+                        BEGIN INSERT INTO change_log (scope, key) VALUES ('{scope}', {row}.{key}); END
+                    ''')
+                else:
+                    self.cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+
+    @contextmanager
+    def transaction(self, user_id: str):
+        """在一个事务中执行多个写方法，全部成功才提交；块内抛出异常或有写方法失败时整体回滚
+        块内各写方法的提交推迟到块结束，嵌套时并入最外层的事务
+        """
+        if self._tx_depth:
+            self._tx_depth += 1
+            try:
+                yield
+            finally:
+                self._tx_depth -= 1
+            return
+        self._tx_depth, self._tx_failed = 1, False
+        try:
+            yield
+            if self._tx_failed:
+                raise sqlite3.OperationalError("事务中的写操作失败，已整体回滚")
+            self._tx_depth = 0
+            self.conn.commit()
+        except BaseException:
+            self._tx_depth = 0
+            self.conn.rollback()
+            # 回滚前在事务中更新过的排行榜状态作废
+            self._board_states.clear()
+            raise
+
+    def _commit(self):
+        """提交写操作，transaction() 中推迟到事务结束"""
+        if not self._tx_depth:
+            self.conn.commit()
+
+    def _rollback(self):
+        """回滚失败的写操作，transaction() 中记为失败，由事务结束时整体回滚"""
+        if self._tx_depth:
+            self._tx_failed = True
+        else:
+            self.conn.rollback()
 
+    def add_statement_hook(self, hook: StatementHook):
+        """注册语句钩子，首次注册时为游标包装计时代理"""
+        self._statement_hooks.append(hook)
+        if not isinstance(self._write_cursor, InstrumentedCursor):
+            self._write_cursor = InstrumentedCursor(self._write_cursor, self._statement_hooks)
+            
+    @read_only
     def get_user_data(self, user_id: str) -> Optional[Dict[str, Any]]:
         """获取用户数据"""
         self.cursor.execute('SELECT * FROM sign_data WHERE user_id = ?', (user_id,))
@@ -91,19 +382,24 @@ class SignDatabase:
         if not row:
             return None
         
-        columns = ['user_id', 'total_days', 'last_sign', 'continuous_days', 'exp', 'level', 'next_level_exp', 'coins', 'group_id']
-        return dict(zip(columns, row))
+        return dict(zip(self.USER_COLUMNS, row))
 
-    def update_user_data(self, user_id: str, **kwargs):
-        """更新用户数据"""
+    def update_user_data(self, user_id: str, ctx=None, **kwargs):
+        """更新用户数据
+        Args:
+            ctx: 请求上下文，传入时复用其中的用户数据，并在写入后同步
+        """
+        existing_data = ctx.user_data if ctx is not None else self.get_user_data(user_id)
+        # 调用方显式传入的群组即本次活动所在的群
+        active_group = kwargs.get('group_id')
+        
         # 确保包含群组信息
         if 'group_id' not in kwargs:
             # 尝试获取现有群组信息
-            existing_data = self.get_user_data(user_id)
             if existing_data and existing_data.get('group_id'):
                 kwargs['group_id'] = existing_data['group_id']
                 
-        if not self.get_user_data(user_id):
+        if not existing_data:
             self.cursor.execute('INSERT INTO sign_data (user_id) VALUES (?)', (user_id,))
             
         update_fields = []
@@ -115,22 +411,53 @@ class SignDatabase:
         
         sql = f"UPDATE sign_data SET {', '.join(update_fields)} WHERE user_id = ?"
         self.cursor.execute(sql, values)
-        self.conn.commit()
+        data = dict(existing_data or self.USER_DEFAULTS, **kwargs)
+        if active_group:
+            self._touch_group_member(active_group, user_id, data)
+        # 同一事务内维护物化排行榜和群内排序列
+        if self.USER_BOARD_COLUMNS & kwargs.keys():
+            self._update_boards(
+                user_id, self._user_board_keys(data),
+                self._user_board_keys(existing_data) if existing_data else None,
+                lambda: self._user_board_labels(user_id)
+            )
+            if not active_group or existing_data:
+                self.cursor.execute(
+                    f"UPDATE group_members SET {', '.join(f'{column} = ?' for column in self.GROUP_MEMBER_COLUMNS)} "
+                    f"WHERE user_id = ?",
+                    (*(data[column] for column in self.GROUP_MEMBER_COLUMNS), user_id)
+                )
+        self._commit()
+        
+        if ctx is not None:
+            ctx.set_user_data(dict(existing_data or dict(self.USER_DEFAULTS, user_id=user_id), **kwargs))
         
-    def update_user_name(self, user_id: str, user_name: str, group_id: str = None):
+    def _touch_group_member(self, group_id: str, user_id: str, data: Dict[str, Any]):
+        """在当前事务中记录用户在群内的活动，首次出现时加入群成员表"""
+        columns = ', '.join(self.GROUP_MEMBER_COLUMNS)
+        today = self.clock.today_str()
+        self.cursor.execute(f'''
+            INSERT INTO group_members (group_id, user_id, joined_date, last_active, {columns})
+            VALUES (?, ?, ?, ?, {', '.join('?' * len(self.GROUP_MEMBER_COLUMNS))})
+            ON CONFLICT (group_id, user_id) DO UPDATE SET last_active = excluded.last_active
+        ''', (group_id, user_id, today, today, *(data[column] for column in self.GROUP_MEMBER_COLUMNS)))
+
+    def update_user_name(self, user_id: str, user_name: str, group_id: str = None, ctx=None):
         """更新用户昵称"""
-        # 检查是否已存在（基于user_id，忽略group_id）
-        self.cursor.execute('SELECT user_id FROM user_names WHERE user_id = ?', (user_id,))
-        if self.cursor.fetchone():
-            # 如果用户已存在，更新其昵称和群组ID
-            self.cursor.execute('UPDATE user_names SET user_name = ?, group_id = ? WHERE user_id = ?', 
-                              (user_name, group_id, user_id))
-        else:
-            # 如果用户不存在，插入新记录
-            self.cursor.execute('INSERT INTO user_names (user_id, user_name, group_id) VALUES (?, ?, ?)', 
-                              (user_id, user_name, group_id))
-        self.conn.commit()
+        # 基于user_id插入或更新昵称和群组ID
+        self.cursor.execute('''
+            INSERT INTO user_names (user_id, user_name, group_id) VALUES (?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET user_name = excluded.user_name, group_id = excluded.group_id
+        ''', (user_id, user_name, group_id))
+        self.cursor.execute(
+            f"UPDATE leaderboards SET name = ? WHERE entity_id = ? AND board IN ({', '.join('?' * len(self.USER_BOARDS))})",
+            (user_name, user_id, *self.USER_BOARDS)
+        )
+        self._commit()
+        if ctx is not None:
+            ctx.set_user_name(user_id, user_name)
         
+    @read_only
     def get_user_name(self, user_id: str, group_id: str = None) -> str:
         """获取用户昵称 - 添加缓存逻辑"""
         # 优先从user_names表获取
@@ -147,14 +474,255 @@ class SignDatabase:
         # 如果没有记录，返回用户ID
         return user_id
 
-    def log_sign(self, user_id: str, exp: int, coins: int):
-        """记录签到历史"""
+    @read_only
+    def get_user_names(self, user_ids: List[str]) -> Dict[str, str]:
+        """批量获取用户昵称，没有记录的用户返回用户ID"""
+        names = {user_id: user_id for user_id in user_ids}
+        if not user_ids:
+            return names
+        self.cursor.execute(
+            f"SELECT user_id, user_name FROM user_names WHERE user_id IN ({', '.join('?' * len(user_ids))})",
+            list(user_ids)
+        )
+        for user_id, user_name in self.cursor.fetchall():
+            if user_name:
+                names[user_id] = user_name
+        return names
+
+    def log_sign(self, user_id: str, exp: int, coins: int, sign_date: str = None):
+        """记录签到历史
+        Args:
+            sign_date: 签到日 YYYY-MM-DD，默认取签到时钟的当前签到日
+        """
+        sign_date = sign_date or self.clock.today_str()
         self.cursor.execute(
             'INSERT INTO sign_history (user_id, exp, coins, sign_date) VALUES (?, ?, ?, ?)',
-            (user_id, exp, coins, datetime.now().strftime('%Y-%m-%d'))
+            (user_id, exp, coins, sign_date)
+        )
+        # 同一事务内更新签到日历位图
+        self._mark_sign_day(user_id, datetime.datetime.strptime(sign_date, '%Y-%m-%d').date())
+        self._commit()
+        
+    def import_users(self, users: List[Dict[str, Any]]) -> bool:
+        """批量导入用户签到数据和昵称，已存在的用户会被覆盖（用于数据迁移和基准测试造数）
+        Args:
+            users: [{'user_id': ..., 'user_name': ..., sign_data 的其他列...}, ...]，缺少的列取默认值
+        """
+        columns = ', '.join(self.USER_COLUMNS)
+        placeholders = ', '.join('?' * len(self.USER_COLUMNS))
+        try:
+            self.cursor.executemany(
+                f'INSERT OR REPLACE INTO sign_data ({columns}) VALUES ({placeholders})',
+                [tuple(user.get(column, self.USER_DEFAULTS.get(column)) for column in self.USER_COLUMNS) for user in users]
+            )
+            self.cursor.executemany(
+                'INSERT OR REPLACE INTO user_names (user_id, user_name, group_id) VALUES (?, ?, ?)',
+                [(user['user_id'], user['user_name'], user.get('group_id', '')) for user in users if user.get('user_name')]
+            )
+            # 同步用户在各群的排序列，并把导入数据中的群加入群成员表
+            member_keys = [tuple(user.get(column, self.USER_DEFAULTS[column]) for column in self.GROUP_MEMBER_COLUMNS)
+                           for user in users]
+            self.cursor.executemany(
+                f"UPDATE group_members SET {', '.join(f'{column} = ?' for column in self.GROUP_MEMBER_COLUMNS)} "
+                f"WHERE user_id = ?",
+                [(*keys, user['user_id']) for user, keys in zip(users, member_keys)]
+            )
+            self.cursor.executemany(
+                f'''INSERT OR IGNORE INTO group_members (group_id, user_id, joined_date, last_active, {', '.join(self.GROUP_MEMBER_COLUMNS)})
+                VALUES (?, ?, ?, ?, {', '.join('?' * len(self.GROUP_MEMBER_COLUMNS))})''',
+                [(user['group_id'], user['user_id'], user.get('last_sign', ''), user.get('last_sign', ''), *keys)
+                 for user, keys in zip(users, member_keys) if user.get('group_id')]
+            )
+            # 批量导入后直接重建用户榜
+            for board in self.USER_BOARDS:
+                self._rebuild_board(board)
+            self._commit()
+            return True
+        except Exception as e:
+            self._rollback()
+            self._board_states.clear()
+            logger.error(f"导入用户数据失败: {str(e)}")
+            return False
+            
+    def import_sign_history(self, rows: List[tuple]) -> bool:
+        """批量导入签到历史 [(user_id, exp, coins, sign_date), ...]，签到日历会在查询时从历史回填"""
+        try:
+            self.cursor.executemany(
+                'INSERT INTO sign_history (user_id, exp, coins, sign_date) VALUES (?, ?, ?, ?)', rows
+            )
+            self._commit()
+            return True
+        except Exception as e:
+            self._rollback()
+            logger.error(f"导入签到历史失败: {str(e)}")
+            return False
+            
+    def _mark_sign_day(self, user_id: str, day: datetime.date):
+        """在签到日历位图中标记某天（不提交事务）"""
+        years = self._load_sign_calendar(user_id)
+        bits = SignCalendar.set_day(years.get(day.year), day)
+        if bits == years.get(day.year):
+            # 已经标记过（例如刚从签到历史回填）
+            return
+        self.cursor.execute(
+            'INSERT OR REPLACE INTO sign_calendar (user_id, year, days) VALUES (?, ?, ?)',
+            (user_id, day.year, bits)
         )
-        self.conn.commit()
         
+    def _load_sign_calendar(self, user_id: str) -> Dict[int, bytes]:
+        """读取用户的签到日历位图，首次读取时从签到历史回填（不提交事务）"""
+        self.cursor.execute('SELECT year, days FROM sign_calendar WHERE user_id = ?', (user_id,))
+        years = {row[0]: row[1] for row in self.cursor.fetchall()}
+        if years:
+            return years
+        
+        # 旧数据没有位图，用现存的签到明细回填（已归档的明细无法回填）
+        self.cursor.execute('SELECT DISTINCT sign_date FROM sign_history WHERE user_id = ?', (user_id,))
+        for (sign_date,) in self.cursor.fetchall():
+            try:
+                day = datetime.datetime.strptime(sign_date, '%Y-%m-%d').date()
+            except (TypeError, ValueError):
+                continue
+            years[day.year] = SignCalendar.set_day(years.get(day.year), day)
+        
+        if years:
+            self.cursor.executemany(
+                'INSERT OR REPLACE INTO sign_calendar (user_id, year, days) VALUES (?, ?, ?)',
+                [(user_id, year, bits) for year, bits in years.items()]
+            )
+        return years
+        
+    @read_only
+    def read_sign_calendar(self, user_id: str) -> Dict[int, bytes]:
+        """只读取已有的签到日历位图，不回填"""
+        self.cursor.execute('SELECT year, days FROM sign_calendar WHERE user_id = ?', (user_id,))
+        return {row[0]: row[1] for row in self.cursor.fetchall()}
+
+    def get_sign_calendar(self, user_id: str) -> Dict[int, bytes]:
+        """获取用户每年的签到日历位图 {年份: 位图}"""
+        years = self._load_sign_calendar(user_id)
+        self._commit()
+        return years
+        
+    def get_expired_history(self, before_date: str, limit: int) -> List[tuple]:
+        """按写入顺序获取早于指定日期的签到历史
+        Returns:
+            [(id, user_id, exp, coins, sign_date, timestamp), ...]
+        """
+        self.cursor.execute('''
+            SELECT id, user_id, exp, coins, sign_date, timestamp
+            FROM sign_history
+            WHERE sign_date < ?
+            ORDER BY id
+            LIMIT ?
+        ''', (before_date, limit))
+        return self.cursor.fetchall()
+        
+    def rollup_history(self, rows: List[tuple]) -> bool:
+        """将一批签到历史汇总进月度统计表并从明细表删除
+        汇总和删除在同一个事务中完成，保证每条记录只被汇总一次
+        """
+        if not rows:
+            return True
+        
+        # 按 (用户, 月份) 聚合
+        monthly = {}
+        for _, user_id, exp, coins, sign_date, _ in rows:
+            key = (user_id, sign_date[:7])
+            stat = monthly.setdefault(key, [0, 0, 0, sign_date, sign_date])
+            stat[0] += 1
+            stat[1] += exp or 0
+            stat[2] += coins or 0
+            stat[3] = min(stat[3], sign_date)
+            stat[4] = max(stat[4], sign_date)
+        
+        try:
+            self.cursor.executemany('''
+                INSERT INTO sign_history_monthly (user_id, month, sign_count, exp, coins, first_sign, last_sign)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, month) DO UPDATE SET
+                    sign_count = sign_count + excluded.sign_count,
+                    exp = exp + excluded.exp,
+                    coins = coins + excluded.coins,
+                    first_sign = MIN(first_sign, excluded.first_sign),
+                    last_sign = MAX(last_sign, excluded.last_sign)
+            ''', [(user_id, month, *stat) for (user_id, month), stat in monthly.items()])
+            self.cursor.executemany('DELETE FROM sign_history WHERE id = ?', [(row[0],) for row in rows])
+            self._commit()
+            return True
+        except Exception as e:
+            self._rollback()
+            logger.error(f"汇总签到历史失败: {str(e)}")
+            return False
+            
+    @read_only
+    def get_monthly_history(self, user_id: str) -> List[tuple]:
+        """获取用户已归档的月度签到统计"""
+        self.cursor.execute('''
+            SELECT month, sign_count, exp, coins, first_sign, last_sign
+            FROM sign_history_monthly
+            WHERE user_id = ?
+            ORDER BY month
+        ''', (user_id,))
+        return self.cursor.fetchall()
+        
+    def incremental_vacuum(self, pages: int) -> int:
+        """增量回收空闲页，仅在 auto_vacuum = INCREMENTAL 的数据库上生效
+        Returns:
+            回收前的空闲页数量，未启用增量模式时返回 0
+        """
+        self.cursor.execute('PRAGMA auto_vacuum')
+        if self.cursor.fetchone()[0] != 2:
+            return 0
+        self.cursor.execute('PRAGMA freelist_count')
+        free_pages = self.cursor.fetchone()[0]
+        if free_pages:
+            self.cursor.execute(f'PRAGMA incremental_vacuum({int(pages)})')
+            self.cursor.fetchall()
+        return free_pages
+        
+    def get_sign_request(self, request_key: str, since: int = 0, user_id: str = None) -> Optional[Dict[str, Any]]:
+        """获取已处理过的签到请求，用于消息重投时重放回复"""
+        self.cursor.execute('''
+            SELECT user_id, result, response, created_at FROM sign_requests
+            WHERE request_key = ? AND created_at >= ?
+        ''', (request_key, since))
+        row = self.cursor.fetchone()
+        if not row:
+            return None
+        return {
+            'user_id': row[0],
+            'result': json.loads(row[1]) if row[1] else None,
+            'response': row[2],
+            'created_at': row[3]
+        }
+        
+    def save_sign_request(self, request_key: str, user_id: str, result: Optional[Dict[str, Any]], response: str, created_at: int) -> bool:
+        """记录已处理的签到请求及其回复"""
+        try:
+            self.cursor.execute('''
+                INSERT OR REPLACE INTO sign_requests (request_key, user_id, result, response, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (request_key, user_id, json.dumps(result, ensure_ascii=False, default=str) if result is not None else None,
+                  response, created_at))
+            self._commit()
+            return True
+        except Exception as e:
+            self._rollback()
+            logger.error(f"记录签到请求失败: {str(e)}")
+            return False
+            
+    def purge_sign_requests(self, before: int) -> int:
+        """删除过期的签到请求记录"""
+        try:
+            self.cursor.execute('DELETE FROM sign_requests WHERE created_at < ?', (before,))
+            self._commit()
+            return self.cursor.rowcount
+        except Exception as e:
+            logger.error(f"清理签到请求失败: {str(e)}")
+            return 0
+            
+    @read_only
     def get_user_inventory(self, user_id: str) -> Dict[str, int]:
         """获取用户背包"""
         self.cursor.execute('SELECT item_name, quantity FROM inventory WHERE user_id = ?', (user_id,))
@@ -176,1597 +744,799 @@ class SignDatabase:
         elif quantity > 0:
             self.cursor.execute('INSERT INTO inventory (user_id, item_name, quantity) VALUES (?, ?, ?)', 
                               (user_id, item_name, quantity))
-        self.conn.commit()
+        self._commit()
         
 
+    @read_only
     def get_continuous_sign_ranking(self, limit: int = 10) -> List[tuple]:
         """获取连续签到排行榜（全局）
         按连续签到次数降序排列，次数相同的按照先来后到排序
+        Returns:
+            [(用户ID, 昵称, 连续天数, 称号), ...]
         """
-        self.cursor.execute('''
-            SELECT sd.user_id, un.user_name, sd.continuous_days 
-            FROM sign_data sd
-            LEFT JOIN user_names un ON sd.user_id = un.user_id
-            ORDER BY sd.continuous_days DESC, sd.last_sign ASC 
-            LIMIT ?
-        ''', (limit,))
-        return self.cursor.fetchall()
-        
+        return [(user_id, name, k1, title) for user_id, name, title, k1, _ in self.get_leaderboard('continuous', limit)]
+
+    @read_only
     def get_level_ranking(self, limit: int = 10) -> List[tuple]:
-        """获取等级排行榜（全局）"""
-        self.cursor.execute('''
-            SELECT sd.user_id, un.user_name, sd.level, sd.exp
-            FROM sign_data sd
-            LEFT JOIN user_names un ON sd.user_id = un.user_id
-            ORDER BY sd.level DESC, sd.exp DESC 
-            LIMIT ?
-        ''', (limit,))
-        return self.cursor.fetchall()
-        
+        """获取等级排行榜（全局）
+        Returns:
+            [(用户ID, 昵称, 等级, 经验, 称号), ...]
+        """
+        return [(user_id, name, k1, k2, title) for user_id, name, title, k1, k2 in self.get_leaderboard('level', limit)]
+
+    @read_only
     def get_world_sign_ranking(self, limit: int = 10) -> List[tuple]:
         """获取世界签到排行榜
         按总签到次数降序排列，次数相同则按当天签到时间早的排前面
+        Returns:
+            [(用户ID, 昵称, 总天数, 称号), ...]
         """
+        return [(user_id, name, k1, title) for user_id, name, title, k1, _ in self.get_leaderboard('world', limit)]
+
+    @read_only
+    def get_leaderboard(self, board: str, limit: int = 10) -> List[tuple]:
+        """读取物化排行榜，最多 LEADERBOARD_SIZE 名；榜还在迁移回填中生成时直接从来源表读取
+        Returns:
+            [(实体ID, 名称, 称号, k1, k2), ...]
+        """
+        limit = min(limit, self.LEADERBOARD_SIZE)
         self.cursor.execute('''
-            SELECT sd.user_id, un.user_name, sd.total_days
-            FROM sign_data sd
-            LEFT JOIN user_names un ON sd.user_id = un.user_id
-            ORDER BY sd.total_days DESC, sd.last_sign ASC
+            SELECT entity_id, name, title, k1, k2
+            FROM leaderboards
+            WHERE board = ? AND NOT EXISTS (SELECT 1 FROM leaderboard_meta WHERE board = ? AND rebuilt_at IS NULL)
+            ORDER BY k1 DESC, k2 DESC, entity_id
             LIMIT ?
+        ''', (board, board, limit))
+        rows = self.cursor.fetchall()
+        if rows:
+            return rows
+        self.cursor.execute('SELECT 1 FROM leaderboard_meta WHERE board = ? AND rebuilt_at IS NULL', (board,))
+        if not self.cursor.fetchone():
+            return []
+        # 榜还在回填生成中，直接从来源表读取
+        source, k1, k2 = self.LEADERBOARDS[board]
+        if source == 'user':
+            return [(user_id, name, title, c1, -int((c2 or '').replace('-', '') or 0) if k2 == 'last_sign' else c2)
+                    for user_id, name, title, c1, c2 in self.get_ranking_page(board, None, limit)]
+        self.cursor.execute(f'''
+            SELECT CAST(castle_id AS TEXT) AS entity_id, castle_name, '', {k1} AS k1, {self._board_k2_sql(k2)} AS k2
+            FROM castle_data
+            ORDER BY k1 DESC, k2 DESC, entity_id LIMIT ?
         ''', (limit,))
         return self.cursor.fetchall()
-        
-    def get_continuous_sign_rank(self, user_id: str) -> int:
-        """获取连续签到排名（修复版）"""
-        # 获取当前用户的连续签到天数
-        self.cursor.execute('SELECT continuous_days FROM sign_data WHERE user_id = ?', (user_id,))
-        user_continuous_days = self.cursor.fetchone()
-        if not user_continuous_days:
-            return 0
-        user_continuous_days = user_continuous_days[0]
-        
-        # 计算比当前用户连续签到天数多的用户数量
-        self.cursor.execute('''
-            SELECT COUNT(*) FROM sign_data 
-            WHERE continuous_days > ? 
-        ''', (user_continuous_days,))
-        row = self.cursor.fetchone()
-        
-        # 计算与当前用户相同天数但更早签到的用户数量
-        self.cursor.execute('''
-            SELECT COUNT(*) FROM sign_data sd1
-            JOIN sign_history sh1 ON sd1.user_id = sh1.user_id
-            WHERE sd1.continuous_days = ? 
-            AND sh1.timestamp < (
-                SELECT sh2.timestamp FROM sign_history sh2
-                WHERE sh2.user_id = ?
-                ORDER BY sh2.timestamp DESC LIMIT 1
-            )
-        ''', (user_continuous_days, user_id))
-        same_days_row = self.cursor.fetchone()
-        
-        return (row[0] if row else 0) + (same_days_row[0] if same_days_row else 0) + 1
-        
-    def get_group_sign_rank(self, group_id: str, user_id: str) -> int:
-        """获取群内签到排名（修复版）"""
-        # 如果没有群组ID，则返回世界排名
-        if not group_id:
-            return self.get_world_sign_rank(user_id)
-        
-        # 获取当前用户的总签到天数
-        self.cursor.execute('SELECT total_days FROM sign_data WHERE user_id = ?', (user_id,))
-        user_total_days = self.cursor.fetchone()
-        if not user_total_days:
-            return 0
-        user_total_days = user_total_days[0]
-        
-        # 计算群内比当前用户签到天数多的用户数量
-        self.cursor.execute('''
-            SELECT COUNT(*) FROM sign_data 
-            WHERE group_id = ? AND total_days > ? 
-        ''', (group_id, user_total_days))
-        row = self.cursor.fetchone()
-        
-        return row[0] + 1 if row else 1  # 排名 = 比自己多的用户数 + 1
-        
-    def get_world_sign_rank(self, user_id: str) -> int:
-        """获取世界签到排名（修复版）"""
-        # 获取当前用户的总签到天数
-        self.cursor.execute('SELECT total_days FROM sign_data WHERE user_id = ?', (user_id,))
-        user_total_days = self.cursor.fetchone()
-        if not user_total_days:
-            return 0
-        user_total_days = user_total_days[0]
-        
-        # 计算比当前用户签到天数多的用户数量
-        self.cursor.execute('''
-            SELECT COUNT(*) FROM sign_data 
-            WHERE total_days > ? 
-        ''', (user_total_days,))
-        row = self.cursor.fetchone()
-        
-        # 计算与当前用户相同天数但更早签到的用户数量
-        self.cursor.execute('''
-            SELECT COUNT(*) FROM sign_data sd1
-            JOIN sign_history sh1 ON sd1.user_id = sh1.user_id
-            WHERE sd1.total_days = ? 
-            AND sh1.timestamp < (
-                SELECT sh2.timestamp FROM sign_history sh2
-                WHERE sh2.user_id = ?
-                ORDER BY sh2.timestamp DESC LIMIT 1
-            )
-        ''', (user_total_days, user_id))
-        same_days_row = self.cursor.fetchone()
-        
-        return (row[0] if row else 0) + (same_days_row[0] if same_days_row else 0) + 1
-        
-    def close(self):
-        """关闭数据库连接"""
 
-        self.conn.close()
-        
-    def add_user_title(self, user_id: str, title: str):
-        """为用户添加称号"""
-        try:
+    def _keyset_branches(self, board: str, key: tuple, before: bool) -> List[tuple]:
+        """把排序键比较拆成多个可以走索引的区间
+        排序为各列按 RANKING_ORDERS 的方向、最后按 user_id 升序。对 (c1, c2, user_id) 之后（before 时为之前）的行，
+        依次生成 “前 i 列相等、第 i+1 列严格在后” 的条件，每个条件都是索引上的一段连续区间，按顺序拼接即为有序结果。
+        Returns:
+            [(where 子句, 参数), ...]，按结果顺序排列
+        """
+        columns = self.RANKING_ORDERS[board] + [('user_id', 'ASC')]
+        branches = []
+        for i in range(len(columns) - 1, -1, -1):
+            conditions = [f"{column} = ?" for column, _ in columns[:i]]
+            column, direction = columns[i]
+            after = '>' if direction == 'ASC' else '<'
+            conditions.append(f"{column} {('<' if after == '>' else '>') if before else after} ?")
+            branches.append((' AND '.join(conditions), key[:i + 1]))
+        return branches
+
+    def _ranking_order(self, board: str, reverse: bool = False) -> str:
+        columns = self.RANKING_ORDERS[board] + [('user_id', 'ASC')]
+        if reverse:
+            columns = [(column, 'DESC' if direction == 'ASC' else 'ASC') for column, direction in columns]
+        return ', '.join(f"{column} {direction}" for column, direction in columns)
+
+    @staticmethod
+    def _ranking_scope(group_id: Optional[str]) -> Tuple[str, List[str], tuple]:
+        """排行范围：全服为 sign_data；群内为 group_members，group_id 是其排序索引的第一列
+        Returns:
+            (表名, 范围条件, 条件参数)
+        """
+        if group_id:
+            return 'group_members', ['group_id = ?'], (group_id,)
+        return 'sign_data', [], ()
+
+    def _seek_ranking(self, board: str, key: Optional[tuple], limit: int, offset: int = 0, before: bool = False,
+                      group_id: str = None) -> List[tuple]:
+        """从排序键 key 之后（before 时为之前，按反向顺序）跳过 offset 行取 limit 行，key 为空时从榜首开始
+        只扫描排序索引上的 offset + limit 个条目；传入 group_id 时只在该群成员中排行
+        """
+        table, scope, scope_params = self._ranking_scope(group_id)
+        order = self._ranking_order(board, reverse=before)
+        select_columns = ', '.join(column for column, _ in self.RANKING_ORDERS[board]) + ', user_id'
+        if key is None:
+            where = f"WHERE {' AND '.join(scope)}" if scope else ''
             self.cursor.execute(
-                'INSERT OR IGNORE INTO user_titles (user_id, title) VALUES (?, ?)', 
-                (user_id, title)
+                f"SELECT {select_columns} FROM {table} {where} ORDER BY {order} LIMIT ? OFFSET ?",
+                (*scope_params, limit, offset)
             )
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"添加用户称号失败: {str(e)}")
-            return False
-            
-    def get_user_titles(self, user_id: str) -> List[tuple]:
-        """获取用户的所有称号"""
-        self.cursor.execute('SELECT title, is_active FROM user_titles WHERE user_id = ?', (user_id,))
-        return self.cursor.fetchall()
-        
-    def activate_title(self, user_id: str, title: str):
-        """激活用户称号"""
+            return self.cursor.fetchall()
+        parts, params = [], []
+        for where, values in self._keyset_branches(board, key, before):
+            parts.append(
+                f"SELECT * FROM (SELECT {select_columns} FROM {table} WHERE {' AND '.join(scope + [where])} "
+                f"ORDER BY {order} LIMIT ?)"
+            )
+            params.extend([*scope_params, *values, limit + offset])
         self.cursor.execute(
-            'UPDATE user_titles SET is_active = 1 WHERE user_id = ? AND title = ?', 
-            (user_id, title)
+            f"SELECT * FROM ({' UNION ALL '.join(parts)}) ORDER BY {order} LIMIT ? OFFSET ?",
+            (*params, limit, offset)
         )
-        self.conn.commit()
-        
-    def deactivate_all_titles(self, user_id: str):
-        """取消激活用户的所有称号"""
+        return self.cursor.fetchall()
+
+    @read_only
+    def get_ranking_page(self, board: str, after: Optional[tuple], limit: int = 10, group_id: str = None) -> List[tuple]:
+        """键集分页读取排行榜（world / continuous / level）
+        Args:
+            after: 上一页最后一行的排序键 (列1, 列2, user_id)，为空时从榜首开始
+            group_id: 传入时读取群内排行榜
+        Returns:
+            [(用户ID, 昵称, 称号, 列1, 列2), ...]
+        """
+        keys = self._seek_ranking(board, after, limit, group_id=group_id)
+        if not keys:
+            return []
+        user_ids = [row[-1] for row in keys]
+        names = self.get_user_names(user_ids)
+        titles = self.get_active_titles(user_ids)
+        return [(user_id, names[user_id], titles[user_id], c1, c2)
+                for c1, c2, user_id in keys]
+
+    @read_only
+    def get_ranking_keys(self, board: str, key: Optional[tuple], limit: int, offset: int = 0, before: bool = False,
+                         group_id: str = None) -> List[tuple]:
+        """排序键 key 之后（before 时为之前，按反向顺序）跳过 offset 行的 limit 个排序键 [(列1, 列2, user_id), ...]"""
+        return [tuple(row) for row in self._seek_ranking(board, key, limit, offset, before, group_id)]
+
+    @read_only
+    def seek_ranking_key(self, board: str, key: Optional[tuple], offset: int = 0, before: bool = False,
+                         group_id: str = None) -> Optional[tuple]:
+        """排序键 key 之后（before 时为之前）第 offset + 1 行的排序键，不存在时返回 None"""
+        rows = self._seek_ranking(board, key, 1, offset, before, group_id)
+        return tuple(rows[0]) if rows else None
+
+    @read_only
+    def get_ranking_key(self, board: str, user_id: str, group_id: str = None) -> Optional[tuple]:
+        """用户在排行榜上的排序键 (列1, 列2, user_id)，传入 group_id 时用户不是群成员则返回 None"""
+        table, scope, scope_params = self._ranking_scope(group_id)
+        columns = ', '.join(column for column, _ in self.RANKING_ORDERS[board])
         self.cursor.execute(
-            'UPDATE user_titles SET is_active = 0 WHERE user_id = ?', 
-            (user_id,)
+            f"SELECT {columns}, user_id FROM {table} WHERE {' AND '.join(scope + ['user_id = ?'])}",
+            (*scope_params, user_id)
         )
-        self.conn.commit()
-        
-    def get_active_title(self, user_id: str) -> str:
-        """获取用户当前激活的称号"""
+        row = self.cursor.fetchone()
+        return tuple(row) if row else None
+
+    @read_only
+    def count_ranking_before(self, board: str, key: tuple, group_id: str = None) -> int:
+        """排在排序键 key 之前的行数（即名次减一），每段只在排序索引上计数"""
+        table, scope, scope_params = self._ranking_scope(group_id)
+        branches = self._keyset_branches(board, key, before=True)
         self.cursor.execute(
-            'SELECT title FROM user_titles WHERE user_id = ? AND is_active = 1', 
-            (user_id,)
+            'SELECT ' + ' + '.join(
+                f"(SELECT COUNT(*) FROM {table} WHERE {' AND '.join(scope + [where])})" for where, _ in branches
+            ),
+            tuple(value for _, values in branches for value in (*scope_params, *values))
         )
-        row = self.cursor.fetchone()
-        return row[0] if row else ""
+        return self.cursor.fetchone()[0]
 
-    def get_castle_by_group(self, group_id: str) -> Optional[Dict[str, Any]]:
-        """根据群组ID获取城堡信息"""
-        self.cursor.execute('SELECT * FROM castle_data WHERE group_id = ?', (group_id,))
-        row = self.cursor.fetchone()
-        if not row:
-            return None
-        
-        columns = ['castle_id', 'group_id', 'castle_name', 'level', 'exp', 'coins', 'lord_id', 'managers', 'members', 'created_date']
-        result = dict(zip(columns, row))
-        
-        # 解析JSON字段
-        try:
-            result['managers'] = json.loads(result['managers'])
-        except:
-            result['managers'] = []
-            
+    @read_only
+    def count_users(self, group_id: str = None) -> int:
+        """参与排行的用户数，传入 group_id 时为群成员数"""
+        table, scope, scope_params = self._ranking_scope(group_id)
+        where = f"WHERE {' AND '.join(scope)}" if scope else ''
+        self.cursor.execute(f'SELECT COUNT(*) FROM {table} {where}', scope_params)
+        return self.cursor.fetchone()[0]
+
+    @read_only
+    def get_group_rank(self, group_id: str, board: str, user_id: str) -> int:
+        """群内名次，用户不是群成员时返回 0"""
+        key = self.get_ranking_key(board, user_id, group_id)
+        if key is None:
+            return 0
+        return self.count_ranking_before(board, key, group_id) + 1
+
+    def rebuild_leaderboards(self, boards: List[str] = None) -> Dict[str, int]:
+        """从 sign_data / castle_data 全量重建物化排行榜，用于修复
+        Returns:
+            {榜名: 行数}，失败时返回空字典
+        """
         try:
-            result['members'] = json.loads(result['members'])
-        except:
-            result['members'] = []
-            
-        return result
-    
-    def get_castle_ranking(self, limit: int = 10) -> List[tuple]:
-        """获取城堡等级排行榜"""
-        self.cursor.execute('''
-            SELECT castle_id, castle_name, level, exp
-            FROM castle_data
-            ORDER BY level DESC, exp DESC
-            LIMIT ?
-        ''', (limit,))
-        return self.cursor.fetchall()
-    
-    def get_castle_coin_ranking(self, limit: int = 10) -> List[tuple]:
-        """获取城堡金币排行榜"""
+            counts = {board: self._rebuild_board(board) for board in boards or self.LEADERBOARDS}
+            self._commit()
+            return counts
+        except Exception as e:
+            self._rollback()
+            self._board_states.clear()
+            logger.error(f"重建排行榜失败: {str(e)}")
+            return {}
+
+    @staticmethod
+    def _board_k2_sql(k2: Optional[str]) -> str:
+        """榜的次排序列在来源表上的表达式"""
+        return "-CAST(REPLACE(last_sign, '-', '') AS INTEGER)" if k2 == 'last_sign' else (k2 or '0')
+
+    def _rebuild_board(self, board: str) -> int:
+        """在当前事务中重建一个榜，保留前 LEADERBOARD_CAPACITY 名"""
+        source, k1, k2 = self.LEADERBOARDS[board]
+        k2_sql = self._board_k2_sql(k2)
+        self.cursor.execute('DELETE FROM leaderboards WHERE board = ?', (board,))
+        if source == 'user':
+            self.cursor.execute(f'''
+                INSERT INTO leaderboards (board, entity_id, name, title, k1, k2)
+                SELECT ?, top.user_id, un.user_name,
+                    COALESCE((SELECT title FROM user_titles WHERE user_id = top.user_id AND is_active = 1 LIMIT 1), ''),
+                    top.k1, top.k2
+                FROM (
+                    SELECT user_id, {k1} AS k1, {k2_sql} AS k2 FROM sign_data
+                    ORDER BY k1 DESC, k2 DESC, user_id LIMIT ?
+                ) top
+                LEFT JOIN user_names un ON un.user_id = top.user_id
+            ''', (board, self.LEADERBOARD_CAPACITY))
+        else:
+            self.cursor.execute(f'''
+                INSERT INTO leaderboards (board, entity_id, name, title, k1, k2)
+                SELECT ?, top.entity_id, top.castle_name, '', top.k1, top.k2
+                FROM (
+                    SELECT CAST(castle_id AS TEXT) AS entity_id, castle_name, {k1} AS k1, {k2_sql} AS k2 FROM castle_data
+                    ORDER BY k1 DESC, k2 DESC, entity_id LIMIT ?
+                ) top
+            ''', (board, self.LEADERBOARD_CAPACITY))
+        count = self.cursor.rowcount
         self.cursor.execute('''
-            SELECT castle_id, castle_name, coins
-            FROM castle_data
-            ORDER BY coins DESC
-            LIMIT ?
-        ''', (limit,))
-        return self.cursor.fetchall()
-    
-    def check_castle_name_exists(self, castle_name: str) -> bool:
-        """检查城堡名称是否已存在"""
-        self.cursor.execute('SELECT castle_id FROM castle_data WHERE castle_name = ?', (castle_name,))
-        return self.cursor.fetchone() is not None
-    
-    def get_castle_id_by_group(self, group_id: str) -> Optional[int]:
-        """根据群组ID获取城堡编号"""
-        self.cursor.execute('SELECT castle_id FROM castle_data WHERE group_id = ?', (group_id,))
-        row = self.cursor.fetchone()
-        return row[0] if row else None
-    
-    def create_castle(self, group_id: str, castle_name: str, creator_id: str, participant_ids: List[str] = None) -> bool:
-        """创建城堡，创建人和5个参与用户自动加入城堡"""
-        try:
-            # 初始化成员列表，包含创建者和参与者
-            members = [creator_id]
-            if participant_ids:
-                # 限制最多5个参与者
-                members.extend(participant_ids[:5])
-            
-            self.cursor.execute('''
-                INSERT INTO castle_data (group_id, castle_name, members) 
-                VALUES (?, ?, ?)
-            ''', (group_id, castle_name, json.dumps(members)))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"创建城堡失败: {str(e)}")
-            return False
-    
-    def join_castle(self, group_id: str, user_id: str) -> bool:
-        """加入城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否已经是成员
-            if user_id in castle['members']:
-                return False
-            
-            # 添加用户到成员列表
-            castle['members'].append(user_id)
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET members = ? 
-                WHERE group_id = ?
-            ''', (json.dumps(castle['members']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"加入城堡失败: {str(e)}")
-            return False
-    
-    def leave_castle(self, group_id: str, user_id: str) -> bool:
-        """退出城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否是成员
-            if user_id not in castle['members']:
-                return False
-            
-            # 从成员列表中移除用户
-            castle['members'].remove(user_id)
-            
-            # 如果是领主，清空领主ID
-            if castle['lord_id'] == user_id:
-                self.cursor.execute('''
-                    UPDATE castle_data 
-                    SET members = ?, lord_id = NULL 
-                    WHERE group_id = ?
-                ''', (json.dumps(castle['members']), group_id))
-            # 如果是总管，从总管列表中移除
-            elif user_id in castle['managers']:
-                castle['managers'].remove(user_id)
-                self.cursor.execute('''
-                    UPDATE castle_data 
-                    SET members = ?, managers = ? 
-                    WHERE group_id = ?
-                ''', (json.dumps(castle['members']), json.dumps(castle['managers']), group_id))
-            else:
-                self.cursor.execute('''
-                    UPDATE castle_data 
-                    SET members = ? 
-                    WHERE group_id = ?
-                ''', (json.dumps(castle['members']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"退出城堡失败: {str(e)}")
-            return False
-    
-    def upgrade_castle(self, group_id: str, exp_cost: int, coin_cost: int) -> bool:
-        """升级城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查资源是否足够
-            if castle['exp'] < exp_cost or castle['coins'] < coin_cost:
-                return False
-            
-            # 扣除资源并升级
-            new_level = castle['level'] + 1
-            new_exp = castle['exp'] - exp_cost
-            new_coins = castle['coins'] - coin_cost
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET level = ?, exp = ?, coins = ? 
-                WHERE group_id = ?
-            ''', (new_level, new_exp, new_coins, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"升级城堡失败: {str(e)}")
-            return False
-    
-    def donate_coins(self, group_id: str, user_id: str, amount: int) -> bool:
-        """捐献金币到城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 增加城堡金币
-            new_coins = castle['coins'] + amount
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET coins = ? 
-                WHERE group_id = ?
-            ''', (new_coins, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"捐献金币失败: {str(e)}")
-            return False
-    
-    def add_castle_exp(self, group_id: str, exp: int) -> bool:
-        """增加城堡经验"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 增加城堡经验
-            new_exp = castle['exp'] + exp
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET exp = ? 
-                WHERE group_id = ?
-            ''', (new_exp, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"增加城堡经验失败: {str(e)}")
-            return False
-    
-    def elect_lord(self, group_id: str, user_id: str) -> bool:
-        """选举领主"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否是成员
-            if user_id not in castle['members']:
-                return False
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET lord_id = ? 
-                WHERE group_id = ?
-            ''', (user_id, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"选举领主失败: {str(e)}")
-            return False
-    
-    def elect_manager(self, group_id: str, user_id: str) -> bool:
-        """选举总管"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否是成员
-            if user_id not in castle['members']:
-                return False
-            
-            # 检查是否已经是总管
-            if user_id in castle['managers']:
-                return False
-            
-            # 添加到总管列表
-            castle['managers'].append(user_id)
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET managers = ? 
-                WHERE group_id = ?
-            ''', (json.dumps(castle['managers']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"选举总管失败: {str(e)}")
-            return False
-    
-    def dismiss_manager(self, group_id: str, user_id: str) -> bool:
-        """罢免总管"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查是否是总管
-            if user_id not in castle['managers']:
-                return False
-            
-            # 从总管列表中移除
-            castle['managers'].remove(user_id)
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET managers = ? 
-                WHERE group_id = ?
-            ''', (json.dumps(castle['managers']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"罢免总管失败: {str(e)}")
-            return False
-    
-    def destroy_castle(self, group_id: str) -> bool:
-        """拆除城堡"""
-        try:
-            self.cursor.execute('DELETE FROM castle_data WHERE group_id = ?', (group_id,))
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"拆除城堡失败: {str(e)}")
-            return False
-    
-    def get_castle_ranking(self, limit: int = 10) -> List[tuple]:
-        """获取城堡等级排行榜"""
-        self.cursor.execute('''
-            SELECT castle_id, castle_name, level, exp
-            FROM castle_data
-            ORDER BY level DESC, exp DESC
-            LIMIT ?
-        ''', (limit,))
-        return self.cursor.fetchall()
-    
-    def get_castle_coin_ranking(self, limit: int = 10) -> List[tuple]:
-        """获取城堡金币排行榜"""
-        self.cursor.execute('''
-            SELECT castle_id, castle_name, coins
-            FROM castle_data
-            ORDER BY coins DESC
-            LIMIT ?
-        ''', (limit,))
-        return self.cursor.fetchall()
-    
-    def get_castle_by_group(self, group_id: str) -> Optional[Dict[str, Any]]:
-        """根据群组ID获取城堡信息"""
-        self.cursor.execute('SELECT * FROM castle_data WHERE group_id = ?', (group_id,))
-        row = self.cursor.fetchone()
-        if not row:
-            return None
-        
-        columns = ['castle_id', 'group_id', 'castle_name', 'level', 'exp', 'coins', 'lord_id', 'managers', 'members', 'created_date']
-        result = dict(zip(columns, row))
-        
-        # 解析JSON字段
-        try:
-            result['managers'] = json.loads(result['managers'])
-        except:
-            result['managers'] = []
-            
-        try:
-            result['members'] = json.loads(result['members'])
-        except:
-            result['members'] = []
-            
-        return result
-    
-
-    
-    def join_castle(self, group_id: str, user_id: str) -> bool:
-        """加入城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否已经是成员
-            if user_id in castle['members']:
-                return False
-            
-            # 添加用户到成员列表
-            castle['members'].append(user_id)
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET members = ? 
-                WHERE group_id = ?
-            ''', (json.dumps(castle['members']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"加入城堡失败: {str(e)}")
-            return False
-    
-    def leave_castle(self, group_id: str, user_id: str) -> bool:
-        """退出城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否是成员
-            if user_id not in castle['members']:
-                return False
-            
-            # 从成员列表中移除用户
-            castle['members'].remove(user_id)
-            
-            # 如果是领主，清空领主ID
-            if castle['lord_id'] == user_id:
-                self.cursor.execute('''
-                    UPDATE castle_data 
-                    SET members = ?, lord_id = NULL 
-                    WHERE group_id = ?
-                ''', (json.dumps(castle['members']), group_id))
-            # 如果是总管，从总管列表中移除
-            elif user_id in castle['managers']:
-                castle['managers'].remove(user_id)
-                self.cursor.execute('''
-                    UPDATE castle_data 
-                    SET members = ?, managers = ? 
-                    WHERE group_id = ?
-                ''', (json.dumps(castle['members']), json.dumps(castle['managers']), group_id))
-            else:
-                self.cursor.execute('''
-                    UPDATE castle_data 
-                    SET members = ? 
-                    WHERE group_id = ?
-                ''', (json.dumps(castle['members']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"退出城堡失败: {str(e)}")
-            return False
-    
-    def upgrade_castle(self, group_id: str, exp_cost: int, coin_cost: int) -> bool:
-        """升级城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查资源是否足够
-            if castle['exp'] < exp_cost or castle['coins'] < coin_cost:
-                return False
-            
-            # 扣除资源并升级
-            new_level = castle['level'] + 1
-            new_exp = castle['exp'] - exp_cost
-            new_coins = castle['coins'] - coin_cost
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET level = ?, exp = ?, coins = ? 
-                WHERE group_id = ?
-            ''', (new_level, new_exp, new_coins, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"升级城堡失败: {str(e)}")
-            return False
-    
-    def donate_coins(self, group_id: str, user_id: str, amount: int) -> bool:
-        """捐献金币到城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 增加城堡金币
-            new_coins = castle['coins'] + amount
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET coins = ? 
-                WHERE group_id = ?
-            ''', (new_coins, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"捐献金币失败: {str(e)}")
-            return False
-    
-    def add_castle_exp(self, group_id: str, exp: int) -> bool:
-        """增加城堡经验"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 增加城堡经验
-            new_exp = castle['exp'] + exp
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET exp = ? 
-                WHERE group_id = ?
-            ''', (new_exp, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"增加城堡经验失败: {str(e)}")
-            return False
-    
-    def elect_lord(self, group_id: str, user_id: str) -> bool:
-        """选举领主"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否是成员
-            if user_id not in castle['members']:
-                return False
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET lord_id = ? 
-                WHERE group_id = ?
-            ''', (user_id, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"选举领主失败: {str(e)}")
-            return False
-    
-    def elect_manager(self, group_id: str, user_id: str) -> bool:
-        """选举总管"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否是成员
-            if user_id not in castle['members']:
-                return False
-            
-            # 检查是否已经是总管
-            if user_id in castle['managers']:
-                return False
-            
-            # 添加到总管列表
-            castle['managers'].append(user_id)
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET managers = ? 
-                WHERE group_id = ?
-            ''', (json.dumps(castle['managers']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"选举总管失败: {str(e)}")
-            return False
-    
-    def dismiss_manager(self, group_id: str, user_id: str) -> bool:
-        """罢免总管"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查是否是总管
-            if user_id not in castle['managers']:
-                return False
-            
-            # 从总管列表中移除
-            castle['managers'].remove(user_id)
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET managers = ? 
-                WHERE group_id = ?
-            ''', (json.dumps(castle['managers']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"罢免总管失败: {str(e)}")
-            return False
-    
-    def destroy_castle(self, group_id: str) -> bool:
-        """拆除城堡"""
-        try:
-            self.cursor.execute('DELETE FROM castle_data WHERE group_id = ?', (group_id,))
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"拆除城堡失败: {str(e)}")
-            return False
-    
-    def get_castle_ranking(self, limit: int = 10) -> List[tuple]:
-        """获取城堡等级排行榜"""
-        self.cursor.execute('''
-            SELECT castle_id, castle_name, level, exp
-            FROM castle_data
-            ORDER BY level DESC, exp DESC
-            LIMIT ?
-        ''', (limit,))
-        return self.cursor.fetchall()
-    
-    def get_castle_coin_ranking(self, limit: int = 10) -> List[tuple]:
-        """获取城堡金币排行榜"""
-        self.cursor.execute('''
-            SELECT castle_id, castle_name, coins
-            FROM castle_data
-            ORDER BY coins DESC
-            LIMIT ?
-        ''', (limit,))
-        return self.cursor.fetchall()
-    
-    def get_castle_by_group(self, group_id: str) -> Optional[Dict[str, Any]]:
-        """根据群组ID获取城堡信息"""
-        self.cursor.execute('SELECT * FROM castle_data WHERE group_id = ?', (group_id,))
-        row = self.cursor.fetchone()
-        if not row:
-            return None
-        
-        columns = ['castle_id', 'group_id', 'castle_name', 'level', 'exp', 'coins', 'lord_id', 'managers', 'members', 'created_date']
-        result = dict(zip(columns, row))
-        
-        # 解析JSON字段
-        try:
-            result['managers'] = json.loads(result['managers'])
-        except:
-            result['managers'] = []
-            
-        try:
-            result['members'] = json.loads(result['members'])
-        except:
-            result['members'] = []
-            
-        return result
-    
-
-    
-    def join_castle(self, group_id: str, user_id: str) -> bool:
-        """加入城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否已经是成员
-            if user_id in castle['members']:
-                return False
-            
-            # 添加用户到成员列表
-            castle['members'].append(user_id)
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET members = ? 
-                WHERE group_id = ?
-            ''', (json.dumps(castle['members']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"加入城堡失败: {str(e)}")
-            return False
-    
-    def leave_castle(self, group_id: str, user_id: str) -> bool:
-        """退出城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否是成员
-            if user_id not in castle['members']:
-                return False
-            
-            # 从成员列表中移除用户
-            castle['members'].remove(user_id)
-            
-            # 如果是领主，清空领主ID
-            if castle['lord_id'] == user_id:
-                self.cursor.execute('''
-                    UPDATE castle_data 
-                    SET members = ?, lord_id = NULL 
-                    WHERE group_id = ?
-                ''', (json.dumps(castle['members']), group_id))
-            # 如果是总管，从总管列表中移除
-            elif user_id in castle['managers']:
-                castle['managers'].remove(user_id)
-                self.cursor.execute('''
-                    UPDATE castle_data 
-                    SET members = ?, managers = ? 
-                    WHERE group_id = ?
-                ''', (json.dumps(castle['members']), json.dumps(castle['managers']), group_id))
-            else:
-                self.cursor.execute('''
-                    UPDATE castle_data 
-                    SET members = ? 
-                    WHERE group_id = ?
-                ''', (json.dumps(castle['members']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"退出城堡失败: {str(e)}")
-            return False
-    
-    def upgrade_castle(self, group_id: str, exp_cost: int, coin_cost: int) -> bool:
-        """升级城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查资源是否足够
-            if castle['exp'] < exp_cost or castle['coins'] < coin_cost:
-                return False
-            
-            # 扣除资源并升级
-            new_level = castle['level'] + 1
-            new_exp = castle['exp'] - exp_cost
-            new_coins = castle['coins'] - coin_cost
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET level = ?, exp = ?, coins = ? 
-                WHERE group_id = ?
-            ''', (new_level, new_exp, new_coins, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"升级城堡失败: {str(e)}")
-            return False
-    
-    def donate_coins(self, group_id: str, user_id: str, amount: int) -> bool:
-        """捐献金币到城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 增加城堡金币
-            new_coins = castle['coins'] + amount
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET coins = ? 
-                WHERE group_id = ?
-            ''', (new_coins, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"捐献金币失败: {str(e)}")
-            return False
-    
-    def add_castle_exp(self, group_id: str, exp: int) -> bool:
-        """增加城堡经验"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 增加城堡经验
-            new_exp = castle['exp'] + exp
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET exp = ? 
-                WHERE group_id = ?
-            ''', (new_exp, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"增加城堡经验失败: {str(e)}")
-            return False
-    
-    def elect_lord(self, group_id: str, user_id: str) -> bool:
-        """选举领主"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否是成员
-            if user_id not in castle['members']:
-                return False
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET lord_id = ? 
-                WHERE group_id = ?
-            ''', (user_id, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"选举领主失败: {str(e)}")
-            return False
-    
-    def elect_manager(self, group_id: str, user_id: str) -> bool:
-        """选举总管"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否是成员
-            if user_id not in castle['members']:
-                return False
-            
-            # 检查是否已经是总管
-            if user_id in castle['managers']:
-                return False
-            
-            # 添加到总管列表
-            castle['managers'].append(user_id)
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET managers = ? 
-                WHERE group_id = ?
-            ''', (json.dumps(castle['managers']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"选举总管失败: {str(e)}")
-            return False
-    
-    def dismiss_manager(self, group_id: str, user_id: str) -> bool:
-        """罢免总管"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查是否是总管
-            if user_id not in castle['managers']:
-                return False
-            
-            # 从总管列表中移除
-            castle['managers'].remove(user_id)
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET managers = ? 
-                WHERE group_id = ?
-            ''', (json.dumps(castle['managers']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"罢免总管失败: {str(e)}")
-            return False
-    
-    def destroy_castle(self, group_id: str) -> bool:
-        """拆除城堡"""
-        try:
-            self.cursor.execute('DELETE FROM castle_data WHERE group_id = ?', (group_id,))
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"拆除城堡失败: {str(e)}")
-            return False
-    
-    def get_castle_ranking(self, limit: int = 10) -> List[tuple]:
-        """获取城堡等级排行榜"""
-        self.cursor.execute('''
-            SELECT castle_id, castle_name, level, exp
-            FROM castle_data
-            ORDER BY level DESC, exp DESC
-            LIMIT ?
-        ''', (limit,))
-        return self.cursor.fetchall()
-    
-    def get_castle_coin_ranking(self, limit: int = 10) -> List[tuple]:
-        """获取城堡金币排行榜"""
-        self.cursor.execute('''
-            SELECT castle_id, castle_name, coins
-            FROM castle_data
-            ORDER BY coins DESC
-            LIMIT ?
-        ''', (limit,))
-        return self.cursor.fetchall()
-    
-    def get_castle_by_group(self, group_id: str) -> Optional[Dict[str, Any]]:
-        """根据群组ID获取城堡信息"""
-        self.cursor.execute('SELECT * FROM castle_data WHERE group_id = ?', (group_id,))
-        row = self.cursor.fetchone()
-        if not row:
-            return None
-        
-        columns = ['castle_id', 'group_id', 'castle_name', 'level', 'exp', 'coins', 'lord_id', 'managers', 'members', 'created_date']
-        result = dict(zip(columns, row))
-        
-        # 解析JSON字段
-        try:
-            result['managers'] = json.loads(result['managers'])
-        except:
-            result['managers'] = []
-            
-        try:
-            result['members'] = json.loads(result['members'])
-        except:
-            result['members'] = []
-            
-        return result
-    
-
-    
-    def join_castle(self, group_id: str, user_id: str) -> bool:
-        """加入城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否已经是成员
-            if user_id in castle['members']:
-                return False
-            
-            # 添加用户到成员列表
-            castle['members'].append(user_id)
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET members = ? 
-                WHERE group_id = ?
-            ''', (json.dumps(castle['members']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"加入城堡失败: {str(e)}")
-            return False
-    
-    def leave_castle(self, group_id: str, user_id: str) -> bool:
-        """退出城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否是成员
-            if user_id not in castle['members']:
-                return False
-            
-            # 从成员列表中移除用户
-            castle['members'].remove(user_id)
-            
-            # 如果是领主，清空领主ID
-            if castle['lord_id'] == user_id:
-                self.cursor.execute('''
-                    UPDATE castle_data 
-                    SET members = ?, lord_id = NULL 
-                    WHERE group_id = ?
-                ''', (json.dumps(castle['members']), group_id))
-            # 如果是总管，从总管列表中移除
-            elif user_id in castle['managers']:
-                castle['managers'].remove(user_id)
-                self.cursor.execute('''
-                    UPDATE castle_data 
-                    SET members = ?, managers = ? 
-                    WHERE group_id = ?
-                ''', (json.dumps(castle['members']), json.dumps(castle['managers']), group_id))
-            else:
-                self.cursor.execute('''
-                    UPDATE castle_data 
-                    SET members = ? 
-                    WHERE group_id = ?
-                ''', (json.dumps(castle['members']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"退出城堡失败: {str(e)}")
-            return False
-    
-    def upgrade_castle(self, group_id: str, exp_cost: int, coin_cost: int) -> bool:
-        """升级城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查资源是否足够
-            if castle['exp'] < exp_cost or castle['coins'] < coin_cost:
-                return False
-            
-            # 扣除资源并升级
-            new_level = castle['level'] + 1
-            new_exp = castle['exp'] - exp_cost
-            new_coins = castle['coins'] - coin_cost
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET level = ?, exp = ?, coins = ? 
-                WHERE group_id = ?
-            ''', (new_level, new_exp, new_coins, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"升级城堡失败: {str(e)}")
-            return False
-    
-    def donate_coins(self, group_id: str, user_id: str, amount: int) -> bool:
-        """捐献金币到城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 增加城堡金币
-            new_coins = castle['coins'] + amount
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET coins = ? 
-                WHERE group_id = ?
-            ''', (new_coins, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"捐献金币失败: {str(e)}")
-            return False
-    
-    def add_castle_exp(self, group_id: str, exp: int) -> bool:
-        """增加城堡经验"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 增加城堡经验
-            new_exp = castle['exp'] + exp
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET exp = ? 
-                WHERE group_id = ?
-            ''', (new_exp, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"增加城堡经验失败: {str(e)}")
-            return False
-    
-    def elect_lord(self, group_id: str, user_id: str) -> bool:
-        """选举领主"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否是成员
-            if user_id not in castle['members']:
-                return False
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET lord_id = ? 
-                WHERE group_id = ?
-            ''', (user_id, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"选举领主失败: {str(e)}")
-            return False
-    
-    def elect_manager(self, group_id: str, user_id: str) -> bool:
-        """选举总管"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否是成员
-            if user_id not in castle['members']:
-                return False
-            
-            # 检查是否已经是总管
-            if user_id in castle['managers']:
-                return False
-            
-            # 添加到总管列表
-            castle['managers'].append(user_id)
-            
+            INSERT INTO leaderboard_meta (board, complete, rebuilt_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (board) DO UPDATE SET complete = excluded.complete, rebuilt_at = excluded.rebuilt_at
+        ''', (board, int(count < self.LEADERBOARD_CAPACITY)))
+        self._board_states.pop(board, None)
+        return count
+
+    def _backfill_leaderboards(self, table: str, lower: Optional[int], upper: Optional[int]) -> int:
+        """迁移回填的 step：从已有数据分批生成物化排行榜，在迁移的事务中执行、不提交
+        每批把来源表 rowid 在 (lower, upper] 内的实体按当前数据并入生成中的榜，再移出超过 LEADERBOARD_CAPACITY 的末位。
+        回填期间的写入照常增量维护这些榜。lower 为 None 时来源表已扫描完，把榜标记为已生成；
+        回填期间成员掉榜太多、保留的名次不够时改为全量重建。
+        Returns:
+            本批写入榜单的行数
+        """
+        source = 'user' if table == 'sign_data' else 'castle'
+        self._board_states.clear()
+        self.cursor.execute('SELECT board FROM leaderboard_meta WHERE rebuilt_at IS NULL')
+        boards = [row[0] for row in self.cursor.fetchall() if row[0] in self.LEADERBOARDS
+                  and self.LEADERBOARDS[row[0]][0] == source]
+        written = 0
+        for board in boards:
+            if lower is None:
+                state = self._get_board_state(board)
+                if not state['complete'] and state['count'] < self.LEADERBOARD_SIZE:
+                    self._rebuild_board(board)
+                else:
+                    self.cursor.execute(
+                        'UPDATE leaderboard_meta SET rebuilt_at = CURRENT_TIMESTAMP WHERE board = ?', (board,)
+                    )
+                continue
+            _, k1, k2 = self.LEADERBOARDS[board]
+            # 榜外已有实体时只并入排在末位之前的实体，保持榜外实体都在末位之后
+            state = self._get_board_state(board)
+            above, above_params = '', ()
+            if not state['complete'] and state['last'] is not None:
+                above = 'AND ((k1, k2) > (?, ?) OR ((k1, k2) = (?, ?) AND entity_id < ?))'
+                above_params = (*state['last'][:2], *state['last'])
+            if source == 'user':
+                self.cursor.execute(f'''
+                    INSERT INTO leaderboards (board, entity_id, name, title, k1, k2)
+                    SELECT ?, top.entity_id, un.user_name,
+                        COALESCE((SELECT title FROM user_titles WHERE user_id = top.entity_id AND is_active = 1 LIMIT 1), ''),
+                        top.k1, top.k2
+                    FROM (
+                        SELECT user_id AS entity_id, {k1} AS k1, {self._board_k2_sql(k2)} AS k2 FROM sign_data
+                        WHERE rowid > ? AND rowid <= ?
+                    ) top
+                    LEFT JOIN user_names un ON un.user_id = top.entity_id
+                    WHERE 1 {above}
+                    ON CONFLICT (board, entity_id) DO UPDATE SET k1 = excluded.k1, k2 = excluded.k2
+                ''', (board, lower, upper, *above_params))
+            else:
+                self.cursor.execute(f'''
+                    INSERT INTO leaderboards (board, entity_id, name, title, k1, k2)
+                    SELECT ?, entity_id, castle_name, '', k1, k2
+                    FROM (
+                        SELECT CAST(castle_id AS TEXT) AS entity_id, castle_name, {k1} AS k1, {self._board_k2_sql(k2)} AS k2
+                        FROM castle_data WHERE rowid > ? AND rowid <= ?
+                    )
+                    WHERE 1 {above}
+                    ON CONFLICT (board, entity_id) DO UPDATE SET k1 = excluded.k1, k2 = excluded.k2
+                ''', (board, lower, upper, *above_params))
+            written += max(0, self.cursor.rowcount)
             self.cursor.execute('''
-                UPDATE castle_data 
-                SET managers = ? 
-                WHERE group_id = ?
-            ''', (json.dumps(castle['managers']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"选举总管失败: {str(e)}")
-            return False
-    
-    def dismiss_manager(self, group_id: str, user_id: str) -> bool:
-        """罢免总管"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查是否是总管
-            if user_id not in castle['managers']:
-                return False
-            
-            # 从总管列表中移除
-            castle['managers'].remove(user_id)
-            
+                DELETE FROM leaderboards WHERE board = ? AND entity_id IN (
+                    SELECT entity_id FROM leaderboards WHERE board = ?
+                    ORDER BY k1 DESC, k2 DESC, entity_id LIMIT -1 OFFSET ?
+                )
+            ''', (board, board, self.LEADERBOARD_CAPACITY))
+            if self.cursor.rowcount:
+                self.cursor.execute('UPDATE leaderboard_meta SET complete = 0 WHERE board = ?', (board,))
+        self._board_states.clear()
+        return written
+
+    def _get_board_state(self, board: str) -> Dict[str, Any]:
+        """榜的行数、末位 (k1, k2, entity_id)、是否包含全部实体和是否在回填生成中，缓存到榜单变化为止
+        在写事务中调用，此时其他进程无法提交，检查 data_version 后缓存即可安全使用
+        """
+        version = self.data_version()
+        if version != self._board_version:
+            self._board_states.clear()
+            self._board_version = version
+        state = self._board_states.get(board)
+        if state is None:
             self.cursor.execute('''
-                UPDATE castle_data 
-                SET managers = ? 
-                WHERE group_id = ?
-            ''', (json.dumps(castle['managers']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"罢免总管失败: {str(e)}")
-            return False
-    
-    def destroy_castle(self, group_id: str) -> bool:
-        """拆除城堡"""
-        try:
-            self.cursor.execute('DELETE FROM castle_data WHERE group_id = ?', (group_id,))
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"拆除城堡失败: {str(e)}")
-            return False
-    
-    def get_castle_ranking(self, limit: int = 10) -> List[tuple]:
-        """获取城堡等级排行榜"""
-        self.cursor.execute('''
-            SELECT castle_id, castle_name, level, exp
-            FROM castle_data
-            ORDER BY level DESC, exp DESC
-            LIMIT ?
-        ''', (limit,))
-        return self.cursor.fetchall()
-    
-    def get_castle_coin_ranking(self, limit: int = 10) -> List[tuple]:
-        """获取城堡金币排行榜"""
+                SELECT COALESCE(meta.complete, 1), meta.board IS NOT NULL AND meta.rebuilt_at IS NULL,
+                    (SELECT COUNT(*) FROM leaderboards WHERE board = ?),
+                    last.k1, last.k2, last.entity_id
+                FROM (SELECT 1)
+                LEFT JOIN leaderboard_meta meta ON meta.board = ?
+                LEFT JOIN (
+                    SELECT k1, k2, entity_id FROM leaderboards WHERE board = ?
+                    ORDER BY k1, k2, entity_id DESC LIMIT 1
+                ) last
+            ''', (board, board, board))
+            complete, building, count, *last = self.cursor.fetchone()
+            state = self._board_states[board] = {
+                'complete': bool(complete),
+                'building': bool(building),
+                'count': count,
+                'last': tuple(last) if last[2] is not None else None,
+            }
+        return state
+
+    @staticmethod
+    def _ranks_above(a: tuple, b: tuple) -> bool:
+        """榜单条目 a=(k1, k2, entity_id) 是否排在 b 之前"""
+        if a[:2] != b[:2]:
+            return a[:2] > b[:2]
+        return a[2] < b[2]
+
+    @staticmethod
+    def _user_board_keys(data: Dict[str, Any]) -> Dict[str, tuple]:
+        last_sign = -int((data.get('last_sign') or '').replace('-', '') or 0)
+        return {
+            'world': (data.get('total_days') or 0, last_sign),
+            'continuous': (data.get('continuous_days') or 0, last_sign),
+            'level': (data.get('level') or 0, data.get('exp') or 0),
+        }
+
+    @staticmethod
+    def _castle_board_keys(castle: Dict[str, Any]) -> Dict[str, tuple]:
+        return {'castle_level': (castle['level'], castle['exp']), 'castle_coins': (castle['coins'], 0)}
+
+    def _user_board_labels(self, user_id: str) -> tuple:
+        """用户在榜上显示的 (昵称, 称号)"""
         self.cursor.execute('''
-            SELECT castle_id, castle_name, coins
-            FROM castle_data
-            ORDER BY coins DESC
-            LIMIT ?
-        ''', (limit,))
-        return self.cursor.fetchall()
-    
-    def get_castle_by_group(self, group_id: str) -> Optional[Dict[str, Any]]:
-        """根据群组ID获取城堡信息"""
-        self.cursor.execute('SELECT * FROM castle_data WHERE group_id = ?', (group_id,))
-        row = self.cursor.fetchone()
-        if not row:
-            return None
-        
-        columns = ['castle_id', 'group_id', 'castle_name', 'level', 'exp', 'coins', 'lord_id', 'managers', 'members', 'created_date']
-        result = dict(zip(columns, row))
-        
-        # 解析JSON字段
-        try:
-            result['managers'] = json.loads(result['managers'])
-        except:
-            result['managers'] = []
-            
-        try:
-            result['members'] = json.loads(result['members'])
-        except:
-            result['members'] = []
-            
-        return result
-    
+            SELECT (SELECT user_name FROM user_names WHERE user_id = ?),
+                COALESCE((SELECT title FROM user_titles WHERE user_id = ? AND is_active = 1 LIMIT 1), '')
+        ''', (user_id, user_id))
+        return self.cursor.fetchone()
 
-    
-    def join_castle(self, group_id: str, user_id: str) -> bool:
-        """加入城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否已经是成员
-            if user_id in castle['members']:
-                return False
-            
-            # 添加用户到成员列表
-            castle['members'].append(user_id)
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET members = ? 
-                WHERE group_id = ?
-            ''', (json.dumps(castle['members']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"加入城堡失败: {str(e)}")
-            return False
-    
-    def leave_castle(self, group_id: str, user_id: str) -> bool:
-        """退出城堡"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否是成员
-            if user_id not in castle['members']:
-                return False
-            
-            # 从成员列表中移除用户
-            castle['members'].remove(user_id)
-            
-            # 如果是领主，清空领主ID
-            if castle['lord_id'] == user_id:
-                self.cursor.execute('''
-                    UPDATE castle_data 
-                    SET members = ?, lord_id = NULL 
-                    WHERE group_id = ?
-                ''', (json.dumps(castle['members']), group_id))
-            # 如果是总管，从总管列表中移除
-            elif user_id in castle['managers']:
-                castle['managers'].remove(user_id)
-                self.cursor.execute('''
-                    UPDATE castle_data 
-                    SET members = ?, managers = ? 
-                    WHERE group_id = ?
-                ''', (json.dumps(castle['members']), json.dumps(castle['managers']), group_id))
-            else:
+    def _update_castle_boards(self, castle: Dict[str, Any], old_castle: Dict[str, Any] = None):
+        self._update_boards(
+            str(castle['castle_id']),
+            self._castle_board_keys(castle),
+            self._castle_board_keys(old_castle) if old_castle else None,
+            lambda: (castle['castle_name'], '')
+        )
+
+    def _update_boards(self, entity_id: str, keys: Dict[str, tuple], old_keys: Optional[Dict[str, tuple]],
+                       labels: Callable[[], tuple]):
+        """在当前事务中按实体的新排序键增量维护物化排行榜
+        不变式：榜上是按排序最靠前的若干实体，榜外实体都排在榜上末位之后；complete 的榜包含全部实体。
+        因此实体是否在榜上可以由写入前的排序键和末位直接判断，不需要额外查询。
+        回填生成中的榜只对已扫描过的实体成立，保留的名次不够时不重建，由回填完成时检查。
+        Args:
+            keys: {榜名: (k1, k2)}
+            old_keys: 写入前的排序键，新实体为 None
+            labels: 返回 (名称, 称号)，只在需要插入榜单时调用
+        """
+        label = None
+        for board, (k1, k2) in keys.items():
+            state = self._get_board_state(board)
+            last = state['last']
+            entry = (k1, k2, entity_id)
+            old = old_keys.get(board) if old_keys else None
+            member = old is not None and (
+                state['complete'] or (last is not None and not self._ranks_above(last, (*old, entity_id)))
+            )
+            if member:
+                if old == (k1, k2):
+                    continue
+                if not state['complete'] and self._ranks_above(last, entry):
+                    # 跌到原末位之后，榜外可能有实体排在他前面，移出榜单；保留的名次不够时重建
+                    self.cursor.execute('DELETE FROM leaderboards WHERE board = ? AND entity_id = ?', (board, entity_id))
+                    self._board_states.pop(board, None)
+                    if state['count'] - 1 < self.LEADERBOARD_SIZE and not state['building']:
+                        self._rebuild_board(board)
+                    continue
+                self.cursor.execute(
+                    'UPDATE leaderboards SET k1 = ?, k2 = ? WHERE board = ? AND entity_id = ?',
+                    (k1, k2, board, entity_id)
+                )
+                if not self.cursor.rowcount:
+                    # 生成中的榜上还没有回填扫描到的实体，由回填按写入后的数据加入
+                    continue
+                if last[2] == entity_id:
+                    # 原末位变化后不确定新的末位，下次重新读取
+                    self._board_states.pop(board, None)
+                elif self._ranks_above(last, entry):
+                    state['last'] = entry
+            elif state['complete'] or (last is not None and self._ranks_above(entry, last)):
+                label = label or labels()
                 self.cursor.execute('''
-                    UPDATE castle_data 
-                    SET members = ? 
-                    WHERE group_id = ?
-                ''', (json.dumps(castle['members']), group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"退出城堡失败: {str(e)}")
-            return False
-    
-    def upgrade_castle(self, group_id: str, exp_cost: int, coin_cost: int) -> bool:
-        """升级城堡"""
+                    INSERT INTO leaderboards (board, entity_id, name, title, k1, k2) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (board, entity_id) DO UPDATE SET k1 = excluded.k1, k2 = excluded.k2
+                ''', (board, entity_id, *label, k1, k2))
+                state['count'] += 1
+                if last is None or self._ranks_above(last, entry):
+                    state['last'] = entry
+                if state['count'] > self.LEADERBOARD_CAPACITY:
+                    # 超出容量，移出末位，此后榜外有实体
+                    self.cursor.execute(
+                        'DELETE FROM leaderboards WHERE board = ? AND entity_id = ?', (board, state['last'][2])
+                    )
+                    self.cursor.execute('UPDATE leaderboard_meta SET complete = 0 WHERE board = ?', (board,))
+                    self._board_states.pop(board, None)
+
+    def _remove_from_boards(self, entity_id: str, boards: tuple):
+        """实体被删除时移出榜单，保留的名次不够时重建"""
+        for board in boards:
+            state = self._get_board_state(board)
+            self.cursor.execute('DELETE FROM leaderboards WHERE board = ? AND entity_id = ?', (board, entity_id))
+            if self.cursor.rowcount:
+                self._board_states.pop(board, None)
+                if not state['complete'] and not state['building'] and state['count'] - 1 < self.LEADERBOARD_SIZE:
+                    self._rebuild_board(board)
+
+    def _refresh_board_title(self, user_id: str):
+        """同步用户在各榜上显示的称号"""
+        self.cursor.execute(f'''
+            UPDATE leaderboards
+            SET title = COALESCE((SELECT title FROM user_titles WHERE user_id = ? AND is_active = 1 LIMIT 1), '')
+            WHERE entity_id = ? AND board IN ({', '.join('?' * len(self.USER_BOARDS))})
+        ''', (user_id, user_id, *self.USER_BOARDS))
+
+    def data_version(self) -> int:
+        """写连接的 PRAGMA data_version，其他连接（包括其他进程）提交修改后变化
+        只读取连接状态，直接在连接上执行，不计入语句统计
+        """
+        return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    @read_only
+    def get_change_bounds(self) -> Tuple[int, int]:
+        """变更日志中现存的最小和最大 ID，日志为空时为 (0, 0)"""
+        self.cursor.execute('SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM change_log')
+        return tuple(self.cursor.fetchone())
+
+    @read_only
+    def get_changes(self, after_id: int, limit: int = 1000) -> List[tuple]:
+        """读取 ID 大于 after_id 的变更 [(id, 范围, 键), ...]"""
+        self.cursor.execute(
+            'SELECT id, scope, key FROM change_log WHERE id > ? ORDER BY id LIMIT ?', (after_id, limit)
+        )
+        return self.cursor.fetchall()
+
+    def prune_change_log(self, before: int) -> int:
+        """删除 created_at 早于 before(Unix 秒) 的变更日志，返回删除的行数"""
         try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查资源是否足够
-            if castle['exp'] < exp_cost or castle['coins'] < coin_cost:
-                return False
-            
-            # 扣除资源并升级
-            new_level = castle['level'] + 1
-            new_exp = castle['exp'] - exp_cost
-            new_coins = castle['coins'] - coin_cost
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET level = ?, exp = ?, coins = ? 
-                WHERE group_id = ?
-            ''', (new_level, new_exp, new_coins, group_id))
-            
-            self.conn.commit()
-            return True
+            self.cursor.execute('DELETE FROM change_log WHERE created_at < ?', (before,))
+            deleted = self.cursor.rowcount
+            self._commit()
+            return deleted
         except Exception as e:
-            logger.error(f"升级城堡失败: {str(e)}")
-            return False
-    
-    def donate_coins(self, group_id: str, user_id: str, amount: int) -> bool:
-        """捐献金币到城堡"""
+            self._rollback()
+            logger.error(f"清理变更日志失败: {str(e)}")
+            return 0
+
+    @read_only
+    def get_continuous_sign_rank(self, user_id: str) -> int:
+        """获取连续签到排名，与连续签到排行榜的顺序一致"""
+        return self.get_group_rank(None, 'continuous', user_id)
+        
+    @read_only
+    def get_level_rank(self, user_id: str) -> int:
+        """等级排名，与等级排行榜的顺序一致"""
+        return self.get_group_rank(None, 'level', user_id)
+
+    @read_only
+    def get_group_sign_rank(self, group_id: str, user_id: str) -> int:
+        """获取群内签到排名，排序与世界排行榜相同，只在群成员中计数"""
+        # 如果没有群组ID，则返回世界排名
+        if not group_id:
+            return self.get_world_sign_rank(user_id)
+        return self.get_group_rank(group_id, 'world', user_id)
+        
+    @read_only
+    def get_world_sign_rank(self, user_id: str) -> int:
+        """获取世界签到排名，与世界排行榜的顺序一致"""
+        return self.get_group_rank(None, 'world', user_id)
+        
+    @property
+    def database_files(self) -> List[str]:
+        return [os.path.basename(self.db_path)]
+
+    def migration_status(self) -> Dict[str, Dict[str, Any]]:
+        return {os.path.basename(self.db_path): self.read_migration_status(self.db_path)}
+
+    def pending_backfills(self) -> List[int]:
+        return self.migrator.pending_backfills()
+
+    async def run_backfills(self, chunk_size: int = 500, pause: float = 0.05) -> Dict[str, Dict[int, int]]:
+        scanned = await self.migrator.run_backfills(chunk_size, pause)
+        return {os.path.basename(self.db_path): scanned} if scanned else {}
+
+    def backup_to(self, target_dir: str, pages: int = 256, pause: float = 0.05) -> Dict[str, int]:
+        name = os.path.basename(self.db_path)
+        return {name: self._backup_file(os.path.join(target_dir, name), pages, pause)}
+
+    def check_integrity(self, source_dir: str) -> Dict[str, List[str]]:
+        name = os.path.basename(self.db_path)
+        return {name: self._check_file_integrity(os.path.join(source_dir, name))}
+
+    def _backup_file(self, target_path: str, pages: int = 256, pause: float = 0.05, max_restarts: int = 3) -> int:
+        """用 SQLite 在线备份 API 把数据库复制到 target_path，可在工作线程中调用
+
+        通过独立的只读连接分步复制，每步 pages 页、步间休眠 pause 秒，不占用写连接，签到照常写入。
+        复制期间其他连接提交的修改会使备份从头开始；重新开始超过 max_restarts 次时改为一步复制完，
+        一步复制只持有一个读事务，WAL 模式下不阻塞写入。
+        Returns:
+            备份的总页数
+        """
+        source = connect_read_only(self.db_path)
+        target = sqlite3.connect(target_path)
+        state = {'remaining': None, 'restarts': 0, 'total': 0}
+
+        def progress(status, remaining, total):
+            state['total'] = total
+            if state['remaining'] is not None and remaining > state['remaining']:
+                state['restarts'] += 1
+                if state['restarts'] > max_restarts:
+                    raise _BackupRestarted()
+            state['remaining'] = remaining
+
         try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 增加城堡金币
-            new_coins = castle['coins'] + amount
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET coins = ? 
-                WHERE group_id = ?
-            ''', (new_coins, group_id))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"捐献金币失败: {str(e)}")
-            return False
-    
-    def add_castle_exp(self, group_id: str, exp: int) -> bool:
-        """增加城堡经验"""
+            try:
+                source.backup(target, pages=max(1, pages), progress=progress, sleep=pause)
+            except _BackupRestarted:
+                logger.warning(f"备份 {os.path.basename(self.db_path)} 期间写入频繁，改为一步复制")
+                source.backup(target)
+            # 备份文件独立使用，不需要 -wal / -shm
+            target.execute('PRAGMA journal_mode = DELETE')
+            return target.execute('PRAGMA page_count').fetchone()[0]
+        finally:
+            target.close()
+            source.close()
+
+    @staticmethod
+    def _check_file_integrity(path: str) -> List[str]:
+        """检查数据库文件的完整性，返回发现的问题，为空表示通过"""
+        if not os.path.exists(path):
+            return ["文件不存在"]
+        try:
+            conn = connect_read_only(path)
+        except sqlite3.Error as e:
+            return [f"无法打开: {str(e)}"]
+        try:
+            problems = [row[0] for row in conn.execute('PRAGMA integrity_check').fetchall() if row[0] != 'ok']
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sign_data'").fetchone():
+                problems.append("缺少 sign_data 表")
+            return problems
+        except sqlite3.Error as e:
+            return [str(e)]
+        finally:
+            conn.close()
+
+    @staticmethod
+    def read_migration_status(path: str) -> Dict[str, Any]:
+        """预览数据库的表结构版本和未完成的迁移，只读打开，不修改数据库，可在工作线程中调用
+        Returns:
+            {'version': 当前版本, 'latest': 插件支持的最新版本, 'steps': SchemaMigrator.plan() 的结果}
+        """
+        conn = connect_read_only(path)
         try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 增加城堡经验
-            new_exp = castle['exp'] + exp
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET exp = ? 
-                WHERE group_id = ?
-            ''', (new_exp, group_id))
-            
-            self.conn.commit()
-            return True
+            migrator = SchemaMigrator(conn)
+            return {'version': migrator.current_version(), 'latest': migrator.latest_version, 'steps': migrator.plan()}
+        finally:
+            conn.close()
+
+    def restore_from(self, source_dir: str) -> List[str]:
+        """用 source_dir 中的同名备份文件覆盖当前数据库
+
+        通过写连接整体复制，期间持有写锁；只读连接和其他进程在复制完成后读到恢复的数据，数据库仍为 WAL 模式。
+        """
+        name = os.path.basename(self.db_path)
+        source = None
+        try:
+            self._commit()
+            source = sqlite3.connect(os.path.join(source_dir, name))
+            source.backup(self.conn)
+            # 较早的备份可能缺少之后版本的表结构
+            self.migrator.apply_schema()
+            # 备份中的变更日志触发器可能与当前设置不同
+            if self.change_log_enabled is not None:
+                self._sync_change_triggers()
+            self._commit()
+            # 恢复后的排行榜状态需要重新读取
+            self._board_states.clear()
+            self._board_version = None
+            return []
         except Exception as e:
-            logger.error(f"增加城堡经验失败: {str(e)}")
-            return False
-    
-    def elect_lord(self, group_id: str, user_id: str) -> bool:
-        """选举领主"""
+            logger.error(f"恢复数据库失败 {name}: {str(e)}")
+            return [name]
+        finally:
+            if source:
+                source.close()
+
+    def close(self):
+        """关闭数据库连接"""
+        if self.slow_query_log:
+            self.slow_query_log.close()
+            self.slow_query_log.conn.close()
+        if self.read_pool:
+            self.read_pool.close()
+        # executemany 之后游标上的语句不会被释放，不先关闭游标时连接要等游标被回收才真正关闭，WAL 也不会被清理
+        self._write_cursor.close()
+        self.conn.close()
+        
+    def add_user_title(self, user_id: str, title: str):
+        """为用户添加称号"""
         try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否是成员
-            if user_id not in castle['members']:
-                return False
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET lord_id = ? 
-                WHERE group_id = ?
-            ''', (user_id, group_id))
-            
-            self.conn.commit()
+            self.cursor.execute(
+                'INSERT OR IGNORE INTO user_titles (user_id, title) VALUES (?, ?)', 
+                (user_id, title)
+            )
+            self._commit()
             return True
         except Exception as e:
-            logger.error(f"选举领主失败: {str(e)}")
+            logger.error(f"添加用户称号失败: {str(e)}")
             return False
-    
-    def elect_manager(self, group_id: str, user_id: str) -> bool:
-        """选举总管"""
-        try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查用户是否是成员
-            if user_id not in castle['members']:
-                return False
-            
-            # 检查是否已经是总管
-            if user_id in castle['managers']:
-                return False
-            
-            # 添加到总管列表
-            castle['managers'].append(user_id)
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET managers = ? 
-                WHERE group_id = ?
-            ''', (json.dumps(castle['managers']), group_id))
             
-            self.conn.commit()
+    def apply_title_changes(self, user_id: str, grants: List[str], revokes: List[str], ctx=None) -> bool:
+        """在一个事务中批量授予和收回用户称号"""
+        if not grants and not revokes:
+            return True
+        if ctx is not None:
+            ctx.invalidate('titles')
+        try:
+            if grants:
+                self.cursor.executemany(
+                    'INSERT OR IGNORE INTO user_titles (user_id, title) VALUES (?, ?)',
+                    [(user_id, title) for title in grants]
+                )
+            if revokes:
+                self.cursor.execute(
+                    f"DELETE FROM user_titles WHERE user_id = ? AND title IN ({', '.join('?' * len(revokes))})",
+                    (user_id, *revokes)
+                )
+                # 收回的可能是正在使用的称号
+                self._refresh_board_title(user_id)
+            self._commit()
             return True
         except Exception as e:
-            logger.error(f"选举总管失败: {str(e)}")
+            self._rollback()
+            logger.error(f"更新用户称号失败: {str(e)}")
             return False
+            
+    @read_only
+    def get_user_titles(self, user_id: str) -> List[tuple]:
+        """获取用户的所有称号，按称号排序"""
+        self.cursor.execute('SELECT title, is_active FROM user_titles WHERE user_id = ? ORDER BY title', (user_id,))
+        return self.cursor.fetchall()
+        
+    def activate_title(self, user_id: str, title: str):
+        """激活用户称号"""
+        self.cursor.execute(
+            'UPDATE user_titles SET is_active = 1 WHERE user_id = ? AND title = ?', 
+            (user_id, title)
+        )
+        self._refresh_board_title(user_id)
+        self._commit()
+        
+    def deactivate_all_titles(self, user_id: str):
+        """取消激活用户的所有称号"""
+        self.cursor.execute(
+            'UPDATE user_titles SET is_active = 0 WHERE user_id = ?', 
+            (user_id,)
+        )
+        self._refresh_board_title(user_id)
+        self._commit()
+        
+    @read_only
+    def get_active_title(self, user_id: str) -> str:
+        """获取用户当前激活的称号"""
+        self.cursor.execute(
+            'SELECT title FROM user_titles WHERE user_id = ? AND is_active = 1', 
+            (user_id,)
+        )
+        row = self.cursor.fetchone()
+        return row[0] if row else ""
+
+    @read_only
+    def get_active_titles(self, user_ids: List[str]) -> Dict[str, str]:
+        """批量获取用户当前激活的称号，没有激活称号的用户返回空字符串"""
+        titles = {user_id: "" for user_id in user_ids}
+        if not user_ids:
+            return titles
+        self.cursor.execute(
+            f"SELECT user_id, title FROM user_titles WHERE is_active = 1 AND user_id IN ({', '.join('?' * len(user_ids))})",
+            list(user_ids)
+        )
+        for user_id, title in self.cursor.fetchall():
+            titles[user_id] = title
+        return titles
+
+    @read_only
+    def check_castle_name_exists(self, castle_name: str) -> bool:
+        """检查城堡名称是否已存在"""
+        self.cursor.execute('SELECT castle_id FROM castle_data WHERE castle_name = ?', (castle_name,))
+        return self.cursor.fetchone() is not None
     
-    def dismiss_manager(self, group_id: str, user_id: str) -> bool:
-        """罢免总管"""
+    @read_only
+    def get_castle_id_by_group(self, group_id: str) -> Optional[int]:
+        """根据群组ID获取城堡编号"""
+        self.cursor.execute('SELECT castle_id FROM castle_data WHERE group_id = ?', (group_id,))
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+    
+    def create_castle(self, group_id: str, castle_name: str, creator_id: str, participant_ids: List[str] = None, ctx=None) -> bool:
+        """创建城堡，创建人和5个参与用户自动加入城堡"""
+        if ctx is not None:
+            ctx.invalidate('castle')
         try:
-            castle = self.get_castle_by_group(group_id)
-            if not castle:
-                return False
-            
-            # 检查是否是总管
-            if user_id not in castle['managers']:
-                return False
-            
-            # 从总管列表中移除
-            castle['managers'].remove(user_id)
-            
-            self.cursor.execute('''
-                UPDATE castle_data 
-                SET managers = ? 
-                WHERE group_id = ?
-            ''', (json.dumps(castle['managers']), group_id))
+            # 初始化成员列表，包含创建者和参与者
+            members = [creator_id]
+            if participant_ids:
+                # 限制最多5个参与者
+                members.extend(participant_ids[:5])
             
-            self.conn.commit()
+            if self.castle_id_step > 1:
+                self.cursor.execute('''
+                    INSERT INTO castle_data (castle_id, group_id, castle_name, members)
+                    VALUES (?, ?, ?, ?)
+                ''', (self._next_castle_id(), group_id, castle_name, json.dumps(members)))
+            else:
+                self.cursor.execute('''
+                    INSERT INTO castle_data (group_id, castle_name, members) 
+                    VALUES (?, ?, ?)
+                ''', (group_id, castle_name, json.dumps(members)))
+            self._update_castle_boards({
+                'castle_id': self.cursor.lastrowid, 'castle_name': castle_name, 'level': 1, 'exp': 0, 'coins': 0
+            })
+            
+            self._commit()
             return True
         except Exception as e:
-            logger.error(f"罢免总管失败: {str(e)}")
+            self._rollback()
+            logger.error(f"创建城堡失败: {str(e)}")
             return False
     
-    def destroy_castle(self, group_id: str) -> bool:
-        """拆除城堡"""
-        try:
-            self.cursor.execute('DELETE FROM castle_data WHERE group_id = ?', (group_id,))
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"拆除城堡失败: {str(e)}")
-            return False
+    def _next_castle_id(self) -> int:
+        """下一个满足 (编号 - 1) % castle_id_step == castle_id_offset 的城堡编号，不复用已删除的编号"""
+        self.cursor.execute('''
+            SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'castle_data'), 0),
+                       COALESCE((SELECT MAX(castle_id) FROM castle_data), 0))
+        ''')
+        last = self.cursor.fetchone()[0]
+        return last + 1 + (self.castle_id_offset - last) % self.castle_id_step
     
+    @read_only
     def get_castle_ranking(self, limit: int = 10) -> List[tuple]:
-        """获取城堡等级排行榜"""
-        self.cursor.execute('''
-            SELECT castle_id, castle_name, level, exp
-            FROM castle_data
-            ORDER BY level DESC, exp DESC
-            LIMIT ?
-        ''', (limit,))
-        return self.cursor.fetchall()
+        """获取城堡等级排行榜 [(城堡编号, 名称, 等级, 经验), ...]"""
+        return [(int(castle_id), name, k1, k2) for castle_id, name, _, k1, k2 in self.get_leaderboard('castle_level', limit)]
     
+    @read_only
     def get_castle_coin_ranking(self, limit: int = 10) -> List[tuple]:
-        """获取城堡金币排行榜"""
-        self.cursor.execute('''
-            SELECT castle_id, castle_name, coins
-            FROM castle_data
-            ORDER BY coins DESC
-            LIMIT ?
-        ''', (limit,))
-        return self.cursor.fetchall()
+        """获取城堡金币排行榜 [(城堡编号, 名称, 金币), ...]"""
+        return [(int(castle_id), name, k1) for castle_id, name, _, k1, _ in self.get_leaderboard('castle_coins', limit)]
     
+    @read_only
     def get_castle_by_group(self, group_id: str) -> Optional[Dict[str, Any]]:
         """根据群组ID获取城堡信息"""
         self.cursor.execute('SELECT * FROM castle_data WHERE group_id = ?', (group_id,))
@@ -1790,12 +1560,18 @@ class SignDatabase:
             
         return result
     
-
+    def _get_castle(self, group_id: str, ctx=None) -> Optional[Dict[str, Any]]:
+        """获取城堡信息，有请求上下文时复用上下文中的城堡
+        写操作会直接修改返回的字典，使上下文与数据库保持一致
+        """
+        if ctx is not None:
+            return ctx.castle_for(group_id)
+        return self.get_castle_by_group(group_id)
     
-    def join_castle(self, group_id: str, user_id: str) -> bool:
+    def join_castle(self, group_id: str, user_id: str, ctx=None) -> bool:
         """加入城堡"""
         try:
-            castle = self.get_castle_by_group(group_id)
+            castle = self._get_castle(group_id, ctx)
             if not castle:
                 return False
             
@@ -1812,16 +1588,18 @@ class SignDatabase:
                 WHERE group_id = ?
             ''', (json.dumps(castle['members']), group_id))
             
-            self.conn.commit()
+            self._commit()
             return True
         except Exception as e:
+            if ctx is not None:
+                ctx.invalidate('castle')
             logger.error(f"加入城堡失败: {str(e)}")
             return False
     
-    def leave_castle(self, group_id: str, user_id: str) -> bool:
+    def leave_castle(self, group_id: str, user_id: str, ctx=None) -> bool:
         """退出城堡"""
         try:
-            castle = self.get_castle_by_group(group_id)
+            castle = self._get_castle(group_id, ctx)
             if not castle:
                 return False
             
@@ -1839,6 +1617,7 @@ class SignDatabase:
                     SET members = ?, lord_id = NULL 
                     WHERE group_id = ?
                 ''', (json.dumps(castle['members']), group_id))
+                castle['lord_id'] = None
             # 如果是总管，从总管列表中移除
             elif user_id in castle['managers']:
                 castle['managers'].remove(user_id)
@@ -1854,16 +1633,18 @@ class SignDatabase:
                     WHERE group_id = ?
                 ''', (json.dumps(castle['members']), group_id))
             
-            self.conn.commit()
+            self._commit()
             return True
         except Exception as e:
+            if ctx is not None:
+                ctx.invalidate('castle')
             logger.error(f"退出城堡失败: {str(e)}")
             return False
     
-    def upgrade_castle(self, group_id: str, exp_cost: int, coin_cost: int) -> bool:
+    def upgrade_castle(self, group_id: str, exp_cost: int, coin_cost: int, ctx=None) -> bool:
         """升级城堡"""
         try:
-            castle = self.get_castle_by_group(group_id)
+            castle = self._get_castle(group_id, ctx)
             if not castle:
                 return False
             
@@ -1881,17 +1662,21 @@ class SignDatabase:
                 SET level = ?, exp = ?, coins = ? 
                 WHERE group_id = ?
             ''', (new_level, new_exp, new_coins, group_id))
+            self._update_castle_boards(dict(castle, level=new_level, exp=new_exp, coins=new_coins), castle)
             
-            self.conn.commit()
+            self._commit()
+            castle.update(level=new_level, exp=new_exp, coins=new_coins)
             return True
         except Exception as e:
+            if ctx is not None:
+                ctx.invalidate('castle')
             logger.error(f"升级城堡失败: {str(e)}")
             return False
     
-    def donate_coins(self, group_id: str, user_id: str, amount: int) -> bool:
+    def donate_coins(self, group_id: str, user_id: str, amount: int, ctx=None) -> bool:
         """捐献金币到城堡"""
         try:
-            castle = self.get_castle_by_group(group_id)
+            castle = self._get_castle(group_id, ctx)
             if not castle:
                 return False
             
@@ -1903,17 +1688,21 @@ class SignDatabase:
                 SET coins = ? 
                 WHERE group_id = ?
             ''', (new_coins, group_id))
+            self._update_castle_boards(dict(castle, coins=new_coins), castle)
             
-            self.conn.commit()
+            self._commit()
+            castle['coins'] = new_coins
             return True
         except Exception as e:
+            if ctx is not None:
+                ctx.invalidate('castle')
             logger.error(f"捐献金币失败: {str(e)}")
             return False
     
-    def add_castle_exp(self, group_id: str, exp: int) -> bool:
+    def add_castle_exp(self, group_id: str, exp: int, ctx=None) -> bool:
         """增加城堡经验"""
         try:
-            castle = self.get_castle_by_group(group_id)
+            castle = self._get_castle(group_id, ctx)
             if not castle:
                 return False
             
@@ -1925,17 +1714,21 @@ class SignDatabase:
                 SET exp = ? 
                 WHERE group_id = ?
             ''', (new_exp, group_id))
+            self._update_castle_boards(dict(castle, exp=new_exp), castle)
             
-            self.conn.commit()
+            self._commit()
+            castle['exp'] = new_exp
             return True
         except Exception as e:
+            if ctx is not None:
+                ctx.invalidate('castle')
             logger.error(f"增加城堡经验失败: {str(e)}")
             return False
     
-    def elect_lord(self, group_id: str, user_id: str) -> bool:
+    def elect_lord(self, group_id: str, user_id: str, ctx=None) -> bool:
         """选举领主"""
         try:
-            castle = self.get_castle_by_group(group_id)
+            castle = self._get_castle(group_id, ctx)
             if not castle:
                 return False
             
@@ -1949,16 +1742,19 @@ class SignDatabase:
                 WHERE group_id = ?
             ''', (user_id, group_id))
             
-            self.conn.commit()
+            self._commit()
+            castle['lord_id'] = user_id
             return True
         except Exception as e:
+            if ctx is not None:
+                ctx.invalidate('castle')
             logger.error(f"选举领主失败: {str(e)}")
             return False
     
-    def elect_manager(self, group_id: str, user_id: str) -> bool:
+    def elect_manager(self, group_id: str, user_id: str, ctx=None) -> bool:
         """选举总管"""
         try:
-            castle = self.get_castle_by_group(group_id)
+            castle = self._get_castle(group_id, ctx)
             if not castle:
                 return False
             
@@ -1979,16 +1775,18 @@ class SignDatabase:
                 WHERE group_id = ?
             ''', (json.dumps(castle['managers']), group_id))
             
-            self.conn.commit()
+            self._commit()
             return True
         except Exception as e:
+            if ctx is not None:
+                ctx.invalidate('castle')
             logger.error(f"选举总管失败: {str(e)}")
             return False
     
-    def dismiss_manager(self, group_id: str, user_id: str) -> bool:
+    def dismiss_manager(self, group_id: str, user_id: str, ctx=None) -> bool:
         """罢免总管"""
         try:
-            castle = self.get_castle_by_group(group_id)
+            castle = self._get_castle(group_id, ctx)
             if not castle:
                 return False
             
@@ -2005,26 +1803,92 @@ class SignDatabase:
                 WHERE group_id = ?
             ''', (json.dumps(castle['managers']), group_id))
             
-            self.conn.commit()
+            self._commit()
             return True
         except Exception as e:
+            if ctx is not None:
+                ctx.invalidate('castle')
             logger.error(f"罢免总管失败: {str(e)}")
             return False
     
     def destroy_castle(self, group_id: str) -> bool:
         """销毁城堡"""
         try:
+            castle_id = self.get_castle_id_by_group(group_id)
             self.cursor.execute('''
                 DELETE FROM castle_data 
                 WHERE group_id = ?
             ''', (group_id,))
+            if castle_id is not None:
+                self._remove_from_boards(str(castle_id), self.CASTLE_BOARDS)
             
-            self.conn.commit()
+            self._commit()
             return True
         except Exception as e:
+            self._rollback()
+            self._board_states.clear()
             logger.error(f"销毁城堡失败: {str(e)}")
             return False
 
+    def get_table_rows(self, table: str, after_rowid: int, limit: int) -> Tuple[List[str], List[tuple]]:
+        """按 rowid 顺序读取 SHARD_KEYS 中的表，用于在分片之间移动数据
+        Returns:
+            (列名, [(rowid, 各列的值...), ...])，不含 SHARD_SKIP_COLUMNS 中的自增主键
+        """
+        self.cursor.execute(f'SELECT rowid AS _rowid, * FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                            (after_rowid, limit))
+        columns = [description[0] for description in self.cursor.description][1:]
+        rows = self.cursor.fetchall()
+        skip = self.SHARD_SKIP_COLUMNS.get(table)
+        if skip is None:
+            return columns, rows
+        index = columns.index(skip) + 1
+        return ([column for column in columns if column != skip],
+                [row[:index] + row[index + 1:] for row in rows])
+
+    def insert_table_rows(self, table: str, columns: List[str], rows: List[tuple]) -> bool:
+        """写入从其他分片移来的行 [(各列的值...), ...]，重复执行不会产生重复数据
+        签到历史没有自然主键，按 (用户, 签到日, 时间) 去重；城堡按本库的规则重新分配编号。
+        """
+        column_list = ', '.join(columns)
+        placeholders = ', '.join('?' * len(columns))
+        try:
+            if table == 'sign_history':
+                positions = [columns.index(column) for column in ('user_id', 'sign_date', 'timestamp')]
+                self.cursor.executemany(f'''
+                    INSERT INTO sign_history ({column_list}) SELECT {placeholders}
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM sign_history WHERE user_id = ? AND sign_date = ? AND timestamp = ?
+                    )
+                ''', [(*row, *(row[position] for position in positions)) for row in rows])
+            elif table == 'castle_data':
+                for row in rows:
+                    self.cursor.execute(
+                        f'INSERT OR REPLACE INTO castle_data (castle_id, {column_list}) VALUES (?, {placeholders})',
+                        (self._next_castle_id(), *row)
+                    )
+            else:
+                self.cursor.executemany(
+                    f'INSERT OR REPLACE INTO {table} ({column_list}) VALUES ({placeholders})', rows
+                )
+            self._commit()
+            return True
+        except Exception as e:
+            self._rollback()
+            logger.error(f"写入迁移数据失败 {table}: {str(e)}")
+            return False
+
+    def delete_table_rows(self, table: str, rowids: List[int]) -> bool:
+        """删除已移到其他分片的行"""
+        try:
+            self.cursor.executemany(f'DELETE FROM {table} WHERE rowid = ?', [(rowid,) for rowid in rowids])
+            self._commit()
+            return True
+        except Exception as e:
+            self._rollback()
+            logger.error(f"删除已迁移数据失败 {table}: {str(e)}")
+            return False
+
     def __del__(self):
         """析构函数，关闭数据库连接"""
         if hasattr(self, 'conn') and self.conn:
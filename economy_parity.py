@@ -0,0 +1,135 @@
+"""签到经济模拟器对拍
+
+economy_sim.py 中的向量化公式是 SignManager / CastleManager 的重写，本检查确认两者逐用户完全一致：
+同一组设置了种子的奖励随机数下，一边用 EconomySimulator 向量化模拟，另一边逐用户逐天调用插件的
+SignManager.daily_sign、buy_item 和 resign，写入纯内存存储，最后比较每个用户的等级、经验、金币、
+累计和连续签到天数以及最后签到日::
+
+    python economy_parity.py
+    python economy_parity.py --users 2000 --days 120 --seed 7
+
+需要 NumPy。一致时退出码为 0，否则列出不一致的字段和用户并以退出码 1 结束。
+"""
+import os
+import sys
+import argparse
+import tempfile
+import datetime
+import shutil
+from typing import Dict, Any, List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_astrbot  # noqa: E402
+
+# 对拍的城堡等级分布，包含没有城堡和各个增益等级
+CASTLE_LEVELS = {0: 0.3, 1: 0.2, 2: 0.2, 3: 0.1, 4: 0.1, 5: 0.1}
+STATE_FIELDS = ['level', 'exp', 'coins', 'total_days', 'continuous_days', 'last_sign']
+
+
+def run_plugin(package, sim, days: int, draws: Dict[str, Any], reward_rng, workdir: str) -> Dict[str, Any]:
+    """按 draws 中的签到、补签决定逐用户逐天执行插件的签到和补签，返回与模拟器相同格式的最终状态"""
+    np = fake_astrbot.plugin_module('economy_sim').np
+    SignManager = package.sign_manager.SignManager
+    db = package.memory_storage.MemorySignStorage(workdir)
+
+    # 每个城堡等级一座城堡，新建的城堡为 1 级
+    groups = {}
+    for level in sorted({int(level) for level in sim.castle_levels if level > 0}):
+        group_id = f"sim-castle-{level}"
+        db.create_castle(group_id, f"模拟城堡{level}", "sim-lord")
+        for _ in range(level - 1):
+            db.upgrade_castle(group_id, 0, 0)
+        groups[level] = group_id
+
+    for day in range(days):
+        today = sim.sign_day(day)
+        yesterday = (today - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+        for user in np.flatnonzero(draws['sign'][day]):
+            user_id = sim.user_key(int(user))
+            group_id = groups.get(int(sim.castle_levels[user]))
+            user_data = db.get_user_data(user_id)
+
+            # 昨天断签的用户先买补签卡补签昨天，金币不足时买不到
+            if draws['resign'][day, user] and user_data and user_data['last_sign'] < yesterday:
+                if SignManager.buy_item(user_id, "补签卡", 1, db)['success']:
+                    result = SignManager.resign(user_id, 1, group_id, db, today=today,
+                                                rng=reward_rng.for_key(f"resign:{user_id}", today))
+                    if not result['success']:
+                        raise RuntimeError(f"{user_id} 第 {day} 天补签失败: {result['message']}")
+                    user_data = db.get_user_data(user_id)
+
+            result = SignManager.daily_sign(user_data, group_id, db, today=today,
+                                            rng=reward_rng.for_key(user_id, today))
+            db.update_user_data(
+                user_id,
+                group_id=group_id,
+                total_days=result['total_days'],
+                last_sign=today.strftime('%Y-%m-%d'),
+                continuous_days=result['continuous_days'],
+                exp=result['exp'],
+                coins=result['coins'],
+                level=result['level'],
+                next_level_exp=result['next_level_exp']
+            )
+
+    state = {field: np.zeros(sim.n_users, dtype=np.int64) for field in STATE_FIELDS}
+    for user in range(sim.n_users):
+        user_data = db.get_user_data(sim.user_key(user))
+        if not user_data:
+            state['level'][user] = 1
+            state['last_sign'][user] = -2
+            continue
+        for field in STATE_FIELDS[:-1]:
+            state[field][user] = user_data[field]
+        last_sign = datetime.datetime.strptime(user_data['last_sign'], '%Y-%m-%d').date()
+        state['last_sign'][user] = (last_sign - sim.START_DAY).days
+    return state
+
+
+def run(n_users: int, days: int, seed: int) -> List[str]:
+    """对拍一次，返回不一致项说明，为空表示一致"""
+    workdir = tempfile.mkdtemp(prefix='sign-economy-')
+    try:
+        fake_astrbot.install()
+        package = fake_astrbot.load_package(workdir)
+        economy_sim = fake_astrbot.plugin_module('economy_sim')
+        if economy_sim.np is None:
+            return ["经济模拟器需要 NumPy，请先安装: pip install numpy"]
+        np = economy_sim.np
+        sim = economy_sim.EconomySimulator(n_users, castle_levels=CASTLE_LEVELS,
+                                                   sign_prob=0.85, resign_prob=0.5, seed=seed)
+        reward_rng = package.reward_rng.RewardRNG(f"economy-parity-{seed}")
+        draws = sim.draw_rewards(days, reward_rng)
+
+        vector_state = sim.run(days, draws)['final_state']
+        plugin_state = run_plugin(package, sim, days, draws, reward_rng, workdir)
+
+        failures = []
+        for field in STATE_FIELDS:
+            mismatched = np.flatnonzero(vector_state[field] != plugin_state[field])
+            for user in mismatched[:5]:
+                failures.append(f"{field}: 用户 {sim.user_key(int(user))} 模拟 {vector_state[field][user]}，"
+                                f"插件 {plugin_state[field][user]}")
+            if len(mismatched) > 5:
+                failures.append(f"{field}: 另有 {len(mismatched) - 5} 个用户不一致")
+        return failures
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="签到经济模拟器与插件奖励代码的对拍")
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--seed', type=int, default=20240101)
+    args = parser.parse_args(argv)
+
+    failures = run(args.users, args.days, args.seed)
+    for failure in failures:
+        print(failure)
+    print(f"{args.users} 用户 {args.days} 天: {'对拍通过' if not failures else '对拍失败'}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
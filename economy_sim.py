@@ -0,0 +1,282 @@
+"""签到经济模拟器
+
+用 NumPy 对 SignManager / CastleManager 的奖励公式做向量化批量计算，
+用于在数百万“用户·天”的规模上评估等级和金币供应的分布，辅助数值平衡。
+
+NumPy 只是开发工具依赖，插件运行时并不需要::
+
+    from astrbot_plugin_advanced_sign.economy_sim import EconomySimulator
+    sim = EconomySimulator(n_users=100000, castle_levels={0: 0.5, 1: 0.3, 3: 0.2}, seed=42)
+    print(sim.format_summary(sim.run(days=365)))
+
+不在 AstrBot 中运行时，先用 fake_astrbot 加载插件包（见 economy_parity.py）。
+向量化公式与插件实际代码的一致性由 economy_parity.py 对拍检查。
+"""
+import datetime
+from typing import Dict, Any, Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .castle_manager import CastleManager
+
+
+class EconomySimulator:
+    """向量化签到经济模拟
+
+    每个模拟日：按签到概率决定哪些用户签到；断签一天的用户按补签概率先买补签卡补签昨天；
+    然后按与 SignManager.daily_sign 相同的公式结算经验、金币和等级。
+    """
+
+    # 补签卡价格，与 SignManager.buy_item 一致
+    RESIGN_CARD_PRICE = 100
+    # 第 0 个模拟日对应的签到日
+    START_DAY = datetime.date(2024, 1, 1)
+
+    def __init__(self, n_users: int, castle_levels: Union[int, Dict[int, float], Any] = 0,
+                 sign_prob: float = 0.8, resign_prob: float = 0.0, seed: int = 0, max_level: int = 150):
+        """
+        Args:
+            n_users: 用户数量
+            castle_levels: 用户所在城堡等级，可以是统一的等级、{等级: 占比} 的分布或长度为 n_users 的数组
+            sign_prob: 每天签到的概率
+            resign_prob: 断签一天后第二天先补签的概率
+            seed: 随机种子
+            max_level: 等级表上限
+        """
+        if np is None:
+            raise ImportError("经济模拟器需要 NumPy，请先安装: pip install numpy")
+
+        self.n_users = n_users
+        self.sign_prob = sign_prob
+        self.resign_prob = resign_prob
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+        if isinstance(castle_levels, dict):
+            levels = np.array(list(castle_levels.keys()), dtype=np.int64)
+            weights = np.array(list(castle_levels.values()), dtype=np.float64)
+            self.castle_levels = self.rng.choice(levels, size=n_users, p=weights / weights.sum())
+        else:
+            self.castle_levels = np.broadcast_to(np.asarray(castle_levels, dtype=np.int64), (n_users,)).copy()
+
+        # 每级升级所需经验表，level_exp[l - 1] == SignManager._get_next_level_exp(l)
+        level_exp = [200]
+        for _ in range(max_level - 1):
+            level_exp.append(int(level_exp[-1] * 1.2))
+        self.level_exp = np.array(level_exp, dtype=np.int64)
+
+        # 各城堡等级的增益参数，不在 CASTLE_BUFFS 中的等级不生效
+        table_size = max(max(CastleManager.CASTLE_BUFFS), int(self.castle_levels.max(initial=0))) + 1
+        self.has_buff = np.zeros(table_size, dtype=bool)
+        self.exp_bonus = np.zeros(table_size, dtype=np.float64)
+        self.coin_low = np.zeros(table_size, dtype=np.int64)
+        self.coin_high = np.zeros(table_size, dtype=np.int64)
+        for level, buff in CastleManager.CASTLE_BUFFS.items():
+            self.has_buff[level] = True
+            self.exp_bonus[level] = buff['exp_bonus']
+            self.coin_low[level], self.coin_high[level] = buff['coin_range']
+
+    # ---- 向量化公式 ----
+
+    def next_level_exp(self, level):
+        return self.level_exp[np.minimum(level, len(self.level_exp)) - 1]
+
+    def calculate_level(self, exp, level):
+        """向量化 SignManager.calculate_level"""
+        new_level = np.maximum(level, np.searchsorted(self.level_exp, exp, side='right') + 1)
+        return new_level, self.next_level_exp(new_level)
+
+    def calculate_exp_reward(self, continuous_days, level, castle_level, base_exp):
+        """向量化 SignManager.calculate_exp_reward，base_exp 为 10-50 的随机基础经验"""
+        level_bonus = base_exp * ((level - 1) * 0.15)
+        next_exp = self.next_level_exp(level)
+        # 保持与标量版本相同的浮点累加顺序
+        continuous_bonus = np.zeros(level.shape, dtype=np.float64)
+        continuous_bonus += np.where(continuous_days >= 7, next_exp * 0.03, 0.0)
+        continuous_bonus += np.where(continuous_days >= 30, next_exp * 0.13, 0.0)
+        continuous_bonus += np.where(continuous_days >= 30, next_exp * 0.03, 0.0)
+        total = np.trunc(base_exp + level_bonus + continuous_bonus).astype(np.int64)
+        return self._buff_exp(total, castle_level)
+
+    def calculate_coin_reward(self, continuous_days, level, castle_level, base_coins, castle_coins):
+        """向量化 SignManager.calculate_coin_reward
+        base_coins 为 90-180 的随机基础金币，castle_coins 为城堡金币区间内的随机值
+        """
+        level_bonus = base_coins * ((level - 1) * 0.15)
+        continuous_bonus = np.zeros(level.shape, dtype=np.float64)
+        continuous_bonus += np.where(continuous_days >= 7, base_coins * 0.03, 0.0)
+        continuous_bonus += np.where(continuous_days >= 30, base_coins * 0.13, 0.0)
+        continuous_bonus += np.where(continuous_days >= 30, base_coins * 0.03, 0.0)
+        total = np.trunc(base_coins + level_bonus + continuous_bonus).astype(np.int64)
+        # 有城堡增益时金币直接取城堡金币区间内的随机值
+        return np.where(self._buffed(castle_level), castle_coins, total)
+
+    def _buffed(self, castle_level):
+        return (castle_level > 0) & self.has_buff[castle_level]
+
+    def _buff_exp(self, exp, castle_level):
+        buffed = np.trunc(exp * (1 + self.exp_bonus[castle_level])).astype(np.int64)
+        return np.where(self._buffed(castle_level), buffed, exp)
+
+    def resign_rewards(self, level, castle_level, castle_coins):
+        """向量化 SignManager.resign 中单日补签的最低奖励"""
+        base_exp = 10 + np.trunc(10 * (level - 1) * 0.15).astype(np.int64)
+        base_coins = 90 + np.trunc(90 * (level - 1) * 0.15).astype(np.int64)
+        return self._buff_exp(base_exp, castle_level), np.where(self._buffed(castle_level), castle_coins, base_coins)
+
+    # ---- 模拟 ----
+
+    def draw(self, days: int = None) -> Dict[str, Any]:
+        """抽取随机数，形状为 (n_users,)，指定 days 时为 (days, n_users)"""
+        shape = (days, self.n_users) if days else (self.n_users,)
+        low, high = self.coin_low[self.castle_levels], self.coin_high[self.castle_levels] + 1
+        # 没有增益的等级区间为空，用 [0, 1) 占位
+        high = np.where(high > low, high, low + 1)
+        return {
+            'sign': self.rng.random(shape) < self.sign_prob,
+            'resign': self.rng.random(shape) < self.resign_prob,
+            'exp_base': self.rng.integers(10, 51, size=shape),
+            'coin_base': self.rng.integers(90, 181, size=shape),
+            'sign_castle_coin': self.rng.integers(low, high, size=shape),
+            'resign_castle_coin': self.rng.integers(low, high, size=shape),
+        }
+
+    @staticmethod
+    def user_key(user: int) -> str:
+        """第 user 个模拟用户的用户 ID"""
+        return f"sim-{user}"
+
+    def sign_day(self, day: int) -> datetime.date:
+        """第 day 个模拟日的签到日"""
+        return self.START_DAY + datetime.timedelta(days=day)
+
+    def draw_rewards(self, days: int, reward_rng) -> Dict[str, Any]:
+        """按插件的奖励随机数源抽取 (days, n_users) 随机数
+        是否签到、补签仍由 NumPy 抽取；经验、金币和城堡金币取自 reward_rng 中每个“用户·天”的随机流，
+        抽取顺序与 SignManager.daily_sign / resign 消耗随机数的顺序相同，
+        因此 reward_rng 设置了种子时，模拟的奖励与插件对同一用户同一天发放的奖励一致。
+        逐个“用户·天”在 Python 中抽取，适合对拍规模的数据。
+        Args:
+            reward_rng: RewardRNG，用户 ID 为 user_key，签到日为 sign_day
+        """
+        draws = self.draw(days)
+        for day in range(days):
+            today = self.sign_day(day)
+            for user in range(self.n_users):
+                castle = int(self.castle_levels[user])
+                buff = CastleManager.CASTLE_BUFFS.get(castle) if castle > 0 else None
+                rng = reward_rng.for_key(self.user_key(user), today)
+                draws['exp_base'][day, user] = rng.randint(10, 50)
+                if castle > 0:
+                    # 经验的城堡增益同样抽取一次金币，结果不使用
+                    rng.randint(*(buff['coin_range'] if buff else (0, 0)))
+                draws['coin_base'][day, user] = rng.randint(90, 180)
+                if buff:
+                    draws['sign_castle_coin'][day, user] = rng.randint(*buff['coin_range'])
+                    # 补签使用独立的随机流，与插件的 /补签 相同
+                    resign_rng = reward_rng.for_key(f"resign:{self.user_key(user)}", today)
+                    draws['resign_castle_coin'][day, user] = resign_rng.randint(*buff['coin_range'])
+        return draws
+
+    def _initial_state(self) -> Dict[str, Any]:
+        zeros = np.zeros(self.n_users, dtype=np.int64)
+        return {
+            'level': np.ones(self.n_users, dtype=np.int64),
+            'exp': zeros.copy(),
+            'coins': zeros.copy(),
+            'total_days': zeros.copy(),
+            'continuous_days': zeros.copy(),
+            # 上次签到是第几天，-2 表示从未签到
+            'last_sign': np.full(self.n_users, -2, dtype=np.int64),
+        }
+
+    def _step(self, state: Dict[str, Any], draws: Dict[str, Any], day: int):
+        """推进一天，draws 为当天的随机数"""
+        castle = self.castle_levels
+        signing = draws['sign']
+
+        # 昨天断签、今天来签到、买得起补签卡的用户先补签昨天
+        resigning = (signing & draws['resign'] & (state['last_sign'] >= 0)
+                     & (state['last_sign'] < day - 1) & (state['coins'] >= self.RESIGN_CARD_PRICE))
+        if resigning.any():
+            exp_reward, coin_reward = self.resign_rewards(state['level'], castle, draws['resign_castle_coin'])
+            exp = state['exp'] + exp_reward
+            level, _ = self.calculate_level(exp, state['level'])
+            state['exp'] = np.where(resigning, exp, state['exp'])
+            state['level'] = np.where(resigning, level, state['level'])
+            state['coins'] = np.where(resigning, state['coins'] - self.RESIGN_CARD_PRICE + coin_reward, state['coins'])
+            state['total_days'] += resigning
+            state['continuous_days'] = np.where(resigning, 1, state['continuous_days'])
+            state['last_sign'] = np.where(resigning, day - 1, state['last_sign'])
+
+        continuous = np.where(state['last_sign'] == day - 1, state['continuous_days'] + 1, 1)
+        exp_reward = self.calculate_exp_reward(continuous, state['level'], castle, draws['exp_base'])
+        coin_reward = self.calculate_coin_reward(continuous, state['level'], castle,
+                                                 draws['coin_base'], draws['sign_castle_coin'])
+        exp = state['exp'] + exp_reward
+        level, _ = self.calculate_level(exp, state['level'])
+
+        state['exp'] = np.where(signing, exp, state['exp'])
+        state['level'] = np.where(signing, level, state['level'])
+        state['coins'] = np.where(signing, state['coins'] + coin_reward, state['coins'])
+        state['total_days'] += signing
+        state['continuous_days'] = np.where(signing, continuous, state['continuous_days'])
+        state['last_sign'] = np.where(signing, day, state['last_sign'])
+
+    def run(self, days: int, draws: Dict[str, Any] = None) -> Dict[str, Any]:
+        """运行模拟
+        Args:
+            draws: 预先抽取的 (days, n_users) 随机数，默认逐日抽取
+        Returns:
+            每日分布统计和最终状态，统计数组长度均为 days
+        """
+        state = self._initial_state()
+        percentiles = (10, 50, 90, 99)
+        summary = {
+            'level_mean': np.zeros(days),
+            'level_percentiles': np.zeros((days, len(percentiles)), dtype=np.int64),
+            'level_max': np.zeros(days, dtype=np.int64),
+            'coin_supply': np.zeros(days, dtype=np.int64),
+            'coin_percentiles': np.zeros((days, len(percentiles)), dtype=np.int64),
+            'coins_minted': np.zeros(days, dtype=np.int64),
+        }
+
+        for day in range(days):
+            previous_supply = int(state['coins'].sum())
+            self._step(state, self._day_draws(draws, day), day)
+            summary['level_mean'][day] = state['level'].mean()
+            summary['level_percentiles'][day] = np.percentile(state['level'], percentiles, method='lower')
+            summary['level_max'][day] = state['level'].max()
+            summary['coin_supply'][day] = state['coins'].sum()
+            summary['coin_percentiles'][day] = np.percentile(state['coins'], percentiles, method='lower')
+            summary['coins_minted'][day] = summary['coin_supply'][day] - previous_supply
+
+        summary['percentiles'] = percentiles
+        summary['level_distribution'] = np.bincount(state['level'])
+        summary['final_state'] = state
+        return summary
+
+    def _day_draws(self, draws: Dict[str, Any], day: int) -> Dict[str, Any]:
+        if draws is None:
+            return self.draw()
+        return {key: value[day] for key, value in draws.items()}
+
+    @staticmethod
+    def format_summary(summary: Dict[str, Any], every: int = 30) -> str:
+        """格式化每隔 every 天的分布统计"""
+        labels = "/".join(f"p{p}" for p in summary['percentiles'])
+        lines = [f"天数 | 平均等级 | 等级 {labels} | 最高等级 | 金币总量 | 金币 {labels} | 当日新增金币"]
+        days = len(summary['level_mean'])
+        for day in list(range(every - 1, days, every)) or [days - 1]:
+            lines.append(
+                f"{day + 1} | {summary['level_mean'][day]:.2f} | "
+                f"{'/'.join(str(v) for v in summary['level_percentiles'][day])} | "
+                f"{summary['level_max'][day]} | {summary['coin_supply'][day]} | "
+                f"{'/'.join(str(v) for v in summary['coin_percentiles'][day])} | "
+                f"{summary['coins_minted'][day]}"
+            )
+        return "\n".join(lines)
+
@@ -0,0 +1,216 @@
+"""离线测试用的 AstrBot 替身
+
+插件依赖 astrbot.api，离开运行中的机器人无法直接调用。这个模块提供：
+
+- install(): 在 sys.modules 中注册最小化的 astrbot.api 替身（已安装 AstrBot 时默认不覆盖）
+- FakeEvent / FakeContext: 命令处理函数所需的事件和上下文
+- create_plugin(): 把插件复制到独立的工作目录后加载，数据库等文件都写在工作目录中
+- run_command(): 调用一个命令处理函数并收集全部回复
+
+本模块不使用相对导入，可以在插件包之外单独导入::
+
+    import fake_astrbot
+    fake_astrbot.install()
+    plugin = await fake_astrbot.create_plugin('/tmp/work', config={'reward_seed': '1'})
+    replies = await fake_astrbot.run_command(plugin, '签到', fake_astrbot.FakeEvent('10001', '签到', group_id='20001'))
+"""
+import os
+import sys
+import types
+import shutil
+import logging
+import itertools
+import importlib
+import importlib.util
+from typing import Dict, Any, List
+
+# 复制到工作目录的插件文件
+PLUGIN_FILES = ('.py', '.json', '.png', '.ttf')
+PACKAGE_NAME = 'advanced_sign_plugin'
+
+_message_ids = itertools.count(1)
+
+
+class FakeResult:
+    """命令回复，kind 为 'image' 或 'plain'"""
+
+    def __init__(self, kind: str, content: str):
+        self.kind = kind
+        self.content = content
+
+    def __repr__(self):
+        return f"FakeResult({self.kind!r}, {self.content!r})"
+
+
+class FakeMessage:
+    def __init__(self, message_id: str, group_id: str, sender_id: str, sender_name: str, message_str: str):
+        self.message_id = message_id
+        self.group_id = group_id
+        self.sender = types.SimpleNamespace(user_id=sender_id, nickname=sender_name)
+        self.message_str = message_str
+
+
+class FakeEvent:
+    """模拟 AstrMessageEvent，只实现插件用到的接口"""
+
+    def __init__(self, sender_id: str, message_str: str, group_id: str = '', sender_name: str = None,
+                 message_id: str = None, platform: str = 'fake'):
+        self.message_str = message_str
+        self.platform = platform
+        self.message_obj = FakeMessage(
+            message_id or f"fake-{next(_message_ids)}", group_id, sender_id,
+            sender_name or f"用户{sender_id}", message_str
+        )
+
+    def get_sender_id(self) -> str:
+        return self.message_obj.sender.user_id
+
+    def get_sender_name(self) -> str:
+        return self.message_obj.sender.nickname
+
+    def get_group_id(self) -> str:
+        return self.message_obj.group_id
+
+    def get_platform_name(self) -> str:
+        return self.platform
+
+    def image_result(self, path: str) -> FakeResult:
+        return FakeResult('image', path)
+
+    def plain_result(self, text: str) -> FakeResult:
+        return FakeResult('plain', text)
+
+
+class FakeContext:
+    """模拟 astrbot.api.star.Context，插件只把它传给 Star"""
+
+
+def _build_modules() -> Dict[str, types.ModuleType]:
+    astrbot = types.ModuleType('astrbot')
+    api = types.ModuleType('astrbot.api')
+    event = types.ModuleType('astrbot.api.event')
+    star = types.ModuleType('astrbot.api.star')
+
+    class PermissionType:
+        ADMIN = 'admin'
+        MEMBER = 'member'
+
+    def _passthrough(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
+    # 命令装饰器直接返回原函数，命令名由 run_command 按函数上的 _fake_command 查找
+    def command(name, *args, **kwargs):
+        def decorator(func):
+            func._fake_command = name
+            return func
+        return decorator
+
+    event.filter = types.SimpleNamespace(
+        command=command,
+        permission_type=_passthrough,
+        PermissionType=PermissionType,
+    )
+    event.AstrMessageEvent = FakeEvent
+
+    class Star:
+        def __init__(self, context):
+            self.context = context
+
+    def register(*args, **kwargs):
+        def decorator(cls):
+            return cls
+        return decorator
+
+    star.Context = FakeContext
+    star.Star = Star
+    star.register = register
+
+    api.logger = logging.getLogger('astrbot')
+    api.AstrBotConfig = dict
+    api.event = event
+    api.star = star
+    astrbot.api = api
+    return {'astrbot': astrbot, 'astrbot.api': api, 'astrbot.api.event': event, 'astrbot.api.star': star}
+
+
+def install(force: bool = False) -> bool:
+    """注册 astrbot.api 替身
+    Args:
+        force: 即使已安装 AstrBot 也覆盖
+    Returns:
+        是否使用了替身
+    """
+    if not force:
+        try:
+            importlib.import_module('astrbot.api')
+            return False
+        except ImportError:
+            pass
+    sys.modules.update(_build_modules())
+    return True
+
+
+def load_package(workdir: str, plugin_dir: str = None) -> types.ModuleType:
+    """把插件复制到 workdir 下并作为包导入，返回插件包"""
+    plugin_dir = plugin_dir or os.path.dirname(os.path.abspath(__file__))
+    target = os.path.join(workdir, PACKAGE_NAME)
+    os.makedirs(target, exist_ok=True)
+    for name in os.listdir(plugin_dir):
+        if name.endswith(PLUGIN_FILES):
+            shutil.copy2(os.path.join(plugin_dir, name), target)
+
+    for module_name in [name for name in sys.modules if name == PACKAGE_NAME or name.startswith(PACKAGE_NAME + '.')]:
+        del sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(
+        PACKAGE_NAME, os.path.join(target, '__init__.py'), submodule_search_locations=[target]
+    )
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE_NAME] = package
+    spec.loader.exec_module(package)
+    return package
+
+
+async def create_plugin(workdir: str, config: Dict[str, Any] = None, clock=None, plugin_dir: str = None):
+    """在运行中的事件循环里创建插件实例
+    Args:
+        workdir: 工作目录，插件副本和数据库都放在这里
+        config: 插件配置
+        clock: 替换插件和数据库使用的签到时钟（如 FrozenClock）
+    """
+    install()
+    package = load_package(workdir, plugin_dir)
+    plugin = package.main.AdvancedSignPlugin(FakeContext(), config or {})
+    if clock is not None:
+        set_clock(plugin, clock)
+    return plugin
+
+
+def plugin_module(name: str) -> types.ModuleType:
+    """获取已加载插件包中的模块，如 plugin_module('clock').FrozenClock"""
+    return importlib.import_module(f"{PACKAGE_NAME}.{name}")
+
+
+def set_clock(plugin, clock):
+    """替换插件和数据库使用的签到时钟"""
+    plugin.clock = clock
+    plugin.db.clock = clock
+
+
+def find_handler(plugin, command: str):
+    """按命令名查找处理函数"""
+    for name in dir(type(plugin)):
+        if getattr(getattr(type(plugin), name, None), '_fake_command', None) == command:
+            return getattr(plugin, name)
+    raise KeyError(f"未找到命令: {command}")
+
+
+async def run_command(plugin, command: str, event: FakeEvent) -> List[FakeResult]:
+    """执行一个命令并收集全部回复"""
+    handler = find_handler(plugin, command)
+    return [result async for result in handler(event)]
+
+
+async def close_plugin(plugin):
+    await plugin.terminate()
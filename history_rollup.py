@@ -0,0 +1,106 @@
+import os
+import csv
+import gzip
+import asyncio
+import datetime
+from typing import Dict, Any, List
+
+from .database import logger
+from .storage import SignStorage
+
+
+class SignHistoryRollup:
+    """签到历史归档
+
+    将超过保留天数的 sign_history 明细分批处理：
+    1. 以追加方式流式写入按月份划分的 gzip 压缩归档文件
+    2. 汇总进 sign_history_monthly 月度统计表并删除明细（同一事务）
+    3. 增量 VACUUM 回收空间
+    每批都是一个独立的短事务，批次之间让出事件循环，不会长时间占用写锁。
+    """
+
+    ARCHIVE_HEADER = ['id', 'user_id', 'exp', 'coins', 'sign_date', 'timestamp']
+
+    def __init__(self, db: SignStorage, retention_days: int = 0, chunk_size: int = 500,
+                 archive_dir: str = None, vacuum_pages: int = 200, pause: float = 0.05):
+        """
+        Args:
+            db: 数据库实例
+            retention_days: 明细保留天数，0 表示不归档
+            chunk_size: 每批处理的记录数
+            archive_dir: 归档文件目录，默认为数据库目录下的 archive
+            vacuum_pages: 每批之后最多回收的空闲页数
+            pause: 批次之间的间隔(秒)
+        """
+        self.db = db
+        self.retention_days = retention_days
+        self.chunk_size = max(1, chunk_size)
+        self.archive_dir = archive_dir or os.path.join(db.data_dir, "archive")
+        self.vacuum_pages = vacuum_pages
+        self.pause = pause
+
+    @property
+    def enabled(self) -> bool:
+        return self.retention_days > 0
+
+    def cutoff_date(self) -> str:
+        """早于该签到日的明细会被归档"""
+        cutoff = self.db.clock.today() - datetime.timedelta(days=self.retention_days)
+        return cutoff.strftime('%Y-%m-%d')
+
+    def _archive_rows(self, rows: List[tuple]):
+        """把一批明细追加写入对应月份的归档文件"""
+        if not os.path.exists(self.archive_dir):
+            os.makedirs(self.archive_dir)
+
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(row[4][:7], []).append(row)
+
+        for month, month_rows in by_month.items():
+            path = os.path.join(self.archive_dir, f"sign_history_{month}.csv.gz")
+            is_new = not os.path.exists(path)
+            # 追加模式会在文件末尾新增一个 gzip 成员，gzip 读取时会自动拼接
+            with gzip.open(path, 'at', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                if is_new:
+                    writer.writerow(self.ARCHIVE_HEADER)
+                writer.writerows(month_rows)
+
+    def run_chunk(self, cutoff: str = None) -> int:
+        """处理一批过期明细
+        Returns:
+            本批处理的记录数，0 表示已经没有需要归档的记录
+        """
+        rows = self.db.get_expired_history(cutoff or self.cutoff_date(), self.chunk_size)
+        if not rows:
+            return 0
+
+        # 先落归档文件再删除明细；若中途失败，重跑时归档中可能出现重复行，但不会丢数据
+        self._archive_rows(rows)
+        if not self.db.rollup_history(rows):
+            return 0
+
+        if self.vacuum_pages:
+            self.db.incremental_vacuum(self.vacuum_pages)
+        return len(rows)
+
+    async def run(self) -> Dict[str, Any]:
+        """归档所有过期明细，批次之间让出事件循环"""
+        stats = {'rows': 0, 'chunks': 0}
+        if not self.enabled:
+            return stats
+
+        # 整个过程使用同一个截止日期，避免跨零点时范围变化
+        cutoff = self.cutoff_date()
+        while True:
+            count = self.run_chunk(cutoff)
+            if not count:
+                break
+            stats['rows'] += count
+            stats['chunks'] += 1
+            await asyncio.sleep(self.pause)
+
+        if stats['rows']:
+            logger.info(f"签到历史归档完成: 归档 {stats['rows']} 条记录，共 {stats['chunks']} 批，截止日期 {cutoff}")
+        return stats
@@ -0,0 +1,86 @@
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+from .storage import SignStorage
+
+
+class SignIdempotency:
+    """签到请求幂等记录
+
+    平台断线重连时会重投消息，同一条消息再次触发签到时直接重放第一次的回复，
+    不再重复计算奖励、写库和生成不同的回复。记录按消息 ID 存在 sign_requests 表中，与签到的其他写入
+    在同一事务中提交，签到生效就一定有记录；重放过的记录缓存在内存中，超过 ttl 的记录会被淘汰。
+    """
+
+    def __init__(self, db: SignStorage, ttl: int = 86400, max_entries: int = 4096, purge_interval: int = 3600):
+        """
+        Args:
+            db: 数据库
+            ttl: 记录保留时间(秒)
+            max_entries: 内存中最多缓存的记录数
+            purge_interval: 清理数据库中过期记录的间隔(秒)
+        """
+        self.db = db
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.purge_interval = purge_interval
+        # request_key -> (过期时间, 记录)，按写入顺序排列
+        self._cache = OrderedDict()
+        self._last_purge = 0
+        self.hits = 0
+
+    def _now(self) -> int:
+        return int(self.db.clock.now().timestamp())
+
+    @staticmethod
+    def request_key(event) -> Optional[str]:
+        """由发送者和平台消息 ID 组成的幂等键，消息没有 ID 时返回 None"""
+        message_id = getattr(event.message_obj, 'message_id', None)
+        if not message_id:
+            return None
+        return f"{event.get_sender_id()}:{message_id}"
+
+    def get(self, request_key: Optional[str], user_id: str = None) -> Optional[Dict[str, Any]]:
+        """获取已处理过的请求记录 {'result': 签到结果, 'response': 回复文本}"""
+        if not request_key:
+            return None
+        now = self._now()
+        cached = self._cache.get(request_key)
+        if cached is not None:
+            expires, record = cached
+            if expires > now:
+                self.hits += 1
+                return record
+            del self._cache[request_key]
+        record = self.db.get_sign_request(request_key, since=now - self.ttl, user_id=user_id)
+        if record:
+            self.hits += 1
+            self._remember(request_key, record, record['created_at'] + self.ttl)
+        return record
+
+    def put(self, request_key: Optional[str], user_id: str, result: Optional[Dict[str, Any]], response: str):
+        """记录请求的处理结果，应在签到写入的 db.transaction(user_id) 中调用
+        记录在事务提交后才算生效，因此这里不写内存缓存，重投时由 get 从数据库读取后缓存
+        """
+        if not request_key:
+            return
+        now = self._now()
+        self.db.save_sign_request(request_key, user_id, result, response, now)
+        if now - self._last_purge >= self.purge_interval:
+            self._last_purge = now
+            self.db.purge_sign_requests(now - self.ttl)
+
+    def _remember(self, request_key: str, record: Dict[str, Any], expires: int):
+        self._cache[request_key] = (expires, record)
+        self._cache.move_to_end(request_key)
+        now = self._now()
+        # 淘汰过期和超出上限的记录
+        while self._cache:
+            oldest_expires, _ = next(iter(self._cache.values()))
+            if oldest_expires > now and len(self._cache) <= self.max_entries:
+                break
+            self._cache.popitem(last=False)
+
+    def clear_cache(self):
+        """丢弃内存中的记录，数据库内容被替换（如恢复备份）后以数据库为准"""
+        self._cache.clear()
@@ -1,14 +1,28 @@
 import os
+import time
+import uuid
+import asyncio
 from PIL import Image, ImageDraw, ImageFont
-from typing import Union
+from typing import Union, Callable, Optional
 
 class ImageGenerator:
-    def __init__(self, plugin_dir: str):
+    def __init__(self, plugin_dir: str, on_render: Optional[Callable[[float], None]] = None):
         self.bg_image = os.path.join(plugin_dir, "Basemap.png")
         self.font_path = os.path.join(plugin_dir, "LXGWWenKai-Medium.ttf")
+        # 每次渲染完成后以耗时(秒)回调，用于统计
+        self.on_render = on_render
 
     async def create_sign_image(self, text: str, font_size: int = 36) -> Union[str, None]:
-        """生成签到图片"""
+        """生成签到图片，绘制在线程池中进行，不阻塞事件循环"""
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(None, self._render, text, font_size)
+        finally:
+            if self.on_render:
+                self.on_render(time.perf_counter() - start)
+
+    def _render(self, text: str, font_size: int) -> Union[str, None]:
         try:
             if not os.path.exists(self.bg_image):
                 return None
@@ -19,6 +33,10 @@ class ImageGenerator:
 
             draw = ImageDraw.Draw(bg)
 
+            # 行数多时缩小字号，保证所有行都落在底图内（上下各留 100 像素）
+            lines = text.split('\n')
+            font_size = max(16, min(font_size, (856 - 200) // len(lines) - 10))
+
             try:
                 if os.path.exists(self.font_path):
                     font = ImageFont.truetype(self.font_path, font_size)
@@ -30,7 +48,6 @@ class ImageGenerator:
                 font_size = 16
 
             # 处理多行文本
-            lines = text.split('\n')
             y_offset = 100
             line_spacing = font_size + 10
             
@@ -46,7 +63,8 @@ class ImageGenerator:
                 draw.text((x, y), line, font=font, fill=(0, 0, 0))
                 y_offset += line_spacing
 
-            temp_path = os.path.join(os.path.dirname(self.bg_image), "temp_sign.png")
+            # 每次生成独立的临时文件，并发请求之间不会互相覆盖
+            temp_path = os.path.join(os.path.dirname(self.bg_image), f"temp_sign_{uuid.uuid4().hex}.png")
             bg.save(temp_path)
             return temp_path
         except Exception as e:
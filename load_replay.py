@@ -0,0 +1,358 @@
+"""零点签到高峰回放
+
+通过 fake_astrbot 替身加载插件，按可配置的到达曲线回放一段跨日流量：
+零点前后几秒内数千个不同用户发送“签到”，同时混有“我的排名”、排行榜和“捐献金币”请求，
+分布在多个已建城堡的群里。插件使用 FrozenClock，时间随回放推进，从而真实地跨过换日。
+
+延迟从请求的计划到达时刻算起（包括等待并发名额的时间），不会因为插件变慢而少发请求。
+统计每个命令的 p50/p99/p999 延迟、失败次数、数据库锁错误（database is locked），
+以及渲染降级和用户锁竞争情况::
+
+    python load_replay.py --users 5000 --peak-rate 1000 --curve spike --concurrency 64
+    python load_replay.py --writer-interval 0.5 --writer-hold 0.3 --busy-timeout 100   # 模拟另一个写入者
+
+所有数据写在临时工作目录中，不会改动插件目录下的数据库。
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import asyncio
+import sqlite3
+import logging
+import argparse
+import datetime
+import tempfile
+import threading
+from collections import Counter
+from typing import Dict, Any, List, Callable, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_astrbot  # noqa: E402
+import benchmark  # noqa: E402
+
+# 换日时刻，合成数据中所有用户都在前一天签到过
+ROLLOVER = datetime.datetime.combine(benchmark.BENCH_NOW.date(), datetime.time())
+
+# 默认命令比例
+DEFAULT_MIX = '签到=80,我的排名=8,世界排行榜=4,等级排行榜=2,连续签到排行榜=2,捐献金币=4'
+
+COMMAND_MESSAGES = dict(benchmark.COMMANDS)
+
+LOCKED = 'database is locked'
+
+
+def arrival_rate(curve: str, peak: float, base: float, tau: float, pre: float) -> Callable[[float], float]:
+    """到达曲线，返回 t(相对零点的秒数) -> 每秒请求数
+    - spike: 零点瞬间达到峰值后按 tau 指数衰减
+    - ramp: 零点前 pre 秒线性爬升到峰值，之后指数衰减
+    - flat: 全程保持峰值
+    base 为叠加在曲线上的背景流量。
+    """
+    if curve == 'spike':
+        return lambda t: base + (peak * math.exp(-t / tau) if t >= 0 else 0.0)
+    if curve == 'ramp':
+        return lambda t: base + (peak * max(0.0, 1 + t / pre) if t < 0 else peak * math.exp(-t / tau))
+    if curve == 'flat':
+        return lambda t: base + peak
+    raise ValueError(f"未知的到达曲线: {curve}")
+
+
+def generate_arrivals(rate: Callable[[float], float], max_rate: float, start: float, end: float,
+                      rng: random.Random) -> List[float]:
+    """按非齐次泊松过程（thinning 法）生成到达时刻"""
+    arrivals = []
+    t = start
+    while True:
+        t += rng.expovariate(max_rate)
+        if t >= end:
+            return arrivals
+        if rng.random() * max_rate < rate(t):
+            arrivals.append(t)
+
+
+def parse_mix(mix: str) -> List[Tuple[str, float]]:
+    items = []
+    for part in mix.split(','):
+        command, _, weight = part.partition('=')
+        if command not in COMMAND_MESSAGES:
+            raise ValueError(f"不支持的命令: {command}")
+        items.append((command, float(weight or 1)))
+    return items
+
+
+def build_schedule(arrivals: List[float], mix: List[Tuple[str, float]], n_users: int,
+                   rng: random.Random) -> List[Tuple[float, str, int]]:
+    """为每个到达时刻分配命令和用户，签到尽量使用不同的用户"""
+    commands = [command for command, _ in mix]
+    weights = [weight for _, weight in mix]
+    sign_users = list(range(n_users))
+    rng.shuffle(sign_users)
+    schedule = []
+    for t in arrivals:
+        command = rng.choices(commands, weights)[0]
+        if command == '签到' and sign_users:
+            user = sign_users.pop()
+        else:
+            user = rng.randrange(n_users)
+        schedule.append((t, command, user))
+    return schedule
+
+
+class ErrorRecorder(logging.Handler):
+    """收集插件日志中的错误，区分数据库锁错误和其他错误"""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.locked = 0
+        self.errors = Counter()
+
+    def record(self, level: str, message: str):
+        if level != 'ERROR':
+            return
+        if LOCKED in message:
+            self.locked += 1
+        # 错误消息形如“签到失败: ...”，按冒号前的部分归类
+        self.errors[message.split(':', 1)[0][:40]] += 1
+
+    def emit(self, record: logging.LogRecord):
+        self.record('ERROR', record.getMessage())
+
+
+class CompetingWriter:
+    """另一个写入者（如第二个机器人进程或外部脚本），周期性地持有写事务"""
+
+    def __init__(self, db_path: str, interval: float, hold: float):
+        self.db_path = db_path
+        self.interval = interval
+        self.hold = hold
+        self.transactions = 0
+        self.failures = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="competing-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path, timeout=self.interval, isolation_level=None)
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.execute("UPDATE sign_data SET coins = coins WHERE user_id = ?", (benchmark.user_id(0),))
+                    time.sleep(self.hold)
+                    conn.execute("COMMIT")
+                    self.transactions += 1
+                except sqlite3.OperationalError:
+                    self.failures += 1
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+        finally:
+            conn.close()
+
+
+async def replay(plugin, clock, schedule: List[Tuple[float, str, int]], n_groups: int, concurrency: int,
+                 speed: float, recorder: ErrorRecorder) -> Dict[str, Any]:
+    """按计划回放请求
+    Returns:
+        每个请求的 (到达时刻, 命令, 延迟秒数, 是否失败) 列表和总耗时
+    """
+    handlers = {command: fake_astrbot.find_handler(plugin, command) for command in {item[1] for item in schedule}}
+    semaphore = asyncio.Semaphore(concurrency)
+    samples: List[Tuple[float, str, float, bool]] = []
+    origin = schedule[0][0] if schedule else 0.0
+
+    async def run_one(t: float, command: str, user: int, due: float):
+        event = fake_astrbot.FakeEvent(benchmark.user_id(user), COMMAND_MESSAGES[command],
+                                       group_id=benchmark.group_id(user, n_groups))
+        failed = False
+        async with semaphore:
+            try:
+                async for response in handlers[command](event):
+                    if response.kind == 'plain' and '请联系管理员' in response.content:
+                        failed = True
+            except Exception as e:
+                recorder.record('ERROR', f"{command}未捕获异常: {e}")
+                failed = True
+        samples.append((t, command, time.perf_counter() - due, failed))
+
+    tasks = []
+    start = time.perf_counter()
+    for t, command, user in schedule:
+        due = start + (t - origin) / speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # 时钟随到达时刻推进，处理中的请求看到的是当前的回放时间
+        clock.set(ROLLOVER + datetime.timedelta(seconds=t))
+        tasks.append(asyncio.ensure_future(run_one(t, command, user, due)))
+    await asyncio.gather(*tasks)
+    return {'samples': samples, 'elapsed': time.perf_counter() - start}
+
+
+def summarize(samples: List[Tuple[float, str, float, bool]]) -> Dict[str, Dict[str, Any]]:
+    by_command: Dict[str, List[Tuple[float, bool]]] = {}
+    for _, command, latency, failed in samples:
+        by_command.setdefault(command, []).append((latency, failed))
+    by_command['全部'] = [(latency, failed) for _, _, latency, failed in samples]
+    summary = {}
+    for command, items in by_command.items():
+        latencies = [latency for latency, _ in items]
+        summary[command] = {
+            'count': len(items),
+            'failed': sum(1 for _, failed in items if failed),
+            'p50_ms': benchmark.percentile(latencies, 0.5) * 1000,
+            'p99_ms': benchmark.percentile(latencies, 0.99) * 1000,
+            'p999_ms': benchmark.percentile(latencies, 0.999) * 1000,
+            'max_ms': max(latencies) * 1000 if latencies else 0.0,
+        }
+    return summary
+
+
+def timeline(samples: List[Tuple[float, str, float, bool]]) -> List[Dict[str, Any]]:
+    """按到达时刻的整秒分组的请求数和延迟"""
+    buckets: Dict[int, List[float]] = {}
+    for t, _, latency, _ in samples:
+        buckets.setdefault(math.floor(t), []).append(latency)
+    return [{
+        'second': second,
+        'count': len(latencies),
+        'p50_ms': benchmark.percentile(latencies, 0.5) * 1000,
+        'p99_ms': benchmark.percentile(latencies, 0.99) * 1000,
+    } for second, latencies in sorted(buckets.items())]
+
+
+async def run(settings: Dict[str, Any]) -> Dict[str, Any]:
+    rng = random.Random(settings['seed'])
+    rate = arrival_rate(settings['curve'], settings['peak_rate'], settings['base_rate'], settings['tau'],
+                        settings['pre'])
+    max_rate = settings['peak_rate'] + settings['base_rate']
+    arrivals = generate_arrivals(rate, max_rate, -settings['pre'], settings['duration'], rng)
+    schedule = build_schedule(arrivals, parse_mix(settings['mix']), settings['users'], rng)
+
+    workdir = tempfile.mkdtemp(prefix='sign-replay-')
+    recorder = ErrorRecorder()
+    astrbot_logger = logging.getLogger('astrbot')
+    writer = None
+    try:
+        config = dict(benchmark.BENCH_CONFIG)
+        # 渲染排队和群限流使用插件默认值，观察高峰下的降级情况
+        for key in ('render_queue_size', 'group_render_per_minute'):
+            config.pop(key)
+        config.update(settings.get('config') or {})
+        plugin = await fake_astrbot.create_plugin(workdir, config=config)
+        clock = fake_astrbot.plugin_module('clock').FrozenClock(ROLLOVER - datetime.timedelta(seconds=settings['pre']))
+        fake_astrbot.set_clock(plugin, clock)
+        benchmark.populate(plugin.db, settings['users'], settings['seed'])
+        if settings['busy_timeout'] is not None:
+            plugin.db.conn.execute(f"PRAGMA busy_timeout = {int(settings['busy_timeout'])}")
+
+        db_logger = fake_astrbot.plugin_module('database').logger
+        db_logger.listeners.append(recorder.record)
+        astrbot_logger.addHandler(recorder)
+        if settings['writer_interval'] > 0:
+            writer = CompetingWriter(plugin.db.db_path, settings['writer_interval'], settings['writer_hold'])
+            writer.start()
+
+        result = await replay(plugin, clock, schedule, benchmark.group_count(settings['users']),
+                              settings['concurrency'], settings['speed'], recorder)
+        if writer:
+            writer.stop()
+        report = {
+            'settings': settings,
+            'requests': len(schedule),
+            'elapsed': result['elapsed'],
+            'commands': summarize(result['samples']),
+            'timeline': timeline(result['samples']),
+            'db_locked': recorder.locked,
+            'errors': dict(recorder.errors),
+            'admission': plugin.admission.stats(),
+            'locks': plugin.locks.stats(),
+            'writer': {'transactions': writer.transactions, 'failures': writer.failures} if writer else None,
+        }
+        db_logger.listeners.remove(recorder.record)
+        await fake_astrbot.close_plugin(plugin)
+        return report
+    finally:
+        if writer:
+            writer.stop()
+        astrbot_logger.removeHandler(recorder)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    settings = report['settings']
+    lines = [
+        f"== 零点回放: {settings['users']} 用户 {benchmark.group_count(settings['users'])} 群，"
+        f"{report['requests']} 个请求，曲线 {settings['curve']}，并发 {settings['concurrency']}，"
+        f"耗时 {report['elapsed']:.1f}s ==",
+        f"{benchmark.pad('命令', 16)}{'次数':>7}{'失败':>6}{'p50 ms':>9}{'p99 ms':>9}{'p999 ms':>9}{'max ms':>9}",
+    ]
+    for command, stat in report['commands'].items():
+        lines.append(
+            f"{benchmark.pad(command, 16)}{stat['count']:>9}{stat['failed']:>8}{stat['p50_ms']:>9.1f}"
+            f"{stat['p99_ms']:>9.1f}{stat['p999_ms']:>9.1f}{stat['max_ms']:>9.1f}"
+        )
+
+    lines.append("\n按到达秒分布（相对零点）:")
+    for bucket in report['timeline']:
+        lines.append(f"  {bucket['second']:>+4}s {bucket['count']:>6} 个  p50 {bucket['p50_ms']:>8.1f}ms"
+                     f"  p99 {bucket['p99_ms']:>8.1f}ms")
+
+    admission, locks = report['admission'], report['locks']
+    lines.append(f"\n数据库锁错误: {report['db_locked']}")
+    for name, count in sorted(report['errors'].items(), key=lambda item: -item[1]):
+        lines.append(f"  {name}: {count}")
+    lines.append(f"渲染: 完成 {admission['rendered']} 合并 {admission['coalesced']} "
+                 f"队列降级 {admission['shed_queue']} 限流降级 {admission['shed_rate']} "
+                 f"最大排队 {admission['max_waiting']}")
+    lines.append(f"用户锁: 竞争 {locks['contended']}/{locks['acquisitions']} "
+                 f"最长等待 {locks['wait_max'] * 1000:.1f}ms")
+    if report['writer']:
+        lines.append(f"竞争写入者: 事务 {report['writer']['transactions']} 失败 {report['writer']['failures']}")
+    return "\n".join(lines)
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="签到插件零点高峰回放")
+    parser.add_argument('--users', type=int, default=5000, help="用户数，群数按每 100 人一个群计算")
+    parser.add_argument('--curve', choices=['spike', 'ramp', 'flat'], default='spike', help="到达曲线")
+    parser.add_argument('--peak-rate', type=float, default=1000, help="峰值请求数/秒")
+    parser.add_argument('--base-rate', type=float, default=20, help="背景请求数/秒")
+    parser.add_argument('--tau', type=float, default=3, help="零点后峰值的衰减时间常数(秒)")
+    parser.add_argument('--pre', type=float, default=5, help="从零点前多少秒开始回放")
+    parser.add_argument('--duration', type=float, default=15, help="回放到零点后多少秒")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="命令比例，如 签到=80,我的排名=10")
+    parser.add_argument('--concurrency', type=int, default=64, help="同时处理的请求数上限")
+    parser.add_argument('--speed', type=float, default=1.0, help="回放倍速，2 表示用一半的真实时间")
+    parser.add_argument('--busy-timeout', type=float, default=None, help="插件连接的 busy_timeout(毫秒)")
+    parser.add_argument('--writer-interval', type=float, default=0, help="竞争写入者的事务间隔(秒)，0 为关闭")
+    parser.add_argument('--writer-hold', type=float, default=0.2, help="竞争写入者每次持有写锁的时间(秒)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default='', help="把结果写入 JSON 文件")
+    args = parser.parse_args(argv)
+
+    settings = {
+        'users': args.users, 'curve': args.curve, 'peak_rate': args.peak_rate, 'base_rate': args.base_rate,
+        'tau': args.tau, 'pre': args.pre, 'duration': args.duration, 'mix': args.mix,
+        'concurrency': args.concurrency, 'speed': args.speed, 'busy_timeout': args.busy_timeout,
+        'writer_interval': args.writer_interval, 'writer_hold': args.writer_hold, 'seed': args.seed,
+    }
+    report = asyncio.run(run(settings))
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'environment': benchmark.environment(), 'report': report}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Any
+
+
+class _LockEntry:
+    __slots__ = ('lock', 'refs', 'last_used')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        # 正在持有或等待该锁的请求数
+        self.refs = 0
+        self.last_used = time.monotonic()
+
+
+class KeyedLockManager:
+    """按键加锁的异步锁管理器
+
+    用于串行化同一用户（user:<id>）或同一城堡（castle:<group_id>）的读-改-写操作，
+    不同键之间完全并行。锁按键的哈希分片存放，空闲的锁会被回收，内存占用有上限。
+    """
+
+    def __init__(self, shards: int = 16, max_locks_per_shard: int = 256, idle_seconds: float = 300):
+        """
+        Args:
+            shards: 分片数量
+            max_locks_per_shard: 每个分片最多保留的锁数量，超过时回收最久未用的空闲锁
+            idle_seconds: 空闲超过该时间的锁会被回收
+        """
+        self._shards = [dict() for _ in range(max(1, shards))]
+        self.max_locks_per_shard = max_locks_per_shard
+        self.idle_seconds = idle_seconds
+        # 竞争统计
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.evicted = 0
+
+    def _shard(self, key: str) -> Dict[str, _LockEntry]:
+        return self._shards[hash(key) % len(self._shards)]
+
+    @asynccontextmanager
+    async def hold(self, *keys: str):
+        """同时持有多个键的锁，按固定顺序加锁避免死锁"""
+        keys = sorted({key for key in keys if key})
+        entries = []
+        for key in keys:
+            shard = self._shard(key)
+            entry = shard.get(key)
+            if entry is None:
+                entry = shard[key] = _LockEntry()
+            entry.refs += 1
+            entries.append((key, entry))
+
+        acquired = []
+        try:
+            for _, entry in entries:
+                if entry.lock.locked():
+                    self.contended += 1
+                    start = time.monotonic()
+                    await entry.lock.acquire()
+                    waited = time.monotonic() - start
+                    self.wait_total += waited
+                    self.wait_max = max(self.wait_max, waited)
+                else:
+                    await entry.lock.acquire()
+                self.acquisitions += 1
+                acquired.append(entry)
+            yield
+        finally:
+            for entry in reversed(acquired):
+                entry.lock.release()
+            now = time.monotonic()
+            for key, entry in entries:
+                entry.refs -= 1
+                entry.last_used = now
+                self._evict(self._shard(key), now)
+
+    def _evict(self, shard: Dict[str, _LockEntry], now: float):
+        """回收分片中的空闲锁"""
+        idle = [(entry.last_used, key) for key, entry in shard.items()
+                if entry.refs == 0 and not entry.lock.locked()]
+        if not idle:
+            return
+        over_limit = len(shard) - self.max_locks_per_shard
+        idle.sort()
+        for index, (last_used, key) in enumerate(idle):
+            if index < over_limit or now - last_used > self.idle_seconds:
+                del shard[key]
+                self.evicted += 1
+            else:
+                break
+
+    def stats(self) -> Dict[str, Any]:
+        """锁竞争统计"""
+        return {
+            'locks': sum(len(shard) for shard in self._shards),
+            'acquisitions': self.acquisitions,
+            'contended': self.contended,
+            'wait_total': self.wait_total,
+            'wait_max': self.wait_max,
+            'evicted': self.evicted,
+        }
@@ -1,199 +1,560 @@
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api.star import Context, Star, register
-from astrbot.api import logger
+from astrbot.api import logger, AstrBotConfig
 import os
-import datetime
 import random
+import datetime
+import asyncio
 
+from .storage import SignStorage
 from .database import SignDatabase
+from .sharded_database import ShardedSignDatabase
+from .memory_storage import MemorySignStorage
+from .shard_rebalance import ShardRebalancer
 from .image_generator import ImageGenerator
 from .sign_manager import SignManager
 from .castle_manager import CastleManager
+from .clock import SignClock
+from .history_rollup import SignHistoryRollup
+from .backup import SignBackup
+from .sign_calendar import SignCalendar
+from .reward_rng import RewardRNG
+from .title_rules import TITLE_ENGINE
+from .request_context import SignContext
+from .locks import KeyedLockManager
+from .admission import RenderAdmission
+from .idempotency import SignIdempotency
+from .metrics import PluginMetrics, instrumented
+from .profiler import SamplingProfiler
+from .ranking_pager import RankingPager
+from .coherence import CoherenceMonitor
 
 @register("astrbot_plugin_advanced_sign", "XiaoJie", "一个高级签到插件，包含等级系统、排行榜、商店系统", "1.0.0", "https://github.com/XiaoJie/astrbot_plugin_advanced_sign")
 class AdvancedSignPlugin(Star):
-    def __init__(self, context: Context):
+    def __init__(self, context: Context, config: AstrBotConfig = None):
         super().__init__(context)
-        self.db = SignDatabase(os.path.dirname(__file__))
-        self.img_gen = ImageGenerator(os.path.dirname(__file__))
+        self.config = config or {}
+        # 签到时钟：所有“今天”的计算都以它为准
+        self.clock = SignClock(
+            self.config.get('timezone', ''),
+            self.config.get('day_rollover_hour', 0)
+        )
+        # 运行指标：命令分阶段耗时、SQL 统计、渲染耗时
+        self.metrics = PluginMetrics()
+        self.db = self._create_storage()
+        self.db.add_statement_hook(self.metrics.on_statement)
+        self.img_gen = ImageGenerator(os.path.dirname(__file__), on_render=self.metrics.on_render)
+        # 采样分析器：由管理员命令开启，只采集命令处理、图片渲染和数据库方法
+        self.profiler = SamplingProfiler(os.path.join(self.db.data_dir, "profiles"))
+        self.profiler.register(type(self), SignStorage, SignDatabase, ShardedSignDatabase, MemorySignStorage, ImageGenerator)
+        self._profile_task = None
+        # 图片渲染准入：有界队列、按群限流、相同内容合并，过载时降级为纯文本
+        self.admission = RenderAdmission(
+            self.img_gen.create_sign_image,
+            concurrency=self.config.get('render_concurrency', 2),
+            queue_size=self.config.get('render_queue_size', 20),
+            group_per_minute=self.config.get('group_render_per_minute', 30)
+        )
+        # 排行榜翻页：键集分页，游标按页缓存
+        self.pager = RankingPager(
+            self.db,
+            page_size=10,
+            cursor_ttl=self.config.get('ranking_cursor_ttl', 300)
+        )
+        self.ranking_cache_ttl = self.config.get('ranking_image_cache_ttl', 60)
+        self.sign_replay_cache_ttl = self.config.get('sign_replay_cache_ttl', 120)
+        # 多实例共用数据库时，按其他进程的写入失效本进程的缓存；分片存储时每个分片各有一份变更日志
+        # 变更日志触发器只在开启检查时安装，单实例部署的写入不额外记日志
+        self.coherence_interval = self.config.get('coherence_poll_interval', 0)
+        self.coherence = []
+        self.db.set_change_log(self.coherence_interval > 0)
+        if self.coherence_interval > 0:
+            for change_log in self.db.change_logs:
+                monitor = CoherenceMonitor(change_log)
+                monitor.subscribe('user', self.pager.invalidate_users)
+                monitor.subscribe('group', self.pager.invalidate)
+                self.coherence.append(monitor)
+        # 奖励随机数源：配置了种子时同一用户同一天的奖励可以重放
+        self.reward_rng = RewardRNG(self.config.get('reward_seed', ''))
+        # 按用户/城堡加锁，不同用户之间互不阻塞
+        self.locks = KeyedLockManager()
+        # 按消息 ID 记录已处理的签到，消息重投时重放回复
+        self.idempotency = SignIdempotency(self.db)
+        
+        # 后台任务
+        self._tasks = []
+        self.history_rollup = SignHistoryRollup(
+            self.db,
+            retention_days=self.config.get('history_retention_days', 0),
+            chunk_size=self.config.get('history_rollup_chunk_size', 500)
+        )
+        if self.history_rollup.enabled:
+            self._tasks.append(asyncio.get_event_loop().create_task(self._history_rollup_loop()))
+        # 表结构迁移的数据回填在后台分批进行，重启后从断点继续
+        self.migration_chunk_size = self.config.get('migration_chunk_size', 500)
+        self._migration_task = None
+        self._start_migration_backfill()
+        # 定时在线备份，快照保存在 plugins_db/backups
+        self.backup = SignBackup(
+            self.db,
+            interval_hours=self.config.get('backup_interval_hours', 0),
+            keep=self.config.get('backup_keep', 7)
+        )
+        if self.backup.enabled:
+            self._tasks.append(asyncio.get_event_loop().create_task(self._backup_loop()))
+        # 定期导出 Prometheus 文本格式的指标
+        self.metrics_path = os.path.join(self.db.data_dir, "metrics.prom")
+        self.metrics_interval = self.config.get('metrics_export_interval', 60)
+        if self.metrics_interval > 0:
+            self._tasks.append(asyncio.get_event_loop().create_task(self._metrics_export_loop()))
+        if self.coherence:
+            self._tasks.append(asyncio.get_event_loop().create_task(self._coherence_loop()))
+        # 全服排行榜的跳页检查点在后台生成并在过期前刷新，跳到任意深的页都不必从榜首数起
+        if self.pager.cursor_ttl > 0:
+            self._tasks.append(asyncio.get_event_loop().create_task(self._ranking_checkpoint_loop()))
+        
+    def _create_storage(self):
+        '''按配置创建存储：SQLite 单文件、SQLite 分片，或仅用于测试的纯内存存储'''
+        plugin_dir = os.path.dirname(__file__)
+        if self.config.get('storage_engine', 'sqlite') == 'memory':
+            logger.warning("签到插件使用纯内存存储，数据不会写入磁盘，重启后丢失")
+            return MemorySignStorage(plugin_dir, clock=self.clock)
+        shard_count = self.config.get('shard_count', 0)
+        if shard_count > 0:
+            # 分片存储：按用户/群号分散到多个数据库文件，各有独立的写连接
+            return ShardedSignDatabase(
+                plugin_dir,
+                shard_count,
+                clock=self.clock,
+                slow_query_ms=self.config.get('slow_query_ms', 0),
+                read_pool_size=self._read_pool_size()
+            )
+        return SignDatabase(
+            plugin_dir,
+            clock=self.clock,
+            slow_query_ms=self.config.get('slow_query_ms', 0),
+            read_pool_size=self._read_pool_size()
+        )
+        
+    def _read_pool_size(self):
+        '''只读连接数配置，负数表示按 CPU 核数'''
+        size = self.config.get('read_pool_size', -1)
+        return None if size < 0 else size
+        
+    async def _read(self, func, *args, **kwargs):
+        '''在线程池中执行只读查询，不阻塞事件循环；未启用只读连接池时直接执行
+        func 只能调用存储的只读方法（SignDatabase 中标记为只读的方法）
+        '''
+        if self.db.read_pool is None:
+            return func(*args, **kwargs)
+        return await asyncio.to_thread(func, *args, **kwargs)
+        
+    async def _history_rollup_loop(self):
+        '''定期归档过期签到历史'''
+        while True:
+            try:
+                await self.history_rollup.run()
+            except Exception as e:
+                logger.error(f"签到历史归档失败: {str(e)}")
+            await asyncio.sleep(3600)
+            
+    def _start_migration_backfill(self):
+        '''有未完成的迁移回填且没有在执行时，启动后台回填'''
+        if self._migration_task and not self._migration_task.done():
+            return
+        if not self.db.pending_backfills():
+            return
+        self._migration_task = asyncio.get_event_loop().create_task(self._migration_backfill())
+        self._tasks.append(self._migration_task)
+        
+    async def _migration_backfill(self):
+        '''完成各数据库的迁移回填'''
+        try:
+            scanned = await self.db.run_backfills(self.migration_chunk_size)
+            for name, versions in scanned.items():
+                logger.info(f"{name} 迁移回填完成: "
+                            + "，".join(f"版本 {version} 扫描 {count} 行" for version, count in versions.items()))
+        except Exception as e:
+            logger.error(f"迁移回填失败: {str(e)}")
+        # 回填可能补全了群成员等排行数据
+        self.pager.invalidate()
+        
+    async def _backup_loop(self):
+        '''定时备份，按最新快照的时间计算下一次备份'''
+        while True:
+            await asyncio.sleep(self.backup.seconds_until_due())
+            try:
+                await self.backup.run()
+            except Exception as e:
+                logger.error(f"签到数据备份失败: {str(e)}")
+                # 失败后等待一个间隔再重试
+                await asyncio.sleep(self.backup.interval_hours * 3600)
+            
+    async def _ranking_checkpoint_loop(self):
+        '''定期重新生成全服排行榜的跳页检查点，间隔为有效期的一半'''
+        while True:
+            for board in self.RANKING_COMMANDS:
+                try:
+                    await self._read(self.pager.build_checkpoints, board)
+                except Exception as e:
+                    logger.error(f"生成排行榜检查点失败 {board}: {str(e)}")
+            await asyncio.sleep(max(1, self.pager.cursor_ttl / 2))
+            
+    def _metrics_gauges(self) -> dict:
+        '''渲染队列和锁的即时状态'''
+        gauges = {f"sign_render_{key}": value for key, value in self.admission.stats().items()}
+        gauges.update({f"sign_lock_{key}": value for key, value in self.locks.stats().items()})
+        gauges['sign_idempotent_replays'] = self.idempotency.hits
+        if self.db.read_pool:
+            gauges.update({f"sign_read_pool_{key}": value for key, value in self.db.read_pool.stats().items()})
+        if self.coherence:
+            gauges.update({f"sign_coherence_{key}": value for key, value in self._coherence_stats().items()})
+        return gauges
+        
+    def _coherence_stats(self) -> dict:
+        '''各分片缓存一致性检查的合计'''
+        totals = {'changes': 0, 'resets': 0}
+        for monitor in self.coherence:
+            stats = monitor.stats()
+            for key in totals:
+                totals[key] += stats[key]
+        return totals
         
+    def _export_metrics(self):
+        try:
+            self.metrics.export(self.metrics_path, self._metrics_gauges())
+        except Exception as e:
+            logger.error(f"导出签到指标失败: {str(e)}")
+            
+    async def _coherence_loop(self):
+        '''定期检查其他实例的写入'''
+        while True:
+            await asyncio.sleep(self.coherence_interval)
+            try:
+                for monitor in self.coherence:
+                    monitor.poll()
+            except Exception as e:
+                logger.error(f"检查缓存一致性失败: {str(e)}")
+            
+    async def _metrics_export_loop(self):
+        '''定期导出运行指标'''
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            self._export_metrics()
+            
+    async def _stop_profiler_later(self, seconds: float):
+        '''到时自动停止采样'''
+        await asyncio.sleep(seconds)
+        result = self.profiler.stop()
+        if result:
+            logger.info(f"性能采样已自动停止，共 {result['samples']} 个样本，输出: {result['path']}")
+            
+    async def terminate(self):
+        '''插件卸载时停止后台任务并关闭数据库'''
+        for task in self._tasks:
+            task.cancel()
+        if self._profile_task:
+            self._profile_task.cancel()
+        self.profiler.stop()
+        if self.metrics_interval > 0:
+            self._export_metrics()
+        self.admission.clear_cache()
+        self.db.close()
+        
+    async def _reply(self, event: AstrMessageEvent, text: str, cache_ttl: float = 0, cached_only: bool = False):
+        '''以图片形式回复，渲染被降级或失败时回复纯文本
+        cache_ttl 大于 0 时相同内容的图片在这段时间内复用，不再重复渲染
+        cached_only 为 True 时只复用缓存中的图片，没有缓存时回复纯文本
+        '''
+        group_id = event.get_group_id() if event.message_obj.group_id else None
+        with self.metrics.phase('render'):
+            image_path = await self.admission.acquire(text, group_id, cache_ttl, cached_only=cached_only)
+        try:
+            if image_path:
+                yield event.image_result(image_path)
+            else:
+                yield event.plain_result(text)
+        finally:
+            self.admission.release(image_path)
+            
     @filter.command("签到")
+    @instrumented
     async def sign(self, event: AstrMessageEvent):
         '''每日签到'''
         try:
             user_id = event.get_sender_id()
             group_id = event.get_group_id() if event.message_obj.group_id else None
-            today = datetime.date.today().strftime('%Y-%m-%d')
-            
-            user_data = self.db.get_user_data(user_id)
-            
-            if user_data and user_data.get('last_sign') == today:
-                image_path = await self.img_gen.create_sign_image("今天已经签到过啦~")
-                if image_path:
-                    yield event.image_result(image_path)
-                    if os.path.exists(image_path):
-                        os.remove(image_path)
-                return
-
-            # 执行签到逻辑
-            result = SignManager.daily_sign(user_data, group_id, self.db)
-            
-            # 更新用户数据
-            self.db.update_user_data(
-                user_id,
-                group_id=group_id,
-                total_days=result['total_days'],
-                last_sign=today,
-                continuous_days=result['continuous_days'],
-                exp=result['exp'],
-                coins=result['coins'],
-                level=result['level'],
-                next_level_exp=result['next_level_exp']
-            )
-
-            # 存储用户昵称
-            user_name = event.get_sender_name()
-            self.db.update_user_name(user_id, user_name, group_id)
-            
-            # 处理新获得的称号
-            new_titles = result.get('new_titles', [])
-            for title in new_titles:
-                self.db.add_user_title(user_id, title)
-            
-            # 如果获得了【七日先锋】或【永恒裁决者】称号，但之前有断签，则需要收回称号
-            if result['continuous_days'] < 7 and '七日先锋' not in new_titles:
-                # 检查用户是否拥有【七日先锋】称号
-                user_titles = self.db.get_user_titles(user_id)
-                for title, is_active in user_titles:
-                    if title == "七日先锋":
-                        # 移除称号
-                        self.db.cursor.execute(
-                            'DELETE FROM user_titles WHERE user_id = ? AND title = ?', 
-                            (user_id, "七日先锋")
-                        )
-                        self.db.conn.commit()
-                        break
-            
-            if result['continuous_days'] < 30 and '永恒裁决者' not in new_titles:
-                # 检查用户是否拥有【永恒裁决者】称号
-                user_titles = self.db.get_user_titles(user_id)
-                for title, is_active in user_titles:
-                    if title == "永恒裁决者":
-                        # 移除称号
-                        self.db.cursor.execute(
-                            'DELETE FROM user_titles WHERE user_id = ? AND title = ?', 
-                            (user_id, "永恒裁决者")
+            # 一次请求内只计算一次签到日，避免零点前后各处日期不一致
+            sign_day = self.clock.today()
+            today = sign_day.strftime('%Y-%m-%d')
+            request_key = self.idempotency.request_key(event)
+            # 同一用户的签到串行执行，读取-计算-写入之间不会被同一用户的其他请求插入
+            async with self.locks.hold(f"user:{user_id}"):
+                # 平台重投的消息直接重放第一次的回复，不重复写库
+                replay = self.idempotency.get(request_key, user_id)
+                if replay:
+                    result_text = replay['response']
+                else:
+                    # 本次请求内缓存用户和城堡数据
+                    ctx = SignContext(self.db, user_id, group_id)
+                
+                    user_data = ctx.user_data
+                
+                    if user_data and user_data.get('last_sign') == today:
+                        result_text = "今天已经签到过啦~"
+                    else:
+                        # 执行签到逻辑
+                        result = SignManager.daily_sign(
+                            user_data, group_id, self.db,
+                            today=sign_day, rng=self.reward_rng.for_key(user_id, sign_day), ctx=ctx
                         )
-                        self.db.conn.commit()
-                        break
-            
-            # 记录签到历史
-            self.db.log_sign(user_id, result['exp'], result['coins'])
-            
-            # 生成结果消息
-            result_text = SignManager.format_sign_result(result, group_id, self.db)
+                    
+                        # 签到的所有写入和幂等记录在同一事务中提交，中途失败时整体回滚，重投的消息会重新签到
+                        with self.db.transaction(user_id):
+                            # 更新用户数据
+                            self.db.update_user_data(
+                                user_id,
+                                ctx=ctx,
+                                group_id=group_id,
+                                total_days=result['total_days'],
+                                last_sign=today,
+                                continuous_days=result['continuous_days'],
+                                exp=result['exp'],
+                                coins=result['coins'],
+                                level=result['level'],
+                                next_level_exp=result['next_level_exp']
+                            )
 
-            image_path = await self.img_gen.create_sign_image(result_text)
-            if image_path:
-                yield event.image_result(image_path)
-                if os.path.exists(image_path):
-                    os.remove(image_path)
+                            # 存储用户昵称
+                            user_name = event.get_sender_name()
+                            self.db.update_user_name(user_id, user_name, group_id, ctx=ctx)
+                        
+                            # 批量授予新称号、收回断签失效的称号
+                            self.db.apply_title_changes(user_id, result['new_titles'], result['revoked_titles'], ctx=ctx)
+                        
+                            # 记录签到历史
+                            self.db.log_sign(user_id, result['exp'], result['coins'], sign_date=today)
+                        
+                            # 生成结果消息
+                            result_text = SignManager.format_sign_result(result, group_id, self.db, ctx=ctx)
+                            self.idempotency.put(request_key, user_id, result, result_text)
+
+            # 图片渲染在锁外进行。有幂等键的签到图片缓存一段时间，重投的消息直接复用，
+            # 缓存过期后重放只回复纯文本，不再渲染
+            cache_ttl = self.sign_replay_cache_ttl if request_key else 0
+            async for response in self._reply(event, result_text, cache_ttl, cached_only=bool(replay)):
+                yield response
 
         except Exception as e:
             logger.error(f"签到失败: {str(e)}")
             yield event.plain_result("签到失败了~请联系管理员检查日志")
             
     @filter.command("个人信息")
+    @instrumented
     async def user_info(self, event: AstrMessageEvent):
         '''查看个人信息'''
         try:
             user_id = event.get_sender_id()
             group_id = event.get_group_id() if event.message_obj.group_id else None
             
-            user_data = self.db.get_user_data(user_id)
+            ctx = SignContext(self.db, user_id, group_id)
+            
+            # 用户数据和当前激活的称号在只读连接上读取
+            user_data, active_title = await self._read(lambda: (ctx.user_data, ctx.user_data and ctx.active_title))
             if not user_data:
                 yield event.plain_result("您还没有签到过哦~")
                 return
                 
-            # 获取用户当前激活的称号
-            active_title = self.db.get_active_title(user_id)
-                
             result_text = SignManager.format_user_info(user_data, active_title)
             
-            image_path = await self.img_gen.create_sign_image(result_text)
-            if image_path:
-                yield event.image_result(image_path)
-                if os.path.exists(image_path):
-                    os.remove(image_path)
+            async for response in self._reply(event, result_text):
+                yield response
 
         except Exception as e:
             logger.error(f"获取个人信息失败: {str(e)}")
             yield event.plain_result("获取个人信息失败~请联系管理员检查日志")
-            
+
+    @filter.command("签到日历")
+    @instrumented
+    async def sign_calendar(self, event: AstrMessageEvent):
+        '''查看月度签到日历'''
+        try:
+            user_id = event.get_sender_id()
+            args = event.message_str.split()[1:]
+
+            today = self.clock.today()
+            year, month = today.year, today.month
+            if args:
+                try:
+                    year, month = (int(part) for part in args[0].split('-'))
+                    datetime.date(year, month, 1)
+                except ValueError:
+                    yield event.plain_result("命令格式错误，请使用: /签到日历 [年-月]，例如 /签到日历 2024-05")
+                    return
+
+            # 已有位图时在只读连接上读取，旧数据第一次查看时才在写连接上从签到历史回填
+            years = await self._read(self.db.read_sign_calendar, user_id) or self.db.get_sign_calendar(user_id)
+            if not years:
+                yield event.plain_result("您还没有签到过哦~")
+                return
+
+            result_text = SignCalendar.format_month(years, year, month, today)
+
+            async for response in self._reply(event, result_text):
+                yield response
+
+        except Exception as e:
+            logger.error(f"获取签到日历失败: {str(e)}")
+            yield event.plain_result("获取签到日历失败~请联系管理员检查日志")
+
+
+    RANKING_COMMANDS = {
+        'continuous': ("连续签到排行榜", "连续", SignManager.format_continuous_ranking),
+        'level': ("等级排行榜", "等级", SignManager.format_level_ranking),
+        'world': ("世界排行榜", "世界", SignManager.format_world_ranking),
+    }
+    RANKING_ALIASES = {"世界": 'world', "连续": 'continuous', "连续签到": 'continuous', "等级": 'level'}
+
+    async def _ranking_reply(self, event: AstrMessageEvent, board: str, args: list, group_id: str = None):
+        '''回复排行榜的一页
+        无参数时读物化排行榜的前 10 名；参数为页码时按键集分页翻页；参数为“我”时跳到自己所在的页。
+        传入 group_id 时为群内排行榜，只在本群签到过的成员中排名
+        '''
+        command, short_name, formatter = self.RANKING_COMMANDS[board]
+        if group_id:
+            command = f"群排行榜 {short_name}"
+        if not args and not group_id:
+            readers = {
+                'continuous': self.db.get_continuous_sign_ranking,
+                'level': self.db.get_level_ranking,
+                'world': self.db.get_world_sign_ranking,
+            }
+            ranking_data = await self._read(readers[board], self.pager.page_size)
+            result_text = formatter(ranking_data)
+            if len(ranking_data) == self.pager.page_size:
+                result_text += "\n" + SignManager.format_page_footer(command, 1)
+            async for response in self._reply(event, result_text):
+                yield response
+            return
+
+        user_id = event.get_sender_id()
+        highlight = None
+        if not args:
+            page = 1
+        elif args[0] == "我":
+            page = await self._read(self.pager.page_of, board, user_id, group_id)
+            if not page:
+                yield event.plain_result("您还没有在本群签到过哦~" if group_id else "您还没有签到过哦~")
+                return
+            highlight = user_id
+        else:
+            try:
+                page = int(args[0])
+            except ValueError:
+                yield event.plain_result(f"命令格式错误，请使用: /{command} [页码|我]")
+                return
+            if page < 1:
+                yield event.plain_result("页码必须大于0")
+                return
+
+        ranking_data = await self._read(self.pager.get_page, board, page, group_id)
+        total_pages = await self._read(self.pager.total_pages, group_id)
+        if not ranking_data and page > 1:
+            yield event.plain_result(f"{command}只有{total_pages}页")
+            return
+        start = (page - 1) * self.pager.page_size + 1
+        result_text = formatter(ranking_data, start=start, highlight=highlight)
+        if group_id:
+            result_text = "本群" + result_text
+        result_text += "\n" + SignManager.format_page_footer(command, page, max(total_pages, page))
+        # 翻页的内容与查询者无关（“我”所在页的标记除外），短时间内相同页面复用同一张图片
+        async for response in self._reply(event, result_text, self.ranking_cache_ttl):
+            yield response
 
     @filter.command("连续签到排行榜")
+    @instrumented
     async def continuous_ranking(self, event: AstrMessageEvent):
-        '''连续签到排行榜'''
+        '''连续签到排行榜，可跟页码或“我”'''
         try:
-            group_id = event.get_group_id() if event.message_obj.group_id else None
-            
-            ranking_data = self.db.get_continuous_sign_ranking(10)
-            result_text = SignManager.format_continuous_ranking(ranking_data, self.db)
-            
-            image_path = await self.img_gen.create_sign_image(result_text)
-            if image_path:
-                yield event.image_result(image_path)
-                if os.path.exists(image_path):
-                    os.remove(image_path)
+            async for response in self._ranking_reply(event, 'continuous', event.message_str.split()[1:]):
+                yield response
 
         except Exception as e:
             logger.error(f"获取连续签到排行榜失败: {str(e)}")
             yield event.plain_result("获取连续签到排行榜失败~请联系管理员检查日志")
             
     @filter.command("等级排行榜")
+    @instrumented
     async def level_ranking(self, event: AstrMessageEvent):
-        '''等级排行榜'''
+        '''等级排行榜，可跟页码或“我”'''
         try:
-            group_id = event.get_group_id() if event.message_obj.group_id else None
-            
-            ranking_data = self.db.get_level_ranking(10)
-            result_text = SignManager.format_level_ranking(ranking_data, self.db)
-            
-            image_path = await self.img_gen.create_sign_image(result_text)
-            if image_path:
-                yield event.image_result(image_path)
-                if os.path.exists(image_path):
-                    os.remove(image_path)
+            async for response in self._ranking_reply(event, 'level', event.message_str.split()[1:]):
+                yield response
 
         except Exception as e:
             logger.error(f"获取等级排行榜失败: {str(e)}")
             yield event.plain_result("获取等级排行榜失败~请联系管理员检查日志")
             
     @filter.command("世界排行榜")
+    @instrumented
     async def world_ranking(self, event: AstrMessageEvent):
-        '''世界总签到排行榜'''
+        '''世界总签到排行榜，可跟页码或“我”'''
         try:
-            ranking_data = self.db.get_world_sign_ranking(10)
-            result_text = SignManager.format_world_ranking(ranking_data, self.db)
-            
-            image_path = await self.img_gen.create_sign_image(result_text)
-            if image_path:
-                yield event.image_result(image_path)
-                if os.path.exists(image_path):
-                    os.remove(image_path)
+            async for response in self._ranking_reply(event, 'world', event.message_str.split()[1:]):
+                yield response
 
         except Exception as e:
             logger.error(f"获取世界排行榜失败: {str(e)}")
             yield event.plain_result("获取世界排行榜失败~请联系管理员检查日志")
             
+    @filter.command("排行榜")
+    @instrumented
+    async def ranking_handler(self, event: AstrMessageEvent):
+        '''排行榜翻页：/排行榜 [世界|连续|等级] [页码|我]'''
+        try:
+            args = event.message_str.split()[1:]
+            if not args or args[0] not in self.RANKING_ALIASES:
+                yield event.plain_result("命令格式错误，请使用: /排行榜 [世界|连续|等级] [页码|我]，例如 /排行榜 世界 3")
+                return
+                
+            async for response in self._ranking_reply(event, self.RANKING_ALIASES[args[0]], args[1:]):
+                yield response
+
+        except Exception as e:
+            logger.error(f"获取排行榜失败: {str(e)}")
+            yield event.plain_result("获取排行榜失败~请联系管理员检查日志")
+            
+    @filter.command("群排行榜")
+    @instrumented
+    async def group_ranking_handler(self, event: AstrMessageEvent):
+        '''本群成员的排行榜：/群排行榜 [世界|连续|等级] [页码|我]，默认世界排行'''
+        try:
+            group_id = event.get_group_id() if event.message_obj.group_id else None
+            if not group_id:
+                yield event.plain_result("群排行榜只能在群聊中查看哦~")
+                return
+                
+            args = event.message_str.split()[1:]
+            board = 'world'
+            if args and args[0] in self.RANKING_ALIASES:
+                board = self.RANKING_ALIASES[args[0]]
+                args = args[1:]
+            async for response in self._ranking_reply(event, board, args, group_id):
+                yield response
+
+        except Exception as e:
+            logger.error(f"获取群排行榜失败: {str(e)}")
+            yield event.plain_result("获取群排行榜失败~请联系管理员检查日志")
+            
     @filter.command("称号")
+    @instrumented
     async def titles_handler(self, event: AstrMessageEvent):
         '''显示已获得的称号'''
         try:
             user_id = event.get_sender_id()
             
             # 获取用户所有称号
-            user_titles = self.db.get_user_titles(user_id)
+            user_titles = await self._read(self.db.get_user_titles, user_id)
             
             if not user_titles:
                 yield event.plain_result("您还没有获得任何称号哦~")
@@ -203,17 +564,15 @@ class AdvancedSignPlugin(Star):
             title_list = "\n".join([f"【{title}】" for title, is_active in user_titles])
             result_text = f"您已获得的称号:\n{title_list}"
             
-            image_path = await self.img_gen.create_sign_image(result_text)
-            if image_path:
-                yield event.image_result(image_path)
-                if os.path.exists(image_path):
-                    os.remove(image_path)
+            async for response in self._reply(event, result_text):
+                yield response
         
         except Exception as e:
             logger.error(f"获取称号列表失败: {str(e)}")
             yield event.plain_result("获取称号列表失败~请联系管理员检查日志")
             
     @filter.command("使用称号")
+    @instrumented
     async def use_title_handler(self, event: AstrMessageEvent):
         '''使用称号'''
         try:
@@ -227,7 +586,7 @@ class AdvancedSignPlugin(Star):
             title_name = "".join(args)
             
             # 检查用户是否拥有该称号
-            user_titles = self.db.get_user_titles(user_id)
+            user_titles = await self._read(self.db.get_user_titles, user_id)
             title_exists = any(title == title_name for title, _ in user_titles)
             
             if not title_exists:
@@ -244,6 +603,7 @@ class AdvancedSignPlugin(Star):
             yield event.plain_result("使用称号失败~请联系管理员检查日志")
             
     @filter.command("不使用称号")
+    @instrumented
     async def unset_title_handler(self, event: AstrMessageEvent):
         '''取消使用称号'''
         try:
@@ -259,20 +619,12 @@ class AdvancedSignPlugin(Star):
             yield event.plain_result("取消使用称号失败~请联系管理员检查日志")
             
     @filter.command("称号大全")
+    @instrumented
     async def all_titles_handler(self, event: AstrMessageEvent):
         '''显示所有称号和获得途径'''
         try:
-            # 定义所有称号和获得途径
-            all_titles = [
-                "【签到新人】 - 首次签到获得",
-                "【签到达人】 - 累计签到7天获得",
-                "【月神之誓】 - 累计签到30天获得",
-                "【七日先锋】 - 连续签到7天获得（断签会收回）",
-                "【永恒裁决者】 - 连续签到30天获得（断签会收回）"
-            ]
-            
-            # 格式化称号列表
-            title_list = "\n".join(all_titles)
+            # 称号说明由称号规则生成
+            title_list = "\n".join(TITLE_ENGINE.describe())
             result_text = f"所有称号和获得途径:\n{title_list}"
             
             yield event.plain_result(result_text)
@@ -281,7 +633,236 @@ class AdvancedSignPlugin(Star):
             logger.error(f"获取称号大全失败: {str(e)}")
             yield event.plain_result("获取称号大全失败~请联系管理员检查日志")
             
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("签到统计")
+    @instrumented
+    async def metrics_handler(self, event: AstrMessageEvent):
+        '''查看插件运行统计（管理员）'''
+        try:
+            result_text = self.metrics.format_summary({
+                "渲染队列": self.admission.stats(),
+                "用户锁": self.locks.stats(),
+                "重投重放": {"hits": self.idempotency.hits},
+                "只读连接池": self.db.read_pool.stats() if self.db.read_pool else {"size": 0},
+                "缓存一致性": self._coherence_stats() if self.coherence else {"enabled": 0},
+            })
+            yield event.plain_result(result_text)
+            
+        except Exception as e:
+            logger.error(f"获取签到统计失败: {str(e)}")
+            yield event.plain_result("获取签到统计失败~请联系管理员检查日志")
+            
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("慢查询")
+    @instrumented
+    async def slow_query_handler(self, event: AstrMessageEvent):
+        '''查看按语句形状聚合的 SQL 耗时排行（管理员）'''
+        try:
+            if not self.db.slow_query_log:
+                yield event.plain_result("慢查询日志未开启，请在配置中设置 slow_query_ms")
+                return
+                
+            yield event.plain_result(self.db.slow_query_log.format_top(10))
+            
+        except Exception as e:
+            logger.error(f"获取慢查询统计失败: {str(e)}")
+            yield event.plain_result("获取慢查询统计失败~请联系管理员检查日志")
+            
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("重建排行榜")
+    @instrumented
+    async def rebuild_leaderboards_handler(self, event: AstrMessageEvent):
+        '''从用户和城堡数据全量重建物化排行榜（管理员）'''
+        try:
+            counts = self.db.rebuild_leaderboards()
+            if not counts:
+                yield event.plain_result("重建排行榜失败~请联系管理员检查日志")
+                return
+                
+            board_names = {
+                'world': "世界排行榜", 'continuous': "连续签到排行榜", 'level': "等级排行榜",
+                'castle_level': "城堡等级排行榜", 'castle_coins': "城堡金币排行榜",
+            }
+            lines = [f"{board_names.get(board, board)}: {count}条" for board, count in counts.items()]
+            self.pager.invalidate()
+            self.admission.clear_cache()
+            yield event.plain_result("排行榜已重建\n" + "\n".join(lines))
+            
+        except Exception as e:
+            logger.error(f"重建排行榜失败: {str(e)}")
+            yield event.plain_result("重建排行榜失败~请联系管理员检查日志")
+            
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("重新分片")
+    @instrumented
+    async def rebalance_shards_handler(self, event: AstrMessageEvent):
+        '''把单文件数据库和旧分片中的数据移到当前分片（管理员）'''
+        try:
+            if not isinstance(self.db, ShardedSignDatabase):
+                yield event.plain_result("未启用分片存储，请先在配置中设置 shard_count")
+                return
+                
+            yield event.plain_result(f"开始迁移到 {self.db.shard_count} 个分片，完成前排行榜可能不准确...")
+            moved = await ShardRebalancer(self.db).run()
+            self.pager.invalidate()
+            self.admission.clear_cache()
+            lines = [f"{table}: {count}行" for table, count in moved.items() if count]
+            yield event.plain_result("分片迁移完成\n" + ("\n".join(lines) if lines else "所有数据已在所属分片"))
+            
+        except Exception as e:
+            logger.error(f"分片迁移失败: {str(e)}")
+            yield event.plain_result("分片迁移失败~已迁移的数据不受影响，可以重新执行 /重新分片 继续")
+            
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("备份")
+    @instrumented
+    async def backup_handler(self, event: AstrMessageEvent):
+        '''立即备份，或查看已有的快照（管理员）'''
+        try:
+            if not self.backup.supported:
+                yield event.plain_result("当前存储不支持备份")
+                return
+                
+            args = event.message_str.split()[1:]
+            if args and args[0] == "列表":
+                snapshots = self.backup.list_snapshots()
+                if not snapshots:
+                    yield event.plain_result("还没有备份~")
+                    return
+                lines = []
+                for i, manifest in enumerate(snapshots, 1):
+                    size = sum(f['compressed_bytes'] for f in manifest['files'])
+                    lines.append(f"{i}. {manifest['id']}  {len(manifest['files'])}个文件  {size / 1024:.1f}KB")
+                yield event.plain_result("备份列表（新的在前）\n" + "\n".join(lines) + "\n恢复请使用: /恢复备份 序号")
+                return
+            if args:
+                yield event.plain_result("命令格式错误，请使用: /备份 或 /备份 列表")
+                return
+                
+            manifest = await self.backup.run()
+            size = sum(f['compressed_bytes'] for f in manifest['files'])
+            yield event.plain_result(
+                f"备份完成: {manifest['id']}\n{len(manifest['files'])} 个文件，压缩后 {size / 1024:.1f}KB，"
+                f"耗时 {manifest['seconds']} 秒"
+            )
+            
+        except Exception as e:
+            logger.error(f"备份失败: {str(e)}")
+            yield event.plain_result("备份失败~请联系管理员检查日志")
+            
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("恢复备份")
+    @instrumented
+    async def restore_backup_handler(self, event: AstrMessageEvent):
+        '''用快照覆盖当前数据，恢复前会检查快照完整性并备份当前数据（管理员）'''
+        try:
+            if not self.backup.supported:
+                yield event.plain_result("当前存储不支持备份")
+                return
+                
+            args = event.message_str.split()[1:]
+            if not args:
+                yield event.plain_result("命令格式错误，请使用: /恢复备份 序号或快照编号（序号见 /备份 列表）")
+                return
+            snapshot_id = self.backup.resolve(args[0])
+            if not snapshot_id:
+                yield event.plain_result("找不到该备份，请使用 /备份 列表 查看")
+                return
+                
+            try:
+                result = await self.backup.restore(snapshot_id)
+            except ValueError as e:
+                yield event.plain_result(f"备份校验未通过，当前数据未修改\n{str(e)}")
+                return
+            # 数据已被整体替换，丢弃本进程的所有缓存
+            self.pager.invalidate()
+            self.admission.clear_cache()
+            self.idempotency.clear_cache()
+            for monitor in self.coherence:
+                monitor.resync()
+            # 较早的备份可能有未完成的迁移回填
+            self._start_migration_backfill()
+            yield event.plain_result(
+                f"已从备份 {result['id']} 恢复\n恢复前的数据已备份为 {result['pre_restore']}，如需撤销可恢复该备份"
+            )
+            
+        except Exception as e:
+            logger.error(f"恢复备份失败: {str(e)}")
+            yield event.plain_result("恢复备份失败~请联系管理员检查日志")
+            
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("数据迁移")
+    @instrumented
+    async def migration_handler(self, event: AstrMessageEvent):
+        '''查看表结构版本和未完成的迁移回填（管理员）'''
+        try:
+            # 估计剩余行数需要扫描来源表，在线程池中通过只读连接进行
+            statuses = await asyncio.to_thread(self.db.migration_status)
+            if not statuses:
+                yield event.plain_result("当前存储不需要迁移")
+                return
+                
+            lines = []
+            for name, status in statuses.items():
+                prefix = f"{name} " if len(statuses) > 1 else ""
+                lines.append(f"{prefix}表结构版本 {status['version']}（插件支持 {status['latest']}）")
+                for step in status['steps']:
+                    rows = f"{'' if step['exact'] else '至多'}{step['rows']} 行"
+                    lines.append(f"- 版本 {step['version']} {step['description']}\n  回填中，进度 rowid {step['cursor']}，估计剩余 {rows}")
+            running = self._migration_task is not None and not self._migration_task.done()
+            if not any(status['steps'] for status in statuses.values()):
+                lines.append("所有迁移已完成")
+            elif not running:
+                self._start_migration_backfill()
+                lines.append("已重新启动后台回填")
+            yield event.plain_result("\n".join(lines))
+            
+        except Exception as e:
+            logger.error(f"查看数据迁移失败: {str(e)}")
+            yield event.plain_result("查看数据迁移失败~请联系管理员检查日志")
+            
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("性能分析")
+    @instrumented
+    async def profiler_handler(self, event: AstrMessageEvent):
+        '''开启或停止采样分析（管理员）'''
+        try:
+            args = event.message_str.split()[1:]
+            action = args[0] if args else ("停止" if self.profiler.running else "开始")
+            
+            if action == "开始":
+                try:
+                    seconds = min(int(args[1]), 600) if len(args) > 1 else 60
+                except ValueError:
+                    yield event.plain_result("采样时长必须是数字")
+                    return
+                if not self.profiler.start():
+                    yield event.plain_result("性能分析已在运行中~")
+                    return
+                self._profile_task = asyncio.get_event_loop().create_task(self._stop_profiler_later(seconds))
+                yield event.plain_result(f"性能分析已开始，{seconds} 秒后自动停止，也可发送 /性能分析 停止")
+            elif action == "停止":
+                if self._profile_task:
+                    self._profile_task.cancel()
+                    self._profile_task = None
+                result = self.profiler.stop()
+                if not result:
+                    yield event.plain_result("性能分析没有在运行~")
+                    return
+                top = "\n".join(f"{name} {count}" for name, count in result['top'])
+                yield event.plain_result(
+                    f"性能分析已停止，采样 {result['ticks']} 次，有效样本 {result['samples']} 个\n"
+                    f"折叠栈文件: {result['path']}\n自身耗时最多的函数:\n{top}"
+                )
+            else:
+                yield event.plain_result("命令格式错误，请使用: /性能分析 开始 [秒数] 或 /性能分析 停止")
+                
+        except Exception as e:
+            logger.error(f"性能分析失败: {str(e)}")
+            yield event.plain_result("性能分析失败~请联系管理员检查日志")
+            
     @filter.command("购买")
+    @instrumented
     async def buy_item(self, event: AstrMessageEvent):
         '''购买物品'''
         try:
@@ -304,7 +885,8 @@ class AdvancedSignPlugin(Star):
                 return
                 
             # 执行购买逻辑
-            result = SignManager.buy_item(user_id, item_name, quantity, self.db)
+            async with self.locks.hold(f"user:{user_id}"):
+                result = SignManager.buy_item(user_id, item_name, quantity, self.db, ctx=SignContext(self.db, user_id))
             
             if result['success']:
                 yield event.plain_result(f"购买成功！花费了{result['cost']}金币，获得了{quantity}张补签卡")
@@ -316,6 +898,7 @@ class AdvancedSignPlugin(Star):
             yield event.plain_result("购买物品失败~请联系管理员检查日志")
             
     @filter.command("补签")
+    @instrumented
     async def resign(self, event: AstrMessageEvent):
         '''补签'''
         try:
@@ -330,7 +913,13 @@ class AdvancedSignPlugin(Star):
                 return
                 
             # 执行补签逻辑
-            result = SignManager.resign(user_id, days, group_id, self.db)
+            today = self.clock.today()
+            async with self.locks.hold(f"user:{user_id}"):
+                result = SignManager.resign(
+                    user_id, days, group_id, self.db,
+                    today=today, rng=self.reward_rng.for_key(f"resign:{user_id}", today),
+                    ctx=SignContext(self.db, user_id, group_id)
+                )
             
             if result['success']:
                 yield event.plain_result(f"补签成功！消耗了{result['cost']}张补签卡和{result['coins']}金币")
@@ -342,25 +931,24 @@ class AdvancedSignPlugin(Star):
             yield event.plain_result("补签失败~请联系管理员检查日志")
             
     @filter.command("查看背包")
+    @instrumented
     async def view_inventory(self, event: AstrMessageEvent):
         '''查看背包'''
         try:
             user_id = event.get_sender_id()
             
-            inventory = self.db.get_user_inventory(user_id)
+            inventory = await self._read(self.db.get_user_inventory, user_id)
             result_text = SignManager.format_inventory(inventory)
             
-            image_path = await self.img_gen.create_sign_image(result_text)
-            if image_path:
-                yield event.image_result(image_path)
-                if os.path.exists(image_path):
-                    os.remove(image_path)
+            async for response in self._reply(event, result_text):
+                yield response
 
         except Exception as e:
             logger.error(f"查看背包失败: {str(e)}")
             yield event.plain_result("查看背包失败~请联系管理员检查日志")
             
     @filter.command("签到商店")
+    @instrumented
     async def sign_shop(self, event: AstrMessageEvent):
         '''签到商店'''
         try:
@@ -374,17 +962,15 @@ class AdvancedSignPlugin(Star):
             for item_name, price, description in shop_items:
                 result_text += f"{item_name} - {price}金币\n{description}\n\n"
             
-            image_path = await self.img_gen.create_sign_image(result_text)
-            if image_path:
-                yield event.image_result(image_path)
-                if os.path.exists(image_path):
-                    os.remove(image_path)
+            async for response in self._reply(event, result_text):
+                yield response
 
         except Exception as e:
             logger.error(f"查看签到商店失败: {str(e)}")
             yield event.plain_result("查看签到商店失败~请联系管理员检查日志")
             
     @filter.command("我的排名")
+    @instrumented
     async def my_ranking(self, event: AstrMessageEvent):
         '''显示自己在世界排行榜、连续签到排行榜和等级排行榜的排名'''
         try:
@@ -392,35 +978,30 @@ class AdvancedSignPlugin(Star):
             group_id = event.get_group_id() if event.message_obj.group_id else None
             
             # 获取用户数据
-            user_data = self.db.get_user_data(user_id)
+            user_data = await self._read(self.db.get_user_data, user_id)
             if not user_data:
                 yield event.plain_result("您还没有签到过哦~")
                 return
                 
             # 获取各项排名（使用修复后的方法）
-            world_total_rank = self.db.get_world_sign_rank(user_id)
-            continuous_rank = self.db.get_continuous_sign_rank(user_id)
-            
-            # 获取等级排名
-            self.db.cursor.execute('''
-                SELECT COUNT(*) + 1 FROM sign_data
-                WHERE level > ? OR (level = ? AND exp > ?)
-            ''', (user_data['level'], user_data['level'], user_data['exp']))
-            level_rank_row = self.db.cursor.fetchone()
-            level_rank = level_rank_row[0] if level_rank_row else 1
+            world_total_rank, continuous_rank, level_rank, group_rank = await self._read(lambda: (
+                self.db.get_world_sign_rank(user_id),
+                self.db.get_continuous_sign_rank(user_id),
+                # 用已读到的等级和经验作为等级排行榜的排序键，名次与排行榜一致且不必再查一次
+                self.db.count_ranking_before('level', (user_data['level'], user_data['exp'], user_id)) + 1,
+                self.db.get_group_sign_rank(group_id, user_id) if group_id else 0
+            ))
             
             # 格式化结果
             result_text = SignManager.format_my_ranking(
                 world_total_rank=world_total_rank,
                 continuous_rank=continuous_rank,
-                level_rank=level_rank
+                level_rank=level_rank,
+                group_rank=group_rank
             )
             
-            image_path = await self.img_gen.create_sign_image(result_text)
-            if image_path:
-                yield event.image_result(image_path)
-                if os.path.exists(image_path):
-                    os.remove(image_path)
+            async for response in self._reply(event, result_text):
+                yield response
 
         except Exception as e:
             logger.error(f"获取我的排名失败: {str(e)}")
@@ -429,6 +1010,7 @@ class AdvancedSignPlugin(Star):
     from .castle_manager import CastleManager
     
     @filter.command("创建城堡")
+    @instrumented
     async def create_castle(self, event: AstrMessageEvent):
         '''创建城堡'''
         try:
@@ -439,40 +1021,17 @@ class AdvancedSignPlugin(Star):
                 yield event.plain_result("只能在群聊中创建城堡哦~")
                 return
                 
-            # 检查是否已有城堡
-            castle = self.db.get_castle_by_group(group_id)
-            if castle:
-                yield event.plain_result("该群聊已经有城堡了哦~")
-                return
-                
-            args = event.message_str.split()[1:]
-            if len(args) < 1:
-                yield event.plain_result("命令格式错误，请使用: /创建城堡 城堡名称 [参与者1] [参与者2] ... [参与者5]")
-                return
-                
-            castle_name = args[0]
-            
-            # 检查城堡名称是否已存在
-            if self.db.check_castle_name_exists(castle_name):
-                yield event.plain_result("城堡名称已存在，请换一个名称~")
-                return
-                
-            # 获取参与者列表
-            participant_ids = args[1:6]  # 最多5个参与者
-            
-            # 创建城堡
-            if self.db.create_castle(group_id, castle_name, user_id, participant_ids):
-                # 选举创建者为领主
-                self.db.elect_lord(group_id, user_id)
-                yield event.plain_result(f"城堡【{castle_name}】创建成功！创建者{user_id}自动成为领主。")
-            else:
-                yield event.plain_result("创建城堡失败，请稍后再试~")
+            # 同一城堡的成员、职位变更都在城堡锁内读改写，避免并发命令互相覆盖
+            async with self.locks.hold(f"castle:{group_id}"):
+                reply = self._create_castle(user_id, group_id, event.message_str.split()[1:])
+            yield event.plain_result(reply)
                 
         except Exception as e:
             logger.error(f"创建城堡失败: {str(e)}")
             yield event.plain_result("创建城堡失败~请联系管理员检查日志")
             
     @filter.command("查看城堡")
+    @instrumented
     async def view_castle(self, event: AstrMessageEvent):
         '''查看城堡信息'''
         try:
@@ -482,20 +1041,18 @@ class AdvancedSignPlugin(Star):
                 yield event.plain_result("只能在群聊中查看城堡哦~")
                 return
                 
-            castle = self.db.get_castle_by_group(group_id)
-            result_text = CastleManager.format_castle_info(castle, self.db)
+            ctx = SignContext(self.db, None, group_id)
+            result_text = await self._read(lambda: CastleManager.format_castle_info(ctx.castle, self.db, ctx=ctx))
             
-            image_path = await self.img_gen.create_sign_image(result_text)
-            if image_path:
-                yield event.image_result(image_path)
-                if os.path.exists(image_path):
-                    os.remove(image_path)
+            async for response in self._reply(event, result_text):
+                yield response
                     
         except Exception as e:
             logger.error(f"查看城堡失败: {str(e)}")
             yield event.plain_result("查看城堡失败~请联系管理员检查日志")
             
     @filter.command("加入城堡")
+    @instrumented
     async def join_castle(self, event: AstrMessageEvent):
         '''加入城堡'''
         try:
@@ -506,50 +1063,36 @@ class AdvancedSignPlugin(Star):
                 yield event.plain_result("只能在群聊中加入城堡哦~")
                 return
                 
-            # 检查是否已有城堡
-            castle = self.db.get_castle_by_group(group_id)
-            if not castle:
-                yield event.plain_result("该群聊还没有建造城堡哦~")
-                return
-                
-            # 加入城堡
-            if self.db.join_castle(group_id, user_id):
-                yield event.plain_result("成功加入城堡！")
-            else:
-                yield event.plain_result("加入城堡失败，请稍后再试~")
+            async with self.locks.hold(f"castle:{group_id}"):
+                reply = self._join_castle(user_id, group_id)
+            yield event.plain_result(reply)
                 
         except Exception as e:
             logger.error(f"加入城堡失败: {str(e)}")
             yield event.plain_result("加入城堡失败~请联系管理员检查日志")
             
     @filter.command("退出城堡")
+    @instrumented
     async def leave_castle(self, event: AstrMessageEvent):
-            '''退出城堡'''
-            try:
-                user_id = event.get_sender_id()
-                group_id = event.get_group_id() if event.message_obj.group_id else None
+        '''退出城堡'''
+        try:
+            user_id = event.get_sender_id()
+            group_id = event.get_group_id() if event.message_obj.group_id else None
+            
+            if not group_id:
+                yield event.plain_result("只能在群聊中退出城堡哦~")
+                return
                 
-                if not group_id:
-                    yield event.plain_result("只能在群聊中退出城堡哦~")
-                    return
-                    
-                # 检查是否已有城堡
-                castle = self.db.get_castle_by_group(group_id)
-                if not castle:
-                    yield event.plain_result("该群聊还没有建造城堡哦~")
-                    return
-                    
-                # 退出城堡
-                if self.db.leave_castle(group_id, user_id):
-                    yield event.plain_result("成功退出城堡！")
-                else:
-                    yield event.plain_result("退出城堡失败，请稍后再试~")
-                    
-            except Exception as e:
-                logger.error(f"退出城堡失败: {str(e)}")
-                yield event.plain_result("退出城堡失败~请联系管理员检查日志")
+            async with self.locks.hold(f"castle:{group_id}"):
+                reply = self._leave_castle(user_id, group_id)
+            yield event.plain_result(reply)
                 
+        except Exception as e:
+            logger.error(f"退出城堡失败: {str(e)}")
+            yield event.plain_result("退出城堡失败~请联系管理员检查日志")
+            
     @filter.command("升级城堡")
+    @instrumented
     async def upgrade_castle(self, event: AstrMessageEvent):
         '''升级城堡'''
         try:
@@ -560,44 +1103,17 @@ class AdvancedSignPlugin(Star):
                 yield event.plain_result("只能在群聊中升级城堡哦~")
                 return
                 
-            # 检查是否已有城堡
-            castle = self.db.get_castle_by_group(group_id)
-            if not castle:
-                yield event.plain_result("该群聊还没有建造城堡哦~")
-                return
-                
-            # 检查是否是领主
-            if castle['lord_id'] != user_id:
-                yield event.plain_result("只有领主才能升级城堡哦~")
-                return
-                
-            # 获取升级成本
-            level = castle['level']
-            if level >= 5:
-                yield event.plain_result("城堡已达到最高等级！")
-                return
-                
-            upgrade_cost = CastleManager.CASTLE_UPGRADE_COSTS.get(level)
-            if not upgrade_cost:
-                yield event.plain_result("无法获取升级成本信息，请联系管理员~")
-                return
-                
-            # 检查资源是否足够
-            if castle['exp'] < upgrade_cost['exp'] or castle['coins'] < upgrade_cost['coins']:
-                yield event.plain_result(f"城堡资源不足！需要经验:{upgrade_cost['exp']}, 金币:{upgrade_cost['coins']}")
-                return
-                
-            # 升级城堡
-            if self.db.upgrade_castle(group_id, upgrade_cost['exp'], upgrade_cost['coins']):
-                yield event.plain_result(f"城堡升级成功！当前等级:{level+1}")
-            else:
-                yield event.plain_result("升级城堡失败，请稍后再试~")
+            # 同一城堡的升级、捐献和成员变更串行执行，避免重复扣除资源
+            async with self.locks.hold(f"castle:{group_id}"):
+                reply = self._upgrade_castle(user_id, group_id)
+            yield event.plain_result(reply)
                 
         except Exception as e:
             logger.error(f"升级城堡失败: {str(e)}")
             yield event.plain_result("升级城堡失败~请联系管理员检查日志")
             
     @filter.command("捐献金币")
+    @instrumented
     async def donate_coins(self, event: AstrMessageEvent):
         '''捐献金币到城堡'''
         try:
@@ -608,12 +1124,6 @@ class AdvancedSignPlugin(Star):
                 yield event.plain_result("只能在群聊中捐献金币哦~")
                 return
                 
-            # 检查是否已有城堡
-            castle = self.db.get_castle_by_group(group_id)
-            if not castle:
-                yield event.plain_result("该群聊还没有建造城堡哦~")
-                return
-                
             args = event.message_str.split()[1:]
             if len(args) < 1:
                 yield event.plain_result("命令格式错误，请使用: /捐献金币 金币数量")
@@ -629,28 +1139,17 @@ class AdvancedSignPlugin(Star):
                 yield event.plain_result("金币数量必须大于0")
                 return
                 
-            # 检查用户是否有足够金币
-            user_data = self.db.get_user_data(user_id)
-            if not user_data or user_data['coins'] < amount:
-                yield event.plain_result("您的金币不足！")
-                return
-                
-            # 捐献金币
-            if self.db.donate_coins(group_id, user_id, amount):
-                # 扣除用户金币
-                self.db.update_user_data(user_id, coins=user_data['coins'] - amount)
-                # 增加城堡经验
-                castle_exp_gain = CastleManager.get_castle_exp_gain()
-                self.db.add_castle_exp(group_id, castle_exp_gain)
-                yield event.plain_result(f"成功捐献{amount}金币到城堡！城堡获得{castle_exp_gain}经验。")
-            else:
-                yield event.plain_result("捐献金币失败，请稍后再试~")
+            # 同时修改用户金币和城堡资源，两把锁按固定顺序获取
+            async with self.locks.hold(f"user:{user_id}", f"castle:{group_id}"):
+                reply = self._donate_coins(user_id, group_id, amount)
+            yield event.plain_result(reply)
                 
         except Exception as e:
             logger.error(f"捐献金币失败: {str(e)}")
             yield event.plain_result("捐献金币失败~请联系管理员检查日志")
             
     @filter.command("选举领主")
+    @instrumented
     async def elect_lord(self, event: AstrMessageEvent):
         '''选举领主'''
         try:
@@ -661,43 +1160,16 @@ class AdvancedSignPlugin(Star):
                 yield event.plain_result("只能在群聊中选举领主哦~")
                 return
                 
-            # 检查是否已有城堡
-            castle = self.db.get_castle_by_group(group_id)
-            if not castle:
-                yield event.plain_result("该群聊还没有建造城堡哦~")
-                return
-                
-            # 检查是否是领主
-            if castle['lord_id'] != user_id:
-                yield event.plain_result("只有领主才能选举新的领主哦~")
-                return
-                
-            args = event.message_str.split()[1:]
-            if len(args) < 1:
-                yield event.plain_result("命令格式错误，请使用: /选举领主 @用户")
-                return
-                
-            # 解析被选举用户ID
-            target_user_id = args[0]
-            if target_user_id.startswith("@"):
-                target_user_id = target_user_id[1:]
-                
-            # 检查用户是否是城堡成员
-            if target_user_id not in castle['members']:
-                yield event.plain_result("被选举用户不是城堡成员！")
-                return
-                
-            # 选举领主
-            if self.db.elect_lord(group_id, target_user_id):
-                yield event.plain_result(f"成功选举{target_user_id}为新领主！")
-            else:
-                yield event.plain_result("选举领主失败，请稍后再试~")
+            async with self.locks.hold(f"castle:{group_id}"):
+                reply = self._elect_lord(user_id, group_id, event.message_str.split()[1:])
+            yield event.plain_result(reply)
                 
         except Exception as e:
             logger.error(f"选举领主失败: {str(e)}")
             yield event.plain_result("选举领主失败~请联系管理员检查日志")
             
     @filter.command("选举总管")
+    @instrumented
     async def elect_manager(self, event: AstrMessageEvent):
         '''选举总管'''
         try:
@@ -708,43 +1180,16 @@ class AdvancedSignPlugin(Star):
                 yield event.plain_result("只能在群聊中选举总管哦~")
                 return
                 
-            # 检查是否已有城堡
-            castle = self.db.get_castle_by_group(group_id)
-            if not castle:
-                yield event.plain_result("该群聊还没有建造城堡哦~")
-                return
-                
-            # 检查是否是领主
-            if castle['lord_id'] != user_id:
-                yield event.plain_result("只有领主才能选举总管哦~")
-                return
-                
-            args = event.message_str.split()[1:]
-            if len(args) < 1:
-                yield event.plain_result("命令格式错误，请使用: /选举总管 @用户")
-                return
-                
-            # 解析被选举用户ID
-            target_user_id = args[0]
-            if target_user_id.startswith("@"):
-                target_user_id = target_user_id[1:]
-                
-            # 检查用户是否是城堡成员
-            if target_user_id not in castle['members']:
-                yield event.plain_result("被选举用户不是城堡成员！")
-                return
-                
-            # 选举总管
-            if self.db.elect_manager(group_id, target_user_id):
-                yield event.plain_result(f"成功选举{target_user_id}为总管！")
-            else:
-                yield event.plain_result("选举总管失败，请稍后再试~")
+            async with self.locks.hold(f"castle:{group_id}"):
+                reply = self._elect_manager(user_id, group_id, event.message_str.split()[1:])
+            yield event.plain_result(reply)
                 
         except Exception as e:
             logger.error(f"选举总管失败: {str(e)}")
             yield event.plain_result("选举总管失败~请联系管理员检查日志")
             
     @filter.command("罢免总管")
+    @instrumented
     async def dismiss_manager(self, event: AstrMessageEvent):
         '''罢免总管'''
         try:
@@ -755,71 +1200,194 @@ class AdvancedSignPlugin(Star):
                 yield event.plain_result("只能在群聊中罢免总管哦~")
                 return
                 
-            # 检查是否已有城堡
-            castle = self.db.get_castle_by_group(group_id)
-            if not castle:
-                yield event.plain_result("该群聊还没有建造城堡哦~")
-                return
-                
-            # 检查是否是领主
-            if castle['lord_id'] != user_id:
-                yield event.plain_result("只有领主才能罢免总管哦~")
-                return
-                
-            args = event.message_str.split()[1:]
-            if len(args) < 1:
-                yield event.plain_result("命令格式错误，请使用: /罢免总管 @用户")
-                return
-                
-            # 解析被罢免用户ID
-            target_user_id = args[0]
-            if target_user_id.startswith("@"):
-                target_user_id = target_user_id[1:]
-                
-            # 检查用户是否是总管
-            if target_user_id not in castle['managers']:
-                yield event.plain_result("被罢免用户不是总管！")
-                return
-                
-            # 罢免总管
-            if self.db.dismiss_manager(group_id, target_user_id):
-                yield event.plain_result(f"成功罢免{target_user_id}的总管职务！")
-            else:
-                yield event.plain_result("罢免总管失败，请稍后再试~")
+            async with self.locks.hold(f"castle:{group_id}"):
+                reply = self._dismiss_manager(user_id, group_id, event.message_str.split()[1:])
+            yield event.plain_result(reply)
                 
         except Exception as e:
             logger.error(f"罢免总管失败: {str(e)}")
             yield event.plain_result("罢免总管失败~请联系管理员检查日志")
             
+    def _create_castle(self, user_id: str, group_id: str, args: list) -> str:
+        '''创建城堡，需在城堡锁内调用，返回回复文本'''
+        # 检查是否已有城堡
+        ctx = SignContext(self.db, user_id, group_id)
+        if ctx.castle:
+            return "该群聊已经有城堡了哦~"
+            
+        if len(args) < 1:
+            return "命令格式错误，请使用: /创建城堡 城堡名称 [参与者1] [参与者2] ... [参与者5]"
+            
+        castle_name = args[0]
+        
+        # 检查城堡名称是否已存在
+        if self.db.check_castle_name_exists(castle_name):
+            return "城堡名称已存在，请换一个名称~"
+            
+        # 获取参与者列表
+        participant_ids = args[1:6]  # 最多5个参与者
+        
+        # 创建城堡
+        if not self.db.create_castle(group_id, castle_name, user_id, participant_ids, ctx=ctx):
+            return "创建城堡失败，请稍后再试~"
+        # 选举创建者为领主
+        self.db.elect_lord(group_id, user_id, ctx=ctx)
+        return f"城堡【{castle_name}】创建成功！创建者{user_id}自动成为领主。"
+        
+    def _join_castle(self, user_id: str, group_id: str) -> str:
+        '''加入城堡，需在城堡锁内调用，返回回复文本'''
+        ctx = SignContext(self.db, user_id, group_id)
+        if not ctx.castle:
+            return "该群聊还没有建造城堡哦~"
+        if self.db.join_castle(group_id, user_id, ctx=ctx):
+            return "成功加入城堡！"
+        return "加入城堡失败，请稍后再试~"
+        
+    def _leave_castle(self, user_id: str, group_id: str) -> str:
+        '''退出城堡，需在城堡锁内调用，返回回复文本'''
+        ctx = SignContext(self.db, user_id, group_id)
+        if not ctx.castle:
+            return "该群聊还没有建造城堡哦~"
+        if self.db.leave_castle(group_id, user_id, ctx=ctx):
+            return "成功退出城堡！"
+        return "退出城堡失败，请稍后再试~"
+        
+    def _castle_lord_target(self, ctx: SignContext, action: str, args: list):
+        '''领主操作的公共检查，返回 (城堡, 目标用户ID, 错误回复)，检查通过时错误回复为 None'''
+        castle = ctx.castle
+        if not castle:
+            return castle, None, "该群聊还没有建造城堡哦~"
+            
+        # 检查是否是领主
+        if castle['lord_id'] != ctx.user_id:
+            return castle, None, f"只有领主才能{action}哦~"
+            
+        if len(args) < 1:
+            return castle, None, f"命令格式错误，请使用: /{action} @用户"
+            
+        # 解析目标用户ID
+        target_user_id = args[0]
+        if target_user_id.startswith("@"):
+            target_user_id = target_user_id[1:]
+        return castle, target_user_id, None
+        
+    def _elect_lord(self, user_id: str, group_id: str, args: list) -> str:
+        '''选举领主，需在城堡锁内调用，返回回复文本'''
+        ctx = SignContext(self.db, user_id, group_id)
+        castle, target_user_id, error = self._castle_lord_target(ctx, "选举领主", args)
+        if error:
+            return error
+        # 检查用户是否是城堡成员
+        if target_user_id not in castle['members']:
+            return "被选举用户不是城堡成员！"
+        if self.db.elect_lord(group_id, target_user_id, ctx=ctx):
+            return f"成功选举{target_user_id}为新领主！"
+        return "选举领主失败，请稍后再试~"
+        
+    def _elect_manager(self, user_id: str, group_id: str, args: list) -> str:
+        '''选举总管，需在城堡锁内调用，返回回复文本'''
+        ctx = SignContext(self.db, user_id, group_id)
+        castle, target_user_id, error = self._castle_lord_target(ctx, "选举总管", args)
+        if error:
+            return error
+        # 检查用户是否是城堡成员
+        if target_user_id not in castle['members']:
+            return "被选举用户不是城堡成员！"
+        if self.db.elect_manager(group_id, target_user_id, ctx=ctx):
+            return f"成功选举{target_user_id}为总管！"
+        return "选举总管失败，请稍后再试~"
+        
+    def _dismiss_manager(self, user_id: str, group_id: str, args: list) -> str:
+        '''罢免总管，需在城堡锁内调用，返回回复文本'''
+        ctx = SignContext(self.db, user_id, group_id)
+        castle, target_user_id, error = self._castle_lord_target(ctx, "罢免总管", args)
+        if error:
+            return error
+        # 检查用户是否是总管
+        if target_user_id not in castle['managers']:
+            return "被罢免用户不是总管！"
+        if self.db.dismiss_manager(group_id, target_user_id, ctx=ctx):
+            return f"成功罢免{target_user_id}的总管职务！"
+        return "罢免总管失败，请稍后再试~"
+        
+    def _upgrade_castle(self, user_id: str, group_id: str) -> str:
+        '''升级城堡，需在城堡锁内调用，返回回复文本'''
+        # 检查是否已有城堡
+        ctx = SignContext(self.db, user_id, group_id)
+        castle = ctx.castle
+        if not castle:
+            return "该群聊还没有建造城堡哦~"
+            
+        # 检查是否是领主
+        if castle['lord_id'] != user_id:
+            return "只有领主才能升级城堡哦~"
+            
+        # 获取升级成本
+        level = castle['level']
+        if level >= 5:
+            return "城堡已达到最高等级！"
+            
+        upgrade_cost = CastleManager.CASTLE_UPGRADE_COSTS.get(level)
+        if not upgrade_cost:
+            return "无法获取升级成本信息，请联系管理员~"
+            
+        # 检查资源是否足够
+        if castle['exp'] < upgrade_cost['exp'] or castle['coins'] < upgrade_cost['coins']:
+            return f"城堡资源不足！需要经验:{upgrade_cost['exp']}, 金币:{upgrade_cost['coins']}"
+            
+        # 升级城堡
+        if self.db.upgrade_castle(group_id, upgrade_cost['exp'], upgrade_cost['coins'], ctx=ctx):
+            return f"城堡升级成功！当前等级:{level+1}"
+        return "升级城堡失败，请稍后再试~"
+        
+    def _donate_coins(self, user_id: str, group_id: str, amount: int) -> str:
+        '''捐献金币，需在用户锁和城堡锁内调用，返回回复文本'''
+        # 检查是否已有城堡
+        ctx = SignContext(self.db, user_id, group_id)
+        castle = ctx.castle
+        if not castle:
+            return "该群聊还没有建造城堡哦~"
+            
+        # 检查用户是否有足够金币
+        user_data = ctx.user_data
+        if not user_data or user_data['coins'] < amount:
+            return "您的金币不足！"
+            
+        # 捐献金币
+        if not self.db.donate_coins(group_id, user_id, amount, ctx=ctx):
+            return "捐献金币失败，请稍后再试~"
+        # 扣除用户金币
+        self.db.update_user_data(user_id, ctx=ctx, coins=user_data['coins'] - amount)
+        # 增加城堡经验
+        castle_exp_gain = CastleManager.get_castle_exp_gain(self.reward_rng.stream)
+        self.db.add_castle_exp(group_id, castle_exp_gain, ctx=ctx)
+        return f"成功捐献{amount}金币到城堡！城堡获得{castle_exp_gain}经验。"
+            
     @filter.command("城堡排行榜")
+    @instrumented
     async def castle_ranking(self, event: AstrMessageEvent):
         '''城堡等级排行榜'''
         try:
-            ranking_data = self.db.get_castle_ranking(10)
+            ranking_data = await self._read(self.db.get_castle_ranking, 10)
             result_text = CastleManager.format_castle_ranking(ranking_data)
             
-            image_path = await self.img_gen.create_sign_image(result_text)
-            if image_path:
-                yield event.image_result(image_path)
-                if os.path.exists(image_path):
-                    os.remove(image_path)
+            async for response in self._reply(event, result_text):
+                yield response
                     
         except Exception as e:
             logger.error(f"获取城堡排行榜失败: {str(e)}")
             yield event.plain_result("获取城堡排行榜失败~请联系管理员检查日志")
             
     @filter.command("城堡金币榜")
+    @instrumented
     async def castle_coin_ranking(self, event: AstrMessageEvent):
         '''城堡金币排行榜'''
         try:
-            ranking_data = self.db.get_castle_coin_ranking(10)
+            ranking_data = await self._read(self.db.get_castle_coin_ranking, 10)
             result_text = CastleManager.format_castle_coin_ranking(ranking_data)
             
-            image_path = await self.img_gen.create_sign_image(result_text)
-            if image_path:
-                yield event.image_result(image_path)
-                if os.path.exists(image_path):
-                    os.remove(image_path)
+            async for response in self._reply(event, result_text):
+                yield response
                     
         except Exception as e:
             logger.error(f"获取城堡金币排行榜失败: {str(e)}")
@@ -0,0 +1,517 @@
+import os
+import copy
+import json
+import time
+import heapq
+import datetime
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, Any, Optional, List
+
+from .clock import SignClock
+from .sign_calendar import SignCalendar
+from .storage import SignStorage, ranking_sort_key
+
+
+def _leaderboard_values(board: str, data: Dict[str, Any]) -> tuple:
+    """用户在物化排行榜上的 (k1, k2)，与 SignDatabase 的榜一致"""
+    if board == 'level':
+        return data.get('level') or 0, data.get('exp') or 0
+    column = 'total_days' if board == 'world' else 'continuous_days'
+    return data.get(column) or 0, -int((data.get('last_sign') or '').replace('-', '') or 0)
+
+
+class _RankIndex:
+    """一个排行范围（全服或某个群）内按排序键有序的用户，插入、删除和定位都是二分查找"""
+
+    def __init__(self, board: str):
+        self.sort_key = ranking_sort_key(board)
+        self.entries: List[tuple] = []
+
+    def add(self, key: tuple):
+        insort(self.entries, self.sort_key(key))
+
+    def remove(self, key: tuple):
+        entry = self.sort_key(key)
+        position = bisect_left(self.entries, entry)
+        if position < len(self.entries) and self.entries[position] == entry:
+            del self.entries[position]
+
+    def count_before(self, key: tuple) -> int:
+        return bisect_left(self.entries, self.sort_key(key))
+
+    def seek(self, key: Optional[tuple], limit: int, offset: int, before: bool) -> List[str]:
+        """排序键 key 之后（before 时为之前，按反向顺序）跳过 offset 个的 limit 个用户ID"""
+        if before:
+            end = len(self.entries) if key is None else bisect_left(self.entries, self.sort_key(key))
+            stop = max(0, end - offset)
+            entries = self.entries[max(0, stop - limit):stop][::-1]
+        else:
+            start = (0 if key is None else bisect_right(self.entries, self.sort_key(key))) + offset
+            entries = self.entries[start:start + limit]
+        return [entry[-1] for entry in entries]
+
+
+class MemorySignStorage(SignStorage):
+    """纯内存存储
+
+    数据只保存在进程内，重启后丢失，用于测试和不落盘的基准测试。
+    全服和每个群的三个用户榜各维护一个有序索引，排行、翻页和名次的代价与 SignDatabase 的索引查询同阶；
+    城堡榜按需排序。不支持多实例共用，也不执行 SQL，语句钩子不会被调用。
+    所有方法都应在同一线程（事件循环）中调用。
+    """
+
+    CASTLE_BOARDS = {'castle_level': ('level', 'exp'), 'castle_coins': ('coins', None)}
+
+    def __init__(self, plugin_dir: str, clock: SignClock = None):
+        """
+        Args:
+            plugin_dir: 插件目录，指标和归档等文件位于其下的 plugins_db
+            clock: 签到时钟
+        """
+        self.clock = clock or SignClock()
+        self._data_dir = os.path.join(plugin_dir, "plugins_db")
+        if not os.path.exists(self._data_dir):
+            os.makedirs(self._data_dir)
+        self._users: Dict[str, Dict[str, Any]] = {}
+        # user_id -> (昵称, 群号)
+        self._names: Dict[str, tuple] = {}
+        # group_id -> {user_id: {'joined_date', 'last_active'}}
+        self._members: Dict[str, Dict[str, Dict[str, str]]] = {}
+        self._user_groups: Dict[str, set] = {}
+        # 排行范围（None 为全服）-> {榜名: 有序索引}
+        self._indexes: Dict[Optional[str], Dict[str, _RankIndex]] = {None: self._new_indexes()}
+        # 签到历史按 ID 顺序保存，另按用户索引，供日历回填使用
+        self._history: Dict[int, tuple] = {}
+        self._user_history: Dict[str, Dict[int, tuple]] = {}
+        self._history_id = 0
+        self._monthly: Dict[tuple, list] = {}
+        self._calendars: Dict[str, Dict[int, bytes]] = {}
+        self._inventory: Dict[str, Dict[str, int]] = {}
+        # user_id -> {称号: 是否激活}
+        self._titles: Dict[str, Dict[str, int]] = {}
+        self._requests: Dict[str, Dict[str, Any]] = {}
+        self._castles: Dict[str, Dict[str, Any]] = {}
+        self._castle_id = 0
+
+    @property
+    def data_dir(self) -> str:
+        return self._data_dir
+
+    @staticmethod
+    def _new_indexes() -> Dict[str, _RankIndex]:
+        return {board: _RankIndex(board) for board in SignStorage.RANKING_ORDERS}
+
+    @staticmethod
+    def _ranking_row(board: str, data: Dict[str, Any]) -> tuple:
+        return (*(data[column] for column, _ in SignStorage.RANKING_ORDERS[board]), data['user_id'])
+
+    def _index_scopes(self, user_id: str) -> List[Dict[str, _RankIndex]]:
+        return [self._indexes[None]] + [self._indexes[group_id] for group_id in self._user_groups.get(user_id, ())]
+
+    def _reindex(self, old: Optional[Dict[str, Any]], new: Dict[str, Any]):
+        """用户排序列变化后更新全服和所在各群的索引"""
+        for indexes in self._index_scopes(new['user_id']):
+            for board, index in indexes.items():
+                if old is not None:
+                    index.remove(self._ranking_row(board, old))
+                index.add(self._ranking_row(board, new))
+
+    def _touch_group_member(self, group_id: str, user_id: str):
+        today = self.clock.today_str()
+        members = self._members.setdefault(group_id, {})
+        if user_id in members:
+            members[user_id]['last_active'] = today
+            return
+        self._add_group_member(group_id, user_id, today, today)
+
+    def _add_group_member(self, group_id: str, user_id: str, joined_date: str, last_active: str):
+        self._members.setdefault(group_id, {})[user_id] = {'joined_date': joined_date, 'last_active': last_active}
+        self._user_groups.setdefault(user_id, set()).add(group_id)
+        indexes = self._indexes.get(group_id)
+        if indexes is None:
+            indexes = self._indexes[group_id] = self._new_indexes()
+        data = self._users[user_id]
+        for board, index in indexes.items():
+            index.add(self._ranking_row(board, data))
+
+    # ---- 用户 ----
+
+    def get_user_data(self, user_id: str) -> Optional[Dict[str, Any]]:
+        data = self._users.get(user_id)
+        return dict(data) if data is not None else None
+
+    def update_user_data(self, user_id: str, ctx=None, **kwargs):
+        existing_data = ctx.user_data if ctx is not None else self.get_user_data(user_id)
+        active_group = kwargs.get('group_id')
+        if 'group_id' not in kwargs and existing_data and existing_data.get('group_id'):
+            kwargs['group_id'] = existing_data['group_id']
+        unknown = kwargs.keys() - set(self.USER_COLUMNS)
+        if unknown:
+            raise KeyError(f"未知的用户数据列: {', '.join(sorted(unknown))}")
+
+        stored = self._users.get(user_id)
+        old = dict(stored) if stored is not None else None
+        if stored is None:
+            stored = self._users[user_id] = dict(self.USER_DEFAULTS, user_id=user_id)
+        stored.update(kwargs)
+        if old is None:
+            self._reindex(None, stored)
+        elif any(old[column] != stored[column] for orders in self.RANKING_ORDERS.values() for column, _ in orders):
+            self._reindex(old, stored)
+        if active_group:
+            self._touch_group_member(active_group, user_id)
+
+        if ctx is not None:
+            ctx.set_user_data(dict(existing_data or dict(self.USER_DEFAULTS, user_id=user_id), **kwargs))
+
+    def update_user_name(self, user_id: str, user_name: str, group_id: str = None, ctx=None):
+        self._names[user_id] = (user_name, group_id)
+        if ctx is not None:
+            ctx.set_user_name(user_id, user_name)
+
+    def get_user_name(self, user_id: str, group_id: str = None) -> str:
+        row = self._names.get(user_id)
+        if row and (not group_id or row[1] == group_id):
+            return row[0]
+        return user_id
+
+    def get_user_names(self, user_ids: List[str]) -> Dict[str, str]:
+        names = {}
+        for user_id in user_ids:
+            row = self._names.get(user_id)
+            names[user_id] = row[0] if row and row[0] else user_id
+        return names
+
+    def import_users(self, users: List[Dict[str, Any]]) -> bool:
+        for user in users:
+            user_id = user['user_id']
+            old = self._users.get(user_id)
+            data = self._users[user_id] = {column: user.get(column, self.USER_DEFAULTS.get(column))
+                                           for column in self.USER_COLUMNS}
+            self._reindex(old, data)
+            if user.get('user_name'):
+                self._names[user_id] = (user['user_name'], user.get('group_id', ''))
+            group_id = user.get('group_id')
+            if group_id and user_id not in self._members.get(group_id, {}):
+                self._add_group_member(group_id, user_id, user.get('last_sign', ''), user.get('last_sign', ''))
+        return True
+
+    # ---- 签到历史与日历 ----
+
+    def log_sign(self, user_id: str, exp: int, coins: int, sign_date: str = None):
+        sign_date = sign_date or self.clock.today_str()
+        self._append_history(user_id, exp, coins, sign_date)
+        day = datetime.datetime.strptime(sign_date, '%Y-%m-%d').date()
+        years = self._load_sign_calendar(user_id)
+        years[day.year] = SignCalendar.set_day(years.get(day.year), day)
+
+    def _append_history(self, user_id: str, exp: int, coins: int, sign_date: str):
+        self._history_id += 1
+        # 与 SQLite 的 CURRENT_TIMESTAMP 相同，为 UTC 时间
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        row = (self._history_id, user_id, exp, coins, sign_date, timestamp)
+        self._history[self._history_id] = row
+        self._user_history.setdefault(user_id, {})[self._history_id] = row
+
+    def import_sign_history(self, rows: List[tuple]) -> bool:
+        for user_id, exp, coins, sign_date in rows:
+            self._append_history(user_id, exp, coins, sign_date)
+        return True
+
+    def _load_sign_calendar(self, user_id: str) -> Dict[int, bytes]:
+        """用户的签到日历，首次读取时从签到历史回填"""
+        years = self._calendars.get(user_id)
+        if years:
+            return years
+        years = {}
+        for row in self._user_history.get(user_id, {}).values():
+            try:
+                day = datetime.datetime.strptime(row[4], '%Y-%m-%d').date()
+            except (TypeError, ValueError):
+                continue
+            years[day.year] = SignCalendar.set_day(years.get(day.year), day)
+        self._calendars[user_id] = years
+        return years
+
+    def get_sign_calendar(self, user_id: str) -> Dict[int, bytes]:
+        return dict(self._load_sign_calendar(user_id))
+
+    def get_expired_history(self, before_date: str, limit: int) -> List[tuple]:
+        rows = []
+        for row in self._history.values():
+            if len(rows) >= limit:
+                break
+            if row[4] < before_date:
+                rows.append(row)
+        return rows
+
+    def rollup_history(self, rows: List[tuple]) -> bool:
+        for history_id, user_id, exp, coins, sign_date, _ in rows:
+            stat = self._monthly.setdefault((user_id, sign_date[:7]), [0, 0, 0, sign_date, sign_date])
+            stat[0] += 1
+            stat[1] += exp or 0
+            stat[2] += coins or 0
+            stat[3] = min(stat[3], sign_date)
+            stat[4] = max(stat[4], sign_date)
+            self._history.pop(history_id, None)
+            self._user_history.get(user_id, {}).pop(history_id, None)
+        return True
+
+    def get_monthly_history(self, user_id: str) -> List[tuple]:
+        return sorted((month, *stat) for (owner, month), stat in self._monthly.items() if owner == user_id)
+
+    # ---- 签到请求 ----
+
+    def get_sign_request(self, request_key: str, since: int = 0, user_id: str = None) -> Optional[Dict[str, Any]]:
+        row = self._requests.get(request_key)
+        if not row or row['created_at'] < since:
+            return None
+        return {
+            'user_id': row['user_id'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'response': row['response'],
+            'created_at': row['created_at']
+        }
+
+    def save_sign_request(self, request_key: str, user_id: str, result: Optional[Dict[str, Any]], response: str,
+                          created_at: int) -> bool:
+        # 与 SQLite 存储一样按 JSON 保存，读取时得到的是反序列化后的新对象
+        self._requests[request_key] = {
+            'user_id': user_id,
+            'result': json.dumps(result, ensure_ascii=False, default=str) if result is not None else None,
+            'response': response,
+            'created_at': created_at
+        }
+        return True
+
+    def purge_sign_requests(self, before: int) -> int:
+        expired = [key for key, row in self._requests.items() if row['created_at'] < before]
+        for key in expired:
+            del self._requests[key]
+        return len(expired)
+
+    # ---- 背包 ----
+
+    def get_user_inventory(self, user_id: str) -> Dict[str, int]:
+        return dict(self._inventory.get(user_id, {}))
+
+    def update_inventory(self, user_id: str, item_name: str, quantity: int):
+        items = self._inventory.setdefault(user_id, {})
+        if item_name in items:
+            new_quantity = items[item_name] + quantity
+            if new_quantity <= 0:
+                del items[item_name]
+            else:
+                items[item_name] = new_quantity
+        elif quantity > 0:
+            items[item_name] = quantity
+
+    # ---- 称号 ----
+
+    def add_user_title(self, user_id: str, title: str) -> bool:
+        self._titles.setdefault(user_id, {}).setdefault(title, 0)
+        return True
+
+    def apply_title_changes(self, user_id: str, grants: List[str], revokes: List[str], ctx=None) -> bool:
+        if not grants and not revokes:
+            return True
+        if ctx is not None:
+            ctx.invalidate('titles')
+        titles = self._titles.setdefault(user_id, {})
+        for title in grants:
+            titles.setdefault(title, 0)
+        for title in revokes:
+            titles.pop(title, None)
+        return True
+
+    def get_user_titles(self, user_id: str) -> List[tuple]:
+        return sorted(self._titles.get(user_id, {}).items())
+
+    def activate_title(self, user_id: str, title: str):
+        titles = self._titles.get(user_id, {})
+        if title in titles:
+            titles[title] = 1
+
+    def deactivate_all_titles(self, user_id: str):
+        titles = self._titles.get(user_id, {})
+        for title in titles:
+            titles[title] = 0
+
+    def get_active_title(self, user_id: str) -> str:
+        for title, is_active in sorted(self._titles.get(user_id, {}).items()):
+            if is_active:
+                return title
+        return ""
+
+    def get_active_titles(self, user_ids: List[str]) -> Dict[str, str]:
+        return {user_id: self.get_active_title(user_id) for user_id in user_ids}
+
+    # ---- 排行榜 ----
+
+    def get_leaderboard(self, board: str, limit: int = 10) -> List[tuple]:
+        limit = min(limit, self.LEADERBOARD_SIZE)
+        if board in self.CASTLE_BOARDS:
+            k1, k2 = self.CASTLE_BOARDS[board]
+            castles = heapq.nsmallest(
+                limit, self._castles.values(),
+                key=lambda castle: (-castle[k1], -(castle[k2] if k2 else 0), str(castle['castle_id']))
+            )
+            return [(str(castle['castle_id']), castle['castle_name'], '', castle[k1], castle[k2] if k2 else 0)
+                    for castle in castles]
+        rows = []
+        for user_id in self._indexes[None][board].seek(None, limit, 0, False):
+            name = self._names.get(user_id)
+            rows.append((user_id, name[0] if name else None, self.get_active_title(user_id),
+                         *_leaderboard_values(board, self._users[user_id])))
+        return rows
+
+    def rebuild_leaderboards(self, boards: List[str] = None) -> Dict[str, int]:
+        """有序索引随写入维护，这里按用户数据重建各索引"""
+        self._indexes = {None: self._new_indexes()}
+        for group_id in self._members:
+            self._indexes[group_id] = self._new_indexes()
+        for data in self._users.values():
+            for indexes in self._index_scopes(data['user_id']):
+                for board, index in indexes.items():
+                    index.add(self._ranking_row(board, data))
+        counts = {board: len(self._users) for board in self.RANKING_ORDERS}
+        counts.update({board: len(self._castles) for board in self.CASTLE_BOARDS})
+        return {board: counts[board] for board in boards or counts}
+
+    def get_ranking_keys(self, board: str, key: Optional[tuple], limit: int, offset: int = 0, before: bool = False,
+                         group_id: str = None) -> List[tuple]:
+        indexes = self._indexes.get(group_id or None)
+        if indexes is None:
+            return []
+        return [self._ranking_row(board, self._users[user_id])
+                for user_id in indexes[board].seek(key, limit, offset, before)]
+
+    def get_ranking_key(self, board: str, user_id: str, group_id: str = None) -> Optional[tuple]:
+        data = self._users.get(user_id)
+        if data is None or (group_id and user_id not in self._members.get(group_id, {})):
+            return None
+        return self._ranking_row(board, data)
+
+    def count_ranking_before(self, board: str, key: tuple, group_id: str = None) -> int:
+        indexes = self._indexes.get(group_id or None)
+        return indexes[board].count_before(key) if indexes else 0
+
+    def count_users(self, group_id: str = None) -> int:
+        if group_id:
+            return len(self._members.get(group_id, {}))
+        return len(self._users)
+
+    # ---- 城堡 ----
+
+    def check_castle_name_exists(self, castle_name: str) -> bool:
+        return any(castle['castle_name'] == castle_name for castle in self._castles.values())
+
+    def get_castle_id_by_group(self, group_id: str) -> Optional[int]:
+        castle = self._castles.get(group_id)
+        return castle['castle_id'] if castle else None
+
+    def get_castle_by_group(self, group_id: str) -> Optional[Dict[str, Any]]:
+        castle = self._castles.get(group_id)
+        return copy.deepcopy(castle) if castle else None
+
+    def _get_castle(self, group_id: str, ctx=None) -> Optional[Dict[str, Any]]:
+        """与 SignDatabase 相同：有请求上下文时修改上下文中的城堡，再写回存储"""
+        if ctx is not None:
+            return ctx.castle_for(group_id)
+        return self.get_castle_by_group(group_id)
+
+    def _save_castle(self, castle: Dict[str, Any]):
+        self._castles[castle['group_id']] = copy.deepcopy(castle)
+
+    def create_castle(self, group_id: str, castle_name: str, creator_id: str, participant_ids: List[str] = None,
+                      ctx=None) -> bool:
+        if ctx is not None:
+            ctx.invalidate('castle')
+        if group_id in self._castles:
+            return False
+        self._castle_id += 1
+        self._castles[group_id] = {
+            'castle_id': self._castle_id,
+            'group_id': group_id,
+            'castle_name': castle_name,
+            'level': 1,
+            'exp': 0,
+            'coins': 0,
+            'lord_id': None,
+            'managers': [],
+            'members': [creator_id] + list(participant_ids or [])[:5],
+            'created_date': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
+        }
+        return True
+
+    def join_castle(self, group_id: str, user_id: str, ctx=None) -> bool:
+        castle = self._get_castle(group_id, ctx)
+        if not castle or user_id in castle['members']:
+            return False
+        castle['members'].append(user_id)
+        self._save_castle(castle)
+        return True
+
+    def leave_castle(self, group_id: str, user_id: str, ctx=None) -> bool:
+        castle = self._get_castle(group_id, ctx)
+        if not castle or user_id not in castle['members']:
+            return False
+        castle['members'].remove(user_id)
+        if castle['lord_id'] == user_id:
+            castle['lord_id'] = None
+        elif user_id in castle['managers']:
+            castle['managers'].remove(user_id)
+        self._save_castle(castle)
+        return True
+
+    def upgrade_castle(self, group_id: str, exp_cost: int, coin_cost: int, ctx=None) -> bool:
+        castle = self._get_castle(group_id, ctx)
+        if not castle or castle['exp'] < exp_cost or castle['coins'] < coin_cost:
+            return False
+        castle.update(level=castle['level'] + 1, exp=castle['exp'] - exp_cost, coins=castle['coins'] - coin_cost)
+        self._save_castle(castle)
+        return True
+
+    def donate_coins(self, group_id: str, user_id: str, amount: int, ctx=None) -> bool:
+        castle = self._get_castle(group_id, ctx)
+        if not castle:
+            return False
+        castle['coins'] += amount
+        self._save_castle(castle)
+        return True
+
+    def add_castle_exp(self, group_id: str, exp: int, ctx=None) -> bool:
+        castle = self._get_castle(group_id, ctx)
+        if not castle:
+            return False
+        castle['exp'] += exp
+        self._save_castle(castle)
+        return True
+
+    def elect_lord(self, group_id: str, user_id: str, ctx=None) -> bool:
+        castle = self._get_castle(group_id, ctx)
+        if not castle or user_id not in castle['members']:
+            return False
+        castle['lord_id'] = user_id
+        self._save_castle(castle)
+        return True
+
+    def elect_manager(self, group_id: str, user_id: str, ctx=None) -> bool:
+        castle = self._get_castle(group_id, ctx)
+        if not castle or user_id not in castle['members'] or user_id in castle['managers']:
+            return False
+        castle['managers'].append(user_id)
+        self._save_castle(castle)
+        return True
+
+    def dismiss_manager(self, group_id: str, user_id: str, ctx=None) -> bool:
+        castle = self._get_castle(group_id, ctx)
+        if not castle or user_id not in castle['managers']:
+            return False
+        castle['managers'].remove(user_id)
+        self._save_castle(castle)
+        return True
+
+    def destroy_castle(self, group_id: str) -> bool:
+        self._castles.pop(group_id, None)
+        return True
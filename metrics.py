@@ -0,0 +1,252 @@
+import os
+import time
+import threading
+import functools
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Any, List, Tuple, Optional
+
+# 延迟直方图的桶上限(秒)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 命令内的耗时阶段：数据库、业务逻辑、图片渲染(含排队)、发送
+PHASES = ('db', 'logic', 'render', 'send')
+
+
+class Histogram:
+    """固定分桶的延迟直方图"""
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """按桶内线性插值估算分位数"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                low = BUCKETS[index - 1] if index else 0.0
+                high = BUCKETS[index] if index < len(BUCKETS) else BUCKETS[-1] * 2
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return BUCKETS[-1]
+
+
+class _CommandTimer:
+    __slots__ = ('command', 'db', 'render', 'send', 'statements')
+
+    def __init__(self, command: str):
+        self.command = command
+        self.db = 0.0
+        self.render = 0.0
+        self.send = 0.0
+        self.statements = 0
+
+
+# 当前正在执行的命令，数据库钩子据此把语句耗时归到对应命令
+_current_timer: ContextVar[Optional[_CommandTimer]] = ContextVar('sign_command_timer', default=None)
+
+
+def _statement_verb(sql: str) -> str:
+    parts = sql.split(None, 1)
+    return parts[0].upper() if parts else ''
+
+
+def _label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class PluginMetrics:
+    """插件运行指标
+
+    - 每个命令的总耗时和分阶段耗时直方图
+    - 按命令和语句类型统计的 SQL 次数与耗时（通过 SignDatabase 语句钩子）
+    - 图片渲染耗时（通过 ImageGenerator 回调）
+    可导出为 Prometheus 文本格式，也可生成 签到统计 命令的文字摘要。
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        # (命令, 阶段) -> Histogram，阶段 total 为命令总耗时
+        self.latency: Dict[Tuple[str, str], Histogram] = {}
+        # (命令, 状态) -> 次数
+        self.commands: Dict[Tuple[str, str], int] = {}
+        # (命令, 语句类型) -> [次数, 耗时]
+        self.statements: Dict[Tuple[str, str], List[float]] = {}
+        # 只读查询可能在线程池中执行，语句统计加锁
+        self._statement_lock = threading.Lock()
+        self.render = Histogram()
+
+    def _histogram(self, command: str, phase: str) -> Histogram:
+        key = (command, phase)
+        histogram = self.latency.get(key)
+        if histogram is None:
+            histogram = self.latency[key] = Histogram()
+        return histogram
+
+    def on_statement(self, sql: str, params, seconds: float, fetch: bool):
+        """SignDatabase 语句钩子"""
+        timer = _current_timer.get()
+        key = (timer.command if timer else 'background', _statement_verb(sql))
+        with self._statement_lock:
+            stat = self.statements.get(key)
+            if stat is None:
+                stat = self.statements[key] = [0, 0.0]
+            stat[1] += seconds
+            if not fetch:
+                stat[0] += 1
+            if timer:
+                timer.db += seconds
+                if not fetch:
+                    timer.statements += 1
+
+    def _statement_snapshot(self) -> List[tuple]:
+        with self._statement_lock:
+            return sorted((key, tuple(stat)) for key, stat in self.statements.items())
+
+    def on_render(self, seconds: float):
+        """ImageGenerator 渲染回调"""
+        self.render.observe(seconds)
+
+    @contextmanager
+    def phase(self, name: str):
+        """把代码块的耗时计入当前命令的某个阶段（render / send）"""
+        timer = _current_timer.get()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if timer:
+                setattr(timer, name, getattr(timer, name) + time.perf_counter() - start)
+
+    def _finish(self, timer: _CommandTimer, total: float, status: str):
+        key = (timer.command, status)
+        self.commands[key] = self.commands.get(key, 0) + 1
+        self._histogram(timer.command, 'total').observe(total)
+        logic = max(0.0, total - timer.db - timer.render - timer.send)
+        for phase, seconds in zip(PHASES, (timer.db, logic, timer.render, timer.send)):
+            self._histogram(timer.command, phase).observe(seconds)
+
+    def render_prometheus(self, gauges: Dict[str, float] = None) -> str:
+        """导出 Prometheus 文本格式"""
+        lines = [
+            '# HELP sign_command_duration_seconds 命令耗时，按阶段拆分',
+            '# TYPE sign_command_duration_seconds histogram',
+        ]
+        for (command, phase), histogram in sorted(self.latency.items()):
+            labels = f'command="{_label(command)}",phase="{phase}"'
+            lines.extend(self._histogram_lines('sign_command_duration_seconds', labels, histogram))
+
+        lines += ['# HELP sign_commands_total 命令调用次数', '# TYPE sign_commands_total counter']
+        for (command, status), count in sorted(self.commands.items()):
+            lines.append(f'sign_commands_total{{command="{_label(command)}",status="{status}"}} {count}')
+
+        statements = self._statement_snapshot()
+        lines += ['# HELP sign_sql_statements_total SQL 语句次数', '# TYPE sign_sql_statements_total counter']
+        for (command, verb), (count, _) in statements:
+            lines.append(f'sign_sql_statements_total{{command="{_label(command)}",verb="{_label(verb)}"}} {count}')
+        lines += ['# HELP sign_sql_duration_seconds_total SQL 语句耗时(含读取结果)', '# TYPE sign_sql_duration_seconds_total counter']
+        for (command, verb), (_, seconds) in statements:
+            lines.append(f'sign_sql_duration_seconds_total{{command="{_label(command)}",verb="{_label(verb)}"}} {seconds:.6f}')
+
+        lines += ['# HELP sign_render_duration_seconds 图片渲染耗时', '# TYPE sign_render_duration_seconds histogram']
+        lines.extend(self._histogram_lines('sign_render_duration_seconds', '', self.render))
+
+        for name, value in sorted((gauges or {}).items()):
+            lines += [f'# TYPE {name} gauge', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _histogram_lines(name: str, labels: str, histogram: Histogram) -> List[str]:
+        prefix = f'{labels},' if labels else ''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {histogram.sum:.6f}')
+        lines.append(f'{name}_count{suffix} {histogram.count}')
+        return lines
+
+    def export(self, path: str, gauges: Dict[str, float] = None):
+        """原子地写入 Prometheus 文本文件，供 node_exporter textfile collector 采集"""
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render_prometheus(gauges))
+        os.replace(temp_path, path)
+
+    def format_summary(self, extra: Dict[str, Dict[str, Any]] = None) -> str:
+        """生成 签到统计 命令的文字摘要"""
+        started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started))
+        lines = [f"签到统计（自 {started} 起）", "命令: 次数 p50/p99 | 平均 数据库/逻辑/渲染/发送 | SQL/次"]
+        commands = sorted({command for command, _ in self.latency})
+        statements = self._statement_snapshot()
+        for command in commands:
+            total = self.latency[(command, 'total')]
+            phases = "/".join(
+                f"{self.latency[(command, phase)].sum / total.count * 1000:.1f}" for phase in PHASES
+            )
+            sql_count = sum(count for (c, _), (count, _) in statements if c == command)
+            lines.append(
+                f"{command}: {total.count} {total.quantile(0.5) * 1000:.0f}/{total.quantile(0.99) * 1000:.0f}ms"
+                f" | {phases}ms | {sql_count / total.count:.1f}"
+            )
+        if self.render.count:
+            lines.append(
+                f"图片渲染: {self.render.count} 次 p50 {self.render.quantile(0.5) * 1000:.0f}ms"
+                f" p99 {self.render.quantile(0.99) * 1000:.0f}ms"
+            )
+        for title, stats in (extra or {}).items():
+            lines.append(f"{title}: " + ", ".join(
+                f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}" for key, value in stats.items()
+            ))
+        return "\n".join(lines)
+
+
+def instrumented(func):
+    """记录命令处理函数的分阶段耗时，插件实例需提供 metrics 属性
+
+    放在 @filter.command 之下，处理函数每次 yield 之后到恢复执行之间的时间计为发送耗时。
+    """
+    @functools.wraps(func)
+    async def wrapper(plugin, event, *args, **kwargs):
+        metrics: Optional[PluginMetrics] = getattr(plugin, 'metrics', None)
+        if metrics is None:
+            async for result in func(plugin, event, *args, **kwargs):
+                yield result
+            return
+
+        timer = _CommandTimer(func.__name__)
+        previous = _current_timer.get()
+        _current_timer.set(timer)
+        status = 'ok'
+        start = time.perf_counter()
+        try:
+            async for result in func(plugin, event, *args, **kwargs):
+                sent = time.perf_counter()
+                yield result
+                timer.send += time.perf_counter() - sent
+        except GeneratorExit:
+            # 调用方提前关闭生成器，不算失败
+            raise
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            _current_timer.set(previous)
+            metrics._finish(timer, time.perf_counter() - start, status)
+    return wrapper
@@ -0,0 +1,80 @@
+"""表结构迁移工具
+
+插件启动时会自动执行表结构迁移，并在后台分批回填数据。升级前可以先预览已有数据库上将要执行的迁移和
+估计的回填行数；也可以在维护窗口中一次性执行完所有迁移，不等插件在后台慢慢回填::
+
+    python migrate.py --dry-run data/plugins/astrbot_plugin_advanced_sign/plugins_db   # 预览，只读打开
+    python migrate.py data/plugins/astrbot_plugin_advanced_sign/plugins_db             # 执行全部迁移
+
+参数可以是 plugins_db 目录（处理其中的单文件数据库和全部分片）或单个数据库文件。
+执行时每批一个短事务，插件运行中也可以执行；中断后再次运行会从断点继续。
+"""
+import os
+import sys
+import glob
+import asyncio
+import argparse
+import tempfile
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_astrbot  # noqa: E402
+
+
+def _database_files(path: str) -> List[str]:
+    if os.path.isfile(path):
+        return [path]
+    return sorted(glob.glob(os.path.join(path, "astrbot_plugin_advanced_sign*.db")))
+
+
+def _print_status(package, path: str):
+    status = package.database.SignDatabase.read_migration_status(path)
+    print(f"{os.path.basename(path)}: 表结构版本 {status['version']}，插件支持 {status['latest']}")
+    if not status['steps']:
+        print("  没有需要执行的迁移")
+    for step in status['steps']:
+        actions = []
+        if step['schema_pending']:
+            actions.append(f"执行 {step['statements']} 条表结构语句")
+        if step['backfill']:
+            estimate = step['rows'] if step['exact'] else f"至多 {step['rows']}"
+            actions.append(f"回填 {estimate} 行（进度 rowid {step['cursor']}）")
+        print(f"  版本 {step['version']} {step['description']}: {'，'.join(actions)}")
+
+
+async def _apply(package, path: str, chunk_size: int):
+    # 打开数据库时执行表结构语句；排行榜等回填需要 SignDatabase 提供的处理函数，数据库须在插件的 plugins_db 目录下
+    db_dir = os.path.dirname(os.path.abspath(path))
+    if os.path.basename(db_dir) != 'plugins_db':
+        print(f"{path}: 不在 plugins_db 目录下，跳过执行")
+        return
+    db = package.database.SignDatabase(os.path.dirname(db_dir), read_pool_size=0, db_name=os.path.basename(path))
+    try:
+        for version, count in (await db.migrator.run_backfills(chunk_size, pause=0)).items():
+            print(f"{os.path.basename(path)}: 版本 {version} 回填完成，扫描 {count} 行")
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="预览或执行签到插件数据库的表结构迁移")
+    parser.add_argument('path', help="plugins_db 目录或数据库文件")
+    parser.add_argument('--dry-run', action='store_true', help="只预览将要执行的迁移和估计的回填行数")
+    parser.add_argument('--chunk-size', type=int, default=1000, help="每批回填的行数")
+    args = parser.parse_args()
+
+    files = _database_files(args.path)
+    if not files:
+        print(f"{args.path} 下没有找到数据库文件")
+        sys.exit(1)
+
+    fake_astrbot.install()
+    package = fake_astrbot.load_package(tempfile.mkdtemp())
+    for path in files:
+        if not args.dry_run:
+            asyncio.run(_apply(package, path, args.chunk_size))
+        _print_status(package, path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""性能回归门禁
+
+基于 benchmark.py 对签到、排行榜、我的排名和城堡命令做多轮测量，与仓库中的基线
+perf_baseline.json 比较，吞吐下降、p99 延迟上升超出容差或每次命令的 SQL 条数增加时以退出码 1 失败::
+
+    python perf_gate.py check            # 与基线比较
+    python perf_gate.py record           # 重新生成基线（有意的性能变化合入前执行并提交）
+
+吞吐和延迟与机器相关，基线应在同一台机器（或同规格的 CI 机器）上生成；
+SQL 条数在固定种子下是确定的，任何增加都视为退化（如排行榜格式化中逐个查询称号的 N+1）。
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+import statistics
+from typing import Dict, Any, List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchmark  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "perf_baseline.json")
+
+# 纳入门禁的命令
+GATE_COMMANDS = ['签到', '我的排名', '世界排行榜', '等级排行榜', '连续签到排行榜', '查看城堡', '捐献金币']
+
+DEFAULT_SETTINGS = {
+    'users': [1000, 100000],
+    'iterations': 20,
+    'repeats': 3,
+    'seed': 0,
+}
+
+
+def _summary(values: List[float]) -> Dict[str, float]:
+    return {
+        'median': statistics.median(values),
+        'stdev': statistics.stdev(values) if len(values) > 1 else 0.0,
+        'runs': values,
+    }
+
+
+def measure(settings: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """按设置多轮运行基准测试，返回 {用户规模: {命令: 指标摘要}}"""
+    commands = [item for item in benchmark.COMMANDS if item[0] in GATE_COMMANDS]
+    runs: Dict[str, Dict[str, Dict[str, List[float]]]] = {}
+    for _ in range(settings['repeats']):
+        results = asyncio.run(benchmark.run(settings['users'], settings['iterations'], seed=settings['seed'],
+                                            commands=commands))
+        for scale in results:
+            for command, stat in scale['commands'].items():
+                series = runs.setdefault(str(scale['users']), {}).setdefault(command, {})
+                for key in ('throughput', 'p99_ms', 'queries'):
+                    series.setdefault(key, []).append(stat[key])
+
+    measured = {}
+    for users, commands_runs in runs.items():
+        measured[users] = {}
+        for command, series in commands_runs.items():
+            measured[users][command] = {
+                'throughput': _summary(series['throughput']),
+                'p99_ms': _summary(series['p99_ms']),
+                'queries': max(series['queries']),
+            }
+    return measured
+
+
+def _noise(base: Dict[str, Any], now: Dict[str, Any], key: str, sigma: float) -> float:
+    """两次测量合并标准差的 sigma 倍"""
+    return sigma * (base[key]['stdev'] ** 2 + now[key]['stdev'] ** 2) ** 0.5
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float = 0.3,
+            sigma: float = 3.0) -> List[str]:
+    """比较两次测量结果
+    吞吐和 p99 的允许波动取 max(相对容差, sigma 倍的合并标准差)，SQL 条数不允许增加。
+    Returns:
+        退化项说明列表，为空表示通过
+    """
+    regressions = []
+    for users, commands in baseline.items():
+        for command, base in commands.items():
+            now = current.get(users, {}).get(command)
+            if now is None:
+                regressions.append(f"[{users}] {command}: 本次没有测量结果")
+                continue
+            name = f"[{users}] {command}"
+
+            if now['queries'] > base['queries'] + 1e-9:
+                regressions.append(f"{name}: SQL 条数 {base['queries']:.1f} -> {now['queries']:.1f}")
+
+            base_tp, now_tp = base['throughput']['median'], now['throughput']['median']
+            if base_tp - now_tp > max(tolerance * base_tp, _noise(base, now, 'throughput', sigma)):
+                regressions.append(f"{name}: 吞吐 {base_tp:.1f} -> {now_tp:.1f} ops/s")
+
+            base_p99, now_p99 = base['p99_ms']['median'], now['p99_ms']['median']
+            if now_p99 - base_p99 > max(tolerance * base_p99, _noise(base, now, 'p99_ms', sigma)):
+                regressions.append(f"{name}: p99 {base_p99:.1f} -> {now_p99:.1f} ms")
+    return regressions
+
+
+def format_comparison(baseline: Dict[str, Any], current: Dict[str, Any]) -> str:
+    lines = []
+    for users, commands in current.items():
+        lines.append(f"== {users} 用户 ==")
+        for command, now in commands.items():
+            base = baseline.get(users, {}).get(command)
+            if base is None:
+                lines.append(f"{benchmark.pad(command, 16)}(无基线)")
+                continue
+            lines.append(
+                f"{benchmark.pad(command, 16)}"
+                f"吞吐 {base['throughput']['median']:.1f} -> {now['throughput']['median']:.1f}  "
+                f"p99 {base['p99_ms']['median']:.1f} -> {now['p99_ms']['median']:.1f}ms  "
+                f"SQL {base['queries']:.1f} -> {now['queries']:.1f}"
+            )
+    return "\n".join(lines)
+
+
+def load_baseline(path: str = BASELINE_PATH) -> Dict[str, Any]:
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(measured: Dict[str, Any], settings: Dict[str, Any], path: str = BASELINE_PATH):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'environment': benchmark.environment(), 'settings': settings, 'results': measured},
+                  f, ensure_ascii=False, indent=2)
+        f.write('\n')
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="签到插件性能回归门禁")
+    parser.add_argument('action', choices=['check', 'record'])
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=0.3, help="吞吐和 p99 的相对容差")
+    parser.add_argument('--sigma', type=float, default=3.0, help="按多轮测量标准差计算的容差倍数")
+    args = parser.parse_args(argv)
+
+    if args.action == 'record':
+        measured = measure(DEFAULT_SETTINGS)
+        save_baseline(measured, DEFAULT_SETTINGS, args.baseline)
+        print(f"基线已写入 {args.baseline}")
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    measured = measure(baseline.get('settings', DEFAULT_SETTINGS))
+    print(format_comparison(baseline['results'], measured))
+    regressions = compare(baseline['results'], measured, args.tolerance, args.sigma)
+    if regressions:
+        print("\n性能退化:")
+        print("\n".join(f"- {item}" for item in regressions))
+        return 1
+    print("\n未发现性能退化")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
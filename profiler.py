@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import inspect
+import threading
+from collections import Counter
+from typing import Dict, Any, Optional, List, Set
+
+from .database import logger
+
+
+def _frame_name(code) -> str:
+    name = getattr(code, 'co_qualname', code.co_name)
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    # 折叠栈格式以 ; 分隔帧、以空格分隔计数
+    return f"{module}:{name}".replace(';', ',').replace(' ', '_')
+
+
+class SamplingProfiler:
+    """采样分析器
+
+    开启后由后台线程定期读取各线程的调用栈（sys._current_frames），
+    只保留经过已登记的热点函数（命令处理函数、图片渲染、数据库方法）的样本，
+    栈从最外层的热点函数开始记录。停止后输出折叠栈文件，可直接交给 flamegraph.pl / speedscope。
+    未开启时没有任何开销。
+    """
+
+    def __init__(self, output_dir: str, interval: float = 0.005):
+        """
+        Args:
+            output_dir: 折叠栈文件的输出目录
+            interval: 采样间隔(秒)
+        """
+        self.output_dir = output_dir
+        self.interval = interval
+        self._targets: Set[Any] = set()
+        self._samples: Counter = Counter()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.started_at = 0.0
+        self.ticks = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def register(self, *classes):
+        """登记类中定义的所有函数为热点函数，装饰器包装过的函数登记其原函数"""
+        for cls in classes:
+            for attr in vars(cls).values():
+                func = getattr(attr, '__func__', attr)
+                if not callable(func):
+                    continue
+                func = inspect.unwrap(func)
+                code = getattr(func, '__code__', None)
+                if code is not None:
+                    self._targets.add(code)
+
+    def start(self) -> bool:
+        if self.running:
+            return False
+        self._samples.clear()
+        self.ticks = 0
+        self._stop.clear()
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="sign-profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self) -> Optional[Dict[str, Any]]:
+        """停止采样并写出折叠栈文件
+        Returns:
+            {'path': 文件路径, 'samples': 样本数, 'ticks': 采样次数, 'top': [(函数, 自身样本数), ...]}
+        """
+        if not self.running:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))
+        path = os.path.join(self.output_dir, f"profile-{stamp}.folded")
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self._samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+        # 按栈顶函数统计自身耗时
+        leaves = Counter()
+        for stack, count in self._samples.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return {
+            'path': path,
+            'samples': sum(self._samples.values()),
+            'ticks': self.ticks,
+            'top': leaves.most_common(5),
+        }
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self.ticks += 1
+            try:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != own:
+                        self._sample(frame)
+            except Exception as e:
+                logger.error(f"性能采样失败: {str(e)}")
+
+    def _sample(self, frame):
+        stack: List[str] = []
+        root = -1
+        while frame is not None:
+            code = frame.f_code
+            if code in self._targets:
+                root = len(stack)
+            stack.append(_frame_name(code))
+            frame = frame.f_back
+        if root < 0:
+            return
+        # stack 从栈顶到栈底，截取到最外层热点函数并反转为根在前
+        self._samples[';'.join(reversed(stack[:root + 1]))] += 1
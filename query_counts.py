@@ -0,0 +1,107 @@
+"""每个命令的 SQL 条数检查
+
+在固定种子的合成数据库上按顺序执行一组命令，统计每条命令执行的 SQL 语句数（不含读取结果），
+与下面 STEPS 中记录的条数逐一比较，任何一条不相等都以退出码 1 失败::
+
+    python query_counts.py
+
+条数在固定的数据、时钟和奖励种子下是确定的。减少语句数的优化合入时，把 STEPS 中的条数一并改小；
+条数增加说明引入了多余的查询（如在循环中逐个查询），应先找出原因。
+"""
+import os
+import sys
+import asyncio
+import shutil
+import tempfile
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchmark  # noqa: E402
+import fake_astrbot  # noqa: E402
+
+# 合成数据的用户数：3 个群，每群一座 6 人城堡
+USERS = 300
+GROUP = benchmark.group_id(0, benchmark.group_count(USERS))
+MEMBER = benchmark.user_id(3)
+OTHER = benchmark.user_id(1)
+# 新用户在新群中创建城堡并成为领主，之后的城堡管理命令都在这个群中执行
+NEWCOMER = "200000"
+NEW_GROUP = "990000"
+
+# (命令消息, 发送者, 群号, 期望的 SQL 条数, 回复中应包含的文字)；按顺序执行，后面的步骤依赖前面的结果
+STEPS: List[Tuple[str, str, str, int, str]] = [
+    ("签到", MEMBER, GROUP, 20, ""),
+    ("签到", MEMBER, GROUP, 2, ""),
+    ("签到", NEWCOMER, GROUP, 15, ""),
+    ("个人信息", MEMBER, GROUP, 2, ""),
+    ("我的排名", MEMBER, GROUP, 8, ""),
+    ("世界排行榜", MEMBER, GROUP, 1, ""),
+    ("世界排行榜 3", MEMBER, GROUP, 5, ""),
+    ("等级排行榜 我", MEMBER, GROUP, 5, ""),
+    ("连续签到排行榜 2", MEMBER, GROUP, 4, ""),
+    ("查看城堡", MEMBER, GROUP, 1, ""),
+    ("捐献金币 10", MEMBER, GROUP, 7, ""),
+    ("创建城堡 新城堡 " + MEMBER, NEWCOMER, NEW_GROUP, 7, "创建成功"),
+    ("查看城堡", NEWCOMER, NEW_GROUP, 2, ""),
+    ("捐献金币 10", NEWCOMER, NEW_GROUP, 8, ""),
+    ("升级城堡", NEWCOMER, NEW_GROUP, 1, ""),
+    ("加入城堡", OTHER, NEW_GROUP, 2, "成功加入城堡"),
+    ("选举总管 " + OTHER, NEWCOMER, NEW_GROUP, 2, "为总管"),
+    ("罢免总管 " + OTHER, NEWCOMER, NEW_GROUP, 2, ""),
+    ("退出城堡", OTHER, NEW_GROUP, 2, "成功退出城堡"),
+    ("选举领主 " + MEMBER, NEWCOMER, NEW_GROUP, 2, "为新领主"),
+    ("城堡排行榜", MEMBER, GROUP, 1, ""),
+    ("城堡金币榜", MEMBER, GROUP, 1, ""),
+]
+
+
+def _reply_text(results) -> str:
+    return "\n".join(str(result.content) for result in results)
+
+
+async def run() -> List[Tuple[str, int, int, str]]:
+    """执行 STEPS，返回 [(命令消息, 期望条数, 实际条数, 回复), ...]"""
+    workdir = tempfile.mkdtemp(prefix='sign-queries-')
+    try:
+        plugin = await fake_astrbot.create_plugin(
+            workdir,
+            config=dict(benchmark.BENCH_CONFIG, coherence_poll_interval=0, read_pool_size=0)
+        )
+        fake_astrbot.set_clock(plugin, fake_astrbot.plugin_module('clock').FrozenClock(benchmark.BENCH_NOW))
+        benchmark.populate(plugin.db, USERS, seed=0)
+        outcomes = []
+        for message, sender, group_id, expected, _ in STEPS:
+            command = message.split()[0]
+            handler = fake_astrbot.find_handler(plugin, command)
+            before = benchmark._snapshot(plugin.metrics, handler.__name__)['statements']
+            results = await fake_astrbot.run_command(
+                plugin, command, fake_astrbot.FakeEvent(sender, message, group_id=group_id)
+            )
+            after = benchmark._snapshot(plugin.metrics, handler.__name__)['statements']
+            outcomes.append((message, expected, int(after - before), _reply_text(results)))
+        await fake_astrbot.close_plugin(plugin)
+        return outcomes
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main() -> int:
+    outcomes = asyncio.run(run())
+    failures = []
+    for (message, expected, actual, reply), step in zip(outcomes, STEPS):
+        mark = "  " if actual == expected else "✗ "
+        print(f"{mark}{benchmark.pad(message, 24)}期望 {expected:>3}  实际 {actual:>3}")
+        if actual != expected:
+            failures.append(f"{message}: SQL 条数 {expected} -> {actual}")
+        if step[4] not in reply:
+            failures.append(f"{message}: 回复中没有“{step[4]}”，实际回复: {reply[:80]}")
+    if failures:
+        print("\n检查失败:")
+        print("\n".join(f"- {item}" for item in failures))
+        return 1
+    print("\n各命令的 SQL 条数与记录一致")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,235 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, List, Tuple, Iterable
+
+from .storage import SignStorage, ranking_sort_key
+
+
+class RankingPager:
+    """排行榜键集分页
+
+    每一页用上一页最后一行的排序键作为游标，在排序索引上从游标处往后取一页。
+    SQLite 的索引不能按名次直接定位，从榜首跳到第 n 页需要沿索引数过前面的所有行，因此：
+    - 游标缓存：取到第 n 页后顺带记下第 n+1 页的游标，逐页翻页不需要额外查询
+    - 检查点：每隔 checkpoint_pages 页记下一个页首游标，由一次顺序遍历生成（全服榜由插件在后台定期刷新，
+      群榜在第一次跳页时生成，代价为遍历一次该群的成员）。跳到没有缓存的页时从最近的检查点或已缓存游标出发，
+      最多沿索引跳过 checkpoint_pages * page_size 行，与页码深浅无关
+    - 定位“我在哪一页”：先按用户的排序键数出名次，再从用户所在行往前退到页首，得到该页的游标
+    游标和检查点在有效期内复用，期间排名变化只会让页边界轻微偏移，不会漏掉或重复整页。
+    传入 group_id 时在群成员中排行，游标和总页数按群分别缓存。
+    可以在多个线程中同时使用（查询走只读连接池），缓存的读写加锁，数据库查询在锁外进行。
+    """
+
+    BOARDS = tuple(SignStorage.RANKING_ORDERS)
+
+    def __init__(self, db: SignStorage, page_size: int = 10, cursor_ttl: float = 300,
+                 max_cursors: int = 4096, count_ttl: float = 60, checkpoint_pages: int = 10,
+                 max_checkpoint_sets: int = 256):
+        """
+        Args:
+            db: 数据库实例
+            page_size: 每页行数
+            cursor_ttl: 游标和检查点的有效期(秒)
+            max_cursors: 最多缓存的游标数量
+            count_ttl: 总页数的缓存时间(秒)
+            checkpoint_pages: 检查点间隔的页数，跳页时最多沿索引跳过这么多页
+            max_checkpoint_sets: 最多保留检查点的 (榜, 群) 组合数
+        """
+        self.db = db
+        self.page_size = page_size
+        self.cursor_ttl = cursor_ttl
+        self.max_cursors = max_cursors
+        self.count_ttl = count_ttl
+        # (榜名, 群号, 页码) -> (上一页最后一行的排序键, 记录时间)，全服排行的群号为空字符串
+        self._cursors: 'OrderedDict[Tuple[str, str, int], Tuple[tuple, float]]' = OrderedDict()
+        # 群号 -> (参与排行的人数, 记录时间)
+        self._counts: 'OrderedDict[str, Tuple[int, float]]' = OrderedDict()
+        self.checkpoint_pages = max(1, checkpoint_pages)
+        self.max_checkpoint_sets = max_checkpoint_sets
+        # (榜名, 群号) -> ([第 k * checkpoint_pages 页最后一行的排序键, ...], 生成时间)，第 i 个是第 (i + 1) * checkpoint_pages + 1 页的游标
+        self._checkpoints: 'OrderedDict[Tuple[str, str], Tuple[List[tuple], float]]' = OrderedDict()
+        # 同一 (榜, 群) 的检查点只由一个线程生成
+        self._building: Dict[Tuple[str, str], threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def total_pages(self, group_id: str = None) -> int:
+        now = time.monotonic()
+        scope = group_id or ''
+        with self._lock:
+            cached = self._counts.get(scope)
+        if cached is None or now - cached[1] >= self.count_ttl:
+            cached = (self.db.count_users(group_id), now)
+            with self._lock:
+                self._counts[scope] = cached
+                self._counts.move_to_end(scope)
+                while len(self._counts) > self.max_cursors:
+                    self._counts.popitem(last=False)
+        return max(1, -(-cached[0] // self.page_size))
+
+    def get_page(self, board: str, page: int, group_id: str = None) -> List[tuple]:
+        """读取第 page 页（从 1 开始）
+        Returns:
+            行格式与 SignStorage.get_*_ranking 相同，超出末页时返回空列表
+        """
+        if page <= 1:
+            cursor = None
+        else:
+            cursor = self._cursor_for(board, group_id, page)
+            if cursor is None:
+                return []
+        rows = self.db.get_ranking_page(board, cursor, self.page_size, group_id)
+        if len(rows) == self.page_size:
+            user_id, _, _, c1, c2 = rows[-1]
+            self._remember(board, group_id, page + 1, (c1, c2, user_id))
+        return [self._display(board, row) for row in rows]
+
+    def page_of(self, board: str, user_id: str, group_id: str = None) -> int:
+        """用户所在的页码，没有签到数据（或不是群成员）时返回 0"""
+        key = self.db.get_ranking_key(board, user_id, group_id)
+        if key is None:
+            return 0
+        position = self.db.count_ranking_before(board, key, group_id)
+        page = position // self.page_size + 1
+        if page > 1:
+            # 从用户所在行往前退到上一页的最后一行
+            cursor = self.db.seek_ranking_key(board, key, position % self.page_size, before=True, group_id=group_id)
+            if cursor is not None:
+                self._remember(board, group_id, page, cursor)
+        return page
+
+    def invalidate(self, scopes: Optional[Iterable[str]] = None):
+        """丢弃游标和总页数，例如全量重建排行榜之后
+        Args:
+            scopes: 只丢弃这些群的缓存，空字符串表示全服排行；为 None 时全部丢弃
+        """
+        with self._lock:
+            if scopes is None:
+                self._cursors.clear()
+                self._counts.clear()
+                self._checkpoints.clear()
+                return
+            # 检查点与游标一样允许页边界轻微偏移，生成代价较高，局部失效时保留到有效期结束
+            scopes = set(scopes)
+            for key in [key for key in self._cursors if key[1] in scopes]:
+                del self._cursors[key]
+            for scope in scopes:
+                self._counts.pop(scope, None)
+
+    def invalidate_users(self, user_ids: Optional[Iterable[str]]):
+        """其他实例修改了这些用户的数据，只丢弃全服排行中受影响的游标
+        游标是上一页最后一行的排序键：以这些用户为键的游标已经过时；用户新位置所在页的结束游标
+        （排在新位置之后的第一个游标）会让这一页被挤出的最后一行在翻页时漏掉，一并丢弃。
+        其余页的边界最多偏移一行，与本实例自己的写入一样保留到有效期结束。
+        Args:
+            user_ids: 发生变化的用户，为 None 时无法确定范围，丢弃全部缓存
+        """
+        if user_ids is None:
+            self.invalidate()
+            return
+        user_ids = set(user_ids)
+        for board in self.BOARDS:
+            with self._lock:
+                cached = [(key, cursor) for key, (cursor, _) in self._cursors.items() if key[:2] == (board, '')]
+            if not cached:
+                continue
+            sort_key = ranking_sort_key(board)
+            stale = {key for key, cursor in cached if cursor[-1] in user_ids}
+            cached.sort(key=lambda item: sort_key(item[1]))
+            for user_id in user_ids:
+                position = self.db.get_ranking_key(board, user_id)
+                if position is None:
+                    continue
+                following = next((key for key, cursor in cached if sort_key(cursor) > sort_key(position)), None)
+                if following is not None:
+                    stale.add(following)
+            with self._lock:
+                for key in stale:
+                    self._cursors.pop(key, None)
+
+    def build_checkpoints(self, board: str, group_id: str = None) -> int:
+        """顺序遍历一次排行，生成检查点，返回检查点个数
+        每一步从上一个检查点沿索引跳过 checkpoint_pages 页，总代价为遍历一次参与排行的行
+        """
+        stride = self.checkpoint_pages * self.page_size
+        keys, key = [], None
+        while True:
+            key = self.db.seek_ranking_key(board, key, stride - 1, group_id=group_id)
+            if key is None:
+                break
+            keys.append(key)
+        scope_key = (board, group_id or '')
+        with self._lock:
+            self._checkpoints[scope_key] = (keys, time.monotonic())
+            self._checkpoints.move_to_end(scope_key)
+            while len(self._checkpoints) > self.max_checkpoint_sets:
+                self._checkpoints.popitem(last=False)
+        return len(keys)
+
+    def _checkpoint_before(self, board: str, group_id: Optional[str], page: int) -> Optional[Tuple[int, tuple]]:
+        """不晚于 page 的最近检查点 (页码, 游标)；检查点缺失或过期时先生成，page 在第一个检查点之前时返回 None"""
+        index = (page - 1) // self.checkpoint_pages - 1
+        if index < 0:
+            return None
+        scope_key = (board, group_id or '')
+        with self._lock:
+            cached = self._checkpoints.get(scope_key)
+            lock = self._building.setdefault(scope_key, threading.Lock())
+        if cached is None or time.monotonic() - cached[1] >= self.cursor_ttl:
+            with lock:
+                with self._lock:
+                    cached = self._checkpoints.get(scope_key)
+                if cached is None or time.monotonic() - cached[1] >= self.cursor_ttl:
+                    self.build_checkpoints(board, group_id)
+                    with self._lock:
+                        cached = self._checkpoints.get(scope_key)
+        keys = cached[0] if cached else []
+        if not keys:
+            return None
+        # 超出生成时末页的页码从最后一个检查点出发，之后最多只有新增的行
+        index = min(index, len(keys) - 1)
+        return (index + 1) * self.checkpoint_pages + 1, keys[index]
+
+    def _cursor_for(self, board: str, group_id: Optional[str], page: int) -> Optional[tuple]:
+        now = time.monotonic()
+        scope = group_id or ''
+        with self._lock:
+            cached = self._cursors.get((board, scope, page))
+            if cached and now - cached[1] < self.cursor_ttl:
+                self._cursors.move_to_end((board, scope, page))
+                return cached[0]
+
+            # 最近的有效游标（没有时从榜首）
+            start_page, start_key = 1, None
+            for (cached_board, cached_scope, cached_page), (key, created) in self._cursors.items():
+                if (cached_board == board and cached_scope == scope and start_page < cached_page < page
+                        and now - created < self.cursor_ttl):
+                    start_page, start_key = cached_page, key
+        if page - start_page > self.checkpoint_pages:
+            checkpoint = self._checkpoint_before(board, group_id, page)
+            if checkpoint and checkpoint[0] > start_page:
+                start_page, start_key = checkpoint
+        if start_page == page:
+            cursor = start_key
+        else:
+            # 游标为空相当于第 1 页的游标，位于第 0 行之前
+            cursor = self.db.seek_ranking_key(board, start_key, (page - start_page) * self.page_size - 1,
+                                              group_id=group_id)
+        if cursor is not None:
+            self._remember(board, group_id, page, cursor)
+        return cursor
+
+    def _remember(self, board: str, group_id: Optional[str], page: int, cursor: tuple):
+        key = (board, group_id or '', page)
+        with self._lock:
+            self._cursors[key] = (cursor, time.monotonic())
+            self._cursors.move_to_end(key)
+            while len(self._cursors) > self.max_cursors:
+                self._cursors.popitem(last=False)
+
+    @staticmethod
+    def _display(board: str, row: tuple) -> tuple:
+        user_id, name, title, c1, c2 = row
+        if board == 'level':
+            return (user_id, name, c1, c2, title)
+        return (user_id, name, c1, title)
@@ -0,0 +1,88 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.request import pathname2url
+from typing import Callable, List
+
+
+class ReadConnectionPool:
+    """只读连接池
+
+    数据库处于 WAL 模式时，读连接读取已提交的快照，不会被写事务阻塞，也不阻塞写入。
+    连接按需创建，最多 size 个；连接可以在任意线程使用，但同一时刻只借给一个线程。
+    """
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection], size: int, wrap_cursor: Callable = None):
+        """
+        Args:
+            connect: 创建只读连接的函数
+            size: 最大连接数
+            wrap_cursor: 包装借出的游标（如计时代理），为空时直接使用原始游标
+        """
+        self._connect = connect
+        self.size = max(1, size)
+        self._wrap_cursor = wrap_cursor
+        self._idle: 'queue.LifoQueue[sqlite3.Connection]' = queue.LifoQueue()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._closed = False
+        # 借出次数和等待空闲连接的次数
+        self.checkouts = 0
+        self.waits = 0
+
+    def _get(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("读连接池已关闭")
+            if len(self._connections) < self.size:
+                conn = self._connect()
+                self._connections.append(conn)
+                return conn
+            self.waits += 1
+        return self._idle.get()
+
+    @contextmanager
+    def cursor(self):
+        """借出一个只读游标，退出时归还连接"""
+        conn = self._get()
+        self.checkouts += 1
+        cursor = conn.cursor()
+        try:
+            yield self._wrap_cursor(cursor) if self._wrap_cursor else cursor
+        finally:
+            cursor.close()
+            # 结束可能残留的读事务，下次借出时读取最新快照
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+    def stats(self) -> dict:
+        return {
+            'size': self.size,
+            'open': len(self._connections),
+            'idle': self._idle.qsize(),
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+        }
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+
+def connect_read_only(db_path: str, timeout: float = 5.0) -> sqlite3.Connection:
+    """以只读方式打开数据库，可跨线程使用"""
+    conn = sqlite3.connect(f"file:{pathname2url(db_path)}?mode=ro", uri=True, timeout=timeout, check_same_thread=False)
+    conn.execute('PRAGMA query_only = ON')
+    return conn
@@ -0,0 +1,82 @@
+from typing import Dict, Any, Optional, List
+
+_MISSING = object()
+
+
+class SignContext:
+    """单次请求上下文
+
+    在一个事件的处理过程中缓存用户数据、城堡、称号和昵称，
+    SignManager / CastleManager / SignDatabase 接收同一个上下文，避免重复查询。
+    上下文只在一次请求内有效，不要跨请求复用。
+    """
+
+    def __init__(self, db, user_id: str, group_id: str = None):
+        self.db = db
+        self.user_id = user_id
+        self.group_id = group_id
+        self._user_data = _MISSING
+        self._castle = _MISSING
+        self._titles = _MISSING
+        self._names = {}
+
+    @property
+    def user_data(self) -> Optional[Dict[str, Any]]:
+        """当前用户的签到数据"""
+        if self._user_data is _MISSING:
+            self._user_data = self.db.get_user_data(self.user_id)
+        return self._user_data
+
+    @property
+    def castle(self) -> Optional[Dict[str, Any]]:
+        """当前群的城堡，私聊时为 None"""
+        if self._castle is _MISSING:
+            self._castle = self.db.get_castle_by_group(self.group_id) if self.group_id else None
+        return self._castle
+
+    @property
+    def titles(self) -> List[tuple]:
+        """当前用户的所有称号 [(称号, 是否激活), ...]"""
+        if self._titles is _MISSING:
+            self._titles = self.db.get_user_titles(self.user_id)
+        return self._titles
+
+    @property
+    def active_title(self) -> str:
+        """当前用户激活的称号"""
+        return next((title for title, is_active in self.titles if is_active), "")
+
+    def get_user_name(self, user_id: str = None) -> str:
+        """获取用户昵称，默认为当前用户"""
+        user_id = user_id or self.user_id
+        if user_id not in self._names:
+            self._names[user_id] = self.db.get_user_name(user_id)
+        return self._names[user_id]
+
+    def get_user_names(self, user_ids: List[str]) -> Dict[str, str]:
+        """批量获取用户昵称，只查询尚未缓存的用户"""
+        missing = [user_id for user_id in user_ids if user_id not in self._names]
+        if missing:
+            self._names.update(self.db.get_user_names(missing))
+        return {user_id: self._names[user_id] for user_id in user_ids}
+
+    def castle_for(self, group_id: str) -> Optional[Dict[str, Any]]:
+        """获取指定群的城堡，与当前群相同时使用缓存"""
+        if group_id == self.group_id:
+            return self.castle
+        return self.db.get_castle_by_group(group_id)
+
+    def set_user_data(self, user_data: Optional[Dict[str, Any]]):
+        """写入数据库后同步缓存中的用户数据"""
+        self._user_data = user_data
+
+    def set_user_name(self, user_id: str, user_name: str):
+        self._names[user_id] = user_name
+
+    def invalidate(self, *keys: str):
+        """使缓存失效，不传参数时全部失效"""
+        for key in keys or ('user_data', 'castle', 'titles', 'names'):
+            if key == 'names':
+                self._names.clear()
+            else:
+                setattr(self, f'_{key}', _MISSING)
@@ -0,0 +1,30 @@
+import random
+import hashlib
+import datetime
+from typing import Union
+
+
+class RewardRNG:
+    """签到奖励随机数源
+
+    - 未设置种子：使用全局 random 模块，与旧版本行为一致
+    - 设置种子：每个 (用户, 签到日) 派生一个独立的 random.Random，
+      同一用户同一天的奖励可以完全重放，与请求先后顺序无关
+    奖励公式只依赖 randint，任何提供 randint(a, b) 的对象都可以作为随机源传入。
+    """
+
+    def __init__(self, seed: Union[int, str, None] = None):
+        self.seed = seed
+        # 不区分用户的随机流（例如捐献金币），设置种子时可整体重放
+        self.stream = random.Random(seed) if self.seeded else random
+
+    @property
+    def seeded(self) -> bool:
+        return self.seed is not None and self.seed != ''
+
+    def for_key(self, key: str, day: Union[datetime.date, str] = '') -> Union[random.Random, object]:
+        """获取某个用户（或城堡等）在某个签到日的随机源"""
+        if not self.seeded:
+            return random
+        digest = hashlib.blake2b(f"{self.seed}:{key}:{day}".encode('utf-8'), digest_size=8).digest()
+        return random.Random(int.from_bytes(digest, 'little'))
@@ -0,0 +1,348 @@
+import sqlite3
+import asyncio
+import datetime
+from typing import Dict, Any, List, Optional, Callable
+
+# 表结构迁移，按 version 升序逐个执行，每个版本在每个数据库上只执行一次
+# SignDatabase.init_db 中的 CREATE ... IF NOT EXISTS 是版本 0 的基线；之后新增的表、列、索引和数据转换都写在这里，
+# 已发布的迁移不能再修改，只能追加新版本。
+# - schema: 表结构语句，启动时在一个事务中执行，必须是快速的操作（建表、建索引、加列）
+# - backfill: 可选的数据回填，启动后在后台按 table 的 rowid 分批执行，每批一个短事务，
+#   sql 的两个参数为本批的 rowid 区间 (下界, 上界]；进度与本批写入在同一事务中提交，重启后从断点继续。
+#   sql 应当可以重复执行（如 INSERT OR IGNORE），回填期间插件照常写入，新行由写入路径自己维护。
+#   estimate 为预览时估计待回填行数的语句，参数为当前进度；语句涉及的表尚未创建时按 table 剩余行数估计。
+#   不能用一条语句表达的回填改用 step: 名称，由存储通过 SchemaMigrator 的 steps 提供同名的处理函数，
+#   step(table, 下界, 上界) 返回本批写入的行数；全部批次完成时在同一事务中再调用一次 step(table, None, None)
+# 之后的迁移的表结构不能依赖之前迁移的回填结果，回填完成前表结构已经全部就绪。
+MIGRATIONS = [
+    {
+        "version": 1,
+        "description": "群成员表：记录用户在哪些群签到过，冗余保存排序列用于群内排行",
+        "schema": [
+            '''CREATE TABLE IF NOT EXISTS group_members (
+                group_id TEXT,
+                user_id TEXT,
+                joined_date TEXT,
+                last_active TEXT,
+                total_days INTEGER DEFAULT 0,
+                last_sign TEXT DEFAULT '',
+                continuous_days INTEGER DEFAULT 0,
+                level INTEGER DEFAULT 1,
+                exp INTEGER DEFAULT 0,
+                PRIMARY KEY (group_id, user_id)
+            )''',
+            'CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members (user_id)',
+            'CREATE INDEX IF NOT EXISTS idx_group_members_world ON group_members (group_id, total_days DESC, last_sign, user_id)',
+            'CREATE INDEX IF NOT EXISTS idx_group_members_continuous ON group_members (group_id, continuous_days DESC, last_sign, user_id)',
+            'CREATE INDEX IF NOT EXISTS idx_group_members_level ON group_members (group_id, level DESC, exp DESC, user_id)',
+        ],
+        # 按每个用户最近签到的群回填
+        "backfill": {
+            "table": "sign_data",
+            "sql": '''
+                INSERT OR IGNORE INTO group_members
+                    (group_id, user_id, joined_date, last_active, total_days, last_sign, continuous_days, level, exp)
+                SELECT group_id, user_id, last_sign, last_sign, total_days, last_sign, continuous_days, level, exp
+                FROM sign_data
+                WHERE rowid > ? AND rowid <= ? AND group_id IS NOT NULL AND group_id != ''
+            ''',
+            "estimate": '''
+                SELECT COUNT(*) FROM sign_data s
+                WHERE s.rowid > ? AND s.group_id IS NOT NULL AND s.group_id != ''
+                  AND NOT EXISTS (SELECT 1 FROM group_members m WHERE m.group_id = s.group_id AND m.user_id = s.user_id)
+            ''',
+        },
+    },
+    {
+        "version": 2,
+        "description": "签到历史归档：按月汇总表，签到明细按日期和用户的索引",
+        "schema": [
+            '''CREATE TABLE IF NOT EXISTS sign_history_monthly (
+                user_id TEXT,
+                month TEXT,
+                sign_count INTEGER DEFAULT 0,
+                exp INTEGER DEFAULT 0,
+                coins INTEGER DEFAULT 0,
+                first_sign TEXT,
+                last_sign TEXT,
+                PRIMARY KEY (user_id, month)
+            )''',
+            'CREATE INDEX IF NOT EXISTS idx_sign_history_date ON sign_history (sign_date)',
+            'CREATE INDEX IF NOT EXISTS idx_sign_history_user ON sign_history (user_id, timestamp)',
+        ],
+    },
+    {
+        # 没有位图的用户第一次读取日历时从签到明细生成，不需要回填
+        "version": 3,
+        "description": "签到日历位图",
+        "schema": [
+            '''CREATE TABLE IF NOT EXISTS sign_calendar (
+                user_id TEXT,
+                year INTEGER,
+                days BLOB,
+                PRIMARY KEY (user_id, year)
+            )''',
+        ],
+    },
+    {
+        "version": 4,
+        "description": "全服排行的排序索引，键集分页和名次计数只扫描索引区间",
+        "schema": [
+            'CREATE INDEX IF NOT EXISTS idx_sign_data_world ON sign_data (total_days DESC, last_sign, user_id)',
+            'CREATE INDEX IF NOT EXISTS idx_sign_data_continuous ON sign_data (continuous_days DESC, last_sign, user_id)',
+            'CREATE INDEX IF NOT EXISTS idx_sign_data_level ON sign_data (level DESC, exp DESC, user_id)',
+        ],
+    },
+    {
+        "version": 5,
+        "description": "物化排行榜：用户榜从已有签到数据分批生成",
+        "schema": [
+            '''CREATE TABLE IF NOT EXISTS leaderboards (
+                board TEXT,
+                entity_id TEXT,
+                name TEXT,
+                title TEXT DEFAULT '',
+                k1 INTEGER,
+                k2 INTEGER,
+                PRIMARY KEY (board, entity_id)
+            )''',
+            '''CREATE TABLE IF NOT EXISTS leaderboard_meta (
+                board TEXT PRIMARY KEY,
+                complete INTEGER DEFAULT 0,
+                rebuilt_at TEXT
+            )''',
+            'CREATE INDEX IF NOT EXISTS idx_leaderboards_rank ON leaderboards (board, k1 DESC, k2 DESC, entity_id)',
+            # 已有数据时榜标记为生成中（rebuilt_at 为空），回填完成前读取直接查询来源表；没有元数据的榜是完整的空榜
+            '''INSERT OR IGNORE INTO leaderboard_meta (board, complete)
+                SELECT board, 1 FROM (SELECT 'world' AS board UNION ALL SELECT 'continuous' UNION ALL SELECT 'level')
+                WHERE EXISTS (SELECT 1 FROM sign_data)''',
+        ],
+        "backfill": {"table": "sign_data", "step": "leaderboards"},
+    },
+    {
+        "version": 6,
+        "description": "物化排行榜：城堡榜从已有城堡数据分批生成",
+        "schema": [
+            '''INSERT OR IGNORE INTO leaderboard_meta (board, complete)
+                SELECT board, 1 FROM (SELECT 'castle_level' AS board UNION ALL SELECT 'castle_coins')
+                WHERE EXISTS (SELECT 1 FROM castle_data)''',
+        ],
+        "backfill": {"table": "castle_data", "step": "leaderboards"},
+    },
+    {
+        "version": 7,
+        "description": "签到请求记录，重复投递的签到消息重放第一次的结果",
+        "schema": [
+            '''CREATE TABLE IF NOT EXISTS sign_requests (
+                request_key TEXT PRIMARY KEY,
+                user_id TEXT,
+                result TEXT,
+                response TEXT,
+                created_at INTEGER
+            )''',
+            'CREATE INDEX IF NOT EXISTS idx_sign_requests_created ON sign_requests (created_at)',
+        ],
+    },
+    {
+        # 触发器只在启用多实例缓存一致性检查时由 SignDatabase.set_change_log 创建
+        "version": 8,
+        "description": "变更日志，多实例部署时各进程据此失效缓存",
+        "schema": [
+            '''CREATE TABLE IF NOT EXISTS change_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                scope TEXT,
+                key TEXT,
+                created_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+            )''',
+            'CREATE INDEX IF NOT EXISTS idx_change_log_created ON change_log (created_at)',
+        ],
+    },
+]
+
+
+class SchemaMigrator:
+    """版本化表结构迁移
+
+    每个数据库的 schema_version 表记录已执行的版本和回填进度：
+    - apply_schema 在启动时执行未执行过的版本的表结构语句，并记下版本，很快完成
+    - 回填由 run_backfills 在后台分批执行，每批只持有一个短写事务，批次之间让出事件循环
+    - plan 只读取数据库，列出未完成的版本和估计的回填行数，可在只读连接上执行（预览）
+    """
+
+    def __init__(self, conn: sqlite3.Connection, migrations: List[Dict[str, Any]] = None,
+                 steps: Dict[str, Callable[[str, Optional[int], Optional[int]], int]] = None):
+        """
+        Args:
+            conn: 数据库连接，执行迁移时为写连接，预览时可以是只读连接
+            migrations: 迁移定义，默认为 MIGRATIONS
+            steps: 回填中 step 名称对应的处理函数，在 conn 的当前事务中执行、不提交；只预览时可以不传
+        """
+        self.conn = conn
+        self.migrations = list(migrations if migrations is not None else MIGRATIONS)
+        self.steps = steps or {}
+        versions = [migration['version'] for migration in self.migrations]
+        if versions != sorted(set(versions)) or (versions and versions[0] < 1):
+            raise ValueError(f"迁移版本必须是从 1 开始的递增整数: {versions}")
+
+    @property
+    def latest_version(self) -> int:
+        return self.migrations[-1]['version'] if self.migrations else 0
+
+    def _migration(self, version: int) -> Dict[str, Any]:
+        return next(migration for migration in self.migrations if migration['version'] == version)
+
+    @staticmethod
+    def _now() -> str:
+        return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    def applied(self) -> Dict[int, Dict[str, Any]]:
+        """已执行的版本 -> {'applied_at', 'backfill_cursor', 'backfill_rows', 'completed_at'}，未建表时为空"""
+        try:
+            rows = self.conn.execute('''
+                SELECT version, applied_at, backfill_cursor, backfill_rows, completed_at FROM schema_version
+            ''').fetchall()
+        except sqlite3.OperationalError:
+            return {}
+        return {
+            row[0]: {'applied_at': row[1], 'backfill_cursor': row[2], 'backfill_rows': row[3], 'completed_at': row[4]}
+            for row in rows
+        }
+
+    def current_version(self) -> int:
+        """已执行表结构的最高版本"""
+        return max(self.applied(), default=0)
+
+    def apply_schema(self) -> List[int]:
+        """执行未执行过的版本的表结构语句，每个版本一个事务
+        Returns:
+            本次执行的版本
+        """
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TEXT,
+                backfill_cursor INTEGER DEFAULT 0,
+                backfill_rows INTEGER DEFAULT 0,
+                completed_at TEXT
+            )
+        ''')
+        self.conn.commit()
+        applied = self.applied()
+        executed = []
+        for migration in self.migrations:
+            if migration['version'] in applied:
+                continue
+            try:
+                # sqlite3 模块不会在 DDL 前自动开启事务，显式开启，表结构语句和版本记录一起提交
+                self.conn.execute('BEGIN')
+                for statement in migration.get('schema', []):
+                    self.conn.execute(statement)
+                now = self._now()
+                self.conn.execute('''
+                    INSERT INTO schema_version (version, description, applied_at, completed_at) VALUES (?, ?, ?, ?)
+                ''', (migration['version'], migration['description'], now,
+                      None if self._needs_backfill(migration) else now))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            executed.append(migration['version'])
+        return executed
+
+    def _needs_backfill(self, migration: Dict[str, Any]) -> bool:
+        """有回填且来源表不为空；新建的数据库不需要回填"""
+        backfill = migration.get('backfill')
+        if not backfill:
+            return False
+        return self.conn.execute(f"SELECT 1 FROM {backfill['table']} LIMIT 1").fetchone() is not None
+
+    def pending_backfills(self) -> List[int]:
+        """表结构已执行、回填尚未完成的版本；更新版本插件写入的未知版本不处理"""
+        known = {migration['version'] for migration in self.migrations}
+        return sorted(version for version, state in self.applied().items() if not state['completed_at'] and version in known)
+
+    def run_backfill_chunk(self, version: int, chunk_size: int) -> int:
+        """回填一批，本批写入和进度在同一事务中提交
+        Returns:
+            本批扫描的行数，0 表示该版本的回填已经完成
+        """
+        backfill = self._migration(version)['backfill']
+        cursor = self.applied()[version]['backfill_cursor']
+        count, upper = self.conn.execute(f'''
+            SELECT COUNT(*), MAX(rowid) FROM (SELECT rowid FROM {backfill['table']} WHERE rowid > ? ORDER BY rowid LIMIT ?)
+        ''', (cursor, max(1, chunk_size))).fetchone()
+        step = self.steps[backfill['step']] if 'step' in backfill else None
+        try:
+            if not count:
+                if step:
+                    step(backfill['table'], None, None)
+                self.conn.execute('UPDATE schema_version SET completed_at = ? WHERE version = ?', (self._now(), version))
+            else:
+                if step:
+                    written = step(backfill['table'], cursor, upper)
+                else:
+                    written = self.conn.execute(backfill['sql'], (cursor, upper)).rowcount
+                self.conn.execute('''
+                    UPDATE schema_version SET backfill_cursor = ?, backfill_rows = backfill_rows + ? WHERE version = ?
+                ''', (upper, max(0, written), version))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return count
+
+    async def run_backfills(self, chunk_size: int = 500, pause: float = 0.05) -> Dict[int, int]:
+        """按版本顺序完成所有未完成的回填，批次之间让出事件循环
+        Returns:
+            版本 -> 本次扫描的行数
+        """
+        scanned = {}
+        for version in self.pending_backfills():
+            scanned[version] = 0
+            while True:
+                count = self.run_backfill_chunk(version, chunk_size)
+                if not count:
+                    break
+                scanned[version] += count
+                await asyncio.sleep(pause)
+        return scanned
+
+    def _estimate(self, backfill: Dict[str, Any], cursor: int) -> Optional[tuple]:
+        """(估计行数, 是否精确)；回填来源表不存在时为 None"""
+        try:
+            return self.conn.execute(backfill['estimate'], (cursor,)).fetchone()[0], True
+        except (KeyError, sqlite3.OperationalError):
+            pass
+        try:
+            count = self.conn.execute(f"SELECT COUNT(*) FROM {backfill['table']} WHERE rowid > ?", (cursor,)).fetchone()[0]
+            return count, False
+        except sqlite3.OperationalError:
+            return None
+
+    def plan(self) -> List[Dict[str, Any]]:
+        """预览：列出未完成的版本，不修改数据库
+        Returns:
+            [{'version', 'description', 'schema_pending': 是否还要执行表结构语句, 'statements': 语句数,
+              'backfill': 是否有回填, 'cursor': 回填进度, 'rows': 估计待回填行数, 'exact': 估计是否精确}, ...]
+        """
+        applied = self.applied()
+        steps = []
+        for migration in self.migrations:
+            state = applied.get(migration['version'])
+            if state and state['completed_at']:
+                continue
+            backfill = migration.get('backfill')
+            cursor = state['backfill_cursor'] if state else 0
+            estimate = self._estimate(backfill, cursor) if backfill else None
+            steps.append({
+                'version': migration['version'],
+                'description': migration['description'],
+                'schema_pending': state is None,
+                'statements': 0 if state else len(migration.get('schema', [])),
+                'backfill': bool(backfill),
+                'cursor': cursor,
+                'rows': estimate[0] if estimate else 0,
+                'exact': estimate[1] if estimate else True,
+            })
+        return steps
@@ -0,0 +1,88 @@
+import os
+import asyncio
+from typing import Dict, List, Tuple
+
+from .database import SignDatabase, logger
+from .sharded_database import ShardedSignDatabase, shard_index
+
+
+class ShardRebalancer:
+    """把数据移到当前分片数下所属的分片
+
+    数据来源包括当前的各个分片（分片数变化后部分行不再属于原分片）、单文件存储的数据库
+    和超出分片数的旧分片文件。按表和 rowid 分批处理，每批：
+    1. 按分片键计算每行的目标分片，写入目标分片并提交
+    2. 从来源删除这些行并提交
+    先写后删，中途停止不会丢数据；再次运行时已写入的行按主键覆盖（签到历史按用户、日期和时间去重），
+    可以安全地重复执行直到完成。每批都是独立的短事务，批次之间让出事件循环。
+    移空的旧数据库文件改名为 *.migrated，确认无误后可以删除。全部移动完成后重建各分片的物化排行榜，
+    移动过程中排行榜和名次可能暂时不准确，建议在低峰期执行。
+    """
+
+    def __init__(self, db: ShardedSignDatabase, chunk_size: int = 1000, pause: float = 0.05):
+        """
+        Args:
+            db: 分片存储
+            chunk_size: 每批读取的行数
+            pause: 批次之间的间隔(秒)
+        """
+        self.db = db
+        self.chunk_size = max(1, chunk_size)
+        self.pause = pause
+
+    def _sources(self) -> List[Tuple[SignDatabase, bool]]:
+        """[(来源数据库, 是否为临时打开需要关闭), ...]"""
+        sources = [(shard, False) for shard in self.db.shards]
+        for name in self.db.unplaced_files():
+            sources.append((SignDatabase(self.db.plugin_dir, clock=self.db.clock, read_pool_size=0, db_name=name), True))
+        return sources
+
+    async def _move_table(self, source: SignDatabase, table: str) -> int:
+        """移动一个来源中一张表里不属于该来源的行，返回移动的行数"""
+        key_column = SignDatabase.SHARD_KEYS[table]
+        shards = self.db.shards
+        moved = 0
+        after = 0
+        while True:
+            columns, rows = source.get_table_rows(table, after, self.chunk_size)
+            if not rows:
+                return moved
+            after = rows[-1][0]
+            key_position = columns.index(key_column) + 1
+            targets: Dict[int, List[tuple]] = {}
+            for row in rows:
+                target = shard_index(row[key_position], self.db.shard_count)
+                if shards[target] is not source:
+                    targets.setdefault(target, []).append(row)
+            if targets:
+                for target, target_rows in targets.items():
+                    if not shards[target].insert_table_rows(table, columns, [row[1:] for row in target_rows]):
+                        raise RuntimeError(f"写入分片 {target} 失败")
+                rowids = [row[0] for target_rows in targets.values() for row in target_rows]
+                if not source.delete_table_rows(table, rowids):
+                    raise RuntimeError(f"从 {os.path.basename(source.db_path)} 删除已迁移数据失败")
+                moved += len(rowids)
+            await asyncio.sleep(self.pause)
+
+    async def run(self) -> Dict[str, int]:
+        """执行迁移
+        Returns:
+            {表名: 移动的行数}
+        """
+        moved = {table: 0 for table in SignDatabase.SHARD_KEYS}
+        for source, temporary in self._sources():
+            try:
+                # 先完成来源上未完成的迁移回填，目标分片不会再为移入的行回填
+                await source.run_backfills(self.chunk_size, self.pause)
+                for table in SignDatabase.SHARD_KEYS:
+                    moved[table] += await self._move_table(source, table)
+            finally:
+                if temporary:
+                    source.close()
+            if temporary:
+                # 已全部移出，改名后不再被当作待迁移的数据库
+                os.replace(source.db_path, f"{source.db_path}.migrated")
+        if any(moved.values()):
+            self.db.rebuild_leaderboards()
+        logger.info(f"分片迁移完成: {moved}")
+        return moved
@@ -0,0 +1,333 @@
+import os
+import zlib
+import heapq
+import functools
+from itertools import islice
+from typing import Dict, Any, Optional, List, Iterable
+
+from .clock import SignClock
+from .database import SignDatabase, logger
+from .storage import SignStorage, StatementHook, ranking_sort_key
+from .slow_query import SlowQueryLog
+from .read_pool import connect_read_only
+
+
+def shard_index(key: str, shard_count: int) -> int:
+    """分片键所在的分片，使用与进程无关的 CRC32，不同实例和重启之后结果一致"""
+    return zlib.crc32(str(key).encode('utf-8')) % shard_count
+
+
+def _leaderboard_sort_key(row: tuple) -> tuple:
+    # 物化排行榜的行 (实体ID, 名称, 称号, k1, k2)，按 k1 DESC, k2 DESC, 实体ID 排序
+    return (-row[3], -row[4], row[0])
+
+
+def _routed(name: str):
+    """按第一个参数（用户ID或群号）路由到所属分片的同名方法"""
+    method = getattr(SignDatabase, name)
+
+    @functools.wraps(method)
+    def route(self, key, *args, **kwargs):
+        return getattr(self.shard_for(key), name)(key, *args, **kwargs)
+    return route
+
+
+class _ReadPoolGroup:
+    """各分片只读连接池的合计状态"""
+
+    def __init__(self, pools: list):
+        self.pools = pools
+
+    def stats(self) -> dict:
+        totals = {}
+        for pool in self.pools:
+            for key, value in pool.stats().items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+
+class ShardedSignDatabase(SignStorage):
+    """分片存储
+
+    把数据分散到 shard_count 个数据库文件，每个分片都是完整的 SignDatabase，各有自己的写连接和只读连接池：
+    - 用户的签到数据、历史、背包、称号、昵称、日历和群成员关系按 user_id 分片，一个用户的写入只涉及一个分片
+    - 城堡按 group_id 分片，幂等记录与发送者在同一分片，签到的所有写入在一个分片的一个事务中完成
+    - 全服排行榜由各分片的物化榜（各自前 LEADERBOARD_SIZE 名准确）k 路归并得到；
+      键集分页、群内排行和名次在各分片上分别查找或计数后归并、求和
+    - 城堡编号按分片交错分配，全局不重复
+    与 SignDatabase 实现相同的 SignStorage 接口，调用方无需区分。分片数变化或从单文件切换过来后，
+    用 ShardRebalancer 把数据移到所属分片。
+    """
+
+    SHARD_NAME = "astrbot_plugin_advanced_sign.shard{}.db"
+
+    def __init__(self, plugin_dir: str, shard_count: int, clock: SignClock = None, slow_query_ms: float = 0,
+                 read_pool_size: int = None):
+        """
+        Args:
+            plugin_dir: 插件目录，分片文件位于其下的 plugins_db
+            shard_count: 分片数
+            clock: 签到时钟
+            slow_query_ms: 慢查询阈值(毫秒)，所有分片共用一份慢查询日志
+            read_pool_size: 每个分片的只读连接数，含义同 SignDatabase
+        """
+        self.plugin_dir = plugin_dir
+        self.shard_count = max(1, shard_count)
+        self._clock = clock or SignClock()
+        self._shards = [
+            SignDatabase(plugin_dir, clock=self._clock, read_pool_size=read_pool_size,
+                         db_name=self.SHARD_NAME.format(index),
+                         castle_id_step=self.shard_count, castle_id_offset=index)
+            for index in range(self.shard_count)
+        ]
+        # 指标、归档等文件放在第一个分片所在目录
+        self.db_path = self._shards[0].db_path
+        pools = [shard.read_pool for shard in self._shards if shard.read_pool]
+        self.read_pool = _ReadPoolGroup(pools) if pools else None
+        self.slow_query_log = None
+        if slow_query_ms and slow_query_ms > 0:
+            # 各分片表结构相同，EXPLAIN 在第一个分片上执行
+            self.slow_query_log = SlowQueryLog(
+                connect_read_only(self.db_path),
+                os.path.join(os.path.dirname(self.db_path), "slow_query.log"), slow_query_ms
+            )
+            self.add_statement_hook(self.slow_query_log)
+        self._warn_unplaced()
+
+    @property
+    def shards(self) -> List[SignDatabase]:
+        return list(self._shards)
+
+    @property
+    def data_dir(self) -> str:
+        return os.path.dirname(self.db_path)
+
+    @property
+    def change_logs(self) -> List[SignDatabase]:
+        # 每个分片有自己的变更日志和 data_version
+        return list(self._shards)
+
+    @property
+    def database_files(self) -> List[str]:
+        return [name for shard in self._shards for name in shard.database_files]
+
+    def migration_status(self) -> Dict[str, Dict[str, Any]]:
+        status = {}
+        for shard in self._shards:
+            status.update(shard.migration_status())
+        return status
+
+    def pending_backfills(self) -> List[int]:
+        return sorted({version for shard in self._shards for version in shard.pending_backfills()})
+
+    async def run_backfills(self, chunk_size: int = 500, pause: float = 0.05) -> Dict[str, Dict[int, int]]:
+        """依次完成各分片的回填，某个分片失败时记录日志并继续其他分片"""
+        scanned = {}
+        for shard in self._shards:
+            try:
+                scanned.update(await shard.run_backfills(chunk_size, pause))
+            except Exception as e:
+                logger.error(f"迁移回填失败 {os.path.basename(shard.db_path)}: {str(e)}")
+        return scanned
+
+    def backup_to(self, target_dir: str, pages: int = 256, pause: float = 0.05) -> Dict[str, int]:
+        """按分片依次复制，各分片分别是一致的，但分片之间不是同一时刻"""
+        copied = {}
+        for shard in self._shards:
+            copied.update(shard.backup_to(target_dir, pages, pause))
+        return copied
+
+    def check_integrity(self, source_dir: str) -> Dict[str, List[str]]:
+        problems = {}
+        for shard in self._shards:
+            problems.update(shard.check_integrity(source_dir))
+        return problems
+
+    def restore_from(self, source_dir: str) -> List[str]:
+        return [name for shard in self._shards for name in shard.restore_from(source_dir)]
+
+    def set_change_log(self, enabled: bool):
+        for shard in self._shards:
+            shard.set_change_log(enabled)
+
+    @property
+    def clock(self) -> SignClock:
+        return self._clock
+
+    @clock.setter
+    def clock(self, value: SignClock):
+        self._clock = value
+        for shard in self._shards:
+            shard.clock = value
+
+    def shard_for(self, key: str) -> SignDatabase:
+        """分片键（用户ID或群号）所在的分片"""
+        return self._shards[shard_index(key, self.shard_count)]
+
+    def unplaced_files(self) -> List[str]:
+        """不属于当前分片的数据库文件：单文件存储的数据库和超出分片数的分片"""
+        db_dir = os.path.dirname(self.db_path)
+        names = [SignDatabase.DB_NAME]
+        index = self.shard_count
+        while os.path.exists(os.path.join(db_dir, self.SHARD_NAME.format(index))):
+            names.append(self.SHARD_NAME.format(index))
+            index += 1
+        return [name for name in names if os.path.exists(os.path.join(db_dir, name))]
+
+    def _warn_unplaced(self):
+        unplaced = self.unplaced_files()
+        if unplaced:
+            logger.warning(f"存在未迁移到当前 {self.shard_count} 个分片的数据库: {', '.join(unplaced)}，"
+                           f"请使用 /重新分片 迁移")
+
+    def _group_by_shard(self, keys: Iterable[str]) -> Dict[int, List[str]]:
+        groups: Dict[int, List[str]] = {}
+        for key in keys:
+            groups.setdefault(shard_index(key, self.shard_count), []).append(key)
+        return groups
+
+    def add_statement_hook(self, hook: StatementHook):
+        for shard in self._shards:
+            shard.add_statement_hook(hook)
+
+    # 单个用户、城堡和签到请求的读写都在所属分片上完成
+    get_user_data = _routed('get_user_data')
+    update_user_data = _routed('update_user_data')
+    update_user_name = _routed('update_user_name')
+    get_user_name = _routed('get_user_name')
+    log_sign = _routed('log_sign')
+    get_sign_calendar = _routed('get_sign_calendar')
+    read_sign_calendar = _routed('read_sign_calendar')
+    get_monthly_history = _routed('get_monthly_history')
+    get_user_inventory = _routed('get_user_inventory')
+    update_inventory = _routed('update_inventory')
+    add_user_title = _routed('add_user_title')
+    apply_title_changes = _routed('apply_title_changes')
+    get_user_titles = _routed('get_user_titles')
+    activate_title = _routed('activate_title')
+    deactivate_all_titles = _routed('deactivate_all_titles')
+    get_active_title = _routed('get_active_title')
+    get_castle_id_by_group = _routed('get_castle_id_by_group')
+    get_castle_by_group = _routed('get_castle_by_group')
+    create_castle = _routed('create_castle')
+    join_castle = _routed('join_castle')
+    leave_castle = _routed('leave_castle')
+    upgrade_castle = _routed('upgrade_castle')
+    donate_coins = _routed('donate_coins')
+    add_castle_exp = _routed('add_castle_exp')
+    elect_lord = _routed('elect_lord')
+    elect_manager = _routed('elect_manager')
+    dismiss_manager = _routed('dismiss_manager')
+    destroy_castle = _routed('destroy_castle')
+
+    def get_user_names(self, user_ids: List[str]) -> Dict[str, str]:
+        """批量获取用户昵称，每个分片查询一次"""
+        names = {}
+        for index, keys in self._group_by_shard(user_ids).items():
+            names.update(self._shards[index].get_user_names(keys))
+        return {user_id: names[user_id] for user_id in user_ids}
+
+    def get_active_titles(self, user_ids: List[str]) -> Dict[str, str]:
+        """批量获取用户当前激活的称号，每个分片查询一次"""
+        titles = {}
+        for index, keys in self._group_by_shard(user_ids).items():
+            titles.update(self._shards[index].get_active_titles(keys))
+        return {user_id: titles[user_id] for user_id in user_ids}
+
+    def import_users(self, users: List[Dict[str, Any]]) -> bool:
+        groups: Dict[int, List[Dict[str, Any]]] = {}
+        for user in users:
+            groups.setdefault(shard_index(user['user_id'], self.shard_count), []).append(user)
+        return all([self._shards[index].import_users(rows) for index, rows in groups.items()])
+
+    def import_sign_history(self, rows: List[tuple]) -> bool:
+        groups: Dict[int, List[tuple]] = {}
+        for row in rows:
+            groups.setdefault(shard_index(row[0], self.shard_count), []).append(row)
+        return all([self._shards[index].import_sign_history(part) for index, part in groups.items()])
+
+    def get_expired_history(self, before_date: str, limit: int) -> List[tuple]:
+        """依次从各分片取早于指定日期的签到历史，合计最多 limit 行（ID 只在所属分片内唯一）"""
+        rows = []
+        for shard in self._shards:
+            if len(rows) >= limit:
+                break
+            rows.extend(shard.get_expired_history(before_date, limit - len(rows)))
+        return rows
+
+    def rollup_history(self, rows: List[tuple]) -> bool:
+        """按用户所在分片分别汇总，签到历史与用户在同一分片"""
+        groups: Dict[int, List[tuple]] = {}
+        for row in rows:
+            groups.setdefault(shard_index(row[1], self.shard_count), []).append(row)
+        return all([self._shards[index].rollup_history(part) for index, part in groups.items()])
+
+    def incremental_vacuum(self, pages: int) -> int:
+        return sum(shard.incremental_vacuum(pages) for shard in self._shards)
+
+    def transaction(self, user_id: str):
+        """用户的数据和签到请求都在所属分片，事务只涉及这一个分片"""
+        return self.shard_for(user_id).transaction(user_id)
+
+    def get_sign_request(self, request_key: str, since: int = 0, user_id: str = None) -> Optional[Dict[str, Any]]:
+        """签到请求与发送者在同一分片；不知道发送者时依次查找各分片"""
+        shards = [self.shard_for(user_id)] if user_id else self._shards
+        for shard in shards:
+            record = shard.get_sign_request(request_key, since)
+            if record:
+                return record
+        return None
+
+    def save_sign_request(self, request_key: str, user_id: str, result: Optional[Dict[str, Any]], response: str,
+                          created_at: int) -> bool:
+        return self.shard_for(user_id).save_sign_request(request_key, user_id, result, response, created_at)
+
+    def purge_sign_requests(self, before: int) -> int:
+        return sum(shard.purge_sign_requests(before) for shard in self._shards)
+
+    def check_castle_name_exists(self, castle_name: str) -> bool:
+        """城堡名称全局唯一，在所有分片中检查"""
+        return any(shard.check_castle_name_exists(castle_name) for shard in self._shards)
+
+    def get_leaderboard(self, board: str, limit: int = 10) -> List[tuple]:
+        """归并各分片物化榜的前 limit 名
+        每个分片的榜保证前 LEADERBOARD_SIZE 名准确，全服前 limit 名必然在各分片的前 limit 名之中
+        """
+        limit = min(limit, self.LEADERBOARD_SIZE)
+        tops = [shard.get_leaderboard(board, limit) for shard in self._shards]
+        return list(islice(heapq.merge(*tops, key=_leaderboard_sort_key), limit))
+
+    def rebuild_leaderboards(self, boards: List[str] = None) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for shard in self._shards:
+            shard_counts = shard.rebuild_leaderboards(boards)
+            if not shard_counts:
+                return {}
+            for board, count in shard_counts.items():
+                counts[board] = counts.get(board, 0) + count
+        return counts
+
+    def get_ranking_keys(self, board: str, key: Optional[tuple], limit: int, offset: int = 0, before: bool = False,
+                         group_id: str = None) -> List[tuple]:
+        """各分片从 key 处各取 offset + limit 个排序键，归并后跳过 offset 个"""
+        parts = [shard.get_ranking_keys(board, key, offset + limit, before=before, group_id=group_id)
+                 for shard in self._shards]
+        merged = heapq.merge(*parts, key=ranking_sort_key(board), reverse=before)
+        return list(islice(merged, offset, offset + limit))
+
+    def get_ranking_key(self, board: str, user_id: str, group_id: str = None) -> Optional[tuple]:
+        # 群成员关系与用户在同一分片
+        return self.shard_for(user_id).get_ranking_key(board, user_id, group_id)
+
+    def count_ranking_before(self, board: str, key: tuple, group_id: str = None) -> int:
+        return sum(shard.count_ranking_before(board, key, group_id) for shard in self._shards)
+
+    def count_users(self, group_id: str = None) -> int:
+        return sum(shard.count_users(group_id) for shard in self._shards)
+
+    def close(self):
+        if self.slow_query_log:
+            self.slow_query_log.close()
+            self.slow_query_log.conn.close()
+        for shard in self._shards:
+            shard.close()
@@ -0,0 +1,120 @@
+import calendar
+import datetime
+from typing import Dict, Tuple
+
+
+class SignCalendar:
+    """签到日历位图
+
+    每个用户每年一个 366 位的位图（46 字节 BLOB），第 n 位表示当年第 n+1 天是否签到。
+    总天数用 popcount 计算，连续天数用位运算计算，不再需要扫描签到历史。
+    """
+
+    # 366 位向上取整到字节
+    YEAR_BYTES = 46
+
+    @staticmethod
+    def day_index(day: datetime.date) -> int:
+        """日期在当年位图中的位置"""
+        return day.timetuple().tm_yday - 1
+
+    @staticmethod
+    def set_day(bits: bytes, day: datetime.date) -> bytes:
+        """在位图中标记某天已签到"""
+        value = int.from_bytes(bits or b'', 'little') | (1 << SignCalendar.day_index(day))
+        return value.to_bytes(SignCalendar.YEAR_BYTES, 'little')
+
+    @staticmethod
+    def has_day(bits: bytes, day: datetime.date) -> bool:
+        """某天是否已签到"""
+        return bool(int.from_bytes(bits or b'', 'little') >> SignCalendar.day_index(day) & 1)
+
+    @staticmethod
+    def count_days(bits: bytes) -> int:
+        """位图中的签到天数"""
+        return bin(int.from_bytes(bits or b'', 'little')).count('1')
+
+    @staticmethod
+    def _days_in_year(year: int) -> int:
+        return 366 if calendar.isleap(year) else 365
+
+    @staticmethod
+    def _merge_years(years: Dict[int, bytes]) -> Tuple[int, int, int]:
+        """把多年的位图按时间顺序拼接成一个整数
+        Returns:
+            (拼接后的位图, 第一年的年份, 总位数)
+        """
+        if not years:
+            return 0, 0, 0
+        first_year = min(years)
+        merged = 0
+        offset = 0
+        for year in range(first_year, max(years) + 1):
+            size = SignCalendar._days_in_year(year)
+            value = int.from_bytes(years.get(year) or b'', 'little') & ((1 << size) - 1)
+            merged |= value << offset
+            offset += size
+        return merged, first_year, offset
+
+    @staticmethod
+    def total_days(years: Dict[int, bytes]) -> int:
+        """累计签到天数"""
+        return sum(SignCalendar.count_days(bits) for bits in years.values())
+
+    @staticmethod
+    def longest_streak(years: Dict[int, bytes]) -> int:
+        """最长连续签到天数（可跨年）"""
+        merged, _, _ = SignCalendar._merge_years(years)
+        # 每次与左移一位的自身相与，连续段长度减一，能进行的次数就是最长连续天数
+        streak = 0
+        while merged:
+            merged &= merged << 1
+            streak += 1
+        return streak
+
+    @staticmethod
+    def current_streak(years: Dict[int, bytes], today: datetime.date) -> int:
+        """截至今天的连续签到天数，今天还没签到时从昨天开始算"""
+        merged, first_year, _ = SignCalendar._merge_years(years)
+        if not merged or today.year < first_year:
+            return 0
+
+        position = (today - datetime.date(first_year, 1, 1)).days
+        if not merged >> position & 1:
+            position -= 1
+        if position < 0 or not merged >> position & 1:
+            return 0
+
+        # 找到 position 及以下最高的未签到位
+        missing = ~merged & ((1 << (position + 1)) - 1)
+        return position + 1 - missing.bit_length()
+
+    @staticmethod
+    def format_month(years: Dict[int, bytes], year: int, month: int, today: datetime.date) -> str:
+        """格式化月度签到日历"""
+        bits = int.from_bytes(years.get(year) or b'', 'little')
+        first_index = SignCalendar.day_index(datetime.date(year, month, 1))
+
+        result = f"{year}年{month}月 签到日历\n"
+        result += "一　二　三　四　五　六　日\n"
+        month_days = 0
+        for week in calendar.Calendar().monthdayscalendar(year, month):
+            cells = []
+            for day in week:
+                if not day:
+                    cells.append("　")
+                elif bits >> (first_index + day - 1) & 1:
+                    cells.append("●")
+                    month_days += 1
+                else:
+                    cells.append("○")
+            result += "　".join(cells) + "\n"
+
+        result += (
+            f"====================\n"
+            f"本月签到：{month_days}天\n"
+            f"累计签到：{SignCalendar.total_days(years)}天\n"
+            f"最长连续：{SignCalendar.longest_streak(years)}天\n"
+            f"当前连续：{SignCalendar.current_streak(years, today)}天（含补签）"
+        )
+        return result
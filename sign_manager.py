@@ -1,21 +1,26 @@
 import random
 import datetime
 from typing import Dict, Any, Tuple, List
-from .database import SignDatabase
+from .storage import SignStorage
+from .clock import SignClock
+from .title_rules import TITLE_ENGINE
+from .request_context import SignContext
 
 class SignManager:
     @staticmethod
-    def calculate_exp_reward(continuous_days: int, level: int, castle_level: int = 0) -> int:
+    def calculate_exp_reward(continuous_days: int, level: int, castle_level: int = 0, rng=None) -> int:
         """计算经验奖励
         Args:
             continuous_days: 连续签到天数
             level: 当前等级
             castle_level: 城堡等级
+            rng: 随机数源，默认使用全局 random
         Returns:
             经验奖励值
         """
+        rng = rng or random
         # 基础经验奖励 (10-50)
-        base_exp = random.randint(10, 50)
+        base_exp = rng.randint(10, 50)
         
         # 等级加成 (每级增加15%)
         level_bonus = base_exp * ((level - 1) * 0.15)
@@ -39,23 +44,25 @@ class SignManager:
         # 如果有城堡，则应用城堡增益
         if castle_level > 0:
             from .castle_manager import CastleManager
-            buffed_exp, _ = CastleManager.get_buffed_rewards(base_total_exp, (0, 0), castle_level)
+            buffed_exp, _ = CastleManager.get_buffed_rewards(base_total_exp, (0, 0), castle_level, rng)
             return buffed_exp
             
         return base_total_exp
     
     @staticmethod
-    def calculate_coin_reward(continuous_days: int, level: int, castle_level: int = 0) -> int:
+    def calculate_coin_reward(continuous_days: int, level: int, castle_level: int = 0, rng=None) -> int:
         """计算金币奖励
         Args:
             continuous_days: 连续签到天数
             level: 当前等级
             castle_level: 城堡等级
+            rng: 随机数源，默认使用全局 random
         Returns:
             金币奖励值
         """
+        rng = rng or random
         # 基础金币奖励 (90-180)
-        base_coins = random.randint(90, 180)
+        base_coins = rng.randint(90, 180)
         
         # 等级加成 (每级增加15%)
         level_bonus = base_coins * ((level - 1) * 0.15)
@@ -79,7 +86,7 @@ class SignManager:
         # 如果有城堡，则应用城堡增益
         if castle_level > 0:
             from .castle_manager import CastleManager
-            _, buffed_coins = CastleManager.get_buffed_rewards(0, (base_total_coins, base_total_coins), castle_level)
+            _, buffed_coins = CastleManager.get_buffed_rewards(0, (base_total_coins, base_total_coins), castle_level, rng)
             return buffed_coins
             
         return base_total_coins
@@ -98,6 +105,12 @@ class SignManager:
             # 每级比上一级多20%
             return int(SignManager._get_next_level_exp(level - 1) * 1.2)
     
+    @staticmethod
+    def _today(db: SignStorage = None) -> datetime.date:
+        """获取当前签到日，优先使用数据库注入的签到时钟"""
+        clock = db.clock if db else SignClock()
+        return clock.today()
+    
     @staticmethod
     def calculate_level(exp: int, current_level: int) -> Tuple[int, int]:
         """计算等级和下一级所需经验
@@ -118,12 +131,16 @@ class SignManager:
         return level, next_level_exp
     
     @staticmethod
-    def daily_sign(user_data: Dict[str, Any], group_id: str = None, db: SignDatabase = None) -> Dict[str, Any]:
+    def daily_sign(user_data: Dict[str, Any], group_id: str = None, db: SignStorage = None,
+                   today: datetime.date = None, rng=None, ctx: SignContext = None) -> Dict[str, Any]:
         """每日签到
         Args:
             user_data: 用户数据
             group_id: 群组ID
             db: 数据库实例
+            today: 当前签到日，默认取数据库签到时钟的日期
+            rng: 奖励随机数源，默认使用全局 random
+            ctx: 请求上下文，传入时复用其中的城堡信息
         Returns:
             签到结果
         """
@@ -140,7 +157,7 @@ class SignManager:
         
         # 计算连续签到天数
         continuous_days = 1
-        today = datetime.date.today()
+        today = today or SignManager._today(db)
         last_sign = user_data.get('last_sign', '')
         
         if last_sign:
@@ -157,15 +174,15 @@ class SignManager:
         
         # 获取城堡等级
         castle_level = 0
-        if group_id and db:
-            castle_data = db.get_castle_by_group(group_id)
+        if group_id and (db or ctx):
+            castle_data = ctx.castle_for(group_id) if ctx else db.get_castle_by_group(group_id)
             if castle_data:
                 castle_level = castle_data.get('level', 0)
         
         # 计算奖励
         level = user_data.get('level', 1)
-        exp_reward = SignManager.calculate_exp_reward(continuous_days, level, castle_level)
-        coin_reward = SignManager.calculate_coin_reward(continuous_days, level, castle_level)
+        exp_reward = SignManager.calculate_exp_reward(continuous_days, level, castle_level, rng)
+        coin_reward = SignManager.calculate_coin_reward(continuous_days, level, castle_level, rng)
         
         # 更新经验
         total_exp = user_data.get('exp', 0) + exp_reward
@@ -173,29 +190,12 @@ class SignManager:
         # 计算新等级
         new_level, next_level_exp = SignManager.calculate_level(total_exp, level)
         
-        # 检查是否获得新称号
-        new_titles = []
+        # 按称号规则计算本次签到获得和需要收回的称号，断签时以断签前的连续天数计算刚跌破阈值的称号
         total_days = user_data.get('total_days', 0) + 1
-        
-        # 首次签到获得【签到新人】称号
-        if total_days == 1:
-            new_titles.append("签到新人")
-        
-        # 首次7天签到获得【签到达人】
-        if total_days == 7 and user_data.get('total_days', 0) < 7:
-            new_titles.append("签到达人")
-            
-        # 首次30天签到获得【月神之誓】
-        if total_days == 30 and user_data.get('total_days', 0) < 30:
-            new_titles.append("月神之誓")
-            
-        # 连续7天签到获得【七日先锋】（断签会收回）
-        if continuous_days == 7:
-            new_titles.append("七日先锋")
-            
-        # 连续30天签到获得【永恒裁决者】（断签会收回）
-        if continuous_days == 30:
-            new_titles.append("永恒裁决者")
+        new_titles, revoked_titles = TITLE_ENGINE.evaluate(
+            {'total_days': total_days - 1, 'continuous_days': user_data.get('continuous_days', 0)},
+            {'total_days': total_days, 'continuous_days': continuous_days}
+        )
         
         return {
             'total_days': total_days,
@@ -206,11 +206,13 @@ class SignManager:
             'coins': user_data.get('coins', 0) + coin_reward,
             'exp_reward': exp_reward,
             'coin_reward': coin_reward,
-            'new_titles': new_titles
+            'new_titles': new_titles,
+            'revoked_titles': revoked_titles
         }
     
     @staticmethod
-    def format_sign_result(result: Dict[str, Any], group_id: str = None, db: SignDatabase = None) -> str:
+    def format_sign_result(result: Dict[str, Any], group_id: str = None, db: SignStorage = None,
+                           ctx: SignContext = None) -> str:
         """格式化签到结果"""
         if not result:
             return "今天已经签到过啦~"
@@ -227,8 +229,8 @@ class SignManager:
         )
         
         # 如果有城堡增益，添加相关信息
-        if group_id and db:
-            castle_data = db.get_castle_by_group(group_id)
+        if group_id and (db or ctx):
+            castle_data = ctx.castle_for(group_id) if ctx else db.get_castle_by_group(group_id)
             if castle_data and castle_data.get('level', 0) > 0:
                 castle_level = castle_data['level']
                 castle_name = castle_data.get('castle_name', '城堡')
@@ -261,69 +263,83 @@ class SignManager:
         )
     
     @staticmethod
-    def format_my_ranking(world_total_rank: int, continuous_rank: int, level_rank: int) -> str:
+    def format_my_ranking(world_total_rank: int, continuous_rank: int, level_rank: int, group_rank: int = 0) -> str:
         """格式化我的排名信息
-        只显示世界排行榜、连续签到排行榜和等级排行榜的排名
+        显示世界排行榜、连续签到排行榜和等级排行榜的排名，group_rank 不为 0 时附加本群签到排名
         """
-        return (
+        result = (
             f"我的排行榜\n"
             f"====================\n"
             f"世界总签到排名: 第{world_total_rank}名\n"
             f"连续签到排名: 第{continuous_rank}名\n"
             f"等级排名: 第{level_rank}名"
         )
+        if group_rank:
+            result += f"\n本群签到排名: 第{group_rank}名"
+        return result
     
 
     @staticmethod
-    def format_continuous_ranking(ranking_data: List[tuple], db_instance=None) -> str:
-        """格式化连续签到排行榜"""
+    def format_continuous_ranking(ranking_data: List[tuple], start: int = 1, highlight: str = None) -> str:
+        """格式化连续签到排行榜
+        Args:
+            start: 第一行的名次，分页时为该页的起始名次
+            highlight: 需要标出的用户ID
+        """
         if not ranking_data:
             return "连续签到排行榜\n暂无连续签到数据"
         result = "连续签到排行榜\n"
-        for i, (user_id, user_name, continuous_days) in enumerate(ranking_data, 1):
+        for i, (user_id, user_name, continuous_days, active_title) in enumerate(ranking_data, start):
             display_name = user_name if user_name else user_id
-            # 获取用户当前激活的称号
-            active_title = db_instance.get_active_title(user_id) if db_instance else ""
             title_display = f" 【{active_title}】" if active_title else ""
-            result += f"{i}. {display_name}{title_display} - {continuous_days}天\n"
+            mark = " ←我" if user_id == highlight else ""
+            result += f"{i}. {display_name}{title_display} - {continuous_days}天{mark}\n"
         return result.strip()
     
     @staticmethod
-    def format_level_ranking(ranking_data: List[tuple], db_instance=None) -> str:
-        """格式化等级排行榜"""
+    def format_level_ranking(ranking_data: List[tuple], start: int = 1, highlight: str = None) -> str:
+        """格式化等级排行榜，参数同 format_continuous_ranking"""
         if not ranking_data:
             return "等级排行榜\n暂无等级数据"
         result = "等级排行榜\n"
-        for i, (user_id, user_name, level, exp) in enumerate(ranking_data, 1):
+        for i, (user_id, user_name, level, exp, active_title) in enumerate(ranking_data, start):
             display_name = user_name if user_name else user_id
-            # 获取用户当前激活的称号
-            active_title = db_instance.get_active_title(user_id) if db_instance else ""
             title_display = f" 【{active_title}】" if active_title else ""
-            result += f"{i}. {display_name}{title_display} - {level}级 ({exp}经验)\n"
+            mark = " ←我" if user_id == highlight else ""
+            result += f"{i}. {display_name}{title_display} - {level}级 ({exp}经验){mark}\n"
         return result.strip()
     
     @staticmethod
-    def format_world_ranking(ranking_data: List[tuple], db_instance=None) -> str:
-        """格式化世界签到排行榜"""
+    def format_world_ranking(ranking_data: List[tuple], start: int = 1, highlight: str = None) -> str:
+        """格式化世界签到排行榜，参数同 format_continuous_ranking"""
         if not ranking_data:
             return "世界签到排行榜\n暂无世界签到数据"
         result = "世界签到排行榜\n"
-        for i, (user_id, user_name, total_days) in enumerate(ranking_data, 1):
+        for i, (user_id, user_name, total_days, active_title) in enumerate(ranking_data, start):
             display_name = user_name if user_name else user_id
-            # 获取用户当前激活的称号
-            active_title = db_instance.get_active_title(user_id) if db_instance else ""
             title_display = f" 【{active_title}】" if active_title else ""
-            result += f"{i}. {display_name}{title_display} - {total_days}天\n"
+            mark = " ←我" if user_id == highlight else ""
+            result += f"{i}. {display_name}{title_display} - {total_days}天{mark}\n"
         return result.strip()
     
     @staticmethod
-    def buy_item(user_id: str, item_name: str, quantity: int, db: SignDatabase) -> Dict[str, Any]:
+    def format_page_footer(command: str, page: int, total_pages: int = None) -> str:
+        """分页排行榜的页脚，total_pages 为空时不显示总页数"""
+        footer = f"第{page}/{total_pages}页" if total_pages else f"第{page}页"
+        if total_pages is None or page < total_pages:
+            footer += f"，发送 /{command} {page + 1} 查看下一页"
+        return footer
+
+    @staticmethod
+    def buy_item(user_id: str, item_name: str, quantity: int, db: SignStorage,
+                 ctx: SignContext = None) -> Dict[str, Any]:
         """购买物品
         Args:
             user_id: 用户ID
             item_name: 物品名称
             quantity: 数量
             db: 数据库实例
+            ctx: 请求上下文
         Returns:
             购买结果
         """
@@ -342,7 +358,7 @@ class SignManager:
         total_cost = price * quantity
         
         # 检查用户金币
-        user_data = db.get_user_data(user_id)
+        user_data = ctx.user_data if ctx else db.get_user_data(user_id)
         if not user_data or user_data.get('coins', 0) < total_cost:
             return {
                 'success': False,
@@ -350,7 +366,7 @@ class SignManager:
             }
             
         # 扣除金币
-        db.update_user_data(user_id, coins=user_data['coins'] - total_cost)
+        db.update_user_data(user_id, ctx=ctx, coins=user_data['coins'] - total_cost)
         
         # 更新背包
         db.update_inventory(user_id, item_name, quantity)
@@ -361,13 +377,17 @@ class SignManager:
         }
     
     @staticmethod
-    def resign(user_id: str, days: int, group_id: str, db: SignDatabase) -> Dict[str, Any]:
+    def resign(user_id: str, days: int, group_id: str, db: SignStorage,
+               today: datetime.date = None, rng=None, ctx: SignContext = None) -> Dict[str, Any]:
         """补签
         Args:
             user_id: 用户ID
             days: 补签天数
             group_id: 群组ID
             db: 数据库实例
+            today: 当前签到日，默认取数据库签到时钟的日期
+            rng: 奖励随机数源，默认使用全局 random
+            ctx: 请求上下文
         Returns:
             补签结果
         """
@@ -382,8 +402,8 @@ class SignManager:
             }
             
         # 检查是否可以补签（前三天内）
-        today = datetime.date.today()
-        user_data = db.get_user_data(user_id)
+        today = today or SignManager._today(db)
+        user_data = ctx.user_data if ctx else db.get_user_data(user_id)
         last_sign = user_data.get('last_sign', '') if user_data else ''
         
         if not last_sign:
@@ -410,7 +430,7 @@ class SignManager:
         # 获取城堡等级
         castle_level = 0
         if group_id:
-            castle_data = db.get_castle_by_group(group_id)
+            castle_data = ctx.castle_for(group_id) if ctx else db.get_castle_by_group(group_id)
             if castle_data:
                 castle_level = castle_data.get('level', 0)
             
@@ -432,7 +452,7 @@ class SignManager:
             # 应用城堡增益
             if castle_level > 0:
                 from .castle_manager import CastleManager
-                exp_reward, coin_reward = CastleManager.get_buffed_rewards(base_exp_reward, (base_coin_reward, base_coin_reward), castle_level)
+                exp_reward, coin_reward = CastleManager.get_buffed_rewards(base_exp_reward, (base_coin_reward, base_coin_reward), castle_level, rng)
             else:
                 exp_reward = base_exp_reward
                 coin_reward = base_coin_reward
@@ -453,8 +473,8 @@ class SignManager:
             }
             
             # 更新数据库
-            db.update_user_data(user_id, **user_data)
-            db.log_sign(user_id, exp_reward, coin_reward)
+            db.update_user_data(user_id, ctx=ctx, **user_data)
+            db.log_sign(user_id, exp_reward, coin_reward, sign_date=user_data['last_sign'])
             
             coins_spent += coin_reward
             
@@ -0,0 +1,134 @@
+import re
+import time
+import sqlite3
+import logging
+import threading
+from logging.handlers import RotatingFileHandler
+from typing import Dict, Any, List
+
+_WHITESPACE = re.compile(r'\s+')
+_PLACEHOLDER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+_NUMBER = re.compile(r'\b\d+\b')
+
+
+def statement_shape(sql: str) -> str:
+    """语句形状：合并空白，占位符列表和数字字面量归一，IN (?, ?, ?) 与 IN (?, ?) 视为同一形状"""
+    shape = _WHITESPACE.sub(' ', sql).strip()
+    shape = _PLACEHOLDER_LIST.sub('?...', shape)
+    return _NUMBER.sub('N', shape)
+
+
+def params_shape(params) -> str:
+    """绑定参数的形状，只记录类型不记录取值"""
+    if isinstance(params, list) and params and isinstance(params[0], (tuple, list, dict)):
+        # executemany 的参数列表
+        return f"[{len(params)} x {params_shape(params[0])}]"
+    if isinstance(params, dict):
+        return '{' + ', '.join(f"{key}: {type(value).__name__}" for key, value in params.items()) + '}'
+    return '(' + ', '.join(type(value).__name__ for value in params or ()) + ')'
+
+
+class SlowQueryLog:
+    """慢查询日志
+
+    作为 SignDatabase 的语句钩子使用：
+    - 所有语句按形状聚合次数、总耗时、最大耗时和慢查询次数
+    - 耗时超过阈值的语句写入滚动日志，附带参数形状和 EXPLAIN QUERY PLAN
+    一条查询的耗时包括 execute 和随后读取结果的时间，因此在下一条语句开始时才结算上一条。
+    只读连接池的查询在其他线程执行，未结算的语句按线程分别记录，统计和 EXPLAIN 加锁进行；
+    conn 应为可跨线程使用的独立连接。
+    """
+
+    # 同一形状的执行计划缓存时间(秒)，数据增长后计划可能变化
+    PLAN_TTL = 600
+
+    def __init__(self, conn: sqlite3.Connection, log_path: str, threshold_ms: float = 100,
+                 max_bytes: int = 5 * 1024 * 1024, backup_count: int = 3):
+        self.conn = conn
+        self.threshold = threshold_ms / 1000
+        self.log_path = log_path
+        self._logger = logging.getLogger(f"astrbot_plugin_advanced_sign.slow_query.{id(self)}")
+        self._logger.setLevel(logging.INFO)
+        self._logger.propagate = False
+        self._handler = RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self._handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        self._logger.addHandler(self._handler)
+        # 形状 -> {'count', 'total', 'max', 'slow'}
+        self.shapes: Dict[str, Dict[str, Any]] = {}
+        # 形状 -> (生成时间, 执行计划)
+        self._plans: Dict[str, tuple] = {}
+        # 各线程尚未结算的语句 [sql, params, 耗时]
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def __call__(self, sql: str, params, seconds: float, fetch: bool):
+        if fetch:
+            pending = getattr(self._local, 'pending', None)
+            if pending is not None:
+                pending[2] += seconds
+            return
+        self.flush()
+        self._local.pending = [sql, params, seconds]
+
+    def flush(self):
+        """结算当前线程的语句"""
+        pending, self._local.pending = getattr(self._local, 'pending', None), None
+        if pending is None:
+            return
+        sql, params, seconds = pending
+        shape = statement_shape(sql)
+        with self._lock:
+            stat = self.shapes.get(shape)
+            if stat is None:
+                stat = self.shapes[shape] = {'count': 0, 'total': 0.0, 'max': 0.0, 'slow': 0}
+            stat['count'] += 1
+            stat['total'] += seconds
+            stat['max'] = max(stat['max'], seconds)
+            if seconds < self.threshold:
+                return
+            stat['slow'] += 1
+            plan = self._explain(shape, sql, params)
+        self._logger.info(
+            f"{seconds * 1000:.1f}ms params={params_shape(params)} sql={_WHITESPACE.sub(' ', sql).strip()}\n"
+            + "\n".join(f"    {line}" for line in plan)
+        )
+
+    def _explain(self, shape: str, sql: str, params) -> List[str]:
+        cached = self._plans.get(shape)
+        now = time.monotonic()
+        if cached and now - cached[0] < self.PLAN_TTL:
+            return cached[1]
+        verb = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+        if verb not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE'):
+            return []
+        if isinstance(params, list) and params and isinstance(params[0], (tuple, list, dict)):
+            params = params[0]
+        try:
+            # 使用独立游标，不经过计时代理，也不会影响当前游标的结果集
+            rows = self.conn.cursor().execute(f"EXPLAIN QUERY PLAN {sql}", params or ()).fetchall()
+            plan = [row[-1] for row in rows]
+        except sqlite3.Error as e:
+            plan = [f"(EXPLAIN 失败: {e})"]
+        self._plans[shape] = (now, plan)
+        return plan
+
+    def top(self, limit: int = 10, key: str = 'total') -> List[tuple]:
+        """按总耗时（或 max / slow / count）排序的语句形状 [(形状, 统计), ...]"""
+        self.flush()
+        with self._lock:
+            return sorted(self.shapes.items(), key=lambda item: item[1][key], reverse=True)[:limit]
+
+    def format_top(self, limit: int = 10) -> str:
+        """生成慢查询统计的文字摘要"""
+        lines = [f"语句耗时排行（阈值 {self.threshold * 1000:g}ms）"]
+        for shape, stat in self.top(limit):
+            lines.append(
+                f"{stat['total'] * 1000:.1f}ms 共{stat['count']}次 均{stat['total'] / stat['count'] * 1000:.2f}ms"
+                f" 最大{stat['max'] * 1000:.1f}ms 慢{stat['slow']}次\n  {shape[:120]}"
+            )
+        return "\n".join(lines)
+
+    def close(self):
+        self.flush()
+        self._logger.removeHandler(self._handler)
+        self._handler.close()
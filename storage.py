@@ -0,0 +1,385 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List, Callable
+
+from .clock import SignClock
+
+# 语句钩子: hook(sql, params, 耗时秒数, 是否为读取结果阶段)
+StatementHook = Callable[[str, Any, float, bool], None]
+
+
+def ranking_sort_key(board: str) -> Callable[[tuple], tuple]:
+    """排序键 (列1, 列2, user_id) 在 Python 中的比较键，与 RANKING_ORDERS 的 SQL 顺序一致（降序列都是整数）"""
+    directions = [direction for _, direction in SignStorage.RANKING_ORDERS[board]]
+
+    def key(row: tuple) -> tuple:
+        values = tuple(-(value or 0) if direction == 'DESC' else ('' if value is None else value)
+                       for value, direction in zip(row, directions))
+        return (*values, row[-1])
+    return key
+
+
+class SignStorage(ABC):
+    """签到插件的存储接口
+
+    插件、SignManager、CastleManager 等只通过这些方法访问数据，不接触底层连接和 SQL。
+    实现：SignDatabase（SQLite 单文件）、ShardedSignDatabase（SQLite 分片）、MemorySignStorage（纯内存）。
+    各实现都应通过 storage_conformance.py 的一致性检查。
+    方法可以接收 ctx（SignContext），写入后同步上下文中的缓存；城堡写操作会直接修改上下文中的城堡字典。
+    """
+
+    # 用户数据的列和新用户的默认值
+    USER_COLUMNS = ['user_id', 'total_days', 'last_sign', 'continuous_days', 'exp', 'level', 'next_level_exp', 'coins', 'group_id']
+    USER_DEFAULTS = {
+        'total_days': 0,
+        'last_sign': '',
+        'continuous_days': 0,
+        'exp': 0,
+        'level': 1,
+        'next_level_exp': 200,
+        'coins': 0,
+        'group_id': ''
+    }
+    # 分页排行榜的排序列，最后再按 user_id 升序；与 get_leaderboard 的顺序一致
+    RANKING_ORDERS = {
+        'world': [('total_days', 'DESC'), ('last_sign', 'ASC')],
+        'continuous': [('continuous_days', 'DESC'), ('last_sign', 'ASC')],
+        'level': [('level', 'DESC'), ('exp', 'DESC')],
+    }
+    # get_leaderboard 最多返回的名次
+    LEADERBOARD_SIZE = 100
+
+    # 签到时钟，“今天”的计算都以它为准
+    clock: SignClock
+    # 只读连接池（SQLite 实现），为 None 时只读查询直接在事件循环中执行
+    read_pool = None
+    # 慢查询日志（SQLite 实现）
+    slow_query_log = None
+
+    @property
+    @abstractmethod
+    def data_dir(self) -> str:
+        """指标、归档、采样等文件的目录"""
+
+    @property
+    def change_logs(self) -> list:
+        """供 CoherenceMonitor 轮询的变更日志来源，不支持多实例共用的存储为空"""
+        return []
+
+    def set_change_log(self, enabled: bool):
+        """开启或关闭 change_logs 的变更记录，只在启用多实例缓存一致性检查时开启；不支持的存储忽略"""
+
+    @contextmanager
+    def transaction(self, user_id: str):
+        """在一个事务中执行同一用户的多个写方法（含该用户的签到请求记录），全部成功才提交，
+        任一失败时整体回滚并抛出异常。不落盘的存储直接执行
+        """
+        yield
+
+    # ---- 表结构迁移与备份（按数据库文件进行，不落盘的存储没有文件） ----
+
+    @property
+    def database_files(self) -> List[str]:
+        """组成存储的数据库文件名，备份快照按文件名保存和恢复；不落盘的存储为空"""
+        return []
+
+    def migration_status(self) -> Dict[str, Dict[str, Any]]:
+        """各数据库文件的表结构版本和未完成的迁移 {文件名: {'version', 'latest', 'steps'}}，
+        steps 为 SchemaMigrator.plan() 的结果；只读打开，可在工作线程中调用
+        """
+        return {}
+
+    def pending_backfills(self) -> List[int]:
+        """表结构已执行、回填尚未完成的迁移版本"""
+        return []
+
+    async def run_backfills(self, chunk_size: int = 500, pause: float = 0.05) -> Dict[str, Dict[int, int]]:
+        """分批完成所有未完成的回填，批次之间让出事件循环，返回 {文件名: {版本: 扫描行数}}"""
+        return {}
+
+    def backup_to(self, target_dir: str, pages: int = 256, pause: float = 0.05) -> Dict[str, int]:
+        """在线复制每个数据库文件到 target_dir 下的同名文件，不阻塞写入，可在工作线程中调用
+        Returns:
+            {文件名: 页数}
+        """
+        raise NotImplementedError("当前存储没有数据库文件，不支持备份")
+
+    def check_integrity(self, source_dir: str) -> Dict[str, List[str]]:
+        """检查 source_dir 下与 database_files 同名的文件（如备份）的完整性，返回 {文件名: 发现的问题}，问题为空表示通过"""
+        return {}
+
+    def restore_from(self, source_dir: str) -> List[str]:
+        """用 source_dir 下的同名文件覆盖当前数据，返回恢复失败的文件名"""
+        raise NotImplementedError("当前存储没有数据库文件，不支持恢复")
+
+    def add_statement_hook(self, hook: StatementHook):
+        """注册语句钩子，不执行 SQL 的存储忽略"""
+
+    def close(self):
+        """释放连接等资源"""
+
+    # ---- 用户 ----
+
+    @abstractmethod
+    def get_user_data(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """用户数据 {USER_COLUMNS 中的列: 值}，没有签到过时返回 None"""
+
+    @abstractmethod
+    def update_user_data(self, user_id: str, ctx=None, **kwargs):
+        """更新用户数据，用户不存在时以 USER_DEFAULTS 创建；传入 group_id 时记为用户在该群的活动"""
+
+    @abstractmethod
+    def update_user_name(self, user_id: str, user_name: str, group_id: str = None, ctx=None):
+        """记录用户昵称及其所在群"""
+
+    @abstractmethod
+    def get_user_name(self, user_id: str, group_id: str = None) -> str:
+        """用户昵称，传入 group_id 时只取该群记录的昵称；没有记录时返回用户ID"""
+
+    @abstractmethod
+    def get_user_names(self, user_ids: List[str]) -> Dict[str, str]:
+        """批量获取用户昵称，没有记录的用户返回用户ID"""
+
+    @abstractmethod
+    def import_users(self, users: List[Dict[str, Any]]) -> bool:
+        """批量导入用户数据和昵称，已存在的用户被覆盖"""
+
+    # ---- 签到历史与日历 ----
+
+    @abstractmethod
+    def log_sign(self, user_id: str, exp: int, coins: int, sign_date: str = None):
+        """记录一次签到（默认为签到时钟的当天）并标记签到日历"""
+
+    @abstractmethod
+    def import_sign_history(self, rows: List[tuple]) -> bool:
+        """批量导入签到历史 [(user_id, exp, coins, sign_date), ...]"""
+
+    @abstractmethod
+    def get_sign_calendar(self, user_id: str) -> Dict[int, bytes]:
+        """每年的签到日历位图 {年份: 位图}，没有位图时从签到历史回填"""
+
+    def read_sign_calendar(self, user_id: str) -> Dict[int, bytes]:
+        """只读取已有的签到日历位图，可在只读连接上执行；为空时调用方再用 get_sign_calendar 回填"""
+        return self.get_sign_calendar(user_id)
+
+    @abstractmethod
+    def get_expired_history(self, before_date: str, limit: int) -> List[tuple]:
+        """早于指定签到日的签到历史 [(id, user_id, exp, coins, sign_date, timestamp), ...]"""
+
+    @abstractmethod
+    def rollup_history(self, rows: List[tuple]) -> bool:
+        """把 get_expired_history 返回的历史汇总进月度统计并删除"""
+
+    @abstractmethod
+    def get_monthly_history(self, user_id: str) -> List[tuple]:
+        """已归档的月度统计 [(月份, 次数, 经验, 金币, 首次签到, 末次签到), ...]，按月份排序"""
+
+    def incremental_vacuum(self, pages: int) -> int:
+        """回收空闲空间，返回回收前的空闲页数"""
+        return 0
+
+    # ---- 签到请求（幂等） ----
+
+    @abstractmethod
+    def get_sign_request(self, request_key: str, since: int = 0, user_id: str = None) -> Optional[Dict[str, Any]]:
+        """created_at 不早于 since 的已处理签到请求 {'user_id', 'result', 'response', 'created_at'}
+        user_id 为请求的发送者，分片存储据此直接定位分片
+        """
+
+    @abstractmethod
+    def save_sign_request(self, request_key: str, user_id: str, result: Optional[Dict[str, Any]], response: str,
+                          created_at: int) -> bool:
+        """记录已处理的签到请求，result 按 JSON 保存；与该用户的其他数据存在一起，可以在同一事务中写入"""
+
+    @abstractmethod
+    def purge_sign_requests(self, before: int) -> int:
+        """删除 created_at 早于 before 的签到请求，返回删除数"""
+
+    # ---- 背包 ----
+
+    @abstractmethod
+    def get_user_inventory(self, user_id: str) -> Dict[str, int]:
+        """用户背包 {物品: 数量}"""
+
+    @abstractmethod
+    def update_inventory(self, user_id: str, item_name: str, quantity: int):
+        """增减物品数量，减到 0 及以下时移除"""
+
+    # ---- 称号 ----
+
+    @abstractmethod
+    def add_user_title(self, user_id: str, title: str) -> bool:
+        """授予称号，已有时不变"""
+
+    @abstractmethod
+    def apply_title_changes(self, user_id: str, grants: List[str], revokes: List[str], ctx=None) -> bool:
+        """一次性授予和收回多个称号"""
+
+    @abstractmethod
+    def get_user_titles(self, user_id: str) -> List[tuple]:
+        """用户的所有称号 [(称号, 是否激活), ...]，按称号排序"""
+
+    @abstractmethod
+    def activate_title(self, user_id: str, title: str):
+        """激活一个已获得的称号"""
+
+    @abstractmethod
+    def deactivate_all_titles(self, user_id: str):
+        """取消激活用户的所有称号"""
+
+    @abstractmethod
+    def get_active_title(self, user_id: str) -> str:
+        """当前激活的称号，没有时为空字符串"""
+
+    @abstractmethod
+    def get_active_titles(self, user_ids: List[str]) -> Dict[str, str]:
+        """批量获取激活的称号，没有时为空字符串"""
+
+    # ---- 排行榜 ----
+
+    @abstractmethod
+    def get_leaderboard(self, board: str, limit: int = 10) -> List[tuple]:
+        """排行榜（world / continuous / level / castle_level / castle_coins）前 limit 名，最多 LEADERBOARD_SIZE 名
+        Returns:
+            [(实体ID, 名称, 称号, k1, k2), ...]，按 k1 DESC, k2 DESC, 实体ID 排序；
+            世界和连续签到榜的 k2 为负的 YYYYMMDD（越早签到越靠前），城堡的实体ID 为城堡编号的字符串
+        """
+
+    @abstractmethod
+    def rebuild_leaderboards(self, boards: List[str] = None) -> Dict[str, int]:
+        """重建排行榜，返回 {榜名: 行数}，失败时返回空字典"""
+
+    @abstractmethod
+    def get_ranking_keys(self, board: str, key: Optional[tuple], limit: int, offset: int = 0, before: bool = False,
+                         group_id: str = None) -> List[tuple]:
+        """排序键 key 之后（before 时为之前，按反向顺序）跳过 offset 行的 limit 个排序键 [(列1, 列2, user_id), ...]
+        key 为空时从榜首开始；传入 group_id 时只在该群成员中排行
+        """
+
+    @abstractmethod
+    def get_ranking_key(self, board: str, user_id: str, group_id: str = None) -> Optional[tuple]:
+        """用户的排序键 (列1, 列2, user_id)，没有签到数据或不是群成员时返回 None"""
+
+    @abstractmethod
+    def count_ranking_before(self, board: str, key: tuple, group_id: str = None) -> int:
+        """排在排序键 key 之前的用户数"""
+
+    @abstractmethod
+    def count_users(self, group_id: str = None) -> int:
+        """参与排行的用户数，传入 group_id 时为群成员数"""
+
+    def get_world_sign_ranking(self, limit: int = 10) -> List[tuple]:
+        """[(用户ID, 昵称, 总天数, 称号), ...]"""
+        return [(user_id, name, k1, title) for user_id, name, title, k1, _ in self.get_leaderboard('world', limit)]
+
+    def get_continuous_sign_ranking(self, limit: int = 10) -> List[tuple]:
+        """[(用户ID, 昵称, 连续天数, 称号), ...]"""
+        return [(user_id, name, k1, title) for user_id, name, title, k1, _ in self.get_leaderboard('continuous', limit)]
+
+    def get_level_ranking(self, limit: int = 10) -> List[tuple]:
+        """[(用户ID, 昵称, 等级, 经验, 称号), ...]"""
+        return [(user_id, name, k1, k2, title) for user_id, name, title, k1, k2 in self.get_leaderboard('level', limit)]
+
+    def get_castle_ranking(self, limit: int = 10) -> List[tuple]:
+        """[(城堡编号, 名称, 等级, 经验), ...]"""
+        return [(int(castle_id), name, k1, k2) for castle_id, name, _, k1, k2 in self.get_leaderboard('castle_level', limit)]
+
+    def get_castle_coin_ranking(self, limit: int = 10) -> List[tuple]:
+        """[(城堡编号, 名称, 金币), ...]"""
+        return [(int(castle_id), name, k1) for castle_id, name, _, k1, _ in self.get_leaderboard('castle_coins', limit)]
+
+    def get_ranking_page(self, board: str, after: Optional[tuple], limit: int = 10, group_id: str = None) -> List[tuple]:
+        """键集分页读取排行榜 [(用户ID, 昵称, 称号, 列1, 列2), ...]"""
+        keys = self.get_ranking_keys(board, after, limit, group_id=group_id)
+        if not keys:
+            return []
+        user_ids = [row[-1] for row in keys]
+        names = self.get_user_names(user_ids)
+        titles = self.get_active_titles(user_ids)
+        return [(user_id, names[user_id], titles[user_id], c1, c2) for c1, c2, user_id in keys]
+
+    def seek_ranking_key(self, board: str, key: Optional[tuple], offset: int = 0, before: bool = False,
+                         group_id: str = None) -> Optional[tuple]:
+        """排序键 key 之后（before 时为之前）第 offset + 1 行的排序键，不存在时返回 None"""
+        rows = self.get_ranking_keys(board, key, 1, offset, before, group_id)
+        return rows[0] if rows else None
+
+    def get_group_rank(self, group_id: Optional[str], board: str, user_id: str) -> int:
+        """名次，group_id 为空时为全服名次；没有签到数据或不是群成员时返回 0"""
+        key = self.get_ranking_key(board, user_id, group_id)
+        if key is None:
+            return 0
+        return self.count_ranking_before(board, key, group_id) + 1
+
+    def get_world_sign_rank(self, user_id: str) -> int:
+        """世界签到排名，与世界排行榜的顺序一致"""
+        return self.get_group_rank(None, 'world', user_id)
+
+    def get_continuous_sign_rank(self, user_id: str) -> int:
+        """连续签到排名，与连续签到排行榜的顺序一致"""
+        return self.get_group_rank(None, 'continuous', user_id)
+
+    def get_level_rank(self, user_id: str) -> int:
+        """等级排名，与等级排行榜的顺序一致（同级同经验按用户ID）"""
+        return self.get_group_rank(None, 'level', user_id)
+
+    def get_group_sign_rank(self, group_id: str, user_id: str) -> int:
+        """群内签到排名，没有群号时为世界排名"""
+        return self.get_group_rank(group_id or None, 'world', user_id)
+
+    # ---- 城堡 ----
+
+    @abstractmethod
+    def check_castle_name_exists(self, castle_name: str) -> bool:
+        """城堡名称是否已被使用"""
+
+    @abstractmethod
+    def get_castle_id_by_group(self, group_id: str) -> Optional[int]:
+        """群的城堡编号"""
+
+    @abstractmethod
+    def get_castle_by_group(self, group_id: str) -> Optional[Dict[str, Any]]:
+        """群的城堡 {castle_id, group_id, castle_name, level, exp, coins, lord_id, managers, members, created_date}
+        每次返回新的字典，managers / members 为列表
+        """
+
+    @abstractmethod
+    def create_castle(self, group_id: str, castle_name: str, creator_id: str, participant_ids: List[str] = None,
+                      ctx=None) -> bool:
+        """创建城堡，创建人和最多 5 个参与者为初始成员；群已有城堡时失败"""
+
+    @abstractmethod
+    def join_castle(self, group_id: str, user_id: str, ctx=None) -> bool:
+        """加入城堡，已是成员时返回 False"""
+
+    @abstractmethod
+    def leave_castle(self, group_id: str, user_id: str, ctx=None) -> bool:
+        """退出城堡，领主退出时清空领主，总管退出时移出总管"""
+
+    @abstractmethod
+    def upgrade_castle(self, group_id: str, exp_cost: int, coin_cost: int, ctx=None) -> bool:
+        """扣除经验和金币升级城堡，资源不足时返回 False"""
+
+    @abstractmethod
+    def donate_coins(self, group_id: str, user_id: str, amount: int, ctx=None) -> bool:
+        """增加城堡金币"""
+
+    @abstractmethod
+    def add_castle_exp(self, group_id: str, exp: int, ctx=None) -> bool:
+        """增加城堡经验"""
+
+    @abstractmethod
+    def elect_lord(self, group_id: str, user_id: str, ctx=None) -> bool:
+        """选举领主，只能是成员"""
+
+    @abstractmethod
+    def elect_manager(self, group_id: str, user_id: str, ctx=None) -> bool:
+        """选举总管，只能是成员，已是总管时返回 False"""
+
+    @abstractmethod
+    def dismiss_manager(self, group_id: str, user_id: str, ctx=None) -> bool:
+        """罢免总管"""
+
+    @abstractmethod
+    def destroy_castle(self, group_id: str) -> bool:
+        """销毁城堡"""
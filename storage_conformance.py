@@ -0,0 +1,427 @@
+"""存储一致性检查
+
+对 SignStorage 的各个实现执行同一组检查：
+1. 契约检查：在固定场景下逐个验证接口方法的返回值（用户、昵称、背包、称号、签到历史与日历、
+   签到请求、城堡、排行榜、键集分页和名次）
+2. 对拍：用固定种子生成随机操作序列，同时作用于所有实现，定期比较各实现的全部读取结果
+
+新增存储实现时加入 ENGINES，通过本检查后即可在插件中替换使用::
+
+    python storage_conformance.py                    # 检查全部实现
+    python storage_conformance.py --engines memory   # 只检查指定实现
+    python storage_conformance.py --ops 5000 --seed 7
+
+全部通过时退出码为 0，否则列出失败项并以退出码 1 结束。所有数据写在临时目录中。
+"""
+import os
+import sys
+import random
+import shutil
+import argparse
+import datetime
+import tempfile
+from typing import Dict, Any, List, Callable
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_astrbot  # noqa: E402
+
+START = datetime.datetime(2024, 6, 1, 12, 0, 0)
+
+
+def _engines(package) -> Dict[str, Callable]:
+    """实现名 -> 工厂(目录, 时钟)"""
+    return {
+        'sqlite': lambda path, clock: package.database.SignDatabase(path, clock=clock, read_pool_size=2),
+        'sharded': lambda path, clock: package.sharded_database.ShardedSignDatabase(path, 3, clock=clock, read_pool_size=2),
+        'memory': lambda path, clock: package.memory_storage.MemorySignStorage(path, clock=clock),
+    }
+
+
+ENGINES = ['sqlite', 'sharded', 'memory']
+
+
+class Checker:
+    """收集失败项，不因第一个失败而中止"""
+
+    def __init__(self, engine: str):
+        self.engine = engine
+        self.failures: List[str] = []
+
+    def equal(self, actual, expected, what: str):
+        if actual != expected:
+            self.failures.append(f"[{self.engine}] {what}: 期望 {expected!r}，实际 {actual!r}")
+
+    def true(self, condition, what: str):
+        if not condition:
+            self.failures.append(f"[{self.engine}] {what}")
+
+
+def _expected_order(package, users: List[Dict[str, Any]], board: str) -> List[tuple]:
+    """按接口约定的顺序排列的排序键"""
+    orders = package.storage.SignStorage.RANKING_ORDERS[board]
+    keys = [(*(user[column] for column, _ in orders), user['user_id']) for user in users]
+    return sorted(keys, key=package.storage.ranking_sort_key(board))
+
+
+def check_contract(package, storage, clock, check: Checker):
+    """在空存储上按固定场景检查各接口方法"""
+    SignCalendar = package.sign_calendar.SignCalendar
+    today = clock.today_str()
+
+    # 用户与昵称
+    check.equal(storage.get_user_data('u1'), None, "新用户没有数据")
+    check.equal(storage.get_ranking_key('world', 'u1'), None, "新用户没有排序键")
+    check.equal(storage.get_world_sign_rank('u1'), 0, "新用户没有名次")
+    storage.update_user_data('u1', total_days=1, last_sign=today, continuous_days=1, exp=10, coins=5, group_id='g1')
+    expected = dict(storage.USER_DEFAULTS, user_id='u1', total_days=1, last_sign=today, continuous_days=1,
+                    exp=10, coins=5, group_id='g1')
+    check.equal(storage.get_user_data('u1'), expected, "创建用户")
+    storage.update_user_data('u1', coins=8)
+    check.equal(storage.get_user_data('u1')['coins'], 8, "部分更新")
+    check.equal(storage.get_user_data('u1')['group_id'], 'g1', "未传群号时保留原群号")
+    check.equal(storage.count_users('g1'), 1, "带群号写入时加入群成员")
+    storage.update_user_name('u1', '甲', 'g1')
+    check.equal(storage.get_user_name('u1'), '甲', "昵称")
+    check.equal(storage.get_user_name('u1', 'g2'), 'u1', "其他群的昵称")
+    check.equal(storage.get_user_names(['u1', 'u9']), {'u1': '甲', 'u9': 'u9'}, "批量昵称")
+
+    # 背包
+    storage.update_inventory('u1', '补签卡', 3)
+    storage.update_inventory('u1', '补签卡', -1)
+    storage.update_inventory('u1', '护身符', -1)
+    check.equal(storage.get_user_inventory('u1'), {'补签卡': 2}, "背包增减")
+    storage.update_inventory('u1', '补签卡', -5)
+    check.equal(storage.get_user_inventory('u1'), {}, "数量减到 0 时移除")
+
+    # 称号
+    check.true(storage.add_user_title('u1', 'A'), "授予称号")
+    check.true(storage.apply_title_changes('u1', ['C', 'B'], ['A']), "批量授予和收回称号")
+    check.equal(storage.get_user_titles('u1'), [('B', 0), ('C', 0)], "称号列表")
+    storage.activate_title('u1', 'C')
+    storage.activate_title('u1', 'Z')
+    check.equal(storage.get_active_title('u1'), 'C', "激活称号")
+    check.equal(storage.get_active_titles(['u1', 'u2']), {'u1': 'C', 'u2': ''}, "批量激活称号")
+    check.equal(storage.get_leaderboard('world', 1), [('u1', '甲', 'C', 1, -int(today.replace('-', '')))], "榜上的昵称和称号")
+    storage.apply_title_changes('u1', [], ['C'])
+    check.equal(storage.get_leaderboard('world', 1)[0][2], '', "收回激活的称号后榜上不再显示")
+    storage.activate_title('u1', 'B')
+    storage.deactivate_all_titles('u1')
+    check.equal(storage.get_active_title('u1'), '', "取消激活")
+
+    # 签到历史、日历和归档
+    storage.log_sign('u1', 10, 5)
+    storage.log_sign('u1', 20, 6, '2024-04-02')
+    storage.log_sign('u1', 30, 7, '2024-04-20')
+    storage.import_sign_history([('u2', 1, 2, '2024-03-31'), ('u2', 3, 4, '2024-04-01')])
+    calendar = storage.get_sign_calendar('u1')
+    check.true(SignCalendar.has_day(calendar.get(2024), datetime.date(2024, 4, 20)), "签到日历标记补记的日期")
+    check.true(SignCalendar.has_day(calendar.get(2024), clock.today()), "签到日历标记当天")
+    check.true(SignCalendar.has_day(storage.get_sign_calendar('u2').get(2024), datetime.date(2024, 3, 31)),
+               "签到日历从历史回填")
+    expired = storage.get_expired_history('2024-05-01', 10)
+    check.equal(sorted(row[1:5] for row in expired),
+                [('u1', 20, 6, '2024-04-02'), ('u1', 30, 7, '2024-04-20'), ('u2', 1, 2, '2024-03-31'),
+                 ('u2', 3, 4, '2024-04-01')], "过期签到历史")
+    check.equal(len(storage.get_expired_history('2024-05-01', 2)), 2, "过期签到历史的条数限制")
+    check.true(storage.rollup_history(expired), "汇总签到历史")
+    check.equal(storage.get_expired_history('2024-05-01', 10), [], "汇总后删除明细")
+    check.equal(storage.get_monthly_history('u1'), [('2024-04', 2, 50, 13, '2024-04-02', '2024-04-20')], "月度统计")
+    check.equal(storage.get_monthly_history('u2'), [('2024-03', 1, 1, 2, '2024-03-31', '2024-03-31'),
+                                                    ('2024-04', 1, 3, 4, '2024-04-01', '2024-04-01')], "按月份排序")
+
+    # 签到请求
+    result = {'exp': 10, 'date': datetime.date(2024, 6, 1), 'items': ('a', 'b')}
+    check.true(storage.save_sign_request('m1', 'u1', result, '签到成功', 100), "记录签到请求")
+    check.true(storage.save_sign_request('m2', 'u1', None, '已签到', 200), "记录没有结果的签到请求")
+    check.equal(storage.get_sign_request('m1'),
+                {'user_id': 'u1', 'result': {'exp': 10, 'date': '2024-06-01', 'items': ['a', 'b']},
+                 'response': '签到成功', 'created_at': 100}, "读取签到请求（按 JSON 往返）")
+    check.equal(storage.get_sign_request('m1', since=150), None, "过期的签到请求")
+    check.equal(storage.purge_sign_requests(150), 1, "清理签到请求")
+    check.equal(storage.get_sign_request('m2')['result'], None, "没有结果的签到请求")
+    check.equal(storage.get_sign_request('m2', user_id='u1')['response'], '已签到', "按发送者读取签到请求")
+
+    # 事务：签到的写入和签到请求一起提交（金币不影响排行）
+    coins = storage.get_user_data('u1')['coins']
+    with storage.transaction('u1'):
+        storage.update_user_data('u1', coins=coins + 5)
+        storage.save_sign_request('m9', 'u1', None, '签到成功', 300)
+    check.equal(storage.get_user_data('u1')['coins'], coins + 5, "事务提交用户数据")
+    check.equal(storage.get_sign_request('m9', user_id='u1')['response'], '签到成功', "事务提交签到请求")
+    if check.engine != 'memory':
+        # 纯内存存储不落盘，事务直接执行，不检查回滚
+        try:
+            with storage.transaction('u1'):
+                storage.update_user_data('u1', coins=coins + 6)
+                storage.save_sign_request('m10', 'u1', None, '签到成功', 300)
+                raise RuntimeError("中途失败")
+        except RuntimeError:
+            pass
+        check.equal(storage.get_user_data('u1')['coins'], coins + 5, "事务回滚用户数据")
+        check.equal(storage.get_sign_request('m10', user_id='u1'), None, "事务回滚签到请求")
+
+    # 城堡
+    check.true(storage.create_castle('g1', '白塔', 'u1', ['u2', 'u3', 'u4', 'u5', 'u6', 'u7']), "创建城堡")
+    check.true(not storage.create_castle('g1', '黑塔', 'u2'), "同一群只能有一座城堡")
+    check.true(storage.check_castle_name_exists('白塔'), "城堡名称已存在")
+    check.true(not storage.check_castle_name_exists('黑塔'), "城堡名称不存在")
+    castle = storage.get_castle_by_group('g1')
+    check.equal(castle['members'], ['u1', 'u2', 'u3', 'u4', 'u5', 'u6'], "初始成员最多 5 个参与者")
+    check.equal((castle['level'], castle['exp'], castle['coins'], castle['lord_id'], castle['managers']),
+                (1, 0, 0, None, []), "新城堡的初始状态")
+    check.equal(storage.get_castle_id_by_group('g1'), castle['castle_id'], "城堡编号")
+    castle['members'].append('x')
+    check.equal(len(storage.get_castle_by_group('g1')['members']), 6, "返回的城堡是副本")
+    check.true(storage.join_castle('g1', 'u8'), "加入城堡")
+    check.true(not storage.join_castle('g1', 'u8'), "重复加入")
+    check.true(not storage.elect_lord('g1', 'u9'), "非成员不能当选领主")
+    check.true(storage.elect_lord('g1', 'u2'), "选举领主")
+    check.true(storage.elect_manager('g1', 'u3'), "选举总管")
+    check.true(not storage.elect_manager('g1', 'u3'), "重复选举总管")
+    check.true(storage.leave_castle('g1', 'u2'), "领主退出")
+    check.true(storage.leave_castle('g1', 'u3'), "总管退出")
+    check.true(storage.elect_manager('g1', 'u4'), "再次选举总管")
+    check.true(storage.dismiss_manager('g1', 'u4'), "罢免总管")
+    check.true(not storage.dismiss_manager('g1', 'u4'), "罢免非总管")
+    check.true(not storage.upgrade_castle('g1', 10, 10), "资源不足时不能升级")
+    check.true(storage.donate_coins('g1', 'u1', 50), "捐献金币")
+    check.true(storage.add_castle_exp('g1', 40), "增加城堡经验")
+    check.true(storage.upgrade_castle('g1', 30, 20), "升级城堡")
+    castle = storage.get_castle_by_group('g1')
+    check.equal((castle['level'], castle['exp'], castle['coins'], castle['lord_id'], castle['managers']),
+                (2, 10, 30, None, []), "城堡状态")
+    check.equal(castle['members'], ['u1', 'u4', 'u5', 'u6', 'u8'], "城堡成员")
+    check.true(storage.create_castle('g2', '黑塔', 'u9'), "创建第二座城堡")
+    storage.donate_coins('g2', 'u9', 100)
+    check.equal([row[1:] for row in storage.get_castle_ranking()], [('白塔', 2, 10), ('黑塔', 1, 0)], "城堡等级榜")
+    check.equal([row[1:] for row in storage.get_castle_coin_ranking()], [('黑塔', 100), ('白塔', 30)], "城堡金币榜")
+    check.true(storage.destroy_castle('g2'), "销毁城堡")
+    check.equal(storage.get_castle_by_group('g2'), None, "销毁后没有城堡")
+    check.equal([row[1] for row in storage.get_castle_ranking()], ['白塔'], "销毁后移出城堡榜")
+    ctx = package.request_context.SignContext(storage, 'u1', 'g1')
+    check.true(storage.donate_coins('g1', 'u1', 5, ctx=ctx), "带上下文捐献金币")
+    check.equal(ctx.castle_for('g1')['coins'], storage.get_castle_by_group('g1')['coins'], "上下文中的城堡与存储一致")
+
+    # 排行榜、键集分页和名次
+    rng = random.Random(1)
+    for index in range(40):
+        day = (START.date() - datetime.timedelta(days=rng.randrange(3))).strftime('%Y-%m-%d')
+        storage.update_user_data(f"r{index:02d}", total_days=rng.randrange(1, 5), last_sign=day,
+                                 continuous_days=rng.randrange(1, 4), level=rng.randrange(1, 4), exp=rng.randrange(3),
+                                 group_id=f"rg{index % 3}")
+    users = [storage.get_user_data(user_id) for user_id in ['u1'] + [f"r{index:02d}" for index in range(40)]]
+    check.equal(storage.count_users(), 41, "用户数")
+    for board in storage.RANKING_ORDERS:
+        order = _expected_order(package, users, board)
+        check.equal(storage.get_ranking_keys(board, None, 100), order, f"{board} 全榜顺序")
+        check.equal(storage.get_ranking_keys(board, order[9], 5), order[10:15], f"{board} 从排序键之后翻页")
+        check.equal(storage.get_ranking_keys(board, order[9], 5, offset=3), order[13:18], f"{board} 翻页并跳过")
+        check.equal(storage.get_ranking_keys(board, order[9], 5, before=True), order[4:9][::-1], f"{board} 向前翻页")
+        check.equal(storage.get_ranking_keys(board, order[9], 5, offset=7, before=True), order[0:2][::-1],
+                    f"{board} 向前翻页越过榜首")
+        check.equal(storage.seek_ranking_key(board, None, 40), order[40], f"{board} 定位")
+        check.equal(storage.seek_ranking_key(board, order[-1]), None, f"{board} 定位越过末尾")
+        check.equal(storage.count_ranking_before(board, order[20]), 20, f"{board} 之前的用户数")
+        check.equal([row[0] for row in storage.get_ranking_page(board, order[0], 3)], [key[-1] for key in order[1:4]],
+                    f"{board} 分页")
+        check.equal(storage.get_group_rank(None, board, order[17][-1]), 18, f"{board} 全服名次")
+        check.equal([row[0] for row in storage.get_leaderboard(board, 10)], [key[-1] for key in order[:10]],
+                    f"{board} 排行榜")
+        members = [user for user in users if user['user_id'].startswith('r') and int(user['user_id'][1:]) % 3 == 1]
+        group_order = _expected_order(package, members, board)
+        check.equal(storage.get_ranking_keys(board, None, 100, group_id='rg1'), group_order, f"{board} 群内顺序")
+        check.equal(storage.get_ranking_keys(board, group_order[2], 2, group_id='rg1'), group_order[3:5],
+                    f"{board} 群内翻页")
+        check.equal(storage.get_group_rank('rg1', board, group_order[4][-1]), 5, f"{board} 群内名次")
+    check.equal(storage.get_group_rank('rg1', 'world', 'r00'), 0, "不是群成员时没有群内名次")
+    check.equal(storage.count_users('rg1'), 13, "群成员数")
+    check.equal([row[0] for row in storage.get_world_sign_ranking(3)],
+                [key[-1] for key in _expected_order(package, users, 'world')[:3]], "世界排行榜")
+    level_order = _expected_order(package, users, 'level')
+    check.equal(storage.get_level_rank(level_order[5][-1]), 6, "等级排名与等级排行榜一致")
+    check.equal(storage.get_world_sign_rank(level_order[5][-1]),
+                storage.get_group_rank(None, 'world', level_order[5][-1]), "世界排名与世界排行榜一致")
+    check.equal(storage.get_group_sign_rank('', 'u1'), storage.get_world_sign_rank('u1'), "没有群号时为世界排名")
+    check.true(storage.rebuild_leaderboards(), "重建排行榜")
+    check.equal([row[0] for row in storage.get_leaderboard('level', 10)], [key[-1] for key in level_order[:10]],
+                "重建后的排行榜")
+    check.true(storage.import_users([{'user_id': 'r00', 'user_name': '导入', 'total_days': 99, 'group_id': 'rg1'}]),
+               "导入用户")
+    check.equal(storage.get_user_data('r00')['total_days'], 99, "导入覆盖用户数据")
+    check.equal(storage.get_leaderboard('world', 1)[0][:2], ('r00', '导入'), "导入后的排行榜")
+    check.equal(storage.get_group_rank('rg1', 'world', 'r00'), 1, "导入加入群成员")
+
+    # 迁移与备份：都按 database_files 中的文件进行
+    files = storage.database_files
+    check.equal(sorted(storage.migration_status()), sorted(files), "迁移状态覆盖所有数据库文件")
+    check.equal(storage.pending_backfills(), [], "新建的存储没有待回填的迁移")
+    if files:
+        backup_dir = tempfile.mkdtemp(prefix='sign-conformance-backup-')
+        try:
+            check.equal(sorted(storage.backup_to(backup_dir, pause=0)), sorted(files), "备份所有数据库文件")
+            check.equal(storage.check_integrity(backup_dir), {name: [] for name in files}, "备份文件完整")
+            storage.update_user_data('r00', total_days=100)
+            check.equal(storage.restore_from(backup_dir), [], "从备份恢复")
+            check.equal(storage.get_user_data('r00')['total_days'], 99, "恢复备份时的数据")
+        finally:
+            shutil.rmtree(backup_dir, ignore_errors=True)
+
+
+def snapshot(storage, user_ids: List[str], group_ids: List[str]) -> Dict[str, Any]:
+    """各实现之间应当一致的全部读取结果（城堡编号和写入时间戳除外）"""
+    state = {'users': {}, 'boards': {}, 'pages': {}, 'castles': {}}
+    for user_id in user_ids:
+        titles = storage.get_user_titles(user_id)
+        state['users'][user_id] = (
+            storage.get_user_data(user_id), storage.get_user_name(user_id), storage.get_user_inventory(user_id),
+            titles, storage.get_active_title(user_id), sorted(storage.get_sign_calendar(user_id).items()),
+            storage.get_monthly_history(user_id), storage.get_world_sign_rank(user_id),
+            storage.get_continuous_sign_rank(user_id), [storage.get_group_sign_rank(group_id, user_id) for group_id in group_ids],
+        )
+    for board in storage.RANKING_ORDERS:
+        state['boards'][board] = storage.get_leaderboard(board, 100)
+        for group_id in [None] + group_ids:
+            state['pages'][(board, group_id)] = storage.get_ranking_keys(board, None, 1000, group_id=group_id)
+    state['boards']['castle'] = sorted(row[1:] for row in storage.get_leaderboard('castle_level', 100))
+    state['boards']['castle_coins'] = sorted(row[1:] for row in storage.get_leaderboard('castle_coins', 100))
+    for group_id in group_ids:
+        castle = storage.get_castle_by_group(group_id)
+        if castle:
+            castle = {key: value for key, value in castle.items() if key not in ('castle_id', 'created_date')}
+        state['castles'][group_id] = castle
+    state['history'] = sorted(row[1:5] for row in storage.get_expired_history('9999-12-31', 100000))
+    state['counts'] = [storage.count_users(group_id) for group_id in [None] + group_ids]
+    return state
+
+
+def random_operation(rng: random.Random, clock, user_ids: List[str], group_ids: List[str]) -> tuple:
+    """生成一个写操作 (方法名, 参数, 关键字参数)，各实现执行同一个操作"""
+    user_id = rng.choice(user_ids)
+    group_id = rng.choice(group_ids)
+    kind = rng.randrange(12)
+    if kind < 4:
+        return 'update_user_data', (user_id,), {
+            'total_days': rng.randrange(6), 'continuous_days': rng.randrange(4), 'level': rng.randrange(1, 4),
+            'exp': rng.randrange(4), 'coins': rng.randrange(100), 'group_id': rng.choice(group_ids + [None]) or '',
+            'last_sign': (clock.today() - datetime.timedelta(days=rng.randrange(3))).strftime('%Y-%m-%d'),
+        }
+    if kind == 4:
+        return 'update_user_name', (user_id, rng.choice(['甲', '乙', '丙', ''])), {'group_id': group_id}
+    if kind == 5:
+        return 'update_inventory', (user_id, rng.choice(['补签卡', '护身符']), rng.randrange(-3, 4)), {}
+    if kind == 6:
+        titles = ['A', 'B', 'C']
+        return 'apply_title_changes', (user_id, rng.sample(titles, rng.randrange(3)), rng.sample(titles, rng.randrange(2))), {}
+    if kind == 7:
+        if rng.random() < 0.5:
+            return 'deactivate_all_titles', (user_id,), {}
+        return 'activate_title', (user_id, rng.choice(['A', 'B', 'C'])), {}
+    if kind == 8:
+        day = (clock.today() - datetime.timedelta(days=rng.randrange(60))).strftime('%Y-%m-%d')
+        return 'log_sign', (user_id, rng.randrange(50), rng.randrange(50), day), {}
+    if kind == 9:
+        return 'create_castle', (group_id, f"城堡{group_id}", user_id, rng.sample(user_ids, 3)), {}
+    if kind == 10:
+        action = rng.choice(['join_castle', 'leave_castle', 'elect_lord', 'elect_manager', 'dismiss_manager'])
+        return action, (group_id, user_id), {}
+    action = rng.choice(['donate_coins', 'add_castle_exp', 'upgrade_castle', 'destroy_castle', 'rollup'])
+    if action == 'donate_coins':
+        return action, (group_id, user_id, rng.randrange(1, 30)), {}
+    if action == 'add_castle_exp':
+        return action, (group_id, rng.randrange(1, 30)), {}
+    if action == 'upgrade_castle':
+        return action, (group_id, rng.randrange(20), rng.randrange(20)), {}
+    if action == 'destroy_castle' and rng.random() < 0.3:
+        return action, (group_id,), {}
+    return 'rollup', ((clock.today() - datetime.timedelta(days=30)).strftime('%Y-%m-%d'),), {}
+
+
+def apply_operation(storage, operation: tuple):
+    name, args, kwargs = operation
+    if name == 'create_castle' and storage.get_castle_id_by_group(args[0]) is not None:
+        # 重复创建已在契约检查中覆盖，这里跳过以免 SQLite 实现反复记录错误日志
+        return False
+    if name == 'rollup':
+        # 汇总整月之前的历史，各实现的结果与批次划分无关
+        storage.rollup_history(storage.get_expired_history(args[0][:8] + '01', 100000))
+        return None
+    return getattr(storage, name)(*args, **kwargs)
+
+
+def check_differential(package, storages: Dict[str, Any], clock, ops: int, seed: int, failures: List[str]):
+    """随机操作序列同时作用于所有实现，比较返回值和读取结果"""
+    rng = random.Random(seed)
+    user_ids = [f"d{index}" for index in range(25)]
+    group_ids = ['dg1', 'dg2', 'dg3']
+    names = list(storages)
+    for step in range(1, ops + 1):
+        if rng.random() < 0.02:
+            clock.advance(days=1)
+        operation = random_operation(rng, clock, user_ids, group_ids)
+        results = {name: apply_operation(storage, operation) for name, storage in storages.items()}
+        if len(set(map(repr, results.values()))) > 1:
+            failures.append(f"第 {step} 步 {operation[0]}{operation[1]} 返回值不一致: {results}")
+            return
+        if step % 50 == 0 or step == ops:
+            states = {name: snapshot(storage, user_ids, group_ids) for name, storage in storages.items()}
+            reference = states[names[0]]
+            for name in names[1:]:
+                for part, value in reference.items():
+                    if states[name][part] != value:
+                        failures.append(f"第 {step} 步后 {name} 与 {names[0]} 的 {part} 不一致")
+            if len(failures):
+                return
+
+
+def run(engines: List[str], ops: int = 2000, seed: int = 0) -> List[str]:
+    """执行检查，返回失败项"""
+    workdir = tempfile.mkdtemp(prefix='sign-conformance-')
+    failures: List[str] = []
+    storages = {}
+    try:
+        fake_astrbot.install()
+        package = fake_astrbot.load_package(workdir)
+        factories = _engines(package)
+        FrozenClock = package.clock.FrozenClock
+        for name in engines:
+            clock = FrozenClock(START)
+            storage = factories[name](os.path.join(workdir, f"contract-{name}"), clock)
+            try:
+                check = Checker(name)
+                check_contract(package, storage, clock, check)
+                failures.extend(check.failures)
+            except Exception as e:
+                failures.append(f"[{name}] 契约检查异常: {e!r}")
+            finally:
+                storage.close()
+        if len(engines) > 1:
+            clock = FrozenClock(START)
+            storages = {name: factories[name](os.path.join(workdir, f"diff-{name}"), clock) for name in engines}
+            check_differential(package, storages, clock, ops, seed, failures)
+    finally:
+        for storage in storages.values():
+            storage.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return failures
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="签到插件存储一致性检查")
+    parser.add_argument('--engines', default=','.join(ENGINES), help="要检查的实现，逗号分隔")
+    parser.add_argument('--ops', type=int, default=2000, help="对拍的随机操作数")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    engines = args.engines.split(',')
+    unknown = [name for name in engines if name not in ENGINES]
+    if unknown:
+        parser.error(f"未知的实现: {', '.join(unknown)}")
+
+    failures = run(engines, args.ops, args.seed)
+    for failure in failures:
+        print(failure)
+    print(f"{', '.join(engines)}: {'通过' if not failures else f'{len(failures)} 项失败'}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+from bisect import bisect_right
+from typing import Dict, Any, List, Tuple
+
+# 称号定义：达到指标阈值时授予，revocable 的称号在指标回落到阈值以下时收回
+TITLE_RULES = [
+    {"title": "签到新人", "metric": "total_days", "threshold": 1, "revocable": False, "description": "首次签到获得"},
+    {"title": "签到达人", "metric": "total_days", "threshold": 7, "revocable": False},
+    {"title": "月神之誓", "metric": "total_days", "threshold": 30, "revocable": False},
+    {"title": "七日先锋", "metric": "continuous_days", "threshold": 7, "revocable": True},
+    {"title": "永恒裁决者", "metric": "continuous_days", "threshold": 30, "revocable": True},
+]
+
+METRIC_NAMES = {
+    "total_days": "累计签到",
+    "continuous_days": "连续签到",
+}
+
+
+class TitleRuleEngine:
+    """称号规则引擎
+
+    规则在初始化时按指标编译成有序阈值表，每次签到只需二分查找：
+    - 授予：阈值落在 (签到前数值, 签到后数值] 区间内的称号
+    - 收回：阈值落在 (签到后数值, 签到前数值] 区间内的可收回称号，即本次刚跌破阈值的称号
+    指标没有变化或只增加时不会产生收回，调用方可以跳过写入。
+    """
+
+    def __init__(self, rules: List[Dict[str, Any]] = None):
+        self.rules = list(rules if rules is not None else TITLE_RULES)
+        # {指标: (阈值列表, 称号列表)}，按阈值升序
+        self._grant_table = {}
+        self._revoke_table = {}
+        for metric in dict.fromkeys(rule['metric'] for rule in self.rules):
+            metric_rules = sorted((r for r in self.rules if r['metric'] == metric), key=lambda r: r['threshold'])
+            self._grant_table[metric] = (
+                [r['threshold'] for r in metric_rules],
+                [r['title'] for r in metric_rules]
+            )
+            revocable = [r for r in metric_rules if r.get('revocable')]
+            if revocable:
+                self._revoke_table[metric] = (
+                    [r['threshold'] for r in revocable],
+                    [r['title'] for r in revocable]
+                )
+
+    def evaluate(self, previous: Dict[str, int], current: Dict[str, int]) -> Tuple[List[str], List[str]]:
+        """计算一次签到后的称号变化
+        Args:
+            previous: 签到前保存的指标 {指标: 数值}，断签时为断签前的连续天数
+            current: 签到后的指标 {指标: 数值}
+        Returns:
+            (新获得的称号, 需要收回的称号)
+        """
+        grants = []
+        for metric, (thresholds, titles) in self._grant_table.items():
+            low = bisect_right(thresholds, previous.get(metric, 0))
+            high = bisect_right(thresholds, current.get(metric, 0))
+            grants.extend(titles[low:high])
+
+        revokes = []
+        for metric, (thresholds, titles) in self._revoke_table.items():
+            low = bisect_right(thresholds, current.get(metric, 0))
+            high = bisect_right(thresholds, previous.get(metric, 0))
+            revokes.extend(t for t in titles[low:high] if t not in grants)
+
+        return grants, revokes
+
+    def describe(self) -> List[str]:
+        """生成所有称号和获得途径的说明"""
+        lines = []
+        for rule in self.rules:
+            description = rule.get('description') or f"{METRIC_NAMES.get(rule['metric'], rule['metric'])}{rule['threshold']}天获得"
+            if rule.get('revocable'):
+                description += "（断签会收回）"
+            lines.append(f"【{rule['title']}】 - {description}")
+        return lines
+
+
+# 模块加载时编译一次
+TITLE_ENGINE = TitleRuleEngine(TITLE_RULES)